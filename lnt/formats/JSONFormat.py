@@ -1,5 +1,10 @@
 from lnt.util import json
 
+# How much of a report to read at a time when streaming it.
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
 def _matches_format(path_or_file):
     if isinstance(path_or_file, str):
         path_or_file = open(path_or_file)
@@ -13,10 +18,156 @@ def _matches_format(path_or_file):
 def _load_format(path_or_file):
     if isinstance(path_or_file, str):
         path_or_file = open(path_or_file)
-    
+
     return json.load(path_or_file)
-    
+
+class _Reader(object):
+    """Read the JSON values of a file one at a time, keeping no more of the
+    file in memory than the value being read."""
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        # The offset in the file of the start of the buffer.
+        try:
+            self.offset = file.tell()
+            self.seekable = True
+        except (AttributeError, IOError):
+            self.offset = 0
+            self.seekable = False
+        self.eof = False
+
+    def _fill(self):
+        # Read as much again as what is left of the buffer, so a large value
+        # is not scanned again for every chunk of it.
+        data = self.file.read(max(self.chunk_size,
+                                  len(self.buffer) - self.pos))
+        if not data:
+            self.eof = True
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+    def tell(self):
+        return self.offset + self.pos
+
+    def seek(self, offset):
+        self.file.seek(offset)
+        self.offset = offset
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def peek(self):
+        """Skip the whitespace, and return the next character (or '' at the
+        end of the file)."""
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self._fill()
+
+    def expect(self, chars):
+        """Read the next character, which must be one of chars."""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("expected %s at offset %d, found %r" % (
+                    ' or '.join(repr(c) for c in chars), self.tell(), c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Read the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # The value may just not be in the buffer yet.
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            # A number at the end of the buffer may go on in the file.
+            if end == len(self.buffer) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        """Read the next array, yielding its items as they are read."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+def _stream_format(path_or_file, chunk_size=CHUNK_SIZE):
+    """Read a report, yielding its machine, its run and then each of its tests
+    as ('Machine', machine), ('Run', run) and ('Test', test) items.
+
+    The tests are read one at a time. If the report has them before its
+    machine or run, they are skipped and read again afterwards, unless the file
+    cannot seek, in which case they are kept in memory in the meantime.
+    """
+    if isinstance(path_or_file, str):
+        path_or_file = open(path_or_file, 'rb')
+    reader = _Reader(path_or_file, chunk_size)
+
+    parts = {}
+    tests_offset = tests = None
+    streamed = False
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+    else:
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == 'Tests' and 'Machine' in parts and 'Run' in parts:
+                yield 'Machine', parts['Machine']
+                yield 'Run', parts['Run']
+                for test in reader.items():
+                    yield 'Test', test
+                streamed = True
+            elif key == 'Tests' and reader.seekable:
+                tests_offset = reader.tell()
+                for _ in reader.items():
+                    pass
+            elif key == 'Tests':
+                tests = list(reader.items())
+            else:
+                parts[key] = reader.value()
+            if reader.expect(',}') == '}':
+                break
+    if reader.peek():
+        raise ValueError("extra data at offset %d" % reader.tell())
+
+    for key in ('Machine', 'Run'):
+        if key not in parts:
+            raise ValueError("report has no %r" % key)
+    if streamed:
+        return
+    yield 'Machine', parts['Machine']
+    yield 'Run', parts['Run']
+    if tests_offset is not None:
+        reader.seek(tests_offset)
+        tests = reader.items()
+    for test in tests or ():
+        yield 'Test', test
+
 format = { 'name' : 'json',
            'predicate' : _matches_format,
            'read' : _load_format,
+           'stream' : _stream_format,
            'write' : json.dump }
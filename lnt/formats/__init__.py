@@ -7,6 +7,9 @@ taking a path_or_file object, the 'write' function should be a callable taking a
 Python object to write, and the path_or_file to write to.
 """
 
+import StringIO
+import tarfile
+
 from PlistFormat import format as plist
 from JSONFormat import format as json
 
@@ -79,4 +82,117 @@ def read_any(path_or_file, format_name):
 
     return f['read'](path_or_file)
 
-__all__ = ['get_format', 'guess_format', 'read_any'] + format_names
+class ReadError(ValueError):
+    """An error reading a report, found while streaming it."""
+
+def _guess_stream_format(path_or_file):
+    # Reports starting like a JSON object are streamed as JSON, without
+    # reading them whole first to check they are.
+    head = path_or_file.read(64)
+    path_or_file.seek(0)
+    if head.lstrip().startswith('{'):
+        return formats_by_name['json']
+    return guess_format(path_or_file)
+
+def read_stream(path_or_file, format_name):
+    """read_stream(path_or_file, format_name) -> iterator of (kind, data)
+
+    Read a report as its machine, its run and then each of its tests, yielded
+    as ('Machine', machine), ('Run', run) and ('Test', test) items, as they are
+    read. Formats which cannot be streamed are read whole first. The
+    format_name can be an actual format name, or "<auto>".
+
+    Errors reading the report once the iteration started are raised as
+    ReadError.
+    """
+    if isinstance(path_or_file, str):
+        path_or_file = open(path_or_file, 'rb')
+
+    # Figure out the input format.
+    if format_name == '<auto>':
+        f = _guess_stream_format(path_or_file)
+        if f is None:
+            raise SystemExit("unable to guess input format for file")
+    else:
+        f = get_format(format_name)
+        if f is None or not f.get('read'):
+            raise SystemExit("unknown input format: %r" % format_name)
+
+    if f.get('stream'):
+        items = f['stream'](path_or_file)
+    else:
+        data = f['read'](path_or_file)
+        items = [('Machine', data['Machine']), ('Run', data['Run'])] + \
+            [('Test', test) for test in data.get('Tests', [])]
+
+    try:
+        for item in items:
+            yield item
+    except ReadError:
+        raise
+    except Exception as e:
+        raise ReadError(str(e))
+
+def read_report(path_or_file, format_name):
+    """read_report(path_or_file, format_name) -> report
+
+    Read a report as read_any does, except that its 'Tests' are an iterator
+    which reads them one at a time (see read_stream), so the report is never
+    whole in memory. The tests can only be iterated once.
+    """
+    items = read_stream(path_or_file, format_name)
+    data = {}
+    for kind, value in items:
+        data[kind] = value
+        if kind == 'Run':
+            break
+    data['Tests'] = (test for kind, test in items)
+    return data
+
+def read_batch(path_or_file):
+    """read_batch(path_or_file) -> iterator of (name, data, error)
+
+    Read the reports of a batch: either a (possibly compressed) tar archive of
+    report files in any of the formats, or a file with a JSON report on each
+    line (NDJSON). The reports are read one at a time, as the iteration gets to
+    them, and named after their file in the archive, or their line. A report
+    which cannot be read is yielded with no data and the reason as its error,
+    so the others can still be imported.
+    """
+    if isinstance(path_or_file, str):
+        path_or_file = open(path_or_file, 'rb')
+
+    try:
+        archive = tarfile.open(fileobj=path_or_file, mode='r:*')
+    except tarfile.TarError:
+        archive = None
+        path_or_file.seek(0)
+
+    if archive is not None:
+        for member in archive:
+            if not member.isfile():
+                continue
+            try:
+                data = read_any(StringIO.StringIO(
+                    archive.extractfile(member).read()), '<auto>')
+            except (Exception, SystemExit) as e:
+                yield member.name, None, str(e)
+            else:
+                yield member.name, data, None
+        return
+
+    json_read = formats_by_name['json']['read']
+    for i, line in enumerate(path_or_file):
+        if not line.strip():
+            continue
+        name = 'line %d' % (i + 1)
+        try:
+            data = json_read(StringIO.StringIO(line))
+        except ValueError as e:
+            yield name, None, str(e)
+        else:
+            yield name, data, None
+
+__all__ = ['get_format', 'guess_format', 'read_any', 'read_batch',
+           'read_stream', 'read_report', 'ReadError'] + \
+    format_names
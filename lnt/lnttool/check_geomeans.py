@@ -0,0 +1,54 @@
+import contextlib
+from optparse import OptionParser
+
+import lnt.server.instance
+from lnt.testing.util.commands import note, fatal
+
+
+def action_check_geomeans(name, args):
+    """check the geometric means of the trends against the samples"""
+    parser = OptionParser("%s [options] <instance>" % name)
+    parser.add_option("", "--database", dest="database", default="default",
+                      help="database to use [%default]")
+    parser.add_option("", "--testsuite", dest="testsuites", action="append",
+                      default=[],
+                      help="test suite to check (default: all of them)")
+    parser.add_option("", "--fix", dest="fix", action="store_true",
+                      default=False,
+                      help="rebuild the geometric means of the test suites "
+                           "which are inconsistent")
+    (opts, args) = parser.parse_args(args)
+
+    if len(args) != 1:
+        parser.error("invalid number of arguments")
+    path, = args
+
+    instance = lnt.server.instance.Instance.frompath(path)
+    db = instance.get_database(opts.database)
+    if db is None:
+        fatal("unknown database %r" % opts.database)
+
+    num_mismatches = 0
+    with contextlib.closing(db):
+        for suite in opts.testsuites or sorted(db.testsuite.keys()):
+            ts = db.testsuite.get(suite)
+            if ts is None:
+                fatal("unknown test suite %r" % suite)
+            mismatches = ts.check_order_geomeans()
+            for stored, expected in mismatches:
+                record = stored if stored is not None else expected
+                print "%s: machine %d, order %d, field %d: %s != %s" % (
+                    suite, record.machine_id, record.order_id,
+                    record.field_id,
+                    stored.geomean if stored is not None else "missing",
+                    expected.geomean if expected is not None else "missing")
+            num_mismatches += len(mismatches)
+
+            if mismatches and opts.fix:
+                ts.rebuild_sample_rollups()
+                ts.rebuild_order_geomeans()
+                ts.commit()
+                note("%s: rebuilt the geometric means" % suite)
+
+    if num_mismatches and not opts.fix:
+        fatal("%d geometric mean(s) are inconsistent" % num_mismatches)
@@ -39,7 +39,9 @@ profile_dir = %(profile_dir)r
 secret_key = %(secret_key)r
 
 # The list of available databases, and their properties. At a minimum, there
-# should be a 'default' entry for the default database.
+# should be a 'default' entry for the default database. Setting 'bulk_import'
+# to True on a database writes submitted samples with bulk inserts instead of
+# going through the ORM, which is much faster for large submissions.
 databases = {
     'default' : { 'path' : %(default_db)r,
                   'db_version' : %(default_db_version)r },
@@ -62,6 +64,25 @@ nt_emailer = {
     'to' : [(".*", None)],
     }
 
+# The number of background worker processes used for post-submission work
+# (such as computing field changes), and the number of jobs which may be queued
+# or running at once. Submissions wait for a free slot once the queue is full.
+async_workers = 8
+async_queue_limit = 64
+
+# The size (in megabytes) of each of the caches of the pages and reports about
+# runs, which are shared by the web app processes and kept in the temporary
+# directory. Setting it to 0 disables the caches.
+response_cache_size = 64
+
+# The largest size (in megabytes) a compressed submission may decompress to.
+# Larger ones are rejected.
+max_submission_size = 1024
+
+# The code review server the Gerrit changes of the commits of the runs are
+# looked up on, in the background after the runs are imported.
+# gerrit_url = 'http://review.couchbase.org'
+
 # Enable automatic restart using the wsgi_restart module; this should be off in
 # a production environment.
 wsgi_restart = False
@@ -35,6 +35,12 @@ def action_import(name, args):
                       action="store_true", default=False)
     parser.add_option("", "--no-report", dest="no_report",
                       action="store_true", default=False)
+    parser.add_option("", "--batch", dest="batch",
+                      help="import each file as a batch of reports",
+                      action="store_true", default=False)
+    parser.add_option("", "--batch-size", dest="batch_size", type=int,
+                      help="reports committed at a time in a batch [%default]",
+                      default=lnt.util.ImportData.BATCH_SIZE)
     (opts, args) = parser.parse_args(args)
 
     if len(args) < 2:
@@ -52,10 +58,15 @@ def action_import(name, args):
         # Load the database.
         success = True
         for file in args:
-            result = lnt.util.ImportData.import_and_report(
-                config, opts.database, db, file,
-                opts.format, opts.commit, opts.show_sample_count,
-                opts.no_email, opts.no_report)
+            if opts.batch:
+                result = lnt.util.ImportData.import_batch(
+                    config, opts.database, db, file, opts.commit,
+                    opts.batch_size)
+            else:
+                result = lnt.util.ImportData.import_and_report(
+                    config, opts.database, db, file,
+                    opts.format, opts.commit, opts.show_sample_count,
+                    opts.no_email, opts.no_report)
 
             success &= result.get('success', False)
             if opts.quiet:
@@ -63,6 +74,9 @@ def action_import(name, args):
 
             if opts.show_raw_result:
                 pprint.pprint(result)
+            elif opts.batch:
+                lnt.util.ImportData.print_batch_result(result, sys.stdout,
+                                                       sys.stderr)
             else:
                 lnt.util.ImportData.print_report_result(result, sys.stdout,
                                                         sys.stderr,
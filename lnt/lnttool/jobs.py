@@ -0,0 +1,145 @@
+import contextlib
+import sys
+import time
+from optparse import OptionParser
+
+import lnt.server.instance
+import lnt.server.db.jobs
+import lnt.server.db.submissions
+from lnt.testing.util.commands import note, fatal
+
+
+def _open_database(parser, opts, args):
+    if len(args) != 1:
+        parser.error("invalid number of arguments")
+    path, = args
+    instance = lnt.server.instance.Instance.frompath(path)
+    db = instance.get_database(opts.database)
+    if db is None:
+        fatal("unknown database %r" % opts.database)
+    return db
+
+
+def _print_jobs(jobs):
+    print "%6s %-12s %-12s %-10s %-8s %-8s %-19s %s" % (
+        "ID", "Kind", "Suite", "Key", "State", "Attempts", "Lease Expires",
+        "Owner / Last Error")
+    for job in jobs:
+        last_error = (job.last_error or '').strip().split('\n')[-1]
+        print "%6d %-12s %-12s %-10s %-8s %8s %-19s %s" % (
+            job.id, job.kind, job.test_suite or '-', job.key, job.state,
+            "%d/%d" % (job.attempts, job.max_attempts),
+            job.lease_expires.strftime("%Y-%m-%d %H:%M:%S")
+            if job.lease_expires else '',
+            job.owner or last_error)
+
+
+def action_jobs(name, args):
+    """show and manage the background job queue"""
+    if len(args) < 1 or args[0] not in ('list', 'requeue', 'work', 'prune'):
+        print >>sys.stderr, """lnt jobs - available actions:
+  list           - Show the jobs in the queue
+  requeue        - Queue stuck (or the given) jobs to run again
+  work           - Run queued jobs, until interrupted
+  prune          - Remove the jobs and submissions which finished long ago
+"""
+        return
+    action = args[0]
+
+    parser = OptionParser("%s %s [options] <instance>%s" % (
+        name, action, " [<job id>+]" if action == 'requeue' else ""))
+    parser.add_option("", "--database", dest="database", default="default",
+                      help="database to use [%default]")
+
+    if action == 'list':
+        parser.add_option("", "--state", dest="states", action="append",
+                          default=[], choices=lnt.server.db.jobs.STATES,
+                          help="only show the jobs in this state")
+        parser.add_option("", "--stuck", dest="stuck", action="store_true",
+                          default=False,
+                          help="only show failed jobs and running jobs whose "
+                          "lease expired")
+        parser.add_option("", "--limit", dest="limit", type=int, default=50,
+                          help="show at most this many jobs [%default]")
+        opts, args = parser.parse_args(args[1:])
+
+        Job = lnt.server.db.jobs.Job
+        with contextlib.closing(_open_database(parser, opts, args)) as db:
+            counts = lnt.server.db.jobs.get_state_counts(db)
+            print ", ".join("%d %s" % (counts[state], state)
+                            for state in lnt.server.db.jobs.STATES)
+            query = db.query(Job)
+            if opts.states:
+                query = query.filter(Job.state.in_(opts.states))
+            if opts.stuck:
+                query = query.filter(Job.state.in_(
+                    [lnt.server.db.jobs.RUNNING, lnt.server.db.jobs.FAILED]))
+            jobs = [job for job in query.order_by(Job.id.desc())
+                    if not opts.stuck or job.is_stuck][:opts.limit]
+            _print_jobs(reversed(jobs))
+        return
+
+    if action == 'requeue':
+        parser.add_option("", "--stuck", dest="stuck", action="store_true",
+                          default=False,
+                          help="requeue the failed jobs and the running jobs "
+                          "whose lease expired")
+        parser.add_option("", "--keep-attempts", dest="reset_attempts",
+                          action="store_false", default=True,
+                          help="don't reset the number of attempts")
+        opts, args = parser.parse_args(args[1:])
+        if len(args) < 1:
+            parser.error("invalid number of arguments")
+        job_ids = map(int, args[1:])
+        if not job_ids and not opts.stuck:
+            parser.error("either job ids or --stuck are required")
+
+        with contextlib.closing(_open_database(parser, opts, args[:1])) as db:
+            jobs = lnt.server.db.jobs.requeue(
+                db, job_ids, stuck=opts.stuck,
+                reset_attempts=opts.reset_attempts)
+            note("requeued %d job(s)" % len(jobs))
+            _print_jobs(jobs)
+        return
+
+    if action == 'prune':
+        parser.add_option("", "--days", dest="days", type=int,
+                          default=lnt.server.db.jobs.RETENTION_DAYS,
+                          help="keep what finished in the last DAYS days "
+                          "[%default]")
+        opts, args = parser.parse_args(args[1:])
+
+        with contextlib.closing(_open_database(parser, opts, args)) as db:
+            jobs = lnt.server.db.jobs.prune(db, opts.days)
+            submissions = lnt.server.db.submissions.prune(db, opts.days)
+            note("removed %d job(s) and %d submission(s)" % (jobs,
+                                                             submissions))
+        return
+
+    if action == 'work':
+        parser.add_option("", "--poll-interval", dest="poll_interval",
+                          type=float, default=10.0,
+                          help="seconds to wait when the queue is empty "
+                          "[%default]")
+        parser.add_option("", "--once", dest="once", action="store_true",
+                          default=False,
+                          help="exit once the queue is empty")
+        opts, args = parser.parse_args(args[1:])
+
+        with contextlib.closing(_open_database(parser, opts, args)) as db:
+            owner = lnt.server.db.jobs.get_owner_name()
+            note("running queued jobs as %s" % owner)
+            last_prune = 0
+            while True:
+                count = lnt.server.db.jobs.run_queued_jobs(db, owner)
+                if count:
+                    note("ran %d job(s)" % count)
+                if time.time() - last_prune >= \
+                        lnt.server.db.jobs.PRUNE_INTERVAL:
+                    last_prune = time.time()
+                    lnt.server.db.jobs.prune(db)
+                    lnt.server.db.submissions.prune(db)
+                if opts.once:
+                    break
+                time.sleep(opts.poll_interval)
+        return
@@ -103,9 +103,13 @@ view the results.\
             threaded = opts.threaded,
             processes = opts.processes)
 
+from check_geomeans import action_check_geomeans
 from create import action_create
 from convert import action_convert
 from import_data import action_import
+from jobs import action_jobs
+from rebuild_rollups import action_rebuild_rollups
+from rebuild_stability import action_rebuild_stability
 from updatedb import action_updatedb
 from viewcomparison import action_view_comparison
 
@@ -208,6 +212,22 @@ def action_submit(name, args):
                       help=("whether the result should be committed "
                             "[%default]"),
                       default=True)
+    parser.add_option("", "--async", dest="async_import", type=int,
+                      help=("whether the server should import the result in "
+                            "the background, while we wait for it [%default]"),
+                      default=True)
+    parser.add_option("", "--compress", dest="compress", type=int,
+                      help=("whether to compress the submissions, which "
+                            "servers taking compressed submissions accept "
+                            "[%default]"),
+                      default=True)
+    parser.add_option("", "--batch", dest="batch",
+                      help="submit all the reports as one batch",
+                      action="store_true", default=False)
+    parser.add_option("", "--batch-size", dest="batch_size", type=int,
+                      help=("reports committed at a time in a batch "
+                            "[%default]"),
+                      default=lnt.util.ImportData.BATCH_SIZE)
     parser.add_option("-v", "--verbose", dest="verbose",
                       help="show verbose test results",
                       action="store_true", default=False)
@@ -221,8 +241,20 @@ def action_submit(name, args):
                 " at the server.")
 
     from lnt.util import ServerUtil
+    if opts.batch:
+        result = ServerUtil.submitBatch(args[0], args[1:], opts.commit,
+                                        opts.verbose, opts.async_import,
+                                        opts.batch_size, opts.compress)
+        if result is None:
+            raise SystemExit(1)
+        if opts.verbose:
+            lnt.util.ImportData.print_batch_result(result, sys.stdout,
+                                                   sys.stderr)
+        return
+
     files = ServerUtil.submitFiles(args[0], args[1:],
-                                   opts.commit, opts.verbose)
+                                   opts.commit, opts.verbose,
+                                   opts.async_import, opts.compress)
     if opts.verbose:
         for f in files:
             lnt.util.ImportData.print_report_result(f, sys.stdout,
@@ -0,0 +1,36 @@
+import contextlib
+from optparse import OptionParser
+
+import lnt.server.instance
+from lnt.testing.util.commands import note, fatal
+
+
+def action_rebuild_rollups(name, args):
+    """recompute the summaries of the samples at each order"""
+    parser = OptionParser("%s [options] <instance>" % name)
+    parser.add_option("", "--database", dest="database", default="default",
+                      help="database to use [%default]")
+    parser.add_option("", "--testsuite", dest="testsuites", action="append",
+                      default=[],
+                      help="test suite to rebuild (default: all of them)")
+    (opts, args) = parser.parse_args(args)
+
+    if len(args) != 1:
+        parser.error("invalid number of arguments")
+    path, = args
+
+    instance = lnt.server.instance.Instance.frompath(path)
+    db = instance.get_database(opts.database)
+    if db is None:
+        fatal("unknown database %r" % opts.database)
+
+    with contextlib.closing(db):
+        for suite in opts.testsuites or sorted(db.testsuite.keys()):
+            ts = db.testsuite.get(suite)
+            if ts is None:
+                fatal("unknown test suite %r" % suite)
+            count = ts.rebuild_sample_rollups()
+            geomean_count = ts.rebuild_order_geomeans()
+            ts.commit()
+            note("%s: rebuilt %d summaries of samples and %d geometric means"
+                 % (suite, count, geomean_count))
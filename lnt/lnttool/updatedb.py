@@ -57,6 +57,15 @@ def action_updatedb(name, args):
                     join(ts.Machine).\
                     filter(ts.Machine.name.in_(opts.delete_machines)))
 
+        # Remember the machines and orders of those runs, to update the
+        # stability of their tests and the summaries of their samples.
+        machine_orders = {}
+        for machine_id, order_id in ts.query(ts.Run.machine_id,
+                                             ts.Run.order_id).\
+                filter(ts.Run.id.in_(runs_to_delete)).distinct():
+            machine_orders.setdefault(machine_id, []).append(order_id)
+        machine_ids = set(machine_orders)
+
         # Delete all samples associated with those runs.
         ts.query(ts.Sample).\
             filter(ts.Sample.run_id.in_(runs_to_delete)).\
@@ -77,6 +86,10 @@ def action_updatedb(name, args):
             filter(ts.Run.id.in_(runs_to_delete)).\
             delete(synchronize_session=False)
 
+        # Update the summaries of the samples left at their orders.
+        for machine_id, order_ids in machine_orders.items():
+            ts.update_sample_rollups(machine_id, order_ids)
+
         # Delete the machines.
         for name in opts.delete_machines:
             # Delete all FieldChanges associated with this machine.
@@ -86,12 +99,36 @@ def action_updatedb(name, args):
                 ts.query(ts.FieldChange).filter(ts.FieldChange.id == i[0]).\
                     delete()
 
+            ts.query(ts.TestStability).\
+                filter(ts.TestStability.machine_id.in_(
+                    ts.query(ts.Machine.id).filter_by(name=name))).\
+                delete(synchronize_session=False)
+            ts.query(ts.DataGeneration).\
+                filter(ts.DataGeneration.machine_id.in_(
+                    ts.query(ts.Machine.id).filter_by(name=name))).\
+                delete(synchronize_session=False)
+
             num_deletes = ts.query(ts.Machine).filter_by(name=name).delete()
             if num_deletes == 0:
                 warning("unable to find machine named: %r" % name)
         if order:
             ts.delete(order)
 
+        # Forget the orders machines no longer have any runs at.
+        ts.delete_unused_machine_orders()
+
+        # Update the stability of the tests of the remaining machines.
+        ts.session.flush()
+        remaining_machine_ids = []
+        if machine_ids:
+            for machine_id, in ts.query(ts.Machine.id).\
+                    filter(ts.Machine.id.in_(machine_ids)).all():
+                ts.update_test_stability(machine_id)
+                remaining_machine_ids.append(machine_id)
+
+        # The pages about their runs are out of date.
+        ts.bump_data_generation(remaining_machine_ids)
+
         if opts.commit:
             db.commit()
         else:
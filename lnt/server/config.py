@@ -60,11 +60,16 @@ class DBInfo:
         baseline_revision = dict.get('baseline_revision',
                                      default_baseline_revision)
 
+        # Whether to import samples with bulk inserts rather than through the
+        # ORM.
+        bulk_import = bool(dict.get('bulk_import', False))
+
         return DBInfo(dbPath,
                       str(dict.get('db_version', '0.4')),
                       dict.get('shadow_import', None),
                       email_config,
-                      baseline_revision)
+                      baseline_revision,
+                      bulk_import)
     
     @staticmethod
     def dummyInstance():
@@ -73,13 +78,14 @@ class DBInfo:
     
     def __init__(self, path,
                  db_version, shadow_import, email_config,
-                 baseline_revision):
+                 baseline_revision, bulk_import=False):
         self.config = None
         self.path = path
         self.db_version = db_version
         self.shadow_import = shadow_import
         self.email_config = email_config
         self.baseline_revision = baseline_revision
+        self.bulk_import = bulk_import
         
     def __str__(self):
         return "DBInfo(" + self.path + ")"
@@ -115,7 +121,12 @@ class Config:
                       dict([(k,DBInfo.fromData(dbDirPath, v,
                                                default_email_config,
                                                0))
-                                     for k,v in data['databases'].items()]))
+                                     for k,v in data['databases'].items()]),
+                      data.get('async_workers'),
+                      data.get('async_queue_limit'),
+                      data.get('response_cache_size'),
+                      data.get('gerrit_url'),
+                      data.get('max_submission_size'))
     
     @staticmethod
     def dummyInstance():
@@ -129,7 +140,10 @@ class Config:
         
         return Config('LNT', 'http://localhost:8000', dbDir, tempDir, profileDirPath, secretKey, dbInfo)
     
-    def __init__(self, name, zorgURL, dbDir, tempDir, profileDir, secretKey, databases):
+    def __init__(self, name, zorgURL, dbDir, tempDir, profileDir, secretKey,
+                 databases, async_workers=None, async_queue_limit=None,
+                 response_cache_size=None, gerrit_url=None,
+                 max_submission_size=None):
         self.name = name
         self.zorgURL = zorgURL
         self.dbDir = dbDir
@@ -139,6 +153,20 @@ class Config:
         while self.zorgURL.endswith('/'):
             self.zorgURL = zorgURL[:-1]
         self.databases = databases
+        # The size of the background worker pool, and the number of jobs which
+        # may be queued or running (None selects the defaults).
+        self.async_workers = async_workers
+        self.async_queue_limit = async_queue_limit
+        # The size (in megabytes) of each of the caches of the pages and
+        # reports about runs, which are kept in the temporary directory (None
+        # selects the default, 0 disables them).
+        self.response_cache_size = response_cache_size
+        # The code review server the Gerrit changes of the commits are looked
+        # up on (None selects the default, see lnt.server.db.gerrit).
+        self.gerrit_url = gerrit_url
+        # The largest size (in megabytes) a compressed submission may
+        # decompress to (None selects the default).
+        self.max_submission_size = max_submission_size
         for db in self.databases.values():
             db.config = self
 
@@ -1,10 +1,12 @@
+import bisect
 import re
+import time
+import sqlalchemy.orm
 import sqlalchemy.sql
 import lnt.server.reporting.analysis
 from lnt.testing.util.commands import warning
 from lnt.testing.util.commands import note, timed
 from lnt.server.db.regression import new_regression, RegressionState
-from lnt.server.db.regression import get_ris
 from lnt.server.db.regression import rebuild_title
 
 from lnt.server.db import rules_manager as rules
@@ -13,46 +15,85 @@ from lnt.server.db import rules_manager as rules
 # more accurate results.
 FIELD_CHANGE_LOOKBACK = 1
 
+# How many ids to look up at a time with an IN clause.
+IN_BATCH_SIZE = 500
+
 
 def post_submit_tasks(ts, run_id):
     regenerate_fieldchanges_for_run(ts, run_id)
 
 
+def post_submit_runs(ts, run_ids):
+    """Run the post submission tasks of the runs of a machine imported in a
+    batch, in the order they were imported."""
+    for run_id in sorted(run_ids):
+        post_submit_tasks(ts, run_id)
+
+
 def delete_fieldchange(ts, change):
     """Delete this field change.  Since it might be attahed to a regression
     via regression indicators, fix those up too.  If this orphans a regression
     delete it as well."""
-    # Find the indicators.
-    indicators = ts.query(ts.RegressionIndicator). \
-        filter(ts.RegressionIndicator.field_change_id == change.id). \
-        all()
-    # And all the related regressions.
-    regression_ids = [r.regression_id for r in indicators]
-
-    # Remove the idicators that point to this change.
-    for ind in indicators:
-        ts.delete(ind)
-    
-    # Now we can remove the change, itself.
-    ts.delete(change)
-    
-    # We might have just created a regression with no changes.
-    # If so, delete it as well.
-    for r in regression_ids:
-        remaining = ts.query(ts.RegressionIndicator). \
-            filter(ts.RegressionIndicator.regression_id == r). \
+    delete_fieldchanges(ts, [change])
+    ts.commit()
+
+
+def delete_fieldchanges(ts, changes):
+    """Delete these field changes, along with their regression indicators and
+    the regressions they orphan, without committing."""
+    change_ids = [change.id for change in changes]
+    regression_ids = set()
+    for i in range(0, len(change_ids), IN_BATCH_SIZE):
+        # Remove the indicators that point to these changes.
+        indicators = ts.query(ts.RegressionIndicator). \
+            filter(ts.RegressionIndicator.field_change_id.in_(
+                change_ids[i:i + IN_BATCH_SIZE])). \
             all()
-        if len(remaining) == 0:
-            r = ts.query(ts.Regression).get(r)
+        for ind in indicators:
+            regression_ids.add(ind.regression_id)
+            ts.delete(ind)
+
+    # Now we can remove the changes, themselves.
+    tests_by_machine = {}
+    for change in changes:
+        tests_by_machine.setdefault(change.machine_id, set()).add(
+            change.test_id)
+        ts.delete(change)
+    ts.session.flush()
+
+    # The tests may have become stable.
+    for machine_id, test_ids in tests_by_machine.items():
+        ts.update_test_stability(machine_id, test_ids)
+    if tests_by_machine:
+        ts.bump_data_generation(tests_by_machine.keys())
+
+    # We might have just created regressions with no changes.
+    # If so, delete them as well.
+    regression_ids = list(regression_ids)
+    for i in range(0, len(regression_ids), IN_BATCH_SIZE):
+        batch = regression_ids[i:i + IN_BATCH_SIZE]
+        remaining = set(r for r, in ts.query(
+            ts.RegressionIndicator.regression_id).filter(
+                ts.RegressionIndicator.regression_id.in_(batch)).distinct())
+        orphans = set(batch) - remaining
+        if not orphans:
+            continue
+        for r in ts.query(ts.Regression).filter(
+                ts.Regression.id.in_(orphans)):
             note("Deleting regression because it has not changes:" + repr(r))
             ts.delete(r)
-    ts.commit()
 
 
 @timed
 def regenerate_fieldchanges_for_run(ts, run_id):
     """Regenerate the set of FieldChange objects for the given run.
+
+    This works in phases: load the runs and all the existing field changes of
+    the machine over the order window at once, compare every test and field,
+    then apply the deletions, insertions and updates and commit once.
     """
+    phase_start = time.time()
+
     # Allow for potentially a few different runs, previous_runs, next_runs
     # all with the same order_id which we will aggregate together to make
     # our comparison result.
@@ -61,7 +102,6 @@ def regenerate_fieldchanges_for_run(ts, run_id):
         filter(ts.Run.order_id == run.order_id). \
         filter(ts.Run.machine_id == run.machine_id). \
         all()
-    regressions = ts.query(ts.Regression).all()[::-1]
     previous_runs = ts.get_previous_runs_on_machine(run, FIELD_CHANGE_LOOKBACK)
     next_runs = ts.get_next_runs_on_machine(run, FIELD_CHANGE_LOOKBACK)
 
@@ -87,52 +127,101 @@ def regenerate_fieldchanges_for_run(ts, run_id):
                 "That will be very slow.".format(run_size))
     runinfo = lnt.server.reporting.analysis.RunInfo(ts, runs_to_load)
 
+    # Load all the field changes of this machine over the window, by test and
+    # field.
+    existing = {}
+    for f in ts.query(ts.FieldChange). \
+            filter(ts.FieldChange.start_order_id == start_order.id). \
+            filter(ts.FieldChange.end_order_id == end_order.id). \
+            filter(ts.FieldChange.machine_id == run.machine_id):
+        existing.setdefault((f.test_id, f.field_id), f)
+    load_time = time.time() - phase_start
+    phase_start = time.time()
+
     # Only store fieldchanges for "metric" samples like execution time;
     # not for fields with other data, e.g. hash of a binary
+    to_delete = []
+    to_create = []
+    to_update = []
     for field in list(ts.Sample.get_metric_fields()):
+        results = runinfo.get_comparison_results(
+            runs, previous_runs, field, ts.Sample.get_hash_of_binary_field(),
+            test_ids=runinfo.test_ids)
         for test_id in runinfo.test_ids:
-            f = None
-            result = runinfo.get_comparison_result(
-                runs, previous_runs, test_id, field,
-                ts.Sample.get_hash_of_binary_field())
-            # Try and find a matching FC and update, else create one.
-            try:
-                f = ts.query(ts.FieldChange) \
-                    .filter(ts.FieldChange.start_order == start_order) \
-                    .filter(ts.FieldChange.end_order == end_order) \
-                    .filter(ts.FieldChange.test_id == test_id) \
-                    .filter(ts.FieldChange.machine == run.machine) \
-                    .filter(ts.FieldChange.field == field) \
-                    .one()
-            except sqlalchemy.orm.exc.NoResultFound:
-                f = None
-
-            if not result.is_result_performance_change() and f:
-                # With more data, its not a regression. Kill it!
-                note("Removing field change: {}".format(f.id))
-                delete_fieldchange(ts, f)
-                continue
+            result = results[test_id]
+            f = existing.get((test_id, field.id))
+            if not result.is_result_performance_change():
+                if f:
+                    # With more data, its not a regression. Kill it!
+                    to_delete.append(f)
+                else:
+                    continue
+            elif f:
+                to_update.append((f, result))
+            else:
+                to_create.append((test_id, field, result))
+    compare_time = time.time() - phase_start
+    phase_start = time.time()
+
+    if to_delete:
+        note("Removing field changes: {}".format(
+            ", ".join(str(f.id) for f in to_delete)))
+        delete_fieldchanges(ts, to_delete)
+
+    # Always update FCs with new values.
+    for f, result in to_update:
+        f.old_value = result.previous
+        f.new_value = result.current
+        f.run = run
+
+    if to_create:
+        test_ids = sorted(set(test_id for test_id, _, _ in to_create))
+        tests = {}
+        for i in range(0, len(test_ids), IN_BATCH_SIZE):
+            for test in ts.query(ts.Test).filter(
+                    ts.Test.id.in_(test_ids[i:i + IN_BATCH_SIZE])):
+                tests[test.id] = test
+
+        new_changes = []
+        for test_id, field, result in to_create:
+            f = ts.FieldChange(start_order=start_order,
+                               end_order=run.order,
+                               machine=run.machine,
+                               test=tests[test_id],
+                               field=field)
+            f.old_value = result.previous
+            f.new_value = result.current
+            f.run = run
+            ts.add(f)
+            new_changes.append(f)
+        ts.session.flush()
+        ts.update_test_stability(run.machine_id, test_ids)
+
+        # Index the open regressions once, newest first, and keep the index
+        # up to date with the new changes.
+        regressions = ts.query(ts.Regression). \
+            filter(ts.Regression.state.in_(RegressionState.open_states)). \
+            order_by(ts.Regression.id.desc()). \
+            all()
+        index = RegressionIndex(ts, regressions)
+        for f in new_changes:
+            found, _ = identify_related_changes(ts, regressions, f,
+                                                commit=False, index=index)
+            if found:
+                note("Found field change: {}".format(run.machine))
+
+    # The pages showing the field changes of the machine are out of date.
+    if to_create or to_update:
+        ts.bump_data_generation([run.machine_id])
+    apply_time = time.time() - phase_start
+    phase_start = time.time()
 
-            if result.is_result_performance_change() and not f:
-                test = ts.query(ts.Test).filter(ts.Test.id == test_id).one()
-                f = ts.FieldChange(start_order=start_order,
-                                   end_order=run.order,
-                                   machine=run.machine,
-                                   test=test,
-                                   field=field)
-                ts.add(f)
-                ts.commit()
-                found, new_reg = identify_related_changes(ts, regressions, f)
-                if found:
-                    regressions.append(new_reg)
-                    note("Found field change: {}".format(run.machine))
-
-            # Always update FCs with new values.
-            if f:
-                f.old_value = result.previous
-                f.new_value = result.current
-                f.run = run
     ts.commit()
+    commit_time = time.time() - phase_start
+    note("Field changes for run {}: {} created, {} updated, {} removed "
+         "(load {:.2f}s, compare {:.2f}s, apply {:.2f}s, commit {:.2f}s)"
+         .format(run_id, len(to_create), len(to_update), len(to_delete),
+                 load_time, compare_time, apply_time, commit_time))
     rules.post_submission_hooks(ts, run_id)
 
 
@@ -149,35 +238,146 @@ def is_overlaping(fc1, fc2):
     return (r1_min == r2_min and r1_max == r2_max) or \
            (r1_min < r2_max and r2_min < r1_max)
 
+class RegressionIndex(object):
+    """An index of the field changes of a list of regressions, by the order
+    ranges they span.
+
+    A change is related to a regression when it overlaps one of the changes of
+    the regression, and matches at least two of its machine, test and field.
+    So the changes are indexed under each pair of those. Under each pair they
+    are kept sorted by start rank, along with the length of the longest range,
+    so the changes which may overlap a range all start within a window found
+    by bisection.
+    """
+
+    def __init__(self, ts, regressions):
+        self.ts = ts
+        # The regressions in priority order: the earliest in the list which
+        # has a related change wins.
+        self.regressions = []
+        self.positions = {}
+        # Key -> [sorted entries, longest range].
+        self.groups = {}
+
+        for regression in regressions:
+            self._add_regression(regression)
+
+        # Load the changes of all the regressions at once.
+        StartOrder = sqlalchemy.orm.aliased(ts.Order)
+        EndOrder = sqlalchemy.orm.aliased(ts.Order)
+        regression_ids = [r.id for r in regressions if r.id is not None]
+        for i in range(0, len(regression_ids), IN_BATCH_SIZE):
+            rows = ts.query(ts.RegressionIndicator.regression_id,
+                            ts.FieldChange.machine_id,
+                            ts.FieldChange.test_id,
+                            ts.FieldChange.field_id,
+                            StartOrder.rank, EndOrder.rank). \
+                join(ts.FieldChange,
+                     ts.RegressionIndicator.field_change_id ==
+                     ts.FieldChange.id). \
+                join(StartOrder,
+                     ts.FieldChange.start_order_id == StartOrder.id). \
+                join(EndOrder, ts.FieldChange.end_order_id == EndOrder.id). \
+                filter(ts.RegressionIndicator.regression_id.in_(
+                    regression_ids[i:i + IN_BATCH_SIZE]))
+            for regression_id, machine_id, test_id, field_id, start, end \
+                    in rows:
+                self._add_entry(self.positions[regression_id], machine_id,
+                                test_id, field_id, start, end)
+
+    def _add_regression(self, regression):
+        position = self.positions.get(regression.id)
+        if position is None:
+            position = self.positions[regression.id] = len(self.regressions)
+            self.regressions.append(regression)
+        return position
+
+    @staticmethod
+    def _keys(machine_id, test_id, field_id):
+        return (('machine-test', machine_id, test_id),
+                ('machine-field', machine_id, field_id),
+                ('test-field', test_id, field_id))
+
+    @staticmethod
+    def _change_info(fc):
+        """Return the machine, test and field ids and the start and end ranks
+        of a (possibly not flushed) field change."""
+        return (fc.machine.id, fc.test.id, fc.field.id,
+                fc.start_order.rank, fc.end_order.rank)
+
+    def _add_entry(self, position, machine_id, test_id, field_id, start, end):
+        entry = (start, end, position, machine_id, test_id, field_id)
+        for key in self._keys(machine_id, test_id, field_id):
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = [[], 0]
+            bisect.insort(group[0], entry)
+            group[1] = max(group[1], end - start)
+
+    def add(self, regression, fc):
+        """Add a change of a regression to the index."""
+        machine_id, test_id, field_id, start, end = self._change_info(fc)
+        self._add_entry(self._add_regression(regression), machine_id, test_id,
+                        field_id, start, end)
+
+    def find(self, fc):
+        """Find the first regression related to a change.
+
+        Returns the regression and the list of what the change and the change
+        of the regression have in common, or (None, None)."""
+        machine_id, test_id, field_id, start, end = self._change_info(fc)
+        best = None
+        for key in self._keys(machine_id, test_id, field_id):
+            group = self.groups.get(key)
+            if group is None:
+                continue
+            entries, longest = group
+            # Changes starting before this window end before ours starts.
+            lo = bisect.bisect_left(entries, (start - longest,))
+            hi = bisect.bisect_right(entries, (end, float('inf')))
+            for entry in entries[lo:hi]:
+                if best is not None and entry[2] >= best[2]:
+                    continue
+                e_start, e_end = entry[:2]
+                if (e_start == start and e_end == end) or \
+                        (e_start < end and start < e_end):
+                    best = entry
+
+        if best is None:
+            return None, None
+        relation = ["Revision"]
+        for name, a, b in (("Machine", best[3], machine_id),
+                           ("Test", best[4], test_id),
+                           ("Field", best[5], field_id)):
+            if a == b:
+                relation.append(name)
+        return self.regressions[best[2]], relation
+
+
 @timed
-def identify_related_changes(ts, regressions, fc):
-    """Can we find a home for this change in some existing regression? """
-    for regression in regressions:
-        regression_indicators = get_ris(ts, regression)
-        for change in regression_indicators:
-            regression_change = change.field_change
-            if is_overlaping(regression_change, fc):
-                confidence = 0
-                relation = ["Revision"]
-                if regression_change.machine == fc.machine:
-                    confidence += 1
-                    relation.append("Machine")
-                if regression_change.test == fc.test:
-                    confidence += 1
-                    relation.append("Test")
-                if regression_change.field == fc.field:
-                    confidence += 1
-                    relation.append("Field")
-
-                if confidence >= 2:
-                    # Matching
-                    note("Found a match:" + str(regression)  + " On " +
-                         ', '.join(relation))
-                    ri = ts.RegressionIndicator(regression, fc)
-                    ts.add(ri)
-                    # Update the default title if needed.
-                    rebuild_title(ts, regression)
-                    return (True, regression)
+def identify_related_changes(ts, regressions, fc, commit=True, index=None):
+    """Can we find a home for this change in some existing regression?
+
+    The first of the regressions with a change which overlaps this one, and
+    matches two of its machine, test and field wins. Passes which look up
+    many changes should build a RegressionIndex of the regressions once, and
+    pass it as index."""
+    if index is None:
+        index = RegressionIndex(ts, regressions)
+
+    regression, relation = index.find(fc)
+    if regression is not None:
+        # Matching
+        note("Found a match:" + str(regression)  + " On " +
+             ', '.join(relation))
+        ri = ts.RegressionIndicator(regression, fc)
+        ts.add(ri)
+        # Update the default title if needed.
+        ts.session.flush()
+        rebuild_title(ts, regression)
+        index.add(regression, fc)
+        return (True, regression)
     note("Could not find a partner, creating new Regression for change")
-    new_reg = new_regression(ts, [fc.id])
+    new_reg = new_regression(ts, [fc.id], commit=commit)
+    index.add(new_reg, fc)
     return (False, new_reg)
@@ -0,0 +1,254 @@
+"""
+Cache of the Gerrit changes of the commits the runs are about.
+
+The change of each commit is looked up on the code review server once, and
+recorded (by the sha of the commit) in the GerritChange table:
+
+ * Imports only read the table. A commit which is not in it yet is added along
+   with a job which looks its change up in the background (see
+   lnt.server.db.jobs), and fills in the change ids of the Gerrit records of
+   its orders once found. So imports never wait for, or fail because of, the
+   code review server; a lookup which fails is retried by the job queue.
+
+ * The pages about commits read the changes from the table, and only look up
+   the ones which are not known yet.
+
+The code review server is the 'gerrit_url' of the configuration.
+"""
+
+import datetime
+import json
+import re
+import urllib
+import urllib2
+
+import sqlalchemy.exc
+from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy.schema import Index
+
+from lnt.server.db import jobs
+from lnt.server.db import testsuite
+
+# The code review server, if the configuration does not set one.
+DEFAULT_URL = 'http://review.couchbase.org'
+
+# How long (in seconds) to wait for the code review server to answer.
+TIMEOUT = 30
+
+# The lookup states. A commit is pending until its change is looked up, and
+# then either resolved, or unknown to the code review server.
+PENDING = 'pending'
+RESOLVED = 'resolved'
+NOT_FOUND = 'not_found'
+STATES = (PENDING, RESOLVED, NOT_FOUND)
+
+# The sha of a patch set in the web link of a revision.
+_web_link_sha_regex = re.compile('h=(?P<sha>[0-9A-z]+)')
+
+
+class GerritChange(testsuite.Base):
+    __tablename__ = 'GerritChange'
+
+    id = Column("ID", Integer, primary_key=True)
+    sha = Column("Sha", String(256))
+    state = Column("State", String(32))
+    change_id = Column("ChangeID", String(256))
+    # The details of the change shown on the pages about commits (see
+    # fetch_change), encoded as JSON.
+    data = Column("Data", Text)
+    created_time = Column("CreatedTime", DateTime)
+    resolved_time = Column("ResolvedTime", DateTime)
+
+    def __init__(self, sha):
+        self.sha = sha
+        self.state = PENDING
+        self.created_time = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return '%s%r' % (self.__class__.__name__,
+                         (self.sha, self.state, self.change_id))
+
+    @property
+    def change(self):
+        if self.data is None:
+            return None
+        return json.loads(self.data)
+
+Index("ix_GerritChange_Sha", GerritChange.sha, unique=True)
+
+
+def get_url(config):
+    """Return the URL of the code review server of the configuration."""
+    url = getattr(config, 'gerrit_url', None) or DEFAULT_URL
+    return url.rstrip('/')
+
+
+def fetch_change(config, sha):
+    """
+    fetch_change(config, sha) -> dict or None
+
+    Look up the change of a commit on the code review server, and return its
+    details, or None if the server knows no change for it. Errors reaching the
+    server are raised.
+    """
+    url = '%s/changes/?q=%s&o=ALL_REVISIONS&o=ALL_COMMITS&o=WEB_LINKS' % (
+        get_url(config), urllib.quote(sha))
+    response = urllib2.urlopen(url, timeout=TIMEOUT).read()
+
+    # Gerrit prefixes its JSON responses with garbage, so they cannot be
+    # included as scripts.
+    changes = json.loads(response[response.index('['):])
+    if not changes:
+        return None
+    change = changes[0]
+
+    # The shas of all the patch sets of the change.
+    patch_shas = []
+    for revision_sha, revision in change.get('revisions', {}).items():
+        web_links = revision.get('commit', {}).get('web_links')
+        match = web_links and _web_link_sha_regex.search(web_links[0]['url'])
+        patch_shas.append(match.group('sha') if match else revision_sha)
+
+    details = dict((key, change.get(key))
+                   for key in ('change_id', '_number', 'project', 'branch',
+                               'subject', 'status'))
+    details['patch_shas'] = sorted(patch_shas)
+    return details
+
+
+def _find_change(db, sha):
+    return db.query(GerritChange).filter(GerritChange.sha == sha).first()
+
+
+def _get_or_add_change(db, sha):
+    """Return the change of the commit, adding a pending one if there is none.
+
+    The change is added in a savepoint, so if a concurrent transaction added
+    the same commit (such as the import of a run of another machine), the
+    transaction of the caller goes on with that one instead of failing.
+    """
+    change = _find_change(db, sha)
+    if change is not None:
+        return change
+    if db.engine.dialect.name == 'sqlite':
+        # pysqlite cannot roll back to savepoints, but SQLite can ignore the
+        # insert of a commit which is there already.
+        table = GerritChange.__table__
+        db.session.execute(table.insert().prefix_with('OR IGNORE').values(
+            Sha=sha, State=PENDING, CreatedTime=datetime.datetime.utcnow()))
+        return _find_change(db, sha)
+    try:
+        with db.session.begin_nested():
+            change = GerritChange(sha)
+            db.add(change)
+    except sqlalchemy.exc.IntegrityError:
+        change = _find_change(db, sha)
+        if change is None:
+            raise
+    return change
+
+
+def get_change_id(db, sha):
+    """
+    get_change_id(db, sha) -> str or None
+
+    Return the change id of the commit, if it is known already. Otherwise,
+    return None and queue the lookup of the change (in the transaction of the
+    caller), which fills in the change ids of the orders of the commit.
+    """
+    change = _get_or_add_change(db, sha)
+    # Databases without a configuration (such as temporary ones) have no code
+    # review server to look the change up on. The lookup is queued again if
+    # the previous one ran out of attempts.
+    if change.state == PENDING and db.config is not None:
+        jobs.enqueue(db, 'resolve_gerrit_change', None, sha, {'sha': sha})
+    return change.change_id
+
+
+def _fill_orders(db, sha, change_id):
+    """Fill in the change id of the commit in the Gerrit records of its orders
+    in every test suite, adding the missing records."""
+    for ts in db.testsuite.values():
+        if 'git_sha' in [f.name for f in ts.order_fields]:
+            for order in ts.query(ts.Order).filter(ts.Order.git_sha == sha):
+                gerrits = ts.query(ts.Gerrit).filter(
+                    ts.Gerrit.order_id == order.id).all()
+                if not gerrits:
+                    gerrits = [ts.Gerrit(order)]
+                    ts.add(gerrits[0])
+                for gerrit in gerrits:
+                    if not gerrit.gerrit_change_id:
+                        gerrit.gerrit_change_id = change_id
+
+        cv_fields = [f.name for f in ts.cv_order_fields]
+        if 'git_sha' in cv_fields:
+            for order in ts.query(ts.CVOrder).filter(
+                    ts.CVOrder.git_sha == sha):
+                gerrits = ts.query(ts.CVGerrit).filter(
+                    ts.CVGerrit.order_id == order.id).all()
+                if not gerrits:
+                    gerrits = [ts.CVGerrit(order)]
+                    ts.add(gerrits[0])
+                    if 'parent_commit' in cv_fields and order.parent_commit:
+                        gerrits[0].gerrit_change_id_parent = get_change_id(
+                            db, order.parent_commit)
+                for gerrit in gerrits:
+                    if not gerrit.gerrit_change_id:
+                        gerrit.gerrit_change_id = change_id
+        if 'parent_commit' in cv_fields:
+            for gerrit in ts.query(ts.CVGerrit).join(ts.CVOrder).filter(
+                    ts.CVOrder.parent_commit == sha):
+                if not gerrit.gerrit_change_id_parent:
+                    gerrit.gerrit_change_id_parent = change_id
+
+
+def record_change(db, sha, details):
+    """Record the change of a commit (None if there is none), along with the
+    other patch sets of the change, and fill in the change ids of the Gerrit
+    records of their orders."""
+    now = datetime.datetime.utcnow()
+    shas = [sha]
+    if details is not None:
+        shas.extend(s for s in details['patch_shas'] if s != sha)
+    for s in shas:
+        change = _get_or_add_change(db, s)
+        if change.state == RESOLVED and s != sha:
+            continue
+        change.resolved_time = now
+        if details is None:
+            change.state = NOT_FOUND
+            continue
+        change.state = RESOLVED
+        change.change_id = details['change_id']
+        change.data = json.dumps(details)
+        # Make the change visible to the queries of the orders.
+        db.session.flush()
+        _fill_orders(db, s, change.change_id)
+
+
+def resolve_change(db, sha):
+    """Look up the change of a commit whose lookup is pending (the job queued
+    by get_change_id)."""
+    change = _find_change(db, sha)
+    if change is not None and change.state != PENDING:
+        return
+    record_change(db, sha, fetch_change(db.config, sha))
+    db.commit()
+
+
+def get_change(db, sha):
+    """
+    get_change(db, sha) -> dict or None
+
+    Return the details of the change of a commit (see fetch_change), looking
+    them up on the code review server if they are not known yet (or the commit
+    had no change then, as it may have been uploaded since). Errors reaching
+    the server are raised.
+    """
+    change = _find_change(db, sha)
+    if change is not None and change.state == RESOLVED:
+        return change.change
+    details = fetch_change(db.config, sha)
+    record_change(db, sha, details)
+    db.commit()
+    return details
@@ -0,0 +1,320 @@
+"""
+Load the data shown in graphs for many plots at once.
+
+A plot is a (machine id, test id, sample field) tuple. Rather than querying
+the samples of each plot in turn, the samples of all the plots of a field are
+loaded with a single query, ordered by plot, and split up afterwards.
+
+Unless the individual samples are asked for, the plots are drawn from the
+summaries of the samples at each order kept in the SampleRollup table, and the
+trends from the geometric means kept in the OrderGeomean table.
+
+Long histories are downsampled before being shipped to the browser, with the
+largest-triangle-three-buckets algorithm (see "Downsampling Time Series for
+Visual Representation", Sveinn Steinarsson, 2013).
+"""
+
+from collections import OrderedDict
+
+import sqlalchemy.orm
+import sqlalchemy.sql
+
+from lnt.testing import PASS
+
+
+def get_machines_and_tests(ts, machine_ids, test_ids):
+    """
+    get_machines_and_tests(ts, machine_ids, test_ids) -> (dict, dict)
+
+    Load the machines and the tests with the given ids with a single query,
+    and return them by id. Ids which do not exist are left out.
+    """
+    machine_ids = set(machine_ids)
+    test_ids = set(test_ids)
+    machines = {}
+    tests = {}
+    if machine_ids and test_ids:
+        for machine, test in ts.query(ts.Machine, ts.Test). \
+                filter(ts.Machine.id.in_(machine_ids)). \
+                filter(ts.Test.id.in_(test_ids)):
+            machines[machine.id] = machine
+            tests[test.id] = test
+    elif machine_ids:
+        for machine in ts.query(ts.Machine). \
+                filter(ts.Machine.id.in_(machine_ids)):
+            machines[machine.id] = machine
+    elif test_ids:
+        for test in ts.query(ts.Test).filter(ts.Test.id.in_(test_ids)):
+            tests[test.id] = test
+    return machines, tests
+
+
+def _group_plots_by_field(plots):
+    plots_by_field = OrderedDict()
+    for machine_id, test_id, field in plots:
+        plots_by_field.setdefault(field, []).append((machine_id, test_id))
+    return plots_by_field
+
+
+def get_plot_samples(ts, plots, max_rank=None, show_failures=False,
+                     min_rank=None):
+    """
+    get_plot_samples(ts, plots, max_rank, show_failures, min_rank) -> dict
+
+    Load the samples of the plots, at the orders of rank min_rank to max_rank
+    (or all of them), with one query per field. Returns by plot an
+    OrderedDict of the (value, run start time, run id) of the samples by
+    revision, in order. Unless show_failures is set, the samples of failing
+    tests are left out.
+    """
+    samples = dict((plot, OrderedDict()) for plot in plots)
+    for field, pairs in _group_plots_by_field(plots).items():
+        q = ts.query(ts.Run.machine_id, ts.Sample.test_id, field.column,
+                     ts.Order.llvm_project_revision, ts.Run.start_time,
+                     ts.Run.id). \
+            select_from(ts.Sample).join(ts.Run).join(ts.Order). \
+            filter(ts.Run.machine_id.in_(set(m for m, _ in pairs))). \
+            filter(ts.Sample.test_id.in_(set(t for _, t in pairs))). \
+            filter(field.column != None). \
+            order_by(ts.Run.machine_id, ts.Sample.test_id, ts.Order.rank,
+                     ts.Order.id)
+        if max_rank is not None:
+            q = q.filter(ts.Order.rank <= max_rank)
+        if min_rank is not None:
+            q = q.filter(ts.Order.rank >= min_rank)
+
+        # Unless all samples requested, filter out failing tests.
+        if not show_failures and field.status_field:
+            q = q.filter((field.status_field.column == PASS) |
+                         (field.status_field.column == None))
+
+        # The machines and tests are filtered separately, so skip the samples
+        # of the combinations which were not asked for.
+        for machine_id, test_id, val, rev, date, run_id in q:
+            data = samples.get((machine_id, test_id, field))
+            if data is not None:
+                data.setdefault(rev, []).append((val, date, run_id))
+    return samples
+
+
+def get_plot_rollups(ts, plots, max_rank=None, min_rank=None):
+    """
+    get_plot_rollups(ts, plots, max_rank, min_rank) -> dict
+
+    Load the summaries of the samples of the plots, at the orders of rank
+    min_rank to max_rank (or all of them), with one query per field. Returns
+    by plot an OrderedDict of the (median, start time of the run of the
+    median, its run id, number of samples, min, mean, MAD) of the passing
+    samples by revision, in order.
+    """
+    rollups = dict((plot, OrderedDict()) for plot in plots)
+    for field, pairs in _group_plots_by_field(plots).items():
+        q = ts.query(ts.SampleRollup.machine_id, ts.SampleRollup.test_id,
+                     ts.Order.llvm_project_revision, ts.SampleRollup.median,
+                     ts.Run.start_time, ts.SampleRollup.run_id,
+                     ts.SampleRollup.num_samples, ts.SampleRollup.min,
+                     ts.SampleRollup.mean, ts.SampleRollup.mad). \
+            join(ts.Order, ts.SampleRollup.order_id == ts.Order.id). \
+            join(ts.Run, ts.SampleRollup.run_id == ts.Run.id). \
+            filter(ts.SampleRollup.field_id == field.id). \
+            filter(ts.SampleRollup.machine_id.in_(set(m for m, _ in pairs))). \
+            filter(ts.SampleRollup.test_id.in_(set(t for _, t in pairs))). \
+            order_by(ts.SampleRollup.machine_id, ts.SampleRollup.test_id,
+                     ts.Order.rank, ts.Order.id)
+        if max_rank is not None:
+            q = q.filter(ts.Order.rank <= max_rank)
+        if min_rank is not None:
+            q = q.filter(ts.Order.rank >= min_rank)
+        for row in q:
+            data = rollups.get((row[0], row[1], field))
+            if data is not None:
+                data[row[2]] = tuple(row[3:])
+    return rollups
+
+
+def get_geomean_trend(ts, machine_id, field, max_rank=None, min_rank=None):
+    """
+    get_geomean_trend(ts, machine_id, field, max_rank, min_rank) -> list
+
+    Load the geometric means of the minimum samples of all the tests of the
+    machine at the orders of rank min_rank to max_rank (or at all of them).
+    Returns the (revision, [(geomean, start time of the earliest run)]) of the
+    orders, in order.
+    """
+    q = ts.query(ts.Order.llvm_project_revision, ts.OrderGeomean.geomean,
+                 ts.Run.start_time). \
+        join(ts.OrderGeomean, ts.OrderGeomean.order_id == ts.Order.id). \
+        join(ts.Run, ts.OrderGeomean.run_id == ts.Run.id). \
+        filter(ts.OrderGeomean.machine_id == machine_id). \
+        filter(ts.OrderGeomean.field_id == field.id). \
+        order_by(ts.Order.rank, ts.Order.id)
+    if max_rank is not None:
+        q = q.filter(ts.Order.rank <= max_rank)
+    if min_rank is not None:
+        q = q.filter(ts.Order.rank >= min_rank)
+    return [(rev, [(geomean, date)]) for rev, geomean, date in q]
+
+
+def get_cv_plot_samples(ts, cv_run, plots):
+    """
+    get_cv_plot_samples(ts, cv_run, plots) -> dict
+
+    Load the samples of the plots in the CV run, with one query per field.
+    Returns the (value, run start time, run id) of the samples by plot.
+    """
+    samples = dict((plot, []) for plot in plots)
+    for field, pairs in _group_plots_by_field(plots).items():
+        cv_field = ts.cv_sample_fields[field.index]
+        q = ts.query(ts.CVRun.machine_id, ts.CVSample.test_id,
+                     cv_field.column, ts.CVRun.start_time, ts.CVRun.id). \
+            select_from(ts.CVSample).join(ts.CVRun). \
+            filter(ts.CVRun.id == cv_run.id). \
+            filter(ts.CVRun.machine_id.in_(set(m for m, _ in pairs))). \
+            filter(ts.CVSample.test_id.in_(set(t for _, t in pairs))). \
+            filter(cv_field.column != None)
+        for machine_id, test_id, val, date, run_id in q:
+            data = samples.get((machine_id, test_id, field))
+            if data is not None:
+                data.append((val, date, run_id))
+    return samples
+
+
+def get_runs(ts, run_ids):
+    """
+    get_runs(ts, run_ids) -> dict
+
+    Load the runs with the given ids, along with their machines and orders,
+    with a single query, and return them by id.
+    """
+    if not run_ids:
+        return {}
+    return dict((run.id, run) for run in ts.query(ts.Run).
+                options(sqlalchemy.orm.joinedload(ts.Run.machine),
+                        sqlalchemy.orm.joinedload(ts.Run.order)).
+                filter(ts.Run.id.in_(set(run_ids))))
+
+
+def get_baseline_means(ts, runs, test_ids, fields):
+    """
+    get_baseline_means(ts, runs, test_ids, fields) -> dict
+
+    Compute the mean of the samples of the tests in each of the runs, with one
+    query per field. Returns the means by (run id, test id, field), leaving
+    out the tests without samples.
+    """
+    means = {}
+    if not runs or not test_ids:
+        return means
+    run_ids = set(run.id for run in runs)
+    for field in set(fields):
+        q = ts.query(ts.Sample.run_id, ts.Sample.test_id,
+                     sqlalchemy.sql.func.sum(field.column),
+                     sqlalchemy.sql.func.count(field.column)). \
+            filter(ts.Sample.run_id.in_(run_ids)). \
+            filter(ts.Sample.test_id.in_(set(test_ids))). \
+            filter(field.column != None). \
+            group_by(ts.Sample.run_id, ts.Sample.test_id)
+        for run_id, test_id, total, count in q:
+            means[run_id, test_id, field] = total / count
+    return means
+
+
+def get_plot_change_revisions(ts, plots):
+    """
+    get_plot_change_revisions(ts, plots) -> dict
+
+    Get the revisions the field changes of the plots start and end at, with a
+    single query. Returns the set of revisions by plot.
+    """
+    revisions = dict((plot, set()) for plot in plots)
+    if not plots:
+        return revisions
+    fields_by_id = dict((field.id, field) for _, _, field in plots)
+    start_order = sqlalchemy.orm.aliased(ts.Order)
+    end_order = sqlalchemy.orm.aliased(ts.Order)
+    q = ts.query(ts.FieldChange.machine_id, ts.FieldChange.test_id,
+                 ts.FieldChange.field_id,
+                 start_order.llvm_project_revision,
+                 end_order.llvm_project_revision). \
+        join(start_order,
+             ts.FieldChange.start_order_id == start_order.id). \
+        join(end_order, ts.FieldChange.end_order_id == end_order.id). \
+        filter(ts.FieldChange.machine_id.in_(set(m for m, _, _ in plots))). \
+        filter(ts.FieldChange.test_id.in_(set(t for _, t, _ in plots))). \
+        filter(ts.FieldChange.field_id.in_(set(fields_by_id)))
+    for machine_id, test_id, field_id, start_rev, end_rev in q:
+        plot_revisions = revisions.get(
+            (machine_id, test_id, fields_by_id[field_id]))
+        if plot_revisions is not None:
+            plot_revisions.update((start_rev, end_rev))
+    return revisions
+
+
+def lttb(points, max_points, keep=()):
+    """
+    lttb(points, max_points, keep) -> [int*]
+
+    Downsample the line through the (x, y, ...) points, in order of x, to
+    max_points points with the largest-triangle-three-buckets algorithm: the
+    points are split into buckets, and from each bucket the point forming the
+    largest triangle with the point kept from the previous bucket and the
+    average of the next bucket is kept. The first and last points and the
+    points of the indices in keep are always kept, in place of others.
+    Returns the indices of the points kept, in order.
+    """
+    n = len(points)
+    keep = set(i for i in keep if 0 <= i < n)
+    if max_points <= 0 or n <= max_points:
+        return range(n)
+
+    # Make room for the points to keep, but always keep a point per bucket.
+    max_points = max(max_points - len(keep - set([0, n - 1])), 3)
+    if n <= max_points:
+        return range(n)
+
+    kept = [0]
+    bucket_size = float(n - 2) / (max_points - 2)
+    for bucket in range(max_points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+
+        # The average of the next bucket, or the last point.
+        next_end = min(int((bucket + 2) * bucket_size) + 1, n)
+        if bucket == max_points - 3:
+            end, next_end = n - 1, n
+        next_points = points[end:next_end]
+        avg_x = sum(p[0] for p in next_points) / float(len(next_points))
+        avg_y = sum(p[1] for p in next_points) / float(len(next_points))
+
+        prev_x, prev_y = points[kept[-1]][:2]
+        best, best_area = start, -1.
+        for i in range(start, end):
+            x, y = points[i][:2]
+            area = abs((prev_x - avg_x) * (y - prev_y) -
+                       (prev_x - x) * (avg_y - prev_y))
+            if area > best_area:
+                best, best_area = i, area
+        kept.append(best)
+    kept.append(n - 1)
+    return sorted(keep.union(kept))
+
+
+def downsample_plot_samples(data, max_points, keep_revisions=()):
+    """
+    downsample_plot_samples(data, max_points, keep_revisions) -> OrderedDict
+
+    Downsample the samples of a plot, as returned by get_plot_samples, to
+    max_points revisions, using the median of the samples of each revision.
+    The revisions in keep_revisions are always kept.
+    """
+    points = []
+    keep = []
+    for pos, (rev, values) in enumerate(data.items()):
+        # Use the revision as x when it is a number, and its position
+        # otherwise, like the graph page does.
+        x = int(rev) if rev.isdigit() else pos
+        points.append((x, sorted(v[0] for v in values)[len(values) // 2]))
+        if rev in keep_revisions:
+            keep.append(pos)
+    items = data.items()
+    return OrderedDict(items[i] for i in lttb(points, max_points, keep))
@@ -0,0 +1,395 @@
+"""
+Durable queue of background jobs.
+
+Work which is done after a submission (computing field changes, running the
+rules) is recorded as a row of the Job table, in the same transaction as the
+submission itself, so it survives restarts of the server. Any process which has
+the database open may run the queued jobs:
+
+ * A job is claimed by atomically moving it from the queued to the running
+   state, and taking a lease on it. Only one process can win the claim, so
+   several server processes can share the work without running a job twice.
+
+ * The lease of a job is renewed while it runs, however long it runs. A running
+   job whose lease expired (because the process running it died, or was
+   restarted) can be claimed again.
+
+ * A job which fails is retried with an exponential backoff, until it runs out
+   of attempts. It then stays in the failed state, until it is requeued by hand
+   (see 'lnt jobs').
+
+ * Jobs which are done or failed are kept for RETENTION_DAYS after they
+   finished, and then removed (see prune).
+"""
+
+import datetime
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, Text, DateTime, Float, and_, or_
+from sqlalchemy.schema import Index
+
+from lnt.server.db import testsuite
+from lnt.testing.util.commands import note, warning, error
+
+# The job states.
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (QUEUED, RUNNING, DONE, FAILED)
+
+# How long (in seconds) a worker may run a job before another worker may
+# assume it died and claim the job again.
+LEASE_TIME = 600
+
+# How many times the lease of a running job is renewed within its lease time.
+LEASE_RENEWALS = 4
+
+# How many times a job is attempted before it is marked as failed.
+MAX_ATTEMPTS = 5
+
+# The delay (in seconds) before a failed job is retried. It doubles with each
+# attempt.
+RETRY_DELAY = 30
+
+# How long (in days) jobs are kept after they finished.
+RETENTION_DAYS = 14
+
+# How often (in seconds) the workers remove the jobs which finished long ago.
+PRUNE_INTERVAL = 3600
+
+# The functions which run each kind of job, by the dotted name of the
+# function. They are called with the test suite (or the database, for the jobs
+# which are not about a test suite) and the arguments of the job.
+JOB_KINDS = {
+    'post_submit': 'lnt.server.db.fieldchange.post_submit_tasks',
+    'post_submit_runs': 'lnt.server.db.fieldchange.post_submit_runs',
+    'import_submission': 'lnt.server.db.submissions.import_submission',
+    'resolve_gerrit_change': 'lnt.server.db.gerrit.resolve_change',
+}
+
+
+class Job(testsuite.Base):
+    __tablename__ = 'Job'
+
+    id = Column("ID", Integer, primary_key=True)
+    kind = Column("Kind", String(256))
+    test_suite = Column("TestSuite", String(256))
+
+    # What the job is about (e.g. the id of a run). There is at most one
+    # queued or running job of each kind for a key.
+    key = Column("Key", String(256))
+
+    # The keyword arguments of the job function, encoded as JSON.
+    arguments_data = Column("Arguments", Text)
+
+    state = Column("State", String(32))
+    attempts = Column("Attempts", Integer)
+    max_attempts = Column("MaxAttempts", Integer)
+
+    created_time = Column("CreatedTime", DateTime)
+    # The job is not run before this time.
+    available_time = Column("AvailableTime", DateTime)
+    # The worker running the job and the time it may run the job until.
+    owner = Column("Owner", String(256))
+    lease_expires = Column("LeaseExpires", DateTime)
+
+    finished_time = Column("FinishedTime", DateTime)
+    # The time the last attempt took to run.
+    run_time = Column("RunTime", Float)
+    last_error = Column("LastError", Text)
+
+    def __init__(self, kind, test_suite, key, arguments,
+                 max_attempts=MAX_ATTEMPTS):
+        now = datetime.datetime.utcnow()
+        self.kind = kind
+        self.test_suite = test_suite
+        self.key = str(key)
+        self.arguments = arguments
+        self.state = QUEUED
+        self.attempts = 0
+        self.max_attempts = max_attempts
+        self.created_time = now
+        self.available_time = now
+
+    def __repr__(self):
+        return '%s%r' % (self.__class__.__name__,
+                         (self.id, self.kind, self.test_suite, self.key,
+                          self.state))
+
+    @property
+    def arguments(self):
+        return json.loads(self.arguments_data)
+
+    @arguments.setter
+    def arguments(self, value):
+        self.arguments_data = json.dumps(value)
+
+    @property
+    def is_stuck(self):
+        """Is the job failed, or running on a lease which expired?"""
+        return self.state == FAILED or (
+            self.state == RUNNING and
+            self.lease_expires < datetime.datetime.utcnow())
+
+Index("ix_Job_State_AvailableTime", Job.state, Job.available_time)
+Index("ix_Job_Kind_Key", Job.kind, Job.test_suite, Job.key)
+
+
+def get_owner_name():
+    """Return the name jobs claimed by this process are leased to."""
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def get_job_function(kind):
+    """Return the function which runs jobs of the given kind."""
+    module_name, func_name = JOB_KINDS[kind].rsplit('.', 1)
+    __import__(module_name)
+    return getattr(sys.modules[module_name], func_name)
+
+
+def enqueue(db, kind, ts_name, key, arguments, max_attempts=MAX_ATTEMPTS):
+    """Queue a job, unless the same job is queued or running already.
+
+    The job is added to the session of the database, and is committed along
+    with the rest of the transaction of the caller.
+    """
+    assert kind in JOB_KINDS, "unknown job kind %r" % kind
+    job = db.query(Job).filter(Job.kind == kind,
+                               Job.test_suite == ts_name,
+                               Job.key == str(key),
+                               Job.state.in_([QUEUED, RUNNING])).first()
+    if job is not None:
+        return job
+
+    job = Job(kind, ts_name, key, arguments, max_attempts)
+    db.add(job)
+    return job
+
+
+def claim(db, owner, lease_time=LEASE_TIME):
+    """Claim the next job ready to run, or return None if there is none.
+
+    A job is ready when it is queued and its retry delay passed, or when it is
+    running but its lease expired. The claim is a conditional update on the
+    state of the job we saw, so if several workers race for the same job only
+    one of them wins it.
+    """
+    now = datetime.datetime.utcnow()
+    candidates = db.query(Job).filter(
+        or_(and_(Job.state == QUEUED, Job.available_time <= now),
+            and_(Job.state == RUNNING, Job.lease_expires < now))).\
+        order_by(Job.available_time, Job.id).limit(16).all()
+
+    for job in candidates:
+        claimed = and_(Job.id == job.id,
+                       Job.state == job.state,
+                       Job.attempts == job.attempts)
+        if job.state == RUNNING and job.attempts >= job.max_attempts:
+            # The worker running the final attempt died.
+            db.query(Job).filter(claimed).update(
+                {Job.state: FAILED, Job.owner: None, Job.lease_expires: None,
+                 Job.finished_time: now,
+                 Job.last_error: "lease of %s expired" % job.owner},
+                synchronize_session=False)
+            db.commit()
+            continue
+
+        count = db.query(Job).filter(claimed).update(
+            {Job.state: RUNNING, Job.owner: owner,
+             Job.lease_expires: now + datetime.timedelta(seconds=lease_time),
+             Job.attempts: Job.attempts + 1},
+            synchronize_session=False)
+        db.commit()
+        if count == 1:
+            # Keep the job as we claimed it, whatever the job does with the
+            # session.
+            db.session.refresh(job)
+            db.session.expunge(job)
+            return job
+    return None
+
+
+def complete(db, job, run_time):
+    """Mark a job claimed by this worker as done."""
+    db.query(Job).filter(Job.id == job.id, Job.owner == job.owner,
+                         Job.state == RUNNING).update(
+        {Job.state: DONE, Job.lease_expires: None, Job.run_time: run_time,
+         Job.finished_time: datetime.datetime.utcnow()},
+        synchronize_session=False)
+    db.commit()
+
+
+def fail(db, job, run_time, message):
+    """Schedule a retry of a job claimed by this worker which failed, or mark it
+    as failed if it has no attempts left."""
+    now = datetime.datetime.utcnow()
+    values = {Job.lease_expires: None, Job.run_time: run_time,
+              Job.last_error: message}
+    if job.attempts < job.max_attempts:
+        delay = RETRY_DELAY * 2 ** (job.attempts - 1)
+        values.update({Job.state: QUEUED, Job.owner: None,
+                       Job.available_time:
+                           now + datetime.timedelta(seconds=delay)})
+    else:
+        values.update({Job.state: FAILED, Job.finished_time: now})
+    db.query(Job).filter(Job.id == job.id, Job.owner == job.owner,
+                         Job.state == RUNNING).update(
+        values, synchronize_session=False)
+    db.commit()
+
+
+def renew(engine, job, lease_time=LEASE_TIME):
+    """Extend the lease of a job claimed by this worker. The lease is updated
+    over a connection of its own, outside of the transaction of the job.
+    Returns whether the job was still leased to this worker."""
+    table = Job.__table__
+    result = engine.execute(table.update().where(
+        and_(table.c.ID == job.id, table.c.Owner == job.owner,
+             table.c.State == RUNNING)).values(
+        LeaseExpires=datetime.datetime.utcnow() +
+            datetime.timedelta(seconds=lease_time)))
+    return result.rowcount == 1
+
+
+class LeaseRenewer(threading.Thread):
+    """Renew the lease of a job while it runs, so it is not claimed again by
+    another worker however long it runs."""
+
+    def __init__(self, engine, job, lease_time=LEASE_TIME):
+        super(LeaseRenewer, self).__init__(name="lease of job %d" % job.id)
+        self.daemon = True
+        self.engine = engine
+        self.job = job
+        self.lease_time = lease_time
+        self.finished = threading.Event()
+
+    def run(self):
+        interval = float(self.lease_time) / LEASE_RENEWALS
+        while not self.finished.wait(interval):
+            try:
+                if not renew(self.engine, self.job, self.lease_time):
+                    warning("Job %d is no longer leased to %s" % (
+                        self.job.id, self.job.owner))
+                    return
+            except Exception:
+                # The database may be busy, try again on the next renewal.
+                warning("Failed to renew the lease of job %d: %s" % (
+                    self.job.id, sys.exc_info()[1]))
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+def run_job(db, job, lease_time=LEASE_TIME):
+    """Run a claimed job, renewing its lease while it runs, and record its
+    outcome."""
+    start_time = time.time()
+    renewer = LeaseRenewer(db.engine, job, lease_time)
+    renewer.start()
+    try:
+        if job.test_suite is None:
+            target = db
+        else:
+            target = db.testsuite[job.test_suite]
+        result = get_job_function(job.kind)(target, **job.arguments)
+        assert result is None
+    except Exception:
+        message = "".join(traceback.format_exception(*sys.exc_info()))
+        error("Job %d (%s of %s) failed with:%s" % (job.id, job.kind, job.key,
+                                                    message))
+        # Get rid of what the job left of its transaction.
+        db.rollback()
+    else:
+        message = None
+    finally:
+        renewer.stop()
+    if message is not None:
+        fail(db, job, time.time() - start_time, message)
+        return False
+    complete(db, job, time.time() - start_time)
+    return True
+
+
+def run_queued_jobs(db, owner=None, limit=None):
+    """Run the jobs which are ready, until there are none left (or we ran
+    limit of them). Returns the number of jobs run."""
+    owner = owner or get_owner_name()
+    count = 0
+    while limit is None or count < limit:
+        job = claim(db, owner)
+        if job is None:
+            break
+        note("Running job %d (%s of %s, attempt %d)" % (
+            job.id, job.kind, job.key, job.attempts))
+        run_job(db, job)
+        count += 1
+    return count
+
+
+def get_next_time(db):
+    """Return the time the next job becomes ready to run (a queued job, or a
+    running job whose lease expires), or None if there are no such jobs."""
+    queued = db.query(sqlalchemy.func.min(Job.available_time)).filter(
+        Job.state == QUEUED).scalar()
+    leased = db.query(sqlalchemy.func.min(Job.lease_expires)).filter(
+        Job.state == RUNNING).scalar()
+    times = [t for t in (queued, leased) if t is not None]
+    if not times:
+        return None
+    return min(times)
+
+
+def requeue(db, job_ids=None, stuck=False, reset_attempts=True):
+    """Queue the given jobs (or all stuck jobs) to run again right away.
+    Returns the requeued jobs."""
+    query = db.query(Job)
+    if job_ids:
+        query = query.filter(Job.id.in_(job_ids))
+    if stuck:
+        query = query.filter(Job.state.in_([RUNNING, FAILED]))
+    jobs = [job for job in query.order_by(Job.id)
+            if not stuck or job.is_stuck]
+
+    now = datetime.datetime.utcnow()
+    for job in jobs:
+        if job.state == RUNNING and not job.is_stuck:
+            warning("requeueing job %d, which is still leased to %s" % (
+                job.id, job.owner))
+        job.state = QUEUED
+        job.owner = None
+        job.lease_expires = None
+        job.available_time = now
+        job.finished_time = None
+        if reset_attempts:
+            job.attempts = 0
+    db.commit()
+    return jobs
+
+
+def prune(db, retention_days=RETENTION_DAYS):
+    """Remove the jobs which finished (whether they were done or failed)
+    more than retention_days ago. Returns the number of jobs removed."""
+    cutoff = datetime.datetime.utcnow() - \
+        datetime.timedelta(days=retention_days)
+    count = db.query(Job).filter(Job.state.in_([DONE, FAILED]),
+                                 Job.finished_time < cutoff).delete(
+        synchronize_session=False)
+    db.commit()
+    return count
+
+
+def get_state_counts(db):
+    """Return the number of jobs in each state."""
+    counts = dict((state, 0) for state in STATES)
+    counts.update(db.query(Job.state, sqlalchemy.func.count(Job.id)).
+                  group_by(Job.state).all())
+    return counts
@@ -0,0 +1,52 @@
+# Version 11 adds an indexed rank to Orders, used to maintain the total
+# ordering of orders without loading all of them.
+
+import sqlalchemy
+from sqlalchemy import *
+from sqlalchemy.engine.reflection import Inspector
+
+import lnt.server.db.migrations.upgrade_0_to_1 as upgrade_0_to_1
+
+
+def upgrade_testsuite(engine, session, name):
+    # Grab Test Suite.
+    test_suite = session.query(upgrade_0_to_1.TestSuite).filter_by(
+        name=name).first()
+    assert (test_suite is not None)
+    db_key_name = test_suite.db_key_name
+    table_name = "%s_Order" % db_key_name
+    index_name = "ix_%s_Order_Rank" % db_key_name
+
+    # Migrations are re-applied whenever a database is opened, so only add the
+    # column and index if they are not there yet.
+    inspector = Inspector.from_engine(engine)
+    if 'Rank' not in [c['name'] for c in inspector.get_columns(table_name)]:
+        session.connection().execute("""
+ALTER TABLE "%s"
+ADD COLUMN "Rank" INTEGER
+        """ % (table_name,))
+    if index_name not in [i['name'] for i in inspector.get_indexes(table_name)]:
+        session.connection().execute("""
+CREATE INDEX "%s" ON "%s" ("Rank")
+        """ % (index_name, table_name))
+
+    # Backfill the rank of any order which does not have one. This must agree
+    # with Order.__cmp__, which compares the revisions as integers.
+    session.connection().execute("""
+UPDATE "%s" SET "Rank" = CAST("llvm_project_revision" AS INTEGER)
+WHERE "Rank" IS NULL
+    """ % (table_name,))
+
+    session.commit()
+
+
+def upgrade(engine, cb_testsuites):
+    # Create a session.
+    session = sqlalchemy.orm.sessionmaker(engine)()
+
+    for testsuite in cb_testsuites:
+        try:
+            upgrade_testsuite(engine, session, testsuite['name'])
+        except Exception as e:
+            print(e)
+            session.rollback()
@@ -0,0 +1,105 @@
+# Version 12 adds the MachineOrder table, which records the orders each machine
+# reported runs at (along with their rank), and a (MachineID, OrderID) index on
+# runs, so adjacent runs can be found with bounded index scans.
+
+import sqlalchemy
+from sqlalchemy import *
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import Index
+
+import lnt.server.db.migrations.upgrade_0_to_1 as upgrade_0_to_1
+import lnt.server.db.migrations.upgrade_2_to_3 as upgrade_2_to_3
+
+
+def add_machine_orders(test_suite):
+    # Grab the Base for the previous schema so that we have all
+    # the definitions we need.
+    Base = upgrade_2_to_3.get_base(test_suite)
+    # Grab our db_key_name for our test suite so we can properly
+    # prefix our fields/table names.
+    db_key_name = test_suite.db_key_name
+
+    class MachineOrder(Base):
+        __tablename__ = db_key_name + '_MachineOrder'
+        id = Column("ID", Integer, primary_key=True)
+        machine_id = Column("MachineID", Integer,
+                            ForeignKey("%s_Machine.ID" % db_key_name))
+        order_id = Column("OrderID", Integer,
+                          ForeignKey("%s_Order.ID" % db_key_name))
+        rank = Column("Rank", Integer)
+
+    Index("ix_%s_MachineOrder_Unique" % db_key_name,
+          MachineOrder.machine_id, MachineOrder.order_id, unique=True)
+    Index("ix_%s_MachineOrder_Rank" % db_key_name,
+          MachineOrder.machine_id, MachineOrder.rank, MachineOrder.order_id)
+
+    return Base
+
+
+def add_run_machine_order_index(engine, test_suite):
+    """Index the runs by machine and order, which is how the runs at the
+    adjacent orders are looked up."""
+    db_key_name = test_suite.db_key_name
+    table_name = "%s_Run" % db_key_name
+    index_name = "ix_%s_Run_MachineID_OrderID" % db_key_name
+
+    # The Run table already exists, so create_all will not add the index.
+    inspector = Inspector.from_engine(engine)
+    if index_name in [i['name'] for i in inspector.get_indexes(table_name)]:
+        return
+    run_table = Table(table_name, MetaData(), autoload=True,
+                      autoload_with=engine)
+    Index(index_name, run_table.c.MachineID, run_table.c.OrderID).create(
+        engine)
+
+
+def upgrade_testsuite(engine, session, name):
+    # Grab Test Suite.
+    test_suite = session.query(upgrade_0_to_1.TestSuite).filter_by(
+        name=name).first()
+    assert (test_suite is not None)
+    db_key_name = test_suite.db_key_name
+
+    Base = add_machine_orders(test_suite)
+
+    # Create tables. We commit now since databases like Postgres run
+    # into deadlocking issues due to previous queries that we have run
+    # during the upgrade process. The commit closes all of the
+    # relevant transactions allowing us to then perform our upgrade.
+    session.commit()
+    Base.metadata.create_all(engine)
+    add_run_machine_order_index(engine, test_suite)
+
+    # Backfill the orders for any runs which are not recorded yet.
+    session.connection().execute("""
+INSERT INTO "%(key)s_MachineOrder" ("MachineID", "OrderID", "Rank")
+SELECT DISTINCT r."MachineID", r."OrderID", o."Rank"
+FROM "%(key)s_Run" r JOIN "%(key)s_Order" o ON r."OrderID" = o."ID"
+WHERE NOT EXISTS (SELECT 1 FROM "%(key)s_MachineOrder" mo
+                  WHERE mo."MachineID" = r."MachineID"
+                  AND mo."OrderID" = r."OrderID")
+    """ % {'key': db_key_name})
+
+    # Drop any records for which the runs have since been removed.
+    session.connection().execute("""
+DELETE FROM "%(key)s_MachineOrder"
+WHERE NOT EXISTS (SELECT 1 FROM "%(key)s_Run" r
+                  WHERE r."MachineID" = "%(key)s_MachineOrder"."MachineID"
+                  AND r."OrderID" = "%(key)s_MachineOrder"."OrderID")
+    """ % {'key': db_key_name})
+
+    # Commit changes (also closing all relevant transactions with
+    # respect to Postgres like databases).
+    session.commit()
+
+
+def upgrade(engine, cb_testsuites):
+    # Create a session.
+    session = sqlalchemy.orm.sessionmaker(engine)()
+
+    for testsuite in cb_testsuites:
+        try:
+            upgrade_testsuite(engine, session, testsuite['name'])
+        except Exception as e:
+            print(e)
+            session.rollback()
@@ -0,0 +1,35 @@
+# Version 13 adds the Job table, the durable queue of the background jobs (see
+# lnt.server.db.jobs).
+
+import sqlalchemy
+from sqlalchemy import *
+from sqlalchemy.schema import Index
+
+Base = sqlalchemy.ext.declarative.declarative_base()
+
+
+class Job(Base):
+    __tablename__ = 'Job'
+
+    id = Column("ID", Integer, primary_key=True)
+    kind = Column("Kind", String(256))
+    test_suite = Column("TestSuite", String(256))
+    key = Column("Key", String(256))
+    arguments_data = Column("Arguments", Text)
+    state = Column("State", String(32))
+    attempts = Column("Attempts", Integer)
+    max_attempts = Column("MaxAttempts", Integer)
+    created_time = Column("CreatedTime", DateTime)
+    available_time = Column("AvailableTime", DateTime)
+    owner = Column("Owner", String(256))
+    lease_expires = Column("LeaseExpires", DateTime)
+    finished_time = Column("FinishedTime", DateTime)
+    run_time = Column("RunTime", Float)
+    last_error = Column("LastError", Text)
+
+Index("ix_Job_State_AvailableTime", Job.state, Job.available_time)
+Index("ix_Job_Kind_Key", Job.kind, Job.test_suite, Job.key)
+
+
+def upgrade(engine, cb_testsuites):
+    Base.metadata.create_all(engine)
@@ -0,0 +1,141 @@
+# Version 15 adds the TestStability table, which records the stability of each
+# test of each machine for each metric field as of the latest order, so the
+# stability of many tests can be read with a single query.
+
+import bisect
+
+import sqlalchemy
+from sqlalchemy import *
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import Index
+
+import lnt.server.db.migrations.upgrade_0_to_1 as upgrade_0_to_1
+import lnt.server.db.migrations.upgrade_2_to_3 as upgrade_2_to_3
+
+
+def add_test_stability(test_suite):
+    # Grab the Base for the previous schema so that we have all
+    # the definitions we need.
+    Base = upgrade_2_to_3.get_base(test_suite)
+    # Grab our db_key_name for our test suite so we can properly
+    # prefix our fields/table names.
+    db_key_name = test_suite.db_key_name
+
+    class TestStability(Base):
+        __tablename__ = db_key_name + '_TestStability'
+        id = Column("ID", Integer, primary_key=True)
+        machine_id = Column("MachineID", Integer,
+                            ForeignKey("%s_Machine.ID" % db_key_name))
+        test_id = Column("TestID", Integer,
+                         ForeignKey("%s_Test.ID" % db_key_name))
+        field_id = Column("FieldID", Integer,
+                          ForeignKey(upgrade_0_to_1.SampleField.id))
+        first_run_id = Column("FirstRunID", Integer)
+        last_run_id = Column("LastRunID", Integer)
+        last_rank = Column("LastRank", Integer)
+        num_orders = Column("NumOrders", Integer)
+        change_rank = Column("ChangeRank", Integer)
+        orders_since_change = Column("OrdersSinceChange", Integer)
+
+    Index("ix_%s_TestStability_Unique" % db_key_name,
+          TestStability.machine_id, TestStability.test_id,
+          TestStability.field_id, unique=True)
+
+    return Base
+
+
+def backfill_test_stability(session, test_suite):
+    """Compute the stability records of every test of every machine from its
+    samples and field changes."""
+    db_key_name = test_suite.db_key_name
+    field_ids = [field.id for field in test_suite.sample_fields
+                 if field.type.name == 'Real']
+    connection = session.connection()
+    machine_ids = [machine_id for machine_id, in connection.execute("""
+SELECT "ID" FROM "%s_Machine"
+    """ % (db_key_name,))]
+    for machine_id in machine_ids:
+        orders = {}
+        for test_id, rank, first_run_id, last_run_id in connection.execute("""
+SELECT s."TestID", o."Rank", MIN(r."ID"), MAX(r."ID")
+FROM "%(key)s_Sample" s JOIN "%(key)s_Run" r ON s."RunID" = r."ID"
+JOIN "%(key)s_Order" o ON r."OrderID" = o."ID"
+WHERE r."MachineID" = %(machine)d
+GROUP BY s."TestID", o."Rank"
+        """ % {'key': db_key_name, 'machine': machine_id}):
+            orders.setdefault(test_id, []).append(
+                (rank, first_run_id, last_run_id))
+
+        change_ranks = {}
+        for test_id, field_id, rank in connection.execute("""
+SELECT fc."TestID", fc."FieldID", MAX(o."Rank")
+FROM "%(key)s_FieldChangeV2" fc JOIN "%(key)s_Order" o
+ON fc."EndOrderID" = o."ID"
+WHERE fc."MachineID" = %(machine)d
+GROUP BY fc."TestID", fc."FieldID"
+        """ % {'key': db_key_name, 'machine': machine_id}):
+            change_ranks[test_id, field_id] = rank
+
+        rows = []
+        for test_id, test_orders in orders.items():
+            test_orders.sort()
+            ranks = [rank for rank, _, _ in test_orders]
+            for field_id in field_ids:
+                change_rank = change_ranks.get((test_id, field_id))
+                orders_since_change = len(ranks)
+                if change_rank is not None:
+                    orders_since_change -= bisect.bisect_right(ranks,
+                                                               change_rank)
+                rows.append({
+                    'MachineID': machine_id, 'TestID': test_id,
+                    'FieldID': field_id,
+                    'FirstRunID': min(run_id for _, run_id, _ in test_orders),
+                    'LastRunID': test_orders[-1][2], 'LastRank': ranks[-1],
+                    'NumOrders': len(ranks), 'ChangeRank': change_rank,
+                    'OrdersSinceChange': orders_since_change})
+        if rows:
+            connection.execute(Table("%s_TestStability" % db_key_name,
+                                     MetaData(), autoload=True,
+                                     autoload_with=connection).insert(),
+                               rows)
+
+
+def upgrade_testsuite(engine, session, name):
+    # Grab Test Suite.
+    test_suite = session.query(upgrade_0_to_1.TestSuite).filter_by(
+        name=name).first()
+    assert (test_suite is not None)
+    db_key_name = test_suite.db_key_name
+
+    # Migrations are re-applied whenever a database is opened, so only create
+    # and fill the table if it is not there yet.
+    inspector = Inspector.from_engine(engine)
+    if "%s_TestStability" % db_key_name in inspector.get_table_names():
+        return
+
+    Base = add_test_stability(test_suite)
+
+    # Create tables. We commit now since databases like Postgres run
+    # into deadlocking issues due to previous queries that we have run
+    # during the upgrade process. The commit closes all of the
+    # relevant transactions allowing us to then perform our upgrade.
+    session.commit()
+    Base.metadata.create_all(engine)
+
+    backfill_test_stability(session, test_suite)
+
+    # Commit changes (also closing all relevant transactions with
+    # respect to Postgres like databases).
+    session.commit()
+
+
+def upgrade(engine, cb_testsuites):
+    # Create a session.
+    session = sqlalchemy.orm.sessionmaker(engine)()
+
+    for testsuite in cb_testsuites:
+        try:
+            upgrade_testsuite(engine, session, testsuite['name'])
+        except Exception as e:
+            print(e)
+            session.rollback()
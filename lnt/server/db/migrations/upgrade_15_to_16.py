@@ -0,0 +1,143 @@
+# Version 16 adds the SampleRollup table, which summarizes the samples of each
+# test of each machine for each metric field at each order, so graphs and
+# trends can be drawn without going through every sample.
+
+import sqlalchemy
+from sqlalchemy import *
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import Index
+
+import lnt.server.db.migrations.upgrade_0_to_1 as upgrade_0_to_1
+import lnt.server.db.migrations.upgrade_2_to_3 as upgrade_2_to_3
+import lnt.util.stats
+from lnt.testing import PASS
+
+
+def add_sample_rollup(test_suite):
+    # Grab the Base for the previous schema so that we have all
+    # the definitions we need.
+    Base = upgrade_2_to_3.get_base(test_suite)
+    # Grab our db_key_name for our test suite so we can properly
+    # prefix our fields/table names.
+    db_key_name = test_suite.db_key_name
+
+    class SampleRollup(Base):
+        __tablename__ = db_key_name + '_SampleRollup'
+        id = Column("ID", Integer, primary_key=True)
+        machine_id = Column("MachineID", Integer,
+                            ForeignKey("%s_Machine.ID" % db_key_name))
+        test_id = Column("TestID", Integer,
+                         ForeignKey("%s_Test.ID" % db_key_name))
+        field_id = Column("FieldID", Integer,
+                          ForeignKey(upgrade_0_to_1.SampleField.id))
+        order_id = Column("OrderID", Integer,
+                          ForeignKey("%s_Order.ID" % db_key_name))
+        run_id = Column("RunID", Integer,
+                        ForeignKey("%s_Run.ID" % db_key_name))
+        num_samples = Column("NumSamples", Integer)
+        min = Column("Min", Float)
+        median = Column("Median", Float)
+        mean = Column("Mean", Float)
+        mad = Column("MAD", Float)
+
+    Index("ix_%s_SampleRollup_Unique" % db_key_name,
+          SampleRollup.machine_id, SampleRollup.test_id,
+          SampleRollup.field_id, SampleRollup.order_id, unique=True)
+
+    return Base
+
+
+def backfill_sample_rollup(session, test_suite):
+    """Summarize the samples of every test of every machine at every order,
+    leaving out the samples of failing tests."""
+    db_key_name = test_suite.db_key_name
+    fields = [field for field in test_suite.sample_fields
+              if field.type.name == 'Real']
+    columns = ['s."%s"' % field.name for field in fields]
+    status_index = {}
+    for field in fields:
+        if field.status_field:
+            status_index[field.id] = 3 + len(columns)
+            columns.append('s."%s"' % field.status_field.name)
+
+    connection = session.connection()
+    table = Table("%s_SampleRollup" % db_key_name, MetaData(), autoload=True,
+                  autoload_with=connection)
+    machine_ids = [machine_id for machine_id, in connection.execute("""
+SELECT "ID" FROM "%s_Machine"
+    """ % (db_key_name,))]
+    for machine_id in machine_ids:
+        samples = {}
+        for row in connection.execute("""
+SELECT r."OrderID", s."TestID", r."ID", %(columns)s
+FROM "%(key)s_Sample" s JOIN "%(key)s_Run" r ON s."RunID" = r."ID"
+WHERE r."MachineID" = %(machine)d
+        """ % {'key': db_key_name, 'machine': machine_id,
+               'columns': ', '.join(columns)}):
+            order_id, test_id, run_id = row[:3]
+            for i, field in enumerate(fields):
+                value = row[3 + i]
+                if value is None:
+                    continue
+                if field.id in status_index and \
+                        row[status_index[field.id]] not in (PASS, None):
+                    continue
+                samples.setdefault((order_id, test_id, field.id),
+                                   []).append((value, run_id))
+
+        rows = []
+        for (order_id, test_id, field_id), values in samples.items():
+            values.sort()
+            data = [value for value, _ in values]
+            median = lnt.util.stats.median(data)
+            rows.append({
+                'MachineID': machine_id, 'TestID': test_id,
+                'FieldID': field_id, 'OrderID': order_id,
+                'RunID': values[len(values) // 2][1],
+                'NumSamples': len(data), 'Min': data[0], 'Median': median,
+                'Mean': lnt.util.stats.mean(data),
+                'MAD': lnt.util.stats.median_absolute_deviation(data,
+                                                                median)})
+        if rows:
+            connection.execute(table.insert(), rows)
+
+
+def upgrade_testsuite(engine, session, name):
+    # Grab Test Suite.
+    test_suite = session.query(upgrade_0_to_1.TestSuite).filter_by(
+        name=name).first()
+    assert (test_suite is not None)
+    db_key_name = test_suite.db_key_name
+
+    # Migrations are re-applied whenever a database is opened, so only create
+    # and fill the table if it is not there yet.
+    inspector = Inspector.from_engine(engine)
+    if "%s_SampleRollup" % db_key_name in inspector.get_table_names():
+        return
+
+    Base = add_sample_rollup(test_suite)
+
+    # Create tables. We commit now since databases like Postgres run
+    # into deadlocking issues due to previous queries that we have run
+    # during the upgrade process. The commit closes all of the
+    # relevant transactions allowing us to then perform our upgrade.
+    session.commit()
+    Base.metadata.create_all(engine)
+
+    backfill_sample_rollup(session, test_suite)
+
+    # Commit changes (also closing all relevant transactions with
+    # respect to Postgres like databases).
+    session.commit()
+
+
+def upgrade(engine, cb_testsuites):
+    # Create a session.
+    session = sqlalchemy.orm.sessionmaker(engine)()
+
+    for testsuite in cb_testsuites:
+        try:
+            upgrade_testsuite(engine, session, testsuite['name'])
+        except Exception as e:
+            print(e)
+            session.rollback()
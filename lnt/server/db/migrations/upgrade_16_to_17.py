@@ -0,0 +1,120 @@
+# Version 17 adds the OrderGeomean table, which records the geometric mean of
+# the tests of each machine for each metric field at each order, so the trend
+# of a machine can be drawn without going through every sample.
+
+import sqlalchemy
+from sqlalchemy import *
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import Index
+
+import lnt.server.db.migrations.upgrade_0_to_1 as upgrade_0_to_1
+import lnt.server.db.migrations.upgrade_2_to_3 as upgrade_2_to_3
+import lnt.server.reporting.analysis
+
+
+def add_order_geomean(test_suite):
+    # Grab the Base for the previous schema so that we have all
+    # the definitions we need.
+    Base = upgrade_2_to_3.get_base(test_suite)
+    # Grab our db_key_name for our test suite so we can properly
+    # prefix our fields/table names.
+    db_key_name = test_suite.db_key_name
+
+    class OrderGeomean(Base):
+        __tablename__ = db_key_name + '_OrderGeomean'
+        id = Column("ID", Integer, primary_key=True)
+        machine_id = Column("MachineID", Integer,
+                            ForeignKey("%s_Machine.ID" % db_key_name))
+        field_id = Column("FieldID", Integer,
+                          ForeignKey(upgrade_0_to_1.SampleField.id))
+        order_id = Column("OrderID", Integer,
+                          ForeignKey("%s_Order.ID" % db_key_name))
+        run_id = Column("RunID", Integer,
+                        ForeignKey("%s_Run.ID" % db_key_name))
+        num_tests = Column("NumTests", Integer)
+        geomean = Column("Geomean", Float)
+
+    Index("ix_%s_OrderGeomean_Unique" % db_key_name,
+          OrderGeomean.machine_id, OrderGeomean.field_id,
+          OrderGeomean.order_id, unique=True)
+
+    return Base
+
+
+def backfill_order_geomean(session, test_suite):
+    """Compute the geometric means of the tests of every machine at every
+    order from the summaries of their samples."""
+    db_key_name = test_suite.db_key_name
+    connection = session.connection()
+    table = Table("%s_OrderGeomean" % db_key_name, MetaData(), autoload=True,
+                  autoload_with=connection)
+    machine_ids = [machine_id for machine_id, in connection.execute("""
+SELECT "ID" FROM "%s_Machine"
+    """ % (db_key_name,))]
+    for machine_id in machine_ids:
+        mins = {}
+        for order_id, field_id, value in connection.execute("""
+SELECT "OrderID", "FieldID", "Min" FROM "%(key)s_SampleRollup"
+WHERE "MachineID" = %(machine)d
+        """ % {'key': db_key_name, 'machine': machine_id}):
+            mins.setdefault((order_id, field_id), []).append(value)
+
+        # The earliest run at each order.
+        first_run_ids = {}
+        for order_id, run_id in connection.execute("""
+SELECT "OrderID", "ID" FROM "%(key)s_Run"
+WHERE "MachineID" = %(machine)d
+ORDER BY "StartTime" DESC, "ID" DESC
+        """ % {'key': db_key_name, 'machine': machine_id}):
+            first_run_ids[order_id] = run_id
+
+        rows = [{'MachineID': machine_id, 'FieldID': field_id,
+                 'OrderID': order_id,
+                 'RunID': first_run_ids.get(order_id),
+                 'NumTests': len(values),
+                 'Geomean': lnt.server.reporting.analysis.calc_geomean(
+                     values)}
+                for (order_id, field_id), values in mins.items()]
+        if rows:
+            connection.execute(table.insert(), rows)
+
+
+def upgrade_testsuite(engine, session, name):
+    # Grab Test Suite.
+    test_suite = session.query(upgrade_0_to_1.TestSuite).filter_by(
+        name=name).first()
+    assert (test_suite is not None)
+    db_key_name = test_suite.db_key_name
+
+    # Migrations are re-applied whenever a database is opened, so only create
+    # and fill the table if it is not there yet.
+    inspector = Inspector.from_engine(engine)
+    if "%s_OrderGeomean" % db_key_name in inspector.get_table_names():
+        return
+
+    Base = add_order_geomean(test_suite)
+
+    # Create tables. We commit now since databases like Postgres run
+    # into deadlocking issues due to previous queries that we have run
+    # during the upgrade process. The commit closes all of the
+    # relevant transactions allowing us to then perform our upgrade.
+    session.commit()
+    Base.metadata.create_all(engine)
+
+    backfill_order_geomean(session, test_suite)
+
+    # Commit changes (also closing all relevant transactions with
+    # respect to Postgres like databases).
+    session.commit()
+
+
+def upgrade(engine, cb_testsuites):
+    # Create a session.
+    session = sqlalchemy.orm.sessionmaker(engine)()
+
+    for testsuite in cb_testsuites:
+        try:
+            upgrade_testsuite(engine, session, testsuite['name'])
+        except Exception as e:
+            print(e)
+            session.rollback()
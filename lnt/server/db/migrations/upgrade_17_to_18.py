@@ -0,0 +1,91 @@
+# Version 18 adds the DataGeneration table, which records the generation of the
+# runs and field changes of each machine, so the pages about runs can be cached
+# until they change.
+
+import datetime
+
+import sqlalchemy
+from sqlalchemy import *
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import Index
+
+import lnt.server.db.migrations.upgrade_0_to_1 as upgrade_0_to_1
+import lnt.server.db.migrations.upgrade_2_to_3 as upgrade_2_to_3
+
+
+def add_data_generation(test_suite):
+    # Grab the Base for the previous schema so that we have all
+    # the definitions we need.
+    Base = upgrade_2_to_3.get_base(test_suite)
+    # Grab our db_key_name for our test suite so we can properly
+    # prefix our fields/table names.
+    db_key_name = test_suite.db_key_name
+
+    class DataGeneration(Base):
+        __tablename__ = db_key_name + '_DataGeneration'
+        id = Column("ID", Integer, primary_key=True)
+        machine_id = Column("MachineID", Integer,
+                            ForeignKey("%s_Machine.ID" % db_key_name))
+        generation = Column("Generation", Integer)
+        modified_time = Column("ModifiedTime", DateTime)
+
+    Index("ix_%s_DataGeneration_MachineID" % db_key_name,
+          DataGeneration.machine_id, unique=True)
+
+    return Base
+
+
+def backfill_data_generation(session, test_suite):
+    """Start the generations of the test suite and of every machine."""
+    db_key_name = test_suite.db_key_name
+    connection = session.connection()
+    table = Table("%s_DataGeneration" % db_key_name, MetaData(),
+                  autoload=True, autoload_with=connection)
+    machine_ids = [machine_id for machine_id, in connection.execute("""
+SELECT "ID" FROM "%s_Machine"
+    """ % (db_key_name,))]
+    now = datetime.datetime.utcnow()
+    connection.execute(table.insert(), [
+        {'MachineID': machine_id, 'Generation': 1, 'ModifiedTime': now}
+        for machine_id in [None] + machine_ids])
+
+
+def upgrade_testsuite(engine, session, name):
+    # Grab Test Suite.
+    test_suite = session.query(upgrade_0_to_1.TestSuite).filter_by(
+        name=name).first()
+    assert (test_suite is not None)
+    db_key_name = test_suite.db_key_name
+
+    # Migrations are re-applied whenever a database is opened, so only create
+    # and fill the table if it is not there yet.
+    inspector = Inspector.from_engine(engine)
+    if "%s_DataGeneration" % db_key_name in inspector.get_table_names():
+        return
+
+    Base = add_data_generation(test_suite)
+
+    # Create tables. We commit now since databases like Postgres run
+    # into deadlocking issues due to previous queries that we have run
+    # during the upgrade process. The commit closes all of the
+    # relevant transactions allowing us to then perform our upgrade.
+    session.commit()
+    Base.metadata.create_all(engine)
+
+    backfill_data_generation(session, test_suite)
+
+    # Commit changes (also closing all relevant transactions with
+    # respect to Postgres like databases).
+    session.commit()
+
+
+def upgrade(engine, cb_testsuites):
+    # Create a session.
+    session = sqlalchemy.orm.sessionmaker(engine)()
+
+    for testsuite in cb_testsuites:
+        try:
+            upgrade_testsuite(engine, session, testsuite['name'])
+        except Exception as e:
+            print(e)
+            session.rollback()
@@ -0,0 +1,23 @@
+# Version 19 adds the Submission table, which records the submissions imported
+# in the background (see lnt.server.db.submissions).
+
+import sqlalchemy
+from sqlalchemy import *
+
+Base = sqlalchemy.ext.declarative.declarative_base()
+
+
+class Submission(Base):
+    __tablename__ = 'Submission'
+
+    id = Column("ID", Integer, primary_key=True)
+    path = Column("Path", String(1024))
+    commit = Column("Commit", Integer)
+    state = Column("State", String(32))
+    created_time = Column("CreatedTime", DateTime)
+    finished_time = Column("FinishedTime", DateTime)
+    result_data = Column("Result", Text)
+
+
+def upgrade(engine, cb_testsuites):
+    Base.metadata.create_all(engine)
@@ -0,0 +1,25 @@
+# Version 20 adds the GerritChange table, which caches the Gerrit changes of
+# the commits of the runs (see lnt.server.db.gerrit).
+
+import sqlalchemy
+from sqlalchemy import *
+
+Base = sqlalchemy.ext.declarative.declarative_base()
+
+
+class GerritChange(Base):
+    __tablename__ = 'GerritChange'
+
+    id = Column("ID", Integer, primary_key=True)
+    sha = Column("Sha", String(256))
+    state = Column("State", String(32))
+    change_id = Column("ChangeID", String(256))
+    data = Column("Data", Text)
+    created_time = Column("CreatedTime", DateTime)
+    resolved_time = Column("ResolvedTime", DateTime)
+
+Index("ix_GerritChange_Sha", GerritChange.sha, unique=True)
+
+
+def upgrade(engine, cb_testsuites):
+    Base.metadata.create_all(engine)
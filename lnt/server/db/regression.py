@@ -28,13 +28,18 @@ class RegressionState:
              DETECTED_FIXED: u'Verify',
              FIXED: u'Fixed'
              }
+    # The states of the regressions new changes can be added to.
+    open_states = [DETECTED, STAGED, ACTIVE, DETECTED_FIXED]
 
 ChangeRuns = namedtuple("ChangeRuns", ["before", "after"])
 ChangeData = namedtuple("ChangeData", ["ri", "cr", "run", "latest_cr"])
 
 
-def new_regression(ts, field_changes):
-    """Make a new regression and add to DB."""
+def new_regression(ts, field_changes, commit=True):
+    """Make a new regression and add to DB.
+
+    With commit=False, the regression is only flushed, and is committed with
+    the rest of the transaction of the caller."""
     today = datetime.date.today()
     MSG = "Regression of 0 benchmarks"
     title = MSG
@@ -44,8 +49,11 @@ def new_regression(ts, field_changes):
         fc = get_fieldchange(ts, fc_id)
         ri1 = ts.RegressionIndicator(regression, fc)
         ts.add(ri1)
+    # The title is built from the indicators in the database.
+    ts.session.flush()
     rebuild_title(ts, regression)
-    ts.commit()
+    if commit:
+        ts.commit()
     return regression
     
     
@@ -79,7 +87,7 @@ def get_all_orders_for_machine(ts, machine):
     return ts.query(ts.Order) \
         .join(ts.Run) \
         .filter(ts.Run.machine_id == machine) \
-        .order_by(asc(ts.Order.llvm_project_revision)) \
+        .order_by(asc(ts.Order.rank), asc(ts.Order.id)) \
         .all()
 
 
@@ -140,6 +148,50 @@ def get_cr_for_field_change(ts, field_change, current=False):
     return cr, runs.after[0], runs_all
 
 
+def get_current_crs_for_field_changes(ts, field_changes):
+    """Calculate the comparison results of many field changes against the
+    latest runs of their machines, loading all the samples at once.
+
+    Returns a dict of the comparison results by field change id."""
+    # Find the latest order of each machine.
+    latest_orders = {}
+    for machine_id in set(fc.machine_id for fc in field_changes):
+        latest = ts.query(ts.MachineOrder.order_id) \
+            .filter(ts.MachineOrder.machine_id == machine_id) \
+            .order_by(desc(ts.MachineOrder.rank),
+                      desc(ts.MachineOrder.order_id)) \
+            .first()
+        if latest is not None:
+            latest_orders[machine_id] = latest[0]
+
+    # Load the runs at the start orders and latest orders of the changes.
+    wanted = set()
+    for fc in field_changes:
+        wanted.add((fc.machine_id, fc.start_order_id))
+        if fc.machine_id in latest_orders:
+            wanted.add((fc.machine_id, latest_orders[fc.machine_id]))
+    runs = {}
+    if wanted:
+        for run in ts.query(ts.Run) \
+                .filter(ts.Run.machine_id.in_(set(m for m, _ in wanted))) \
+                .filter(ts.Run.order_id.in_(set(o for _, o in wanted))):
+            if (run.machine_id, run.order_id) in wanted:
+                runs.setdefault((run.machine_id, run.order_id), []).append(run)
+
+    run_ids = [r.id for machine_runs in runs.values() for r in machine_runs]
+    ri = RunInfo(ts, run_ids,
+                 only_tests=list(set(fc.test_id for fc in field_changes)))
+    crs = {}
+    for fc in field_changes:
+        before = runs.get((fc.machine_id, fc.start_order_id), [])
+        after = runs.get((fc.machine_id, latest_orders.get(fc.machine_id)),
+                         [])
+        crs[fc.id] = ri.get_comparison_result(
+            after, before, fc.test_id, fc.field,
+            ts.Sample.get_hash_of_binary_field())
+    return crs
+
+
 def get_fieldchange(ts, fc_id):
     """Get a fieldchange given an ID."""
     return ts.query(ts.FieldChange).filter(ts.FieldChange.id == fc_id).one()
@@ -2,28 +2,37 @@
 Detcted + fixed -> Ignored
 Staged or Active + fixed -> Verify
 """
+from sqlalchemy import distinct
 from lnt.server.db.regression import RegressionState
-from lnt.server.db.regression import get_cr_for_field_change, get_ris
+from lnt.server.db.regression import get_current_crs_for_field_changes
 from lnt.testing.util.commands import note, timed
 
-def _fixed_rind(ts, rind):
-    """Is this regression indicator fixed?"""
-    fc = rind.field_change
-    if fc is None:
-        return False
-    current_cr, _, _ = get_cr_for_field_change(ts, fc, current=True)
-    if current_cr.pct_delta < 0.01:
-        return True
-    else:
-        return False
+# The states of the regressions which are checked for fixes, and the state
+# a fixed regression moves to.
+FIXED_STATES = {RegressionState.DETECTED: RegressionState.IGNORED,
+                RegressionState.STAGED: RegressionState.DETECTED_FIXED,
+                RegressionState.ACTIVE: RegressionState.DETECTED_FIXED}
+
+FIXED_NAMES = {RegressionState.DETECTED: "Detected",
+               RegressionState.STAGED: "Staged",
+               RegressionState.ACTIVE: "Active"}
 
-def is_fixed(ts, regression):
-    """Comparing the current value to the regression, is this regression now
-    fixed?
-    """
-    r_inds = get_ris(ts, regression)
-    fixes = [_fixed_rind(ts, x) for x in r_inds]
-    return all(fixes)
+
+def _affected_regressions(ts, run):
+    """Get the regressions which may have been fixed by this run: the ones
+    with changes of the tests of its machine."""
+    run_tests = ts.query(ts.Sample.test_id) \
+        .filter(ts.Sample.run_id == run.id)
+    regression_ids = ts.query(distinct(ts.RegressionIndicator.regression_id)) \
+        .join(ts.FieldChange,
+              ts.RegressionIndicator.field_change_id == ts.FieldChange.id) \
+        .filter(ts.FieldChange.machine_id == run.machine_id) \
+        .filter(ts.FieldChange.test_id.in_(run_tests.subquery()))
+    return ts.query(ts.Regression) \
+        .filter(ts.Regression.state.in_(FIXED_STATES.keys())) \
+        .filter(ts.Regression.id.in_(regression_ids.subquery())) \
+        .order_by(ts.Regression.id) \
+        .all()
 
 
 @timed
@@ -33,39 +42,43 @@ def regression_evolution(ts, run_id):
     Look at each regression in state stage. Move to verify if fixed.
     Look at regressions in detect, do they match our policy? If no, move to NTBF.
 
+    Only the regressions with changes of the machine and tests of the
+    submitted run can have been fixed by it, so the others are skipped.
     """
     note("Running regression evolution")
-    changed = 0
-    regressions = ts.query(ts.Regression).all()
-    detects = [r for r in regressions if r.state == RegressionState.DETECTED]
-    
-    for regression in detects:
-        if is_fixed(ts, regression):
-            note("Detected fixed regression" + str(regression))
-            regression.state = RegressionState.IGNORED
-            regression.title = regression.title + " [Detected Fixed]"
-            changed += 1
-    ts.commit()
+    run = ts.getRun(run_id)
+    num_open = ts.query(ts.Regression) \
+        .filter(ts.Regression.state.in_(FIXED_STATES.keys())) \
+        .count()
+    regressions = _affected_regressions(ts, run)
 
-    staged = [r for r in regressions if r.state == RegressionState.STAGED]
-    
-    for regression in staged:
-        if is_fixed(ts, regression):
-            note("Staged fixed regression" + str(regression))
-            regression.state = RegressionState.DETECTED_FIXED
-            regression.title = regression.title + " [Detected Fixed]"
-            changed += 1
-    ts.commit()
-    
-    active = [r for r in regressions if r.state == RegressionState.ACTIVE]
-    
-    for regression in active:
-        if is_fixed(ts, regression):
-            note("Active fixed regression" + str(regression))
-            regression.state = RegressionState.DETECTED_FIXED
+    # Compare the changes of all these regressions to the latest runs at once.
+    indicators = {}
+    if regressions:
+        for ri in ts.query(ts.RegressionIndicator) \
+                .filter(ts.RegressionIndicator.regression_id.in_(
+                    [r.id for r in regressions])):
+            indicators.setdefault(ri.regression_id, []).append(ri)
+    field_changes = [ri.field_change for ris in indicators.values()
+                     for ri in ris if ri.field_change is not None]
+    crs = {}
+    if field_changes:
+        crs = get_current_crs_for_field_changes(ts, field_changes)
+
+    changed = 0
+    for regression in regressions:
+        fixed = all(ri.field_change is not None and
+                    crs[ri.field_change_id].pct_delta < 0.01
+                    for ri in indicators.get(regression.id, []))
+        if fixed:
+            note(FIXED_NAMES[regression.state] + " fixed regression" +
+                 str(regression))
+            regression.state = FIXED_STATES[regression.state]
             regression.title = regression.title + " [Detected Fixed]"
             changed += 1
     ts.commit()
+    note("Re-evaluated {} regressions, skipped {}".format(
+        len(regressions), num_open - len(regressions)))
     note("Changed the state of {} regressions".format(changed))
-    
+
 post_submission_hook = regression_evolution
@@ -55,7 +55,9 @@ def _naive_search_for_run(ts, query, num_results, default_machine):
         oq = '%' + str(order_queries[0]) + '%'
         q = q.filter(llvm_project_revision_col.like(oq))            
 
-    return q.order_by(llvm_project_revision_col.desc()).limit(num_results).all()
+    # Sort by the integer revision, not the string.
+    return q.order_by(ts.Order.rank.desc(), ts.Order.id.desc()) \
+        .limit(num_results).all()
         
         
 def search(ts, query,
@@ -0,0 +1,133 @@
+"""
+Submissions imported in the background.
+
+An asynchronous submission is staged by writing it to the temporary directory,
+and recording it as a row of the Submission table along with the job which
+imports it (see lnt.server.db.jobs), in one transaction, so it is not lost if
+the server stops before importing it. The submitter is answered right away with
+the id of the submission, and polls its state (see the /submission/<id> page)
+until the import finished, and its result was recorded. The submissions are
+kept as long as the jobs which imported them (see prune).
+"""
+
+import datetime
+import json
+import sys
+import traceback
+
+from sqlalchemy import Column, Integer, String, Text, DateTime
+
+from lnt.server.db import jobs
+from lnt.server.db import testsuite
+from lnt.testing.util.commands import error
+
+# The submission states. A submission is queued until a worker starts
+# importing it, and done once the result of the import is recorded (whether the
+# import succeeded or not).
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+STATES = (QUEUED, RUNNING, DONE)
+
+
+class Submission(testsuite.Base):
+    __tablename__ = 'Submission'
+
+    id = Column("ID", Integer, primary_key=True)
+    # The staged file, and whether its run should be committed.
+    path = Column("Path", String(1024))
+    commit = Column("Commit", Integer)
+    state = Column("State", String(32))
+    created_time = Column("CreatedTime", DateTime)
+    finished_time = Column("FinishedTime", DateTime)
+    # The result of the import, encoded as JSON.
+    result_data = Column("Result", Text)
+
+    def __init__(self, path, commit):
+        self.path = path
+        self.commit = int(bool(commit))
+        self.state = QUEUED
+        self.created_time = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return '%s%r' % (self.__class__.__name__,
+                         (self.id, self.path, self.state))
+
+    @property
+    def result(self):
+        if self.result_data is None:
+            return None
+        return json.loads(self.result_data)
+
+    @result.setter
+    def result(self, value):
+        self.result_data = json.dumps(value)
+
+
+def stage(db, db_name, path, commit, batch=False):
+    """Record the submission of the file at path, and queue its import.
+
+    The file is a batch of reports (see lnt.util.ImportData.import_batch) if
+    batch is set. The submission is added to the session of the database, and
+    is committed along with the rest of the transaction of the caller.
+    """
+    submission = Submission(path, commit)
+    db.add(submission)
+    # Get the id of the submission.
+    db.session.flush()
+    # Imports are not about a test suite until the file is read.
+    arguments = {'db_name': db_name, 'submission_id': submission.id}
+    if batch:
+        arguments['batch'] = True
+    jobs.enqueue(db, 'import_submission', None, submission.id, arguments)
+    return submission
+
+
+def import_submission(db, db_name, submission_id, batch=False):
+    """Import a staged submission, and record the result.
+
+    A submission which fails to import is done as well, with the error as its
+    result, as the import would fail again.
+    """
+    # Imported here, as importing the data requires most of LNT.
+    import lnt.util.ImportData
+
+    submission = db.query(Submission).get(submission_id)
+    submission.state = RUNNING
+    db.commit()
+    # The formats take paths as (byte) strings.
+    path, commit = str(submission.path), bool(submission.commit)
+
+    try:
+        # The worker importing the submission runs the jobs it queues.
+        if batch:
+            result = lnt.util.ImportData.import_batch(
+                db.config, db_name, db, path, commit, run_jobs=False)
+        else:
+            result = lnt.util.ImportData.import_and_report(
+                db.config, db_name, db, path, '<auto>', commit, run_jobs=False)
+    except Exception:
+        message = "".join(traceback.format_exception(*sys.exc_info()))
+        error("Import of submission %d failed with:%s" % (submission_id,
+                                                          message))
+        db.rollback()
+        result = {'success': False, 'import_file': path,
+                  'error': "import failure: %s" % message}
+
+    submission = db.query(Submission).get(submission_id)
+    submission.result = result
+    submission.state = DONE
+    submission.finished_time = datetime.datetime.utcnow()
+    db.commit()
+
+
+def prune(db, retention_days=jobs.RETENTION_DAYS):
+    """Remove the submissions which were done importing more than
+    retention_days ago. Returns the number of submissions removed."""
+    cutoff = datetime.datetime.utcnow() - \
+        datetime.timedelta(days=retention_days)
+    count = db.query(Submission).filter(Submission.state == DONE,
+                                        Submission.finished_time < cutoff).\
+        delete(synchronize_session=False)
+    db.commit()
+    return count
@@ -5,18 +5,23 @@ These are a bit magical because the models themselves are driven by the test
 suite metadata, so we only create the classes at runtime.
 """
 
+import bisect
 import datetime
+import hashlib
 import json
 import os
-import urllib2
+import threading
 from collections import OrderedDict
 
 import sqlalchemy
 from sqlalchemy import *
 
 import testsuite
+import lnt.server.db.gerrit
+import lnt.server.reporting.analysis
 import lnt.testing.profile.profile as profile
-from lnt.testing.util.commands import fatal
+import lnt.util.stats
+from lnt.testing import PASS
 
 
 def strip(obj):
@@ -37,20 +42,87 @@ class TestSuiteDB(object):
     through the model classes constructed by this wrapper object.
     """
 
+    # The model classes generated for each test suite, by database path, test
+    # suite name and version. Generating them takes far longer than the
+    # queries of a typical request, so they are generated once per process and
+    # shared by all the sessions of the database.
+    _models_lock = threading.Lock()
+    _models = {}
+
+    # The attributes holding the generated model classes and the fields they
+    # are made of.
+    _model_attributes = (
+        'machine_fields', 'order_fields', 'run_fields', 'sample_fields',
+        'cv_order_fields', 'cv_run_fields', 'cv_sample_fields', 'base',
+        'Machine', 'Run', 'MachineOrder', 'Test', 'Profile', 'Sample', 'Order',
+        'CVOrder', 'CVRun', 'CVSample', 'FieldChange', 'TestStability',
+        'SampleRollup', 'OrderGeomean', 'DataGeneration', 'Regression',
+        'RegressionIndicator', 'ChangeIgnore', 'Gerrit', 'CVGerrit')
+
     def __init__(self, v4db, name, test_suite):
-        testsuitedb = self
         self.v4db = v4db
         self.name = name
         self.test_suite = test_suite
 
+        key = (v4db.path, name, test_suite.version)
+        with TestSuiteDB._models_lock:
+            models = TestSuiteDB._models.get(key)
+            if models is None:
+                self._create_models()
+                models = dict((attr, getattr(self, attr))
+                              for attr in TestSuiteDB._model_attributes)
+                TestSuiteDB._models[key] = models
+        self.__dict__.update(models)
+
+        # Add several shortcut aliases, similar to the ones on the v4db.
+        self.session = self.v4db.session
+        self.add = self.v4db.add
+        self.delete = self.v4db.delete
+        self.commit = self.v4db.commit
+        self.query = self.v4db.query
+        self.rollback = self.v4db.rollback
+
+    @staticmethod
+    def invalidate_models(path=None, name=None):
+        """Forget the model classes generated for the test suite name (or all
+        of them) of the database at path (or of all databases), so they are
+        generated again. This must be done when the fields of a test suite
+        change."""
+        with TestSuiteDB._models_lock:
+            for key in TestSuiteDB._models.keys():
+                if path not in (None, key[0]) or name not in (None, key[1]):
+                    continue
+                del TestSuiteDB._models[key]
+
+    def _load_fields(self):
+        """Load the fields of the test suite, in a session of their own: they
+        are shared by every session using the models, so must not belong to
+        any of them."""
+        session = sqlalchemy.orm.sessionmaker(self.v4db.engine)()
+        try:
+            test_suite = session.query(testsuite.TestSuite). \
+                filter(testsuite.TestSuite.name == self.name).one()
+            fields = dict((attr, list(getattr(test_suite, attr)))
+                          for attr in ('machine_fields', 'order_fields',
+                                       'run_fields', 'sample_fields',
+                                       'cv_order_fields', 'cv_run_fields',
+                                       'cv_sample_fields'))
+            # Load the relations of the sample fields while we can.
+            for field in fields['sample_fields'] + fields['cv_sample_fields']:
+                field.type
+                field.status_field
+            session.expunge_all()
+        finally:
+            session.close()
+        return fields
+
+    def _create_models(self):
+        """Generate the model classes of the test suite."""
+        testsuitedb = self
+        suite_name = self.name
+
         # Save caches of the various fields.
-        self.machine_fields = list(self.test_suite.machine_fields)
-        self.order_fields = list(self.test_suite.order_fields)
-        self.run_fields = list(self.test_suite.run_fields)
-        self.sample_fields = list(self.test_suite.sample_fields)
-        self.cv_order_fields = list(self.test_suite.cv_order_fields)
-        self.cv_run_fields = list(self.test_suite.cv_run_fields)
-        self.cv_sample_fields = list(self.test_suite.cv_sample_fields)
+        self.__dict__.update(self._load_fields())
         for i,field in enumerate(self.sample_fields):
             field.index = i
 
@@ -58,9 +130,15 @@ class TestSuiteDB(object):
 
         # Create parameterized model classes for this test suite.
         class ParameterizedMixin(object):
-            # Class variable to allow finding the associated test suite from
-            # model instances.
-            testsuite = self
+            # Property to allow finding the associated test suite from model
+            # instances: the TestSuiteDB of the session they belong to, as the
+            # model classes are shared by all the sessions.
+            @property
+            def testsuite(self):
+                session = sqlalchemy.orm.object_session(self)
+                if session is None:
+                    return None
+                return session.info['v4db'].testsuite[suite_name]
 
             # Class variable (expected to be defined by subclasses) to allow
             # easy access to the field list for parameterized model classes.
@@ -76,12 +154,12 @@ class TestSuiteDB(object):
                 return setattr(self, field, value)
 
         db_key_name = self.test_suite.db_key_name
+        sample_fields_by_id = dict((field.id, field)
+                                   for field in self.sample_fields)
 
         class Machine(self.base, ParameterizedMixin):
             __tablename__ = db_key_name + '_Machine'
 
-            DEFAULT_BASELINE_REVISION = self.v4db.baseline_revision
-
             fields = self.machine_fields
             id = Column("ID", Integer, primary_key=True)
             name = Column("Name", String(256), index=True)
@@ -119,7 +197,7 @@ class TestSuiteDB(object):
                 self.parameters_data = json.dumps(sorted(data.items()))
 
             def get_baseline_run(self):
-                baseline = Machine.DEFAULT_BASELINE_REVISION
+                baseline = self.testsuite.v4db.baseline_revision
                 return self.get_closest_previously_reported_run(baseline)
 
             def get_closest_previously_reported_run(self, revision):
@@ -131,7 +209,7 @@ class TestSuiteDB(object):
                 # FIXME: Scalability! Pretty fast in practice, but
                 # still pretty lame.
 
-                ts = Machine.testsuite
+                ts = self.testsuite
 
                 # If we have an int, convert it to a proper string.
                 if isinstance(revision, int):
@@ -182,6 +260,11 @@ class TestSuiteDB(object):
             previous_order_id = Column("PreviousOrder", Integer, ForeignKey(
                     "%s.ID" % __tablename__))
 
+            # The position of this order in the total ordering, used to find
+            # the neighbours of an order without loading every order. Orders
+            # with the same rank are ordered by ID.
+            rank = Column("Rank", Integer, index=True)
+
             # This will implicitly create the previous_order relation.
             next_order = sqlalchemy.orm.relation("Order",
                                                  backref=sqlalchemy.orm.backref('previous_order',
@@ -272,6 +355,9 @@ class TestSuiteDB(object):
 
             id = Column("ID", Integer, primary_key=True)
 
+            # The position of this order in the total ordering, as for Order.
+            rank = Column("Rank", Integer, index=True)
+
             # Dynamically create fields for all of the test suite defined order
             # fields.
             class_dict = locals()
@@ -404,6 +490,31 @@ class TestSuiteDB(object):
                 self.order
                 return strip(self.__dict__)
 
+        class MachineOrder(self.base, ParameterizedMixin):
+            """The orders a machine has reported runs at.
+
+            This keeps a copy of the order rank, so that the orders adjacent
+            to a run on the same machine can be found with a bounded index
+            scan."""
+
+            __tablename__ = db_key_name + '_MachineOrder'
+            id = Column("ID", Integer, primary_key=True)
+            machine_id = Column("MachineID", Integer, ForeignKey(Machine.id))
+            order_id = Column("OrderID", Integer, ForeignKey(Order.id))
+            rank = Column("Rank", Integer)
+
+            machine = sqlalchemy.orm.relation(Machine)
+            order = sqlalchemy.orm.relation(Order)
+
+            def __init__(self, machine, order):
+                self.machine = machine
+                self.order = order
+                self.rank = order.rank
+
+            def __repr__(self):
+                return '%s_%s%r' % (db_key_name, self.__class__.__name__,
+                                    (self.machine, self.order))
+
         class Test(self.base, ParameterizedMixin):
             __tablename__ = db_key_name + '_Test'
 
@@ -739,7 +850,7 @@ class TestSuiteDB(object):
             machine_id = Column("MachineID", Integer,
                                 ForeignKey("%s_Machine.ID" % db_key_name))
             field_id = Column("FieldID", Integer,
-                              ForeignKey(self.v4db.SampleField.id))
+                              ForeignKey(testsuite.SampleField.id))
             # Could be from many runs, but most recent one is interesting.
             run_id = Column("RunID", Integer,
                                 ForeignKey("%s_Run.ID" % db_key_name))
@@ -752,12 +863,18 @@ class TestSuiteDB(object):
                                                 'end_order_id==Order.id')
             test = sqlalchemy.orm.relation(Test)
             machine = sqlalchemy.orm.relation(Machine)
-            field = sqlalchemy.orm.relation(self.v4db.SampleField,
-                                            primaryjoin= \
-                                              self.v4db.SampleField.id == \
-                                              field_id)
             run = sqlalchemy.orm.relation(Run)
 
+            # The fields are shared by all the sessions, so they are looked up
+            # rather than loaded.
+            @property
+            def field(self):
+                return sample_fields_by_id.get(self.field_id)
+
+            @field.setter
+            def field(self, field):
+                self.field_id = field.id
+
             def __init__(self, start_order, end_order, machine,
                          test, field):
                 self.start_order = start_order
@@ -774,12 +891,130 @@ class TestSuiteDB(object):
             def __json__(self):
                 self.machine
                 self.test
-                self.field
                 self.run
                 self.start_order
                 self.end_order
-                return strip(self.__dict__)
+                result = strip(self.__dict__)
+                result['field'] = self.field
+                return result
+
+        class TestStability(self.base, ParameterizedMixin):
+            """The stability of a test on a machine for a metric field, as
+            of the latest order the machine has samples of the test at.
+
+            This is kept up to date as runs are imported and field changes
+            are created and removed, so the stability of all the tests of a
+            run can be read with a single query."""
+
+            __tablename__ = db_key_name + '_TestStability'
+            id = Column("ID", Integer, primary_key=True)
+            machine_id = Column("MachineID", Integer, ForeignKey(Machine.id))
+            test_id = Column("TestID", Integer, ForeignKey(Test.id))
+            field_id = Column("FieldID", Integer,
+                              ForeignKey(testsuite.SampleField.id))
+            # The first and latest runs with samples of the test.
+            first_run_id = Column("FirstRunID", Integer)
+            last_run_id = Column("LastRunID", Integer)
+            # The rank of the latest order with samples of the test, and the
+            # number of orders with samples of the test.
+            last_rank = Column("LastRank", Integer)
+            num_orders = Column("NumOrders", Integer)
+            # The rank of the latest end order of the field changes of the
+            # test, and the number of orders with samples of the test after
+            # it.
+            change_rank = Column("ChangeRank", Integer)
+            orders_since_change = Column("OrdersSinceChange", Integer)
+
+            def __repr__(self):
+                return '%s_%s%r' % (db_key_name, self.__class__.__name__,
+                                    (self.machine_id, self.test_id,
+                                     self.field_id))
+
+            def is_stable(self, stability_threshold):
+                """Is the test stable at the latest order, i.e., has it
+                samples at (at least) stability_threshold orders and no field
+                change ending within the latest stability_threshold + 1 of
+                them?"""
+                if self.num_orders < stability_threshold:
+                    return False
+                return (self.change_rank is None or
+                        self.orders_since_change > stability_threshold)
+
+        class SampleRollup(self.base, ParameterizedMixin):
+            """The summary of the samples of a test on a machine for a metric
+            field at an order, over all the runs at the order, leaving out the
+            samples of failing tests.
+
+            This is kept up to date as runs are imported and removed, so the
+            graphs and trends of long histories can be drawn from a row per
+            order rather than from every sample."""
+
+            __tablename__ = db_key_name + '_SampleRollup'
+            id = Column("ID", Integer, primary_key=True)
+            machine_id = Column("MachineID", Integer, ForeignKey(Machine.id))
+            test_id = Column("TestID", Integer, ForeignKey(Test.id))
+            field_id = Column("FieldID", Integer,
+                              ForeignKey(testsuite.SampleField.id))
+            order_id = Column("OrderID", Integer, ForeignKey(Order.id))
+            # The run of the median sample (the upper one, for an even number
+            # of samples).
+            run_id = Column("RunID", Integer, ForeignKey(Run.id))
+            num_samples = Column("NumSamples", Integer)
+            min = Column("Min", Float)
+            median = Column("Median", Float)
+            mean = Column("Mean", Float)
+            # The median absolute deviation from the median.
+            mad = Column("MAD", Float)
+
+            def __repr__(self):
+                return '%s_%s%r' % (db_key_name, self.__class__.__name__,
+                                    (self.machine_id, self.test_id,
+                                     self.field_id, self.order_id))
+
+        class OrderGeomean(self.base, ParameterizedMixin):
+            """The geometric mean of the minimum passing sample of every test
+            of a machine for a metric field at an order, which the trend of
+            the machine is drawn from.
+
+            This is kept up to date along with the summaries of the samples
+            it is computed from."""
+
+            __tablename__ = db_key_name + '_OrderGeomean'
+            id = Column("ID", Integer, primary_key=True)
+            machine_id = Column("MachineID", Integer, ForeignKey(Machine.id))
+            field_id = Column("FieldID", Integer,
+                              ForeignKey(testsuite.SampleField.id))
+            order_id = Column("OrderID", Integer, ForeignKey(Order.id))
+            # The earliest run of the machine at the order.
+            run_id = Column("RunID", Integer, ForeignKey(Run.id))
+            num_tests = Column("NumTests", Integer)
+            geomean = Column("Geomean", Float)
+
+            def __repr__(self):
+                return '%s_%s%r' % (db_key_name, self.__class__.__name__,
+                                    (self.machine_id, self.field_id,
+                                     self.order_id))
+
+        class DataGeneration(self.base, ParameterizedMixin):
+            """The generation of the runs and field changes of a machine (or,
+            with no machine, of the whole test suite), which changes whenever
+            they do.
+
+            The pages about runs are cached by the generations of the machines
+            they show data of (see lnt.server.ui.cache). The generations are
+            drawn from the one of the test suite, which increases with every
+            change, so a generation is never reused, even by a machine
+            created again."""
 
+            __tablename__ = db_key_name + '_DataGeneration'
+            id = Column("ID", Integer, primary_key=True)
+            machine_id = Column("MachineID", Integer, ForeignKey(Machine.id))
+            generation = Column("Generation", Integer)
+            modified_time = Column("ModifiedTime", DateTime)
+
+            def __repr__(self):
+                return '%s_%s%r' % (db_key_name, self.__class__.__name__,
+                                    (self.machine_id, self.generation))
 
         class Regression(self.base, ParameterizedMixin):
             """Regession hold data about a set of RegressionIndicies."""
@@ -898,6 +1133,7 @@ class TestSuiteDB(object):
 
         self.Machine = Machine
         self.Run = Run
+        self.MachineOrder = MachineOrder
         self.Test = Test
         self.Profile = Profile
         self.Sample = Sample
@@ -906,6 +1142,10 @@ class TestSuiteDB(object):
         self.CVRun = CVRun
         self.CVSample = CVSample
         self.FieldChange = FieldChange
+        self.TestStability = TestStability
+        self.SampleRollup = SampleRollup
+        self.OrderGeomean = OrderGeomean
+        self.DataGeneration = DataGeneration
         self.Regression = Regression
         self.RegressionIndicator = RegressionIndicator
         self.ChangeIgnore = ChangeIgnore
@@ -916,6 +1156,35 @@ class TestSuiteDB(object):
         sqlalchemy.schema.Index("ix_%s_Sample_RunID_TestID" % db_key_name,
                                 Sample.run_id, Sample.test_id)
 
+        # Create the indices used to find the orders adjacent to a run.
+        sqlalchemy.schema.Index("ix_%s_MachineOrder_Unique" % db_key_name,
+                                MachineOrder.machine_id,
+                                MachineOrder.order_id, unique=True)
+        sqlalchemy.schema.Index("ix_%s_MachineOrder_Rank" % db_key_name,
+                                MachineOrder.machine_id, MachineOrder.rank,
+                                MachineOrder.order_id)
+        sqlalchemy.schema.Index("ix_%s_Run_MachineID_OrderID" % db_key_name,
+                                Run.machine_id, Run.order_id)
+
+        # Create the index the stability of the tests is looked up with.
+        sqlalchemy.schema.Index("ix_%s_TestStability_Unique" % db_key_name,
+                                TestStability.machine_id,
+                                TestStability.test_id,
+                                TestStability.field_id, unique=True)
+
+        # Create the index the summaries of the samples are looked up with.
+        sqlalchemy.schema.Index("ix_%s_SampleRollup_Unique" % db_key_name,
+                                SampleRollup.machine_id, SampleRollup.test_id,
+                                SampleRollup.field_id, SampleRollup.order_id,
+                                unique=True)
+        sqlalchemy.schema.Index("ix_%s_OrderGeomean_Unique" % db_key_name,
+                                OrderGeomean.machine_id, OrderGeomean.field_id,
+                                OrderGeomean.order_id, unique=True)
+
+        # Create the index the data generations are looked up with.
+        sqlalchemy.schema.Index("ix_%s_DataGeneration_MachineID" % db_key_name,
+                                DataGeneration.machine_id, unique=True)
+
         # Create the index we use to ensure machine uniqueness.
         args = [Machine.name, Machine.parameters_data]
         for item in self.machine_fields:
@@ -923,13 +1192,18 @@ class TestSuiteDB(object):
         sqlalchemy.schema.Index("ix_%s_Machine_Unique" % db_key_name,
                                 *args, unique = True)
 
-        # Add several shortcut aliases, similar to the ones on the v4db.
-        self.session = self.v4db.session
-        self.add = self.v4db.add
-        self.delete = self.v4db.delete
-        self.commit = self.v4db.commit
-        self.query = self.v4db.query
-        self.rollback = self.v4db.rollback
+    def _get_import_cache(self, kind):
+        """
+        _get_import_cache(kind) -> dict or None
+
+        Get the cache of the records of the given kind looked up by the
+        imports, if the database is importing a batch of reports (see
+        V4DB.import_caching), or None.
+        """
+        caches = self.v4db.import_caches
+        if caches is None:
+            return None
+        return caches.setdefault((self.name, kind), {})
 
     def _getOrCreateMachine(self, machine_data):
         """
@@ -972,14 +1246,24 @@ class TestSuiteDB(object):
         query = query.filter(self.Machine.parameters_data ==
                              machine.parameters_data)
 
+        cache = self._get_import_cache('machines')
+        if cache is not None:
+            key = (machine.name, machine.parameters_data) + tuple(
+                machine.get_field(item) for item in self.machine_fields)
+            if key in cache:
+                return cache[key],False
+
         # Execute the query to see if we already have this machine.
         try:
-            return query.one(),False
+            machine,inserted = query.one(),False
         except sqlalchemy.orm.exc.NoResultFound:
             # If not, add the machine.
             self.add(machine)
+            inserted = True
 
-            return machine,True
+        if cache is not None:
+            cache[key] = machine
+        return machine,inserted
 
     def _getOrCreateOrder(self, run_parameters, cv=False):
         """
@@ -1020,63 +1304,92 @@ class TestSuiteDB(object):
             query = query.filter(item.column == value)
             order.set_field(item, value)
 
+        cache = self._get_import_cache('orders')
+        if cache is not None:
+            key = (cv,) + tuple(order.get_field(item) for item in order_fields)
+            if key in cache:
+                return cache[key],False
+
         # Execute the query to see if we already have this order.
         try:
-            return query.one(),False
+            order = query.one()
+            if cache is not None:
+                cache[key] = order
+            return order,False
         except sqlalchemy.orm.exc.NoResultFound:
             # If not, then we need to insert this order into the total ordering
             # linked list.
+            order.rank = self._get_order_rank(order)
 
-            # Add the new order and commit, to assign an ID.
+            # Add the new order and commit, to assign an ID. Imports of
+            # batches only flush it, as they commit (or roll back) the runs of
+            # their reports together.
             self.add(order)
-            self.v4db.session.commit()
-
-            # Load all the orders.
-            orders = list(self.query(order_type))
-
-            # Sort the objects to form the total ordering.
-            orders.sort()
-
-            # Find the order we just added.
-            index = orders.index(order)
+            if self.v4db.import_caches is not None:
+                self.v4db.session.flush()
+            else:
+                self.v4db.session.commit()
 
             # Insert this order into the linked list which forms the total
             # ordering.
             if not cv:
-                if index > 0:
-                    previous_order = orders[index - 1]
+                previous_order = self._get_predecessor_order(order)
+                if previous_order is not None:
                     previous_order.next_order_id = order.id
                     order.previous_order_id = previous_order.id
-                if index + 1 < len(orders):
-                    next_order = orders[index + 1]
+                next_order = self._get_successor_order(order)
+                if next_order is not None:
                     next_order.previous_order_id = order.id
                     order.next_order_id = next_order.id
 
+            if cache is not None:
+                cache[key] = order
             return order,True
 
-    def _getOrCreateGerrit(self, order, run_parameters, cv=False):
+    @staticmethod
+    def _get_order_rank(order):
+        """
+        _get_order_rank(order) -> int
 
-        def get_gerrit_id_for_sha(sha):
-            url = 'http://review.couchbase.org/changes/{}'.format(sha)
+        Compute the rank of an order, which must agree with Order.__cmp__.
+        """
+        return int(order.llvm_project_revision)
 
-            try:
-                response = urllib2.urlopen(url).read()
-            except Exception:
-                fatal('failed to get parent commit from {}')
-                raise
+    def _get_predecessor_order(self, order):
+        """
+        _get_predecessor_order(order) -> Order or None
 
-            start_index = response.index('{')
-            response = response[start_index:]
+        Return the order immediately preceding the given (ranked) order in the
+        total ordering.
+        """
+        return self.query(self.Order).\
+            filter(or_(self.Order.rank < order.rank,
+                       and_(self.Order.rank == order.rank,
+                            self.Order.id < order.id))).\
+            order_by(self.Order.rank.desc(), self.Order.id.desc()).first()
+
+    def _get_successor_order(self, order):
+        """
+        _get_successor_order(order) -> Order or None
 
-            try:
-                json_response = json.loads(response)
-            except Exception:
-                fatal('Failed to decode Gerrit json response: {}'.format(
-                    response))
-                raise
+        Return the order immediately following the given (ranked) order in the
+        total ordering.
+        """
+        return self.query(self.Order).\
+            filter(or_(self.Order.rank > order.rank,
+                       and_(self.Order.rank == order.rank,
+                            self.Order.id > order.id))).\
+            order_by(self.Order.rank.asc(), self.Order.id.asc()).first()
 
-            return json_response["change_id"]
+    def _getOrCreateGerrit(self, order, run_parameters, cv=False):
+        """
+        _getOrCreateGerrit(order, run_parameters, cv=False) -> Gerrit, bool
 
+        Get or create the record of the Gerrit changes of the commits of an
+        order. The change ids are taken from the cache of the changes (see
+        lnt.server.db.gerrit); the ones which are not known yet are looked up
+        in the background, and filled in then.
+        """
         if cv:
             gerrit_type = self.CVGerrit
             gerrit_fields = [{"raw": "git_sha",
@@ -1088,23 +1401,21 @@ class TestSuiteDB(object):
             gerrit_fields = [{"raw": "git_sha",
                               "inserted": "gerrit_change_id"}]
 
-        query = self.query(gerrit_type)
-        gerrit = gerrit_type(order)
-        query.filter(gerrit_type.order == order)
+        gerrit = self.query(gerrit_type).filter(
+            gerrit_type.order_id == order.id).first()
+        if gerrit is not None:
+            return gerrit, False
 
+        gerrit = gerrit_type(order)
         for item in gerrit_fields:
-            if item["raw"] in run_parameters:
-                value = get_gerrit_id_for_sha(run_parameters.pop(item["raw"]))
+            sha = run_parameters.pop(item["raw"], None)
+            if sha:
+                value = lnt.server.db.gerrit.get_change_id(self.v4db, sha)
             else:
                 value = ''
-            query = query.filter(item["inserted"] == value)
             gerrit.set_field_by_name(item["inserted"], value)
-
-        try:
-            return query.one(), False
-        except sqlalchemy.orm.exc.NoResultFound:
-            self.add(gerrit)
-            return gerrit, True
+        self.add(gerrit)
+        return gerrit, True
 
     def backCreateGerrit(self, order, git_parameters, cv):
         return self._getOrCreateGerrit(order, git_parameters, cv)
@@ -1176,9 +1487,47 @@ class TestSuiteDB(object):
         except sqlalchemy.orm.exc.NoResultFound:
             # If not, add the run.
             self.add(run)
+            if not cv:
+                self._getOrCreateMachineOrder(machine, order)
 
             return run,True
 
+    def _getOrCreateMachineOrder(self, machine, order):
+        """
+        _getOrCreateMachineOrder(machine, order) -> MachineOrder, bool
+
+        Record that the machine has reported a run at the given order.
+
+        The boolean result indicates whether the returned record was constructed
+        or not.
+        """
+        # Flush, so that we see records (and machines) added in this session.
+        self.session.flush()
+        machine_order = self.query(self.MachineOrder).\
+            filter(self.MachineOrder.machine_id == machine.id).\
+            filter(self.MachineOrder.order_id == order.id).first()
+        if machine_order is not None:
+            return machine_order, False
+
+        machine_order = self.MachineOrder(machine, order)
+        self.add(machine_order)
+        return machine_order, True
+
+    def delete_unused_machine_orders(self):
+        """
+        delete_unused_machine_orders() -> int
+
+        Remove the records of machines reporting at orders for which they no
+        longer have any runs, e.g., after runs have been deleted. Returns the
+        number of removed records.
+        """
+        has_runs = sqlalchemy.sql.exists().\
+            where(self.Run.machine_id == self.MachineOrder.machine_id).\
+            where(self.Run.order_id == self.MachineOrder.order_id)
+        return self.query(self.MachineOrder).\
+            filter(sqlalchemy.not_(has_runs)).\
+            delete(synchronize_session=False)
+
     def _importSampleValues(self, tests_data, run, tag, commit, config, cv=False):
         # We now need to transform the old schema data (composite samples split
         # into multiple tests with mangling) into the V4DB format where each
@@ -1186,22 +1535,12 @@ class TestSuiteDB(object):
         tag_dot = "%s." % tag
         tag_dot_len = len(tag_dot)
 
-        # Load a map of all the tests, which we will extend when we find tests
-        # that need to be added.
-        test_cache = dict((test.name, test)
-                          for test in self.query(self.Test))
-
-        if cv:
-            sample_fields = self.cv_sample_fields
-            sample_type = self.CVSample
-        else:
-            sample_fields = self.sample_fields
-            sample_type = self.Sample
         # First, we aggregate all of the samples by test name. The schema allows
         # reporting multiple values for a test in two ways, one by multiple
         # samples and the other by multiple test entries with the same test
         # name. We need to handle both.
         tests_values = {}
+        profiles = {}
         for test_data in tests_data:
             if test_data['Info']:
                 raise ValueError("Test parameter sets are not supported by V4DB databases")
@@ -1216,7 +1555,50 @@ class TestSuiteDB(object):
             if values is None:
                 tests_values[name] = values = []
 
-            values.extend(test_data['Data'])
+            if not name.endswith('.profile'):
+                values.extend(test_data['Data'])
+                continue
+
+            # Save the profiles as the tests are read, rather than holding on
+            # to their (large) encoded form until all of them are read.
+            # Identical profiles share their record.
+            for encoded in test_data['Data']:
+                key = hashlib.sha1(encoded).hexdigest()
+                profile_record = profiles.get(key)
+                if profile_record is None:
+                    profiles[key] = profile_record = self.Profile(
+                        encoded, config, name[:-len('.profile')])
+                values.append(profile_record)
+
+        if config is not None and config.bulk_import:
+            self._importSampleValuesBulk(tests_values, run, config, cv=cv)
+        else:
+            self._importSampleValuesORM(tests_values, run, config, cv=cv)
+
+        if not cv:
+            self._updateTestStabilityForRun(run)
+            self._updateSampleRollupsForRun(run)
+
+    def _importSampleValuesORM(self, tests_values, run, config, cv=False):
+        """
+        Create the samples of the run, one model instance per sample.
+        """
+        # Load a map of all the tests, which we will extend when we find tests
+        # that need to be added. When importing a batch of reports, it is
+        # loaded once for the batch.
+        test_cache = self._get_import_cache('tests')
+        if test_cache is None:
+            test_cache = {}
+        if not test_cache:
+            test_cache.update((test.name, test)
+                              for test in self.query(self.Test))
+
+        if cv:
+            sample_fields = self.cv_sample_fields
+            sample_type = self.CVSample
+        else:
+            sample_fields = self.sample_fields
+            sample_type = self.Sample
 
         # Next, build a map of test name to sample values, by scanning all the
         # tests. This is complicated by the interchange's support of multiple
@@ -1226,20 +1608,8 @@ class TestSuiteDB(object):
         profiles = {}
         for name,test_samples in tests_values.items():
             # Map this reported test name into a test name and a sample field.
-            #
-            # FIXME: This is really slow.
-            if name.endswith('.profile'):
-                test_name = name[:-len('.profile')]
-                sample_field = 'profile'
-            else:
-                for item in sample_fields:
-                    if name.endswith(item.info_key):
-                        test_name = name[:-len(item.info_key)]
-                        sample_field = item
-                        break
-                else:
-                    # Disallow tests which do not map to a sample field.
-                    raise ValueError("test {} does not map to a sample field in the reported suite".format(name))
+            test_name, sample_field = self._splitSampleName(name,
+                                                            sample_fields)
 
             # Get or create the test.
             test = test_cache.get(test_name)
@@ -1257,9 +1627,114 @@ class TestSuiteDB(object):
                 if sample_field != 'profile':
                     sample.set_field(sample_field, value)
                 else:
-                    sample.profile = profiles.get(hash(value),
-                                                  self.Profile(value, config,
-                                                               test_name))
+                    sample.profile = value
+
+    def _splitSampleName(self, name, sample_fields):
+        """
+        _splitSampleName(name, sample_fields) -> (test_name, sample_field)
+
+        Map a reported (tag stripped) test name onto the test name and the
+        sample field it carries a value for. Profiles are reported with the
+        sample field 'profile'.
+        """
+        # FIXME: This is really slow.
+        if name.endswith('.profile'):
+            return name[:-len('.profile')], 'profile'
+
+        for item in sample_fields:
+            if name.endswith(item.info_key):
+                return name[:-len(item.info_key)], item
+
+        # Disallow tests which do not map to a sample field.
+        raise ValueError("test {} does not map to a sample field in the reported suite".format(name))
+
+    def _importSampleValuesBulk(self, tests_values, run, config, cv=False):
+        """
+        Bulk variant of the sample creation done by _importSampleValues.
+
+        Instead of building one model instance per sample and leaving the work
+        to the unit of work, we build plain row dictionaries and write each
+        table (tests, profiles, samples) with a single executemany.
+        """
+        if cv:
+            sample_fields = self.cv_sample_fields
+            sample_type = self.CVSample
+        else:
+            sample_fields = self.sample_fields
+            sample_type = self.Sample
+
+        # Build the sample rows keyed by (test name, sample index), as the ORM
+        # path does. Profiles are collected separately, as we need their IDs
+        # before the samples can reference them.
+        empty_row = dict((item.name, None) for item in sample_fields)
+        empty_row['ProfileID'] = None
+        sample_rows = {}
+        profile_records = {}
+        for name,test_samples in tests_values.items():
+            test_name, sample_field = self._splitSampleName(name,
+                                                            sample_fields)
+            for i, value in enumerate(test_samples):
+                record_key = (test_name, i)
+                row = sample_rows.get(record_key)
+                if row is None:
+                    sample_rows[record_key] = row = empty_row.copy()
+
+                if sample_field != 'profile':
+                    row[sample_field.name] = value
+                else:
+                    profile_records[record_key] = value
+
+        # Insert any tests we have not seen before, then look up the IDs of the
+        # new ones. When importing a batch of reports, the map of test names
+        # to IDs is loaded once for the batch.
+        test_ids = self._get_import_cache('test_ids')
+        if test_ids is None:
+            test_ids = {}
+        if not test_ids:
+            test_ids.update(self.query(self.Test.name, self.Test.id))
+        new_tests = set(test_name for test_name, _ in sample_rows
+                        if test_name not in test_ids)
+        if new_tests:
+            self.session.execute(self.Test.__table__.insert(),
+                                 [{'Name': test_name}
+                                  for test_name in sorted(new_tests)])
+            for q in self._filter_in_batches(
+                    self.query(self.Test.name, self.Test.id), self.Test.name,
+                    new_tests):
+                test_ids.update(q)
+
+        # Write out the profiles (saved as they were read, sharing the record
+        # between identical submissions). Every saved profile gets its own
+        # file, which we use to map the inserted rows back to their IDs.
+        if profile_records:
+            profile_rows = {}
+            for p in profile_records.values():
+                profile_rows[p.filename] = {'CreatedTime': p.created_time,
+                                            'AccessedTime': p.accessed_time,
+                                            'Filename': p.filename,
+                                            'Counters': p.counters}
+            self.session.execute(self.Profile.__table__.insert(),
+                                 profile_rows.values())
+
+            filenames = profile_rows.keys()
+            profile_ids = {}
+            for i in range(0, len(filenames), 500):
+                profile_ids.update(self.query(self.Profile.filename,
+                                              self.Profile.id).\
+                    filter(self.Profile.filename.in_(filenames[i:i+500])))
+            for record_key, p in profile_records.items():
+                sample_rows[record_key]['ProfileID'] = profile_ids[p.filename]
+
+        # We need the run ID for the sample rows.
+        self.session.flush()
+        for (test_name, _), row in sample_rows.items():
+            row['RunID'] = run.id
+            row['TestID'] = test_ids[test_name]
+
+        if sample_rows:
+            self.session.execute(sample_type.__table__.insert(),
+                                 [sample_rows[record_key]
+                                  for record_key in sorted(sample_rows)])
 
     def importDataFromDict(self, data, commit, config=None, cv=False):
         """
@@ -1270,6 +1745,11 @@ class TestSuiteDB(object):
 
         The boolean result indicates whether the returned record was constructed
         or not (i.e., whether the data was a duplicate submission).
+
+        The data generation of the machine of a constructed run is left to the
+        caller to bump, just before it commits (see bump_data_generation), so
+        concurrent imports do not wait on each other for the generation of the
+        test suite.
         """
 
         # Construct the machine entry.
@@ -1278,6 +1758,11 @@ class TestSuiteDB(object):
         # Construct the run entry.
         run,inserted = self._getOrCreateRun(data['Run'], machine, cv=cv)
 
+        # If we didn't construct a new run, this is a duplicate
+        # submission. Return the prior Run.
+        if not inserted:
+            return False, run
+
         # Copy them again to setup the Gerrit info
         run_parameters_gerrit = data['Run']['Info'].copy()
         self._getOrCreateGerrit(run.order, run_parameters_gerrit, cv=cv)
@@ -1285,11 +1770,6 @@ class TestSuiteDB(object):
         # Get the schema tag.
         tag = data['Run']['Info']['tag']
 
-        # If we didn't construct a new run, this is a duplicate
-        # submission. Return the prior Run.
-        if not inserted:
-            return False, run
-
         self._importSampleValues(data['Tests'], run, tag, commit, config, cv=cv)
 
         return True, run
@@ -1330,81 +1810,63 @@ class TestSuiteDB(object):
         if N==0:
             return []
 
-        # The obvious algorithm here is to step through the run orders in the
-        # appropriate direction and yield any runs on the same machine which
-        # were reported at that order.
-        #
-        # However, this has one large problem. In some cases, the gap between
-        # orders reported on that machine may be quite high. This will be
-        # particularly true when a machine has stopped reporting for a while,
-        # for example, as there may be large gap between the largest reported
-        # order and the last order the machine reported at.
-        #
-        # In such cases, we could end up executing a large number of individual
-        # SA object materializations in traversing the order list, which is very
-        # bad.
-        #
-        # We currently solve this by instead finding all the orders reported on
-        # this machine, ordering those programatically, and then iterating over
-        # that. This performs worse (O(N) instead of O(1)) than the obvious
-        # algorithm in the common case but more uniform and significantly better
-        # in the worst cast, and I prefer that response times be uniform. In
-        # practice, this appears to perform fine even for quite large (~1GB,
-        # ~20k runs) databases.
-
-        # Find all the orders on this machine, then sort them.
-        #
-        # FIXME: Scalability! However, pretty fast in practice, see elaborate
-        # explanation above.
-        all_machine_orders = self.query(self.Order).\
-            join(self.Run).\
-            filter(self.Run.machine == run.machine).distinct().all()
-        all_machine_orders.sort()
-
-        if len(all_machine_orders) == 0:
-            return []
+        # We find the orders this machine reported at which are adjacent to
+        # the run's order using the per-machine order index, which is ordered
+        # by the order rank (and ID, for orders of the same rank). This is a
+        # bounded index scan, independent of how many orders the machine has
+        # reported.
+        MachineOrder = self.MachineOrder
+        machine_orders = self.query(MachineOrder.order_id).\
+            filter(MachineOrder.machine_id == run.machine.id)
 
-        # Find the index of the current run.
         if cv:
+            # CV runs are compared against the runs leading up to (and
+            # including) the parent order, or the latest order reported by
+            # this machine if the parent order is unknown.
+            if direction == 1:
+                return []
+
             parent_order = self.get_parent_order(run)
             if parent_order:
-                index = all_machine_orders.index(parent_order)
-            else:
-                index = max(0, len(all_machine_orders) - 1)
+                machine_orders = machine_orders.filter(or_(
+                    MachineOrder.rank < parent_order.rank,
+                    and_(MachineOrder.rank == parent_order.rank,
+                         MachineOrder.order_id <= parent_order.id)))
+        elif direction == -1:
+            machine_orders = machine_orders.filter(or_(
+                MachineOrder.rank < run.order.rank,
+                and_(MachineOrder.rank == run.order.rank,
+                     MachineOrder.order_id < run.order.id)))
         else:
-            index = all_machine_orders.index(run.order)
+            machine_orders = machine_orders.filter(or_(
+                MachineOrder.rank > run.order.rank,
+                and_(MachineOrder.rank == run.order.rank,
+                     MachineOrder.order_id > run.order.id)))
+            # Only the N-1 following orders have ever been returned here,
+            # and the field change generation relies on this.
+            N -= 1
+            if N == 0:
+                return []
 
-        # Gather the next N orders.
         if direction == -1:
-            orders_to_return = all_machine_orders[max(0, index - N):index]
-            if cv:
-                if parent_order:
-                    orders_to_return.append(parent_order)
-                elif all_machine_orders:
-                    orders_to_return.append(all_machine_orders[-1])
-                if len(orders_to_return) > N:
-                    orders_to_return.pop(0)
+            machine_orders = machine_orders.order_by(
+                MachineOrder.rank.desc(), MachineOrder.order_id.desc())
         else:
-            if cv:
-                return []
-            orders_to_return = all_machine_orders[index+1:index+N]
-
-        # Get all the runs for those orders on this machine in a single query.
-        ids_to_fetch = [o.id
-                        for o in orders_to_return]
-        if not ids_to_fetch:
+            machine_orders = machine_orders.order_by(
+                MachineOrder.rank.asc(), MachineOrder.order_id.asc())
+        order_ids = [order_id
+                     for order_id, in machine_orders.limit(N)]
+        if not order_ids:
             return []
 
+        # Get all the runs for those orders on this machine in a single query,
+        # and return them in adjacency order.
+        order_index = dict((order_id, i)
+                           for i, order_id in enumerate(order_ids))
         runs = self.query(self.Run).\
-            filter(self.Run.machine == run.machine).\
-            filter(self.Run.order_id.in_(ids_to_fetch)).all()
-
-        # Sort the result by order, accounting for direction to satisfy our
-        # requirement of returning the runs in adjacency order.
-        #
-        # Even though we already know the right order, this is faster than
-        # issueing separate queries.
-        runs.sort(key = lambda r: r.order, reverse = (direction==-1))
+            filter(self.Run.machine_id == run.machine.id).\
+            filter(self.Run.order_id.in_(order_ids)).all()
+        runs.sort(key=lambda r: (order_index[r.order_id], r.id))
 
         return runs
 
@@ -1421,134 +1883,584 @@ class TestSuiteDB(object):
 
     def _get_max_run_order(self, cv=False):
         order_class = self.CVOrder if cv else self.Order
-        values = self.query(order_class.llvm_project_revision).all()
+        max_value = self.query(func.max(order_class.rank)).scalar()
 
-        if not values:
+        if max_value is None:
             return 0
 
-        max_value = max(int(value[0]) for value in values)
-
         return max_value + 1
 
-    def is_test_stable(self, run, test_id, stability_threshold, cv=False):
+    @staticmethod
+    def _filter_in_batches(query, column, ids):
+        """
+        _filter_in_batches(query, column, ids) -> [Query*]
 
-        field_changes_for_test = self.query(self.FieldChange)\
-            .filter(self.FieldChange.test_id == test_id).all()
+        Split the query on the column being one of ids (or not at all, if ids
+        is None) into queries of a bounded number of ids each.
+        """
+        if ids is None:
+            return [query]
+        ids = sorted(ids)
+        return [query.filter(column.in_(ids[i:i+500]))
+                for i in range(0, len(ids), 500)]
+
+    def _compute_test_stability(self, machine_id, test_ids=None,
+                                max_rank=None):
+        """
+        _compute_test_stability(machine_id, test_ids, max_rank) -> dict
 
-        # Similarly to the adjacent runs method, get all orders for
-        # a given test and sort them
-        orders_for_test = self.query(self.Order).join(self.Run)\
-            .join(self.Sample).filter(self.Sample.test_id == test_id)\
-            .distinct().all()
-        orders_for_test.sort()
+        Compute the stability of the given tests (or of all the tests) of the
+        machine from its samples and field changes, as of the order of rank
+        max_rank (or of the latest order). Returns TestStability records, not
+        added to the session, by test ID and field ID.
+        """
+        # The orders with samples of each test, along with the first and the
+        # latest runs at them.
+        query = self.query(self.Sample.test_id, self.Order.rank,
+                           func.min(self.Run.id), func.max(self.Run.id)).\
+            join(self.Run, self.Sample.run_id == self.Run.id).\
+            join(self.Order, self.Run.order_id == self.Order.id).\
+            filter(self.Run.machine_id == machine_id).\
+            group_by(self.Sample.test_id, self.Order.rank)
+        if max_rank is not None:
+            query = query.filter(self.Order.rank <= max_rank)
+        orders = {}
+        for q in self._filter_in_batches(query, self.Sample.test_id, test_ids):
+            for test_id, rank, first_run_id, last_run_id in q:
+                orders.setdefault(test_id, []).append(
+                    (rank, first_run_id, last_run_id))
+
+        # The latest order each field of each test changed at. As of an
+        # earlier order, a change ending after it counts from its start.
+        start_order = sqlalchemy.orm.aliased(self.Order)
+        end_order = sqlalchemy.orm.aliased(self.Order)
+        query = self.query(self.FieldChange.test_id,
+                           self.FieldChange.field_id,
+                           start_order.rank, end_order.rank).\
+            join(start_order,
+                 self.FieldChange.start_order_id == start_order.id).\
+            join(end_order, self.FieldChange.end_order_id == end_order.id).\
+            filter(self.FieldChange.machine_id == machine_id)
+        if max_rank is not None:
+            query = query.filter(start_order.rank <= max_rank)
+        change_ranks = {}
+        for q in self._filter_in_batches(query, self.FieldChange.test_id,
+                                         test_ids):
+            for test_id, field_id, start_rank, end_rank in q:
+                if max_rank is not None and end_rank > max_rank:
+                    end_rank = start_rank
+                key = (test_id, field_id)
+                change_ranks[key] = max(change_ranks.get(key), end_rank)
+
+        fields = list(self.Sample.get_metric_fields())
+        stability = {}
+        for test_id, test_orders in orders.items():
+            test_orders.sort()
+            ranks = [rank for rank, _, _ in test_orders]
+            for field in fields:
+                change_rank = change_ranks.get((test_id, field.id))
+                orders_since_change = len(ranks)
+                if change_rank is not None:
+                    orders_since_change -= bisect.bisect_right(ranks,
+                                                               change_rank)
+                stability[test_id, field.id] = self.TestStability(
+                    machine_id=machine_id, test_id=test_id,
+                    field_id=field.id,
+                    first_run_id=min(run_id for _, run_id, _ in test_orders),
+                    last_run_id=test_orders[-1][2], last_rank=ranks[-1],
+                    num_orders=len(ranks), change_rank=change_rank,
+                    orders_since_change=orders_since_change)
+        return stability
+
+    def update_test_stability(self, machine_id, test_ids=None):
+        """
+        update_test_stability(machine_id, test_ids) -> None
 
-        try:
-            if cv:
-                parent_order = self.get_parent_order(run)
-                if parent_order:
-                    run_index = orders_for_test.index(parent_order)
+        Recompute the stability records of the given tests (or of all the
+        tests) of the machine, e.g., after field changes of them were created
+        or removed, or runs were imported out of order or removed.
+        """
+        stability = self._compute_test_stability(machine_id, test_ids)
+        query = self.query(self.TestStability).\
+            filter(self.TestStability.machine_id == machine_id)
+        for q in self._filter_in_batches(query, self.TestStability.test_id,
+                                         test_ids):
+            for record in q:
+                state = stability.pop((record.test_id, record.field_id), None)
+                if state is None:
+                    self.delete(record)
+                    continue
+                for attr in ('first_run_id', 'last_run_id', 'last_rank',
+                             'num_orders', 'change_rank',
+                             'orders_since_change'):
+                    setattr(record, attr, getattr(state, attr))
+        for state in stability.values():
+            self.add(state)
+
+    def rebuild_test_stability(self):
+        """
+        rebuild_test_stability() -> int
+
+        Recompute the stability records of all the tests of all the machines
+        from their samples and field changes, and return their number.
+        """
+        self.query(self.TestStability).delete(synchronize_session=False)
+        count = 0
+        for machine_id, in self.query(self.Machine.id).all():
+            stability = self._compute_test_stability(machine_id)
+            for state in stability.values():
+                self.add(state)
+            self.session.flush()
+            count += len(stability)
+        return count
+
+    def _updateTestStabilityForRun(self, run):
+        """
+        Update the stability records of the tests with samples in the newly
+        imported run. Runs are usually imported in order, which only moves
+        the records of the tests on by one order.
+        """
+        self.session.flush()
+        test_ids = [test_id for test_id, in self.query(self.Sample.test_id).
+                    filter(self.Sample.run_id == run.id).distinct()]
+        query = self.query(self.TestStability).\
+            filter(self.TestStability.machine_id == run.machine_id)
+        records = dict(((record.test_id, record.field_id), record)
+                       for q in self._filter_in_batches(
+                           query, self.TestStability.test_id, test_ids)
+                       for record in q)
+
+        rank = run.order.rank
+        out_of_order = set()
+        for test_id in test_ids:
+            for field in self.Sample.get_metric_fields():
+                record = records.get((test_id, field.id))
+                if record is None:
+                    self.add(self.TestStability(
+                        machine_id=run.machine_id, test_id=test_id,
+                        field_id=field.id, first_run_id=run.id,
+                        last_run_id=run.id, last_rank=rank, num_orders=1,
+                        change_rank=None, orders_since_change=1))
+                elif rank > record.last_rank:
+                    record.last_run_id = run.id
+                    record.last_rank = rank
+                    record.num_orders += 1
+                    record.orders_since_change += 1
+                elif rank == record.last_rank:
+                    record.last_run_id = max(record.last_run_id, run.id)
                 else:
-                    run_index = max(0, len(orders_for_test) - 1)
-            else:
-                run_index = orders_for_test.index(run.order)
-        except ValueError:
-            return True
+                    out_of_order.add(test_id)
+        if out_of_order:
+            self.update_test_stability(run.machine_id, out_of_order)
 
-        # We only care about orders within the threshold
-        orders_within_threshold = orders_for_test[
-            max(0, run_index - stability_threshold): run_index+1]
+    def _compute_sample_rollups(self, machine_id, order_ids=None,
+                                test_ids=None):
+        """
+        _compute_sample_rollups(machine_id, order_ids, test_ids) -> dict
 
-        # If we have less orders with results for that test than
-        # the threshold then the test cannot be stable
-        if len(orders_within_threshold) < stability_threshold:
-            return False
+        Summarize the samples of the given tests (or of all the tests) of the
+        machine at the given orders (or at all of them), leaving out the
+        samples of failing tests. Returns SampleRollup records, not added to
+        the session, by order ID, test ID and field ID.
+        """
+        # Load the values of the metric fields along with their statuses.
+        fields = list(self.Sample.get_metric_fields())
+        columns = [field.column for field in fields]
+        status_index = {}
+        for field in fields:
+            if field.status_field:
+                status_index[field] = 3 + len(columns)
+                columns.append(field.status_field.column)
+        query = self.query(self.Run.order_id, self.Sample.test_id,
+                           self.Run.id, *columns).\
+            select_from(self.Sample).\
+            join(self.Run, self.Sample.run_id == self.Run.id).\
+            filter(self.Run.machine_id == machine_id)
+        if order_ids is not None:
+            query = query.filter(self.Run.order_id.in_(order_ids))
+
+        samples = {}
+        for q in self._filter_in_batches(query, self.Sample.test_id, test_ids):
+            for row in q:
+                order_id, test_id, run_id = row[:3]
+                for i, field in enumerate(fields):
+                    value = row[3 + i]
+                    if value is None:
+                        continue
+                    if field in status_index and \
+                            row[status_index[field]] not in (PASS, None):
+                        continue
+                    samples.setdefault((order_id, test_id, field.id),
+                                       []).append((value, run_id))
+
+        rollups = {}
+        for (order_id, test_id, field_id), values in samples.items():
+            values.sort()
+            data = [value for value, _ in values]
+            median = lnt.util.stats.median(data)
+            rollups[order_id, test_id, field_id] = self.SampleRollup(
+                machine_id=machine_id, test_id=test_id, field_id=field_id,
+                order_id=order_id, run_id=values[len(values) // 2][1],
+                num_samples=len(data), min=data[0], median=median,
+                mean=lnt.util.stats.mean(data),
+                mad=lnt.util.stats.median_absolute_deviation(data, median))
+        return rollups
+
+    def update_sample_rollups(self, machine_id, order_ids, test_ids=None):
+        """
+        update_sample_rollups(machine_id, order_ids, test_ids) -> None
 
-        order_ids = [order.id for order in orders_within_threshold]
-        return not any(field_change.start_order_id in order_ids or
-                       field_change.end_order_id in order_ids
-                       for field_change in field_changes_for_test)
+        Recompute the summaries of the samples of the given tests (or of all
+        the tests) of the machine at the given orders, e.g., after runs at
+        them were imported or removed.
+        """
+        order_ids = sorted(order_ids)
+        for i in range(0, len(order_ids), 500):
+            batch = order_ids[i:i+500]
+            rollups = self._compute_sample_rollups(machine_id, batch,
+                                                   test_ids)
+            query = self.query(self.SampleRollup).\
+                filter(self.SampleRollup.machine_id == machine_id).\
+                filter(self.SampleRollup.order_id.in_(batch))
+            for q in self._filter_in_batches(query, self.SampleRollup.test_id,
+                                             test_ids):
+                for record in q:
+                    state = rollups.pop((record.order_id, record.test_id,
+                                         record.field_id), None)
+                    if state is None:
+                        self.delete(record)
+                        continue
+                    for attr in ('run_id', 'num_samples', 'min', 'median',
+                                 'mean', 'mad'):
+                        setattr(record, attr, getattr(state, attr))
+            for state in rollups.values():
+                self.add(state)
+
+        # The geometric means at the orders are computed from the summaries.
+        self.session.flush()
+        self.update_order_geomeans(machine_id, order_ids)
+
+    def rebuild_sample_rollups(self):
+        """
+        rebuild_sample_rollups() -> int
 
-    def get_stability_status(self, stability_threshold):
-        test_status = OrderedDict()
+        Recompute the summaries of the samples of all the tests of all the
+        machines at all the orders, and return their number.
+        """
+        self.query(self.SampleRollup).delete(synchronize_session=False)
+        count = 0
+        for machine_id, in self.query(self.Machine.id).all():
+            rollups = self._compute_sample_rollups(machine_id)
+            for state in rollups.values():
+                self.add(state)
+            self.session.flush()
+            count += len(rollups)
+        return count
+
+    def _compute_order_geomeans(self, machine_id, rollups, order_ids=None):
+        """
+        _compute_order_geomeans(machine_id, rollups, order_ids) -> dict
+
+        Compute the geometric means of the minimum samples of the tests of
+        the machine at the given orders (or at all of them) from the
+        summaries of their samples. Returns OrderGeomean records, not added to
+        the session, by order ID and field ID.
+        """
+        mins = {}
+        for rollup in rollups:
+            mins.setdefault((rollup.order_id, rollup.field_id),
+                            []).append(rollup.min)
+
+        # The earliest run at each order.
+        query = self.query(self.Run.order_id, self.Run.id).\
+            filter(self.Run.machine_id == machine_id).\
+            order_by(self.Run.start_time.desc(), self.Run.id.desc())
+        first_run_ids = {}
+        for q in self._filter_in_batches(query, self.Run.order_id, order_ids):
+            for order_id, run_id in q:
+                first_run_ids[order_id] = run_id
+
+        geomeans = {}
+        for (order_id, field_id), values in mins.items():
+            geomeans[order_id, field_id] = self.OrderGeomean(
+                machine_id=machine_id, field_id=field_id, order_id=order_id,
+                run_id=first_run_ids.get(order_id), num_tests=len(values),
+                geomean=lnt.server.reporting.analysis.calc_geomean(values))
+        return geomeans
+
+    def update_order_geomeans(self, machine_id, order_ids):
+        """
+        update_order_geomeans(machine_id, order_ids) -> None
 
-        latest_order = (self.query(self.Order).
-                        filter(self.Order.id == self._get_max_run_order()).
-                        first())
+        Recompute the geometric means of the tests of the machine at the
+        given orders from the summaries of their samples.
+        """
+        order_ids = sorted(order_ids)
+        for i in range(0, len(order_ids), 500):
+            batch = order_ids[i:i+500]
+            geomeans = self._compute_order_geomeans(
+                machine_id, self.query(self.SampleRollup).
+                filter(self.SampleRollup.machine_id == machine_id).
+                filter(self.SampleRollup.order_id.in_(batch)), batch)
+            for record in self.query(self.OrderGeomean).\
+                    filter(self.OrderGeomean.machine_id == machine_id).\
+                    filter(self.OrderGeomean.order_id.in_(batch)):
+                state = geomeans.pop((record.order_id, record.field_id), None)
+                if state is None:
+                    self.delete(record)
+                    continue
+                for attr in ('run_id', 'num_tests', 'geomean'):
+                    setattr(record, attr, getattr(state, attr))
+            for state in geomeans.values():
+                self.add(state)
+
+    def rebuild_order_geomeans(self):
+        """
+        rebuild_order_geomeans() -> int
 
-        latest_run = (self.query(self.Run).
-                      filter(self.Run.order == latest_order).first())
+        Recompute the geometric means of the tests of all the machines at all
+        the orders from the summaries of their samples, and return their
+        number.
+        """
+        self.query(self.OrderGeomean).delete(synchronize_session=False)
+        count = 0
+        for machine_id, in self.query(self.Machine.id).all():
+            geomeans = self._compute_order_geomeans(
+                machine_id, self.query(self.SampleRollup).
+                filter(self.SampleRollup.machine_id == machine_id))
+            for state in geomeans.values():
+                self.add(state)
+            self.session.flush()
+            count += len(geomeans)
+        return count
+
+    def check_order_geomeans(self):
+        """
+        check_order_geomeans() -> [(OrderGeomean, OrderGeomean)*]
 
-        tests = (self.query(self.Sample).
-                 filter(self.Sample.run == latest_run).all())
+        Compare the geometric means of the tests of all the machines at all
+        the orders with the ones recomputed from the samples. Returns the
+        (stored, recomputed) pairs of records which differ, with None for a
+        missing record.
+        """
+        def differ(a, b):
+            if a is None or b is None:
+                return a is not b
+            return abs(a - b) > 1e-9 * max(abs(a), abs(b))
+
+        mismatches = []
+        for machine_id, in self.query(self.Machine.id).all():
+            expected = self._compute_order_geomeans(
+                machine_id,
+                self._compute_sample_rollups(machine_id).values())
+            for record in self.query(self.OrderGeomean).\
+                    filter(self.OrderGeomean.machine_id == machine_id):
+                state = expected.pop((record.order_id, record.field_id), None)
+                if state is None or \
+                        record.run_id != state.run_id or \
+                        record.num_tests != state.num_tests or \
+                        differ(record.geomean, state.geomean):
+                    mismatches.append((record, state))
+            mismatches.extend((None, state) for state in expected.values())
+        return mismatches
+
+    def _updateSampleRollupsForRun(self, run):
+        """
+        Update the summaries of the samples of the tests with samples in the
+        newly imported run, at its order.
+        """
+        self.session.flush()
+        test_ids = [test_id for test_id, in self.query(self.Sample.test_id).
+                    filter(self.Sample.run_id == run.id).distinct()]
+        if test_ids:
+            self.update_sample_rollups(run.machine_id, [run.order_id],
+                                       test_ids)
+
+    def bump_data_generation(self, machine_ids):
+        """
+        bump_data_generation(machine_ids) -> int
 
-        test_ids = set()
+        Record that the runs or field changes of the given machines changed,
+        in the current transaction, and return their new generation.
 
-        for test in tests:
-            test_ids.add(test.test_id)
+        This locks the generation of the test suite until the transaction ends,
+        so it is best done just before committing.
+        """
+        DataGeneration = self.DataGeneration
+        now = datetime.datetime.utcnow()
+
+        # The generation of the test suite increases with every change, and
+        # the machines take it on.
+        suite = self.query(DataGeneration).\
+            filter(DataGeneration.machine_id == None)
+        updated = suite.update(
+            {DataGeneration.generation: DataGeneration.generation + 1,
+             DataGeneration.modified_time: now}, synchronize_session=False)
+        if not updated:
+            self.add(DataGeneration(machine_id=None, generation=1,
+                                    modified_time=now))
+            self.session.flush()
+        generation = self.query(func.max(DataGeneration.generation)).\
+            filter(DataGeneration.machine_id == None).scalar()
+
+        machine_ids = set(machine_ids)
+        known = set()
+        for q in self._filter_in_batches(self.query(DataGeneration),
+                                         DataGeneration.machine_id,
+                                         machine_ids):
+            q.update({DataGeneration.generation: generation,
+                      DataGeneration.modified_time: now},
+                     synchronize_session=False)
+        for q in self._filter_in_batches(
+                self.query(DataGeneration.machine_id),
+                DataGeneration.machine_id, machine_ids):
+            known.update(machine_id for machine_id, in q)
+        for machine_id in sorted(machine_ids - known):
+            self.add(DataGeneration(machine_id=machine_id,
+                                    generation=generation,
+                                    modified_time=now))
+        return generation
+
+    def get_data_generation(self, machine_ids):
+        """
+        get_data_generation(machine_ids) -> (generations, datetime)
 
-        for test_id in test_ids:
-            test_status[test_id] = {}
-            field_changes_for_test = self.query(self.FieldChange).filter(
-                self.FieldChange.test_id == test_id).all()
-
-            orders_for_test = self.query(self.Order).join(self.Run).join(
-                self.Sample).filter(
-                self.Sample.test_id == test_id).distinct().all()
-            orders_for_test.sort()
-
-            try:
-                run_index = orders_for_test.index(latest_run.order)
-            except ValueError:
-                test_status[test_id]["stable"] = True
-                continue
+        Get the generations of the runs and field changes of the given
+        machines (None standing for the whole test suite), as a tuple which
+        changes whenever any of them change, along with the (UTC) time of
+        their latest change, or None if they never changed.
+        """
+        DataGeneration = self.DataGeneration
+        query = self.query(DataGeneration.machine_id,
+                           DataGeneration.generation,
+                           DataGeneration.modified_time)
+        keys = sorted(set(machine_ids))
+        queries = self._filter_in_batches(query, DataGeneration.machine_id,
+                                          [key for key in keys
+                                           if key is not None])
+        if None in keys:
+            queries.append(query.filter(DataGeneration.machine_id == None))
+        generations = {}
+        modified = None
+        for q in queries:
+            for machine_id, generation, modified_time in q:
+                generations[machine_id] = max(generation,
+                                              generations.get(machine_id, 0))
+                if modified is None or modified_time > modified:
+                    modified = modified_time
+        return tuple(generations.get(key, 0) for key in keys), modified
+
+    def get_stable_tests(self, run, test_ids, stability_threshold, cv=False):
+        """
+        get_stable_tests(run, test_ids, stability_threshold, cv) -> dict
 
-            orders_within_threshold = (orders_for_test[
-                                       max(0, run_index - stability_threshold):
-                                       run_index + 1])
+        Get whether each of the given tests is stable at the order of the run
+        (or, for CV runs, at the order of its parent commit), by test ID. A
+        test is stable if the machine has samples of it at (at least)
+        stability_threshold orders up to that one, and none of its fields
+        changed within the latest stability_threshold + 1 of them.
+        """
+        if cv:
+            parent_order = self.get_parent_order(run)
+            rank = parent_order.rank if parent_order else None
+        else:
+            rank = run.order.rank
+
+        records = {}
+        query = self.query(self.TestStability).\
+            filter(self.TestStability.machine_id == run.machine_id)
+        for q in self._filter_in_batches(query, self.TestStability.test_id,
+                                         test_ids):
+            for record in q:
+                records.setdefault(record.test_id, []).append(record)
+
+        # The records are as of the latest order, so the tests with samples
+        # after the order of the run are looked at as of that order.
+        earlier = [test_id for test_id, test_records in records.items()
+                   if rank is not None and rank < test_records[0].last_rank]
+        if earlier:
+            for test_id in earlier:
+                records[test_id] = []
+            for (test_id, _), state in self._compute_test_stability(
+                    run.machine_id, earlier, rank).items():
+                records[test_id].append(state)
+
+        stable_tests = {}
+        for test_id in test_ids:
+            test_records = records.get(test_id)
+            if not test_records:
+                # A CV run without a parent commit has no history to be
+                # stable in.
+                stable_tests[test_id] = rank is not None
+            elif rank is not None and test_records[0].last_rank != rank:
+                # The test has no samples at the order.
+                stable_tests[test_id] = True
+            else:
+                stable_tests[test_id] = all(
+                    record.is_stable(stability_threshold)
+                    for record in test_records)
+        return stable_tests
 
-            if len(orders_within_threshold) < stability_threshold:
-                test_status[test_id]["stable"] = False
-                continue
+    def is_test_stable(self, run, test_id, stability_threshold, cv=False):
+        return self.get_stable_tests(run, [test_id], stability_threshold,
+                                     cv=cv)[test_id]
 
-            order_ids = [order.id for order in orders_within_threshold]
-            test_status[test_id]["stable"] = not any(
-                field_change.start_order_id in order_ids
-                or field_change.end_order_id in order_ids
-                for field_change in field_changes_for_test)
+    def get_stability_status(self, stability_threshold):
+        """
+        get_stability_status(stability_threshold) -> (dict, Order, Run)
 
-        for test_id in test_ids:
-            first_run = self.query(self.Sample).filter(
-                self.Sample.test_id == test_id).order_by(
-                self.Sample.run_id.asc()).first()
-            test_status[test_id]["stable_for"] = "failure"
-            test_status[test_id]["number_of_runs"] = latest_run.id - first_run.run_id
-            if test_status[test_id]["stable"]:
-                regressions = (self.query(self.Regression).
-                               join(self.RegressionIndicator).
-                               join(self.FieldChange).
-                               filter(self.FieldChange.test_id == test_id).
-                               order_by(self.Regression.id.desc()).all())
-                if regressions:
-                    regression_id = max(r.id for r in regressions)
-                    regression_ind = (self.query(self.RegressionIndicator).
-                                      join(self.Regression).
-                                      filter(self.Regression.id == regression_id).first())
-                    regressed_run = regression_ind.field_change.run
-                    test_status[test_id]["has_regressed"] = True
-                    try:
-                        test_status[test_id]["stable_for"] = latest_run.id - regressed_run.id
-                    except Exception:
-                        print("Unable to get status of test [{}] for field "
-                              "change [{}]".format(
-                            regression_ind.field_change.test_id,
-                            regression_ind.field_change.id))
-                        test_status[test_id]["stable_for"] = "Error calculating"
+        Get the stability of the tests of the latest run, by test ID, along
+        with its order and the run.
+        """
+        test_status = OrderedDict()
 
+        latest_run = self.query(self.Run).join(self.Order).\
+            order_by(self.Order.rank.desc(), self.Order.id.desc(),
+                     self.Run.id).first()
+        if latest_run is None:
+            return test_status, None, None
+        latest_order = latest_run.order
+
+        # The records of the tests with samples at the latest order.
+        first_run_ids = {}
+        for record, name in self.query(self.TestStability, self.Test.name).\
+                join(self.Test, self.TestStability.test_id == self.Test.id).\
+                filter(self.TestStability.machine_id ==
+                       latest_run.machine_id).\
+                filter(self.TestStability.last_rank == latest_order.rank).\
+                order_by(self.TestStability.test_id):
+            status = test_status.get(record.test_id)
+            if status is None:
+                test_status[record.test_id] = status = {"name": name,
+                                                        "stable": True}
+            status["stable"] &= record.is_stable(stability_threshold)
+            first_run_ids[record.test_id] = min(
+                first_run_ids.get(record.test_id, record.first_run_id),
+                record.first_run_id)
+
+        # The run of the latest regression of each test.
+        regressed_run_ids = dict(
+            self.query(self.FieldChange.test_id, self.FieldChange.run_id).
+            join(self.RegressionIndicator,
+                 self.RegressionIndicator.field_change_id ==
+                 self.FieldChange.id).
+            filter(self.FieldChange.machine_id == latest_run.machine_id).
+            order_by(self.RegressionIndicator.regression_id))
+
+        for test_id, status in test_status.items():
+            status["number_of_runs"] = latest_run.id - first_run_ids[test_id]
+            if not status["stable"]:
+                status["stable_for"] = "N/A"
+                status["has_regressed"] = True
+            elif test_id in regressed_run_ids:
+                status["has_regressed"] = True
+                regressed_run_id = regressed_run_ids[test_id]
+                if regressed_run_id is None:
+                    status["stable_for"] = "Error calculating"
                 else:
-                    test_status[test_id]["stable_for"] = latest_run.id - first_run.run_id
-                    test_status[test_id]["has_regressed"] = False
+                    status["stable_for"] = latest_run.id - regressed_run_id
             else:
-                test_status[test_id]["stable_for"] = "N/A"
-                test_status[test_id]["has_regressed"] = True
+                status["has_regressed"] = False
+                status["stable_for"] = status["number_of_runs"]
 
-        return test_status, latest_order, latest_run, tests
+        return test_status, latest_order, latest_run
@@ -4,6 +4,8 @@ try:
 except:
     import dummy_threading as threading
 
+import contextlib
+
 import sqlalchemy
 
 import lnt.testing
@@ -34,8 +36,8 @@ class V4DB(object):
 
         def get(self, name, default = None):
             # Check the test suite cache, to avoid gratuitous reinstantiation.
-            #
-            # FIXME: Invalidation?
+            # The model classes are also cached across databases, see
+            # TestSuiteDB.
             if name in self._cache:
                 return self._cache[name]
 
@@ -81,16 +83,16 @@ class V4DB(object):
                 V4DB._engine[path] = sqlalchemy.create_engine(path, echo=echo)
         self.engine = V4DB._engine[path]
 
-        # Update the database to the current version, if necessary. Only check
-        # this once per path.
-        if path not in V4DB._db_updated:
-            lnt.server.db.migrate.update(self.engine)
-            V4DB._db_updated.add(path)
-
         # Proxy object for implementing dict-like .testsuite property.
         self._testsuite_proxy = None
 
+        # The records looked up by the imports of a batch of reports, by test
+        # suite and kind (see import_caching).
+        self.import_caches = None
+
         self.session = sqlalchemy.orm.sessionmaker(self.engine, autoflush=False)()
+        # Allow the model instances to find the database they belong to.
+        self.session.info['v4db'] = self
 
         # Add several shortcut aliases.
         self.add = self.session.add
@@ -107,27 +109,65 @@ class V4DB(object):
         self.SampleField = testsuite.SampleField
         self.CVSampleField = testsuite.CVSampleField
 
-        # Resolve or create the known status kinds.
-        self.pass_status_kind = self.query(testsuite.StatusKind)\
-            .filter_by(id = lnt.testing.PASS).first()
-        self.fail_status_kind = self.query(testsuite.StatusKind)\
-            .filter_by(id = lnt.testing.FAIL).first()
-        self.xfail_status_kind = self.query(testsuite.StatusKind)\
-            .filter_by(id = lnt.testing.XFAIL).first()
-        assert (self.pass_status_kind and self.fail_status_kind and
-                self.xfail_status_kind), \
-                "status kinds not initialized!"
-
-        # Resolve or create the known sample types.
-        self.real_sample_type = self.query(testsuite.SampleType)\
-            .filter_by(name="Real").first()
-        self.status_sample_type = self.query(testsuite.SampleType)\
-            .filter_by(name="Status").first()
-        self.hash_sample_type = self.query(testsuite.SampleType)\
-            .filter_by(name="Hash").first()
-        assert (self.real_sample_type and self.status_sample_type and
-                self.hash_sample_type), \
-            "sample types not initialized!"
+        # Update the database to the current version, if necessary. Only check
+        # this once per path.
+        if path not in V4DB._db_updated:
+            lnt.server.db.migrate.update(self.engine)
+            # The fields of the test suites may have changed.
+            lnt.server.db.testsuitedb.TestSuiteDB.invalidate_models(path)
+
+            assert (self.pass_status_kind and self.fail_status_kind and
+                    self.xfail_status_kind), \
+                    "status kinds not initialized!"
+            assert (self.real_sample_type and self.status_sample_type and
+                    self.hash_sample_type), \
+                "sample types not initialized!"
+            V4DB._db_updated.add(path)
+
+    # The known status kinds and sample types, which the migrations create.
+    @property
+    def pass_status_kind(self):
+        return self.query(testsuite.StatusKind).get(lnt.testing.PASS)
+
+    @property
+    def fail_status_kind(self):
+        return self.query(testsuite.StatusKind).get(lnt.testing.FAIL)
+
+    @property
+    def xfail_status_kind(self):
+        return self.query(testsuite.StatusKind).get(lnt.testing.XFAIL)
+
+    @property
+    def real_sample_type(self):
+        return self.query(testsuite.SampleType).filter_by(name="Real").first()
+
+    @property
+    def status_sample_type(self):
+        return self.query(testsuite.SampleType).filter_by(
+            name="Status").first()
+
+    @property
+    def hash_sample_type(self):
+        return self.query(testsuite.SampleType).filter_by(name="Hash").first()
+
+    @contextlib.contextmanager
+    def import_caching(self):
+        """
+        Share the machines, orders and tests looked up (or created) by the
+        imports made within the block, so importing many reports in a row looks
+        each of them up once. The caches must be reset (see
+        reset_import_caches) whenever the session is rolled back.
+        """
+        self.import_caches = {}
+        try:
+            yield
+        finally:
+            self.import_caches = None
+
+    def reset_import_caches(self):
+        """Forget the records looked up by the imports, if caching them."""
+        if self.import_caches is not None:
+            self.import_caches.clear()
 
     def close(self):
         if self.session is not None:
@@ -141,12 +181,24 @@ class V4DB(object):
         V4DB._engine[db_path].dispose()
         V4DB._engine.pop(db_path)
         V4DB._db_updated.remove(db_path)
+        lnt.server.db.testsuitedb.TestSuiteDB.invalidate_models(db_path)
     
     @staticmethod
     def close_all_engines():
         for key in V4DB._engine.keys():
             V4DB.close_engine(key)
 
+    @staticmethod
+    def dispose_engines():
+        """Dispose of all the engines, so new connections are made the next
+        time a database is used. This is used by forked worker processes,
+        which must not share the connections of their parent. Unlike
+        close_all_engines, the databases are not upgraded again."""
+        with V4DB._engine_lock:
+            for engine in V4DB._engine.values():
+                engine.dispose()
+            V4DB._engine.clear()
+
     def settings(self):
         """All the setting needed to recreate this instnace elsewhere."""
         return {'path': self.path,
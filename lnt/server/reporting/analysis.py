@@ -56,104 +56,50 @@ def calc_geomean(run_values):
     return util.geometric_mean(values) - MIN_VALUE_PRECISION
 
 
-class ComparisonResult:
-    """A ComparisonResult is ultimatly responsible for determining if a test
-    improves, regresses or does not change, given some new and old data."""
-
-    def __init__(self, aggregation_fn,
-                 cur_failed, prev_failed, samples, prev_samples,
-                 cur_hash, prev_hash, cur_profile=None, prev_profile=None,
-                 confidence_lv=0.05, bigger_is_better=False, stable_test=True):
-        self.aggregation_fn = aggregation_fn
-
-        # Special case: if we're using the minimum to aggregate, swap it for max
-        # if bigger_is_better.
-        if aggregation_fn == stats.safe_min and bigger_is_better:
-            aggregation_fn = stats.safe_max
-
-        self.cur_hash = cur_hash
-        self.prev_hash = prev_hash
-        self.cur_profile = cur_profile
-        self.prev_profile = prev_profile
-
-        if samples:
-            self.current = aggregation_fn(samples)
-        else:
-            self.current = None
-
-        self.previous = None
-        # Compute the comparison status for the test value.
-        self.delta = 0
-        self.pct_delta = 0.0
-        if self.current and prev_samples:
-            prev_median = stats.median(prev_samples)
-            self.delta, value = absmin_diff(self.current, [prev_median])
-            if value != 0:
-                self.pct_delta = self.delta / value
-            self.previous = value
-
-        # If we have multiple values for this run, use that to estimate the
-        # distribution.
-        #
-        # We can get integer sample types here - for example if the field is
-        # .exec.status. Make sure we don't assert by avoiding the stats
-        # functions in this case.
-        if samples and len(samples) > 1 and isinstance(samples[0], float):
-            self.stddev = stats.standard_deviation(samples)
-            self.MAD = stats.median_absolute_deviation(samples)
-            self.variance = stats.variance(samples)
-        else:
-            self.stddev = None
-            self.MAD = None
-            self.variance = None
-
-        if prev_samples and len(prev_samples) > 1 and isinstance(prev_samples[0], float):
-            self.prev_stddev = stats.standard_deviation(prev_samples)
-            self.prev_MAD = stats.median_absolute_deviation(prev_samples)
-            self.prev_variance = stats.variance(prev_samples)
-        else:
-            self.prev_stddev = None
-            self.prev_MAD = None
-            self.prev_variance = None
-
-        self.stddev_mean = None  # Only calculate this if needed.
-        self.failed = cur_failed
-        self.prev_failed = prev_failed
-        self.samples = samples
-        self.prev_samples = prev_samples
-
-        self.confidence_lv = confidence_lv
-        self.bigger_is_better = bigger_is_better
-        self.stable_test = stable_test
-
-    @property
-    def stddev_mean(self):
-        """The mean around stddev for current sampples. Cached after first call.
-        """
-        if not self.stddev_mean:
-            self.stddev_mean = stats.mean(self.samples)
-        return self.stddev_mean
-
-    def __repr__(self):
-        """Print this ComparisonResult's constructor.
-
-        Handy for generating test cases for comparisons doing odd things."""
-        fmt = "{}(" + "{}, " * 9 + ")"
-        return fmt.format(self.__class__.__name__,
-                          self.aggregation_fn.__name__,
-                          self.failed,
-                          self.prev_failed,
-                          self.cur_hash,
-                          self.prev_hash,
-                          self.samples,
-                          self.prev_samples,
-                          self.confidence_lv,
-                          bool(self.bigger_is_better))
-                          
-    def __json__(self):
-        simple_dict = self.__dict__
-        simple_dict['aggregation_fn'] = self.aggregation_fn.__name__
-        return simple_dict
+def compare_values(aggregation_fn, samples, prev_samples,
+                   bigger_is_better=False):
+    """compare_values(...) -> (current, previous, delta, pct_delta)
+
+    Aggregate the current samples, and compare them to the median of the
+    previous samples."""
+    # Special case: if we're using the minimum to aggregate, swap it for max
+    # if bigger_is_better.
+    if aggregation_fn == stats.safe_min and bigger_is_better:
+        aggregation_fn = stats.safe_max
+
+    if samples:
+        current = aggregation_fn(samples)
+    else:
+        current = None
+
+    previous = None
+    delta = 0
+    pct_delta = 0.0
+    if current and prev_samples:
+        prev_median = stats.median(prev_samples)
+        delta, value = absmin_diff(current, [prev_median])
+        if value != 0:
+            pct_delta = delta / value
+        previous = value
+    return current, previous, delta, pct_delta
+
+
+def get_stddev(samples):
+    """Return the standard deviation of the samples, if there are several.
+
+    We can get integer sample types here - for example if the field is
+    .exec.status. Make sure we don't assert by avoiding the stats functions in
+    this case."""
+    if samples and len(samples) > 1 and isinstance(samples[0], float):
+        return stats.standard_deviation(samples)
+    return None
+
+
+class ComparisonStatus:
+    """Classification of a comparison from its current and previous values.
+
+    Subclasses provide current, previous, delta, pct_delta, stddev,
+    prev_stddev, failed, prev_failed, bigger_is_better and stable_test."""
 
     def is_result_performance_change(self):
         """Check if we think there was a performance change."""
@@ -284,6 +230,183 @@ class ComparisonResult:
             return UNCHANGED_PASS
 
 
+class ComparisonResult(ComparisonStatus):
+    """A ComparisonResult is ultimatly responsible for determining if a test
+    improves, regresses or does not change, given some new and old data."""
+
+    def __init__(self, aggregation_fn,
+                 cur_failed, prev_failed, samples, prev_samples,
+                 cur_hash, prev_hash, cur_profile=None, prev_profile=None,
+                 confidence_lv=0.05, bigger_is_better=False, stable_test=True):
+        self.aggregation_fn = aggregation_fn
+
+        self.cur_hash = cur_hash
+        self.prev_hash = prev_hash
+        self.cur_profile = cur_profile
+        self.prev_profile = prev_profile
+
+        # Compute the comparison status for the test value.
+        self.current, self.previous, self.delta, self.pct_delta = \
+            compare_values(aggregation_fn, samples, prev_samples,
+                           bigger_is_better)
+
+        # If we have multiple values for this run, use that to estimate the
+        # distribution.
+        self.stddev = get_stddev(samples)
+        if self.stddev is not None:
+            # The deviations are found from the samples sorted once.
+            self.MAD = stats.SlidingWindow(
+                samples).median_absolute_deviation()
+            self.variance = stats.variance(samples)
+        else:
+            self.MAD = None
+            self.variance = None
+
+        self.prev_stddev = get_stddev(prev_samples)
+        if self.prev_stddev is not None:
+            self.prev_MAD = stats.SlidingWindow(
+                prev_samples).median_absolute_deviation()
+            self.prev_variance = stats.variance(prev_samples)
+        else:
+            self.prev_MAD = None
+            self.prev_variance = None
+
+        self.stddev_mean = None  # Only calculate this if needed.
+        self.failed = cur_failed
+        self.prev_failed = prev_failed
+        self.samples = samples
+        self.prev_samples = prev_samples
+
+        self.confidence_lv = confidence_lv
+        self.bigger_is_better = bigger_is_better
+        self.stable_test = stable_test
+
+    @property
+    def stddev_mean(self):
+        """The mean around stddev for current sampples. Cached after first call.
+        """
+        if not self.stddev_mean:
+            self.stddev_mean = stats.mean(self.samples)
+        return self.stddev_mean
+
+    def __repr__(self):
+        """Print this ComparisonResult's constructor.
+
+        Handy for generating test cases for comparisons doing odd things."""
+        fmt = "{}(" + "{}, " * 9 + ")"
+        return fmt.format(self.__class__.__name__,
+                          self.aggregation_fn.__name__,
+                          self.failed,
+                          self.prev_failed,
+                          self.cur_hash,
+                          self.prev_hash,
+                          self.samples,
+                          self.prev_samples,
+                          self.confidence_lv,
+                          bool(self.bigger_is_better))
+                          
+    def __json__(self):
+        simple_dict = self.__dict__
+        simple_dict['aggregation_fn'] = self.aggregation_fn.__name__
+        return simple_dict
+
+
+class LazyComparisonResult(ComparisonStatus, object):
+    """The comparison of one test, computed in bulk by
+    RunInfo.get_comparison_results.
+
+    Only the values needed to classify the comparison are computed up front.
+    The full ComparisonResult is built when any other attribute is used."""
+
+    def __init__(self, results, test_id, current, previous, delta, pct_delta,
+                 stddev, prev_stddev, failed, prev_failed, stable_test):
+        self._results = results
+        self._result = None
+        self.test_id = test_id
+        self.current = current
+        self.previous = previous
+        self.delta = delta
+        self.pct_delta = pct_delta
+        self.stddev = stddev
+        self.prev_stddev = prev_stddev
+        self.failed = failed
+        self.prev_failed = prev_failed
+        self.bigger_is_better = results.field.bigger_is_better
+        self.stable_test = stable_test
+
+    @property
+    def result(self):
+        """The full ComparisonResult."""
+        if self._result is None:
+            self._result = self._results.get_full_result(self.test_id,
+                                                         self.stable_test)
+        return self._result
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.result, name)
+
+    def __json__(self):
+        return self.result.__json__()
+
+
+class ComparisonResults(dict):
+    """The comparisons of the tests of a field between two sets of runs, by
+    test id (see RunInfo.get_comparison_results)."""
+
+    def __init__(self, runinfo, runs, compare_runs, field,
+                 hash_of_binary_field, cv):
+        dict.__init__(self)
+        self.runinfo = runinfo
+        self.runs = runs
+        self.compare_runs = compare_runs
+        self.field = field
+        self.hash_of_binary_field = hash_of_binary_field
+        self.cv = cv
+
+    def __getstate__(self):
+        # The runs and fields are pickled by ID and index, without the samples
+        # they were loaded from, which are loaded again (see bind) if a full
+        # result is needed.
+        state = self.__dict__.copy()
+        state['runinfo'] = None
+        state.pop('_get_runinfo', None)
+        state['runs'] = [r.id for r in self.runs]
+        state['compare_runs'] = [r.id for r in self.compare_runs]
+        state['field'] = self.field.index
+        if self.hash_of_binary_field is not None:
+            state['hash_of_binary_field'] = self.hash_of_binary_field.index
+        return state
+
+    def bind(self, testsuite, get_runinfo):
+        """Attach unpickled results to the test suite, and to the function
+        which gets the RunInfo of their runs when a full result is needed."""
+        if self.runinfo is not None or hasattr(self, '_get_runinfo'):
+            return
+        self.runs = [testsuite.query(testsuite.Run).get(id)
+                     for id in self.runs]
+        self.compare_runs = [testsuite.query(testsuite.Run).get(id)
+                             for id in self.compare_runs]
+        self.field = testsuite.sample_fields[self.field]
+        if self.hash_of_binary_field is not None:
+            self.hash_of_binary_field = \
+                testsuite.sample_fields[self.hash_of_binary_field]
+        self._get_runinfo = get_runinfo
+
+    def get_full_result(self, test_id, stable_test=True):
+        if self.runinfo is None:
+            self.runinfo = self._get_runinfo()
+        return self.runinfo.get_comparison_result(
+            self.runs, self.compare_runs, test_id, self.field,
+            self.hash_of_binary_field, cv=self.cv, stable_test=stable_test)
+
+    def get_changed_test_ids(self):
+        """Return the ids of the tests with a performance change."""
+        return [test_id for test_id, cr in self.iteritems()
+                if cr.is_result_performance_change()]
+
+
 class RunInfo(object):
     def __init__(self, testsuite, runs_to_load,
                  aggregation_fn=stats.median, confidence_lv=.05,
@@ -336,6 +459,18 @@ class RunInfo(object):
         return self.get_comparison_result([run], compare_to, test_id, field,
                                           hash_of_binary_field, cv=cv, stable_test=stable_test)
 
+    def get_run_comparison_results(self, run, compare_to, field,
+                                   hash_of_binary_field, test_ids=None,
+                                   cv=False, stable_tests=None):
+        if compare_to is not None:
+            compare_to = [compare_to]
+        else:
+            compare_to = []
+        return self.get_comparison_results([run], compare_to, field,
+                                           hash_of_binary_field,
+                                           test_ids=test_ids, cv=cv,
+                                           stable_tests=stable_tests)
+
     def get_samples(self, runs, test_id):
         all_samples = []
         for run in runs:
@@ -423,6 +558,65 @@ class RunInfo(object):
                              stable_test=stable_test)
         return r
 
+    def get_comparison_results(self, runs, compare_runs, field,
+                               hash_of_binary_field, test_ids=None, cv=False,
+                               stable_tests=None):
+        """Compare all the tests of a field between two sets of runs at once.
+
+        This gathers the samples of the runs for every test in a single pass
+        over the loaded samples, and computes just what is needed to classify
+        each comparison. Returns a ComparisonResults, which maps each test id
+        (by default, each test with samples in either set of runs) to a
+        LazyComparisonResult. stable_tests optionally maps test ids to whether
+        the test is stable (which they are by default).
+        """
+        results = ComparisonResults(self, runs, compare_runs, field,
+                                    hash_of_binary_field, cv)
+        status_field = field.status_field
+        index = field.index
+        status_index = status_field.index if status_field else None
+
+        # Gather the samples of each test into columns: the values, and
+        # whether any sample failed.
+        run_ids = set(r.id for r in runs)
+        compare_run_ids = set(r.id for r in compare_runs)
+        run_columns, prev_columns = {}, {}
+        run_failed, prev_failed = set(), set()
+        for columns, failed, sample_map, ids in (
+                (run_columns, run_failed,
+                 self.cv_sample_map if cv else self.sample_map, run_ids),
+                (prev_columns, prev_failed, self.sample_map,
+                 compare_run_ids)):
+            if not ids:
+                continue
+            for (run_id, test_id), samples in sample_map.items():
+                if run_id not in ids:
+                    continue
+                values = columns.setdefault(test_id, [])
+                for sample in samples:
+                    if status_index is not None and \
+                            sample[status_index] == FAIL:
+                        failed.add(test_id)
+                    if sample[index] is not None:
+                        values.append(sample[index])
+
+        if test_ids is None:
+            test_ids = set(run_columns) | set(prev_columns)
+        for test_id in test_ids:
+            run_values = run_columns.get(test_id, [])
+            prev_values = prev_columns.get(test_id, [])
+            current, previous, delta, pct_delta = compare_values(
+                self.aggregation_fn, run_values, prev_values,
+                field.bigger_is_better)
+            stable_test = True
+            if stable_tests is not None:
+                stable_test = stable_tests.get(test_id, True)
+            results[test_id] = LazyComparisonResult(
+                results, test_id, current, previous, delta, pct_delta,
+                get_stddev(run_values), get_stddev(prev_values),
+                test_id in run_failed, test_id in prev_failed, stable_test)
+        return results
+
     def get_geomean_comparison_result(self, run, compare_to, field, tests):
         if tests:
             prev_values, run_values, prev_hash, cur_hash = zip(
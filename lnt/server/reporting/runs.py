@@ -2,35 +2,110 @@
 Report functionality centered around individual runs.
 """
 
+import hashlib
 import time
 import lnt.server.reporting.analysis
 import lnt.server.ui.app
+import lnt.server.ui.cache
 import lnt.util.stats
 
 STABILITY_THRESHOLD = 10
 
 
-def generate_run_report(run, baseurl, only_html_body=False,
-                        num_comparison_runs=0, result=None,
-                        compare_to=None, baseline=None,
-                        aggregation_fn=lnt.util.stats.median, confidence_lv=.05,
-                        styles=dict(), classes=dict(), cv=False):
+class RunReport(object):
     """
-    generate_run_report(...) -> (str: subject, str: text_report,
-                                 str: html_report)
+    The comparison of a run against a previous run and a baseline, which the
+    run reports are rendered from.
 
-    Generate a comprehensive report on the results of the given individual
-    run, suitable for emailing or presentation on a web page.
+    It refers to runs by ID and to fields by index, so it can be pickled and
+    cached: the report sent on submission of a run, its page and its text
+    report all share it (see get_run_report).
     """
 
-    assert num_comparison_runs >= 0
-
-    start_time = time.time()
-
-    ts = run.testsuite
-
+    def __init__(self, run_id, compare_to_id, baseline_id, run_ids,
+                 cv_run_ids, aggregation_fn, confidence_lv, cv, test_names,
+                 num_total_tests, test_results, run_to_run_info,
+                 baselined_results, run_to_baseline_info):
+        self.run_id = run_id
+        self.compare_to_id = compare_to_id
+        self.baseline_id = baseline_id
+        # The runs the comparison was made from.
+        self.run_ids = run_ids
+        self.cv_run_ids = cv_run_ids
+        self.aggregation_fn = aggregation_fn
+        self.confidence_lv = confidence_lv
+        self.cv = cv
+        self.test_names = test_names
+        self.num_total_tests = num_total_tests
+        # The changes of each field (by index), by type, and the comparison
+        # results of each test, by test name and field index.
+        self.test_results = test_results
+        self.run_to_run_info = run_to_run_info
+        self.baselined_results = baselined_results
+        self.run_to_baseline_info = run_to_baseline_info
+        # The key of the report in the cache of run reports, what the key was
+        # made from besides the data generation of the machine, and the data
+        # generation of the test suite the report was computed at.
+        self.cache_key = None
+        self.cache_identity = None
+        self.cache_generation = None
+        self._run_info = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_run_info'] = None
+        return state
+
+    def get_run_info(self, ts):
+        """Get the RunInfo of the runs the comparison was made from, loading
+        their samples again if the report came from the cache."""
+        if self._run_info is None:
+            self._run_info = lnt.server.reporting.analysis.RunInfo(
+                ts, self.run_ids, self.aggregation_fn, self.confidence_lv,
+                cv=self.cv_run_ids)
+        return self._run_info
+
+    def bind(self, ts):
+        """Attach the comparison results of a report which came from the
+        cache to the test suite, loading the samples of the runs the
+        comparison was made from only if a full result is needed."""
+        for cr in self.run_to_run_info.values() + \
+                (self.run_to_baseline_info or {}).values():
+            results = getattr(cr, '_results', None)
+            if results is not None:
+                results.bind(ts, lambda: self.get_run_info(ts))
+
+    def get_test_results(self, ts):
+        """The changes of each field, by type."""
+        return _with_fields(ts, self.test_results)
+
+    def get_baselined_results(self, ts):
+        """The changes of each field against the baseline, by type, or None
+        if there is no baseline."""
+        if self.baselined_results is None:
+            return None
+        return _with_fields(ts, self.baselined_results)
+
+
+def _with_fields(ts, results):
+    return [(ts.sample_fields[field_index], field_results)
+            for field_index, field_results in results]
+
+
+def _by_field(ts, info):
+    return dict(((name, ts.sample_fields[field_index]), cr)
+                for (name, field_index), cr in info.items())
+
+
+# The caches of the run reports are in this subdirectory of the temporary
+# directory.
+REPORT_CACHE_NAME = 'reports'
+
+
+def _resolve_runs(ts, run, num_comparison_runs, compare_to, baseline, cv):
+    """Find the runs the run is compared against, and all the runs the
+    comparison is made from."""
     machine = run.machine
-    machine_parameters = machine.parameters
 
     if baseline is None:
         # If a baseline has not been given, look up the run closest to
@@ -74,6 +149,17 @@ def generate_run_report(run, baseurl, only_html_body=False,
         runs_to_load.add(compare_to.id)
     if baseline:
         runs_to_load.add(baseline.id)
+    return compare_to, baseline, runs_to_load, cv_runs_to_load
+
+
+def compute_run_report(ts, run, compare_to, baseline, runs_to_load,
+                       cv_runs_to_load, aggregation_fn, confidence_lv, cv):
+    """
+    compute_run_report(...) -> RunReport
+
+    Compare the run against compare_to and baseline (either of which may be
+    None), from the samples of the given runs.
+    """
     sri = lnt.server.reporting.analysis.RunInfo(
         ts, runs_to_load, aggregation_fn, confidence_lv, cv=cv_runs_to_load)
 
@@ -88,25 +174,134 @@ def generate_run_report(run, baseurl, only_html_body=False,
     # Gather the run-over-run changes to report, organized by field and then
     # collated by change type.
     run_to_run_info, test_results = _get_changes_by_type(
-        ts, run, compare_to, metric_fields, test_names, num_comparison_runs,
-        sri, cv=cv)
+        ts, run, compare_to, metric_fields, test_names, sri, cv=cv)
 
     # If we have a baseline, gather the run-over-baseline results and
     # changes.
     if baseline:
         run_to_baseline_info, baselined_results = _get_changes_by_type(
-            ts, run, baseline, metric_fields, test_names, num_comparison_runs,
-            sri, cv=cv)
+            ts, run, baseline, metric_fields, test_names, sri, cv=cv)
     else:
         run_to_baseline_info = baselined_results = None
 
-    # Gather the run-over-run changes to report.
+    # The reports show the full comparisons of the tests which changed, so
+    # they are computed before the report is cached, without the samples.
+    for results in (test_results, baselined_results or []):
+        for _, field_results in results:
+            for bucket_name, bucket, _ in field_results:
+                if bucket_name != 'Unchanged Tests':
+                    for _, cr, _ in bucket:
+                        cr.result
+
+    report = RunReport(
+        run.id, compare_to and compare_to.id, baseline and baseline.id,
+        sorted(runs_to_load), sorted(cv_runs_to_load), aggregation_fn,
+        confidence_lv, cv, [tuple(t) for t in test_names], num_total_tests,
+        test_results, run_to_run_info, baselined_results,
+        run_to_baseline_info)
+    report._run_info = sri
+    return report
+
+
+def get_run_report(run, num_comparison_runs=0, compare_to=None,
+                   baseline=None, aggregation_fn=lnt.util.stats.median,
+                   confidence_lv=.05, cv=False, cache=True):
+    """
+    get_run_report(...) -> (RunReport, compare_to, baseline)
+
+    Get the comparison of the run against compare_to (by default, the previous
+    run) and baseline (by default, the baseline run of its machine), along
+    with those runs.
+
+    The comparison depends on the samples of the runs it is made from, which
+    never change, and on the stability of the tests of the machine of the run,
+    which changes with its data generation. It is looked up in the cache of
+    run reports by those, unless cache is False, and stored there if cache is
+    True. What the key of the report is made from is kept, so a report computed
+    before its run was committed can be stored later with store_run_report.
+    """
+    assert num_comparison_runs >= 0
+
+    ts = run.testsuite
+    compare_to, baseline, runs_to_load, cv_runs_to_load = _resolve_runs(
+        ts, run, num_comparison_runs, compare_to, baseline, cv)
+
+    generations, _ = ts.get_data_generation([run.machine_id])
+    identity = (lnt.server.ui.cache.VERSION, ts.v4db.path, ts.name, run.id,
+                cv, compare_to and compare_to.id, baseline and baseline.id,
+                sorted(runs_to_load), sorted(cv_runs_to_load),
+                getattr(aggregation_fn, '__name__', aggregation_fn),
+                confidence_lv)
+    key = _report_key(identity, generations)
+
+    report_cache = lnt.server.ui.cache.get_cache(ts.v4db.config,
+                                                 REPORT_CACHE_NAME)
+    report = None
+    if cache and report_cache is not None:
+        report = report_cache.get(key)
+        if report is not None:
+            report.bind(ts)
+    if report is None:
+        # Any change to the data the report is computed from changes the
+        # generation of the test suite after this.
+        (suite_generation,), _ = ts.get_data_generation([None])
+        report = compute_run_report(ts, run, compare_to, baseline,
+                                    runs_to_load, cv_runs_to_load,
+                                    aggregation_fn, confidence_lv, cv)
+        report.cache_key = key
+        report.cache_identity = identity
+        report.cache_generation = suite_generation
+        if cache and report_cache is not None:
+            report_cache.put(key, report)
+    return report, compare_to, baseline
+
+
+def _report_key(identity, generations):
+    return hashlib.sha1(repr(identity + (generations,))).hexdigest()
+
+
+def store_run_report(ts, report, generation):
+    """Store the report, computed with get_run_report before its run was
+    committed, in the cache of run reports, given the data generation the
+    import of the run was committed with (see
+    TestSuiteDB.bump_data_generation).
+
+    The report is left out if anything else changed the test suite between its
+    computation and the commit, as it may not have seen the change."""
+    report_cache = lnt.server.ui.cache.get_cache(ts.v4db.config,
+                                                 REPORT_CACHE_NAME)
+    if report_cache is None or report.cache_identity is None or \
+            generation != report.cache_generation + 1:
+        return
+    report.cache_key = _report_key(report.cache_identity, (generation,))
+    report_cache.put(report.cache_key, report)
+
+
+def generate_run_report(run, baseurl, only_html_body=False,
+                        num_comparison_runs=0, result=None,
+                        compare_to=None, baseline=None,
+                        aggregation_fn=lnt.util.stats.median, confidence_lv=.05,
+                        styles=dict(), classes=dict(), cv=False, cache=True):
+    """
+    generate_run_report(...) -> (str: subject, str: text_report,
+                                 str: html_report, RunReport: report)
+
+    Generate a comprehensive report on the results of the given individual
+    run, suitable for emailing or presentation on a web page. The comparison
+    the report is rendered from is cached, see get_run_report.
+    """
+    start_time = time.time()
+
+    ts = run.testsuite
+    report, compare_to, baseline = get_run_report(
+        run, num_comparison_runs, compare_to, baseline, aggregation_fn,
+        confidence_lv, cv, cache)
 
     # Collect the simplified results, if desired, for sending back to clients.
     if result is not None:
         pset_results = []
         result['test_results'] = [{ 'pset' : (), 'results' : pset_results}]
-        for field,field_results in test_results:
+        for field,field_results in report.get_test_results(ts):
             for _,bucket,_ in field_results:
                 for name,cr,_ in bucket:
                     # FIXME: Include additional information about performance
@@ -115,6 +310,39 @@ def generate_run_report(run, baseurl, only_html_body=False,
                                          cr.get_test_status(),
                                          cr.get_value_status()))
 
+    subject, text_report, html_report = render_run_report(
+        report, run, compare_to, baseline, baseurl,
+        only_html_body=only_html_body, styles=styles, classes=classes,
+        start_time=start_time)
+    return subject, text_report, html_report, report
+
+
+def render_run_report(report, run, compare_to, baseline, baseurl,
+                      only_html_body=False, styles=dict(), classes=dict(),
+                      start_time=None):
+    """
+    render_run_report(...) -> (str: subject, str: text_report,
+                               str: html_report)
+
+    Render the text and HTML reports of the comparison of the run against
+    compare_to and baseline.
+    """
+    if start_time is None:
+        start_time = time.time()
+
+    ts = run.testsuite
+    cv = report.cv
+    machine = run.machine
+    machine_parameters = machine.parameters
+    num_total_tests = report.num_total_tests
+    test_results = report.get_test_results(ts)
+    run_to_run_info = _by_field(ts, report.run_to_run_info)
+    if baseline:
+        baselined_results = report.get_baselined_results(ts)
+        run_to_baseline_info = _by_field(ts, report.run_to_baseline_info)
+    else:
+        baselined_results = run_to_baseline_info = None
+
     # Aggregate counts across all bucket types for our num item
     # display
     def aggregate_counts_across_all_bucket_types(i, name):
@@ -249,14 +477,21 @@ def generate_run_report(run, baseurl, only_html_body=False,
         styles=styles_, classes=classes_,
         start_time=start_time)
 
-    return subject, text_report, html_report, sri
+    return subject, text_report, html_report
 
 
-def _get_changes_by_type(ts, run_a, run_b, metric_fields, test_names,
-                         num_comparison_runs, sri, cv=False):
+def _get_changes_by_type(ts, run_a, run_b, metric_fields, test_names, sri,
+                         cv=False):
     comparison_results = {}
     results_by_type = []
+    stable_tests = ts.get_stable_tests(
+        run_a, [test_id for _, test_id in test_names], STABILITY_THRESHOLD,
+        cv=cv)
     for field in metric_fields:
+        field_results = sri.get_run_comparison_results(
+            run_a, run_b, field, ts.Sample.get_hash_of_binary_field(),
+            test_ids=[test_id for _, test_id in test_names], cv=cv,
+            stable_tests=stable_tests)
         new_failures = []
         new_passes = []
         perf_regressions = []
@@ -268,11 +503,8 @@ def _get_changes_by_type(ts, run_a, run_b, metric_fields, test_names,
         existing_failures = []
         unchanged_tests = []
         for name, test_id in test_names:
-            stable_test = ts.is_test_stable(run_a, test_id, STABILITY_THRESHOLD, cv=cv)
-            cr = sri.get_run_comparison_result(
-                run_a, run_b, test_id, field,
-                ts.Sample.get_hash_of_binary_field(), cv=cv, stable_test=stable_test)
-            comparison_results[(name, field)] = cr
+            cr = field_results[test_id]
+            comparison_results[(name, field.index)] = cr
             test_status = cr.get_test_status()
             perf_status = cr.get_value_status()
             if test_status == lnt.server.reporting.analysis.REGRESSED:
@@ -299,7 +531,7 @@ def _get_changes_by_type(ts, run_a, run_b, metric_fields, test_names,
             bucket.append((name, cr, test_id))
 
         results_by_type.append(
-            (field, (('New Failures', new_failures, False),
+            (field.index, (('New Failures', new_failures, False),
                      ('New Passes', new_passes, False),
                      ('Stable Performance Regressions', perf_regressions, True),
                      ('Stable Performance Improvements', perf_improvements, True),
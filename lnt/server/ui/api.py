@@ -1,9 +1,13 @@
 from flask import current_app, g
 from flask import request
 from sqlalchemy.orm.exc import NoResultFound
-from flask_restful import Resource, reqparse, fields, marshal_with, abort
-from lnt.testing import PASS
+from flask_restful import Resource, reqparse, fields, marshal, marshal_with
+from flask_restful import abort
 import json
+from collections import OrderedDict
+
+import lnt.server.db.graph
+import lnt.server.ui.cache
 parser = reqparse.RequestParser()
 parser.add_argument('db', type=str)
 
@@ -118,20 +122,34 @@ run_fields = {
 }
 
 
+def cached_api_response(ts, machine_ids, render, resource_fields):
+    """Respond with the marshalled result of render(), cached until the data
+    of the given machines change (see lnt.server.ui.cache)."""
+    return lnt.server.ui.cache.cached_response(
+        ts, machine_ids,
+        lambda: current_app.api.make_response(
+            marshal(render(), resource_fields), 200))
+
+
 class Runs(Resource):
     method_decorators = [in_db]
 
-    @marshal_with(run_fields)
     def get(self, run_id):
         ts = request.get_testsuite()
-        try:
-            changes = ts.query(ts.Run).join(ts.Machine).filter(
-                ts.Run.id == run_id).one()
-        except NoResultFound:
-            abort(404, message="Invalid run.")
+        machine_ids = [machine_id for machine_id, in
+                       ts.query(ts.Run.machine_id).
+                       filter(ts.Run.id == run_id)]
 
-        changes = with_ts(changes)
-        return changes
+        def render():
+            try:
+                changes = ts.query(ts.Run).join(ts.Machine).filter(
+                    ts.Run.id == run_id).one()
+            except NoResultFound:
+                abort(404, message="Invalid run.")
+
+            changes = with_ts(changes)
+            return changes
+        return cached_api_response(ts, machine_ids, render, run_fields)
 
 
 order_fields = {
@@ -145,14 +163,18 @@ order_fields = {
 class Order(Resource):
     method_decorators = [in_db]
 
-    @marshal_with(order_fields)
     def get(self, order_id):
         ts = request.get_testsuite()
-        try:
-            changes = ts.query(ts.Order).filter(ts.Order.id == order_id).one()
-        except NoResultFound:
-            abort(404, message="Invalid order.")
-        return changes
+
+        def render():
+            try:
+                changes = ts.query(ts.Order).filter(
+                    ts.Order.id == order_id).one()
+            except NoResultFound:
+                abort(404, message="Invalid order.")
+            return changes
+        # The orders next to an order change with the runs of any machine.
+        return cached_api_response(ts, [None], render, order_fields)
 
 
 class Graph(Resource):
@@ -162,30 +184,47 @@ class Graph(Resource):
     def get(self, machine_id, test_id, field_index):
         """Get the data for a particular line in a graph."""
         ts = request.get_testsuite()
-        # Maybe we don't need to do this?
-        try:
-            machine = ts.query(ts.Machine) \
-                .filter(ts.Machine.id == machine_id) \
-                .one()
-            test = ts.query(ts.Test) \
-                .filter(ts.Test.id == test_id) \
-                .one()
-            field = ts.sample_fields[field_index]
-        except NoResultFound:
+        machines, tests = lnt.server.db.graph.get_machines_and_tests(
+            ts, [machine_id], [test_id])
+        if machine_id not in machines or test_id not in tests:
             return abort(404)
+        field = ts.sample_fields[field_index]
 
-        q = ts.query(field.column, ts.Order.llvm_project_revision, ts.Run.start_time, ts.Run.id) \
-            .join(ts.Run) \
-            .join(ts.Order) \
-            .filter(ts.Run.machine_id == machine.id) \
-            .filter(ts.Sample.test == test) \
-            .filter(field.column != None) \
-            .order_by(ts.Order.llvm_project_revision)
-
-        if field.status_field:
-            q = q.filter((field.status_field.column == PASS) |
-                         (field.status_field.column == None))
-        samples = [[rev, val, {'label': rev, 'date': str(time), 'runID': str(rid)}] for val, rev, time, rid in q.all()]
+        # Long histories can be restricted to a range of revisions, and
+        # downsampled to max_points revisions, keeping the regressions.
+        min_revision = request.args.get('min_revision', None, type=int)
+        max_revision = request.args.get('max_revision', None, type=int)
+        max_points = request.args.get('max_points', 0, type=int)
+
+        # With summary set, give the median of the passing samples at each
+        # revision, along with the summary of the samples, rather than every
+        # sample.
+        summary = bool(request.args.get('summary'))
+
+        plot = (machine_id, test_id, field)
+        if summary:
+            rollups = lnt.server.db.graph.get_plot_rollups(
+                ts, [plot], max_rank=max_revision, min_rank=min_revision)[plot]
+            data = OrderedDict((rev, [rollup[:3]])
+                               for rev, rollup in rollups.items())
+        else:
+            data = lnt.server.db.graph.get_plot_samples(
+                ts, [plot], max_rank=max_revision,
+                min_rank=min_revision)[plot]
+        if max_points:
+            change_revisions = lnt.server.db.graph.get_plot_change_revisions(
+                ts, [plot])[plot]
+            data = lnt.server.db.graph.downsample_plot_samples(
+                data, max_points, change_revisions)
+        samples = [[rev, val, {'label': rev, 'date': str(time),
+                               'runID': str(rid)}]
+                   for rev, values in data.items()
+                   for val, time, rid in values]
+        if summary:
+            for rev, _, metadata in samples:
+                _, _, _, num_samples, min_value, mean, mad = rollups[rev]
+                metadata.update({'count': num_samples, 'min': min_value,
+                                 'mean': mean, 'mad': mad})
 
         return samples
 
@@ -1,12 +1,17 @@
+import contextlib
+import datetime
 import sys
+import threading
 import jinja2
 import logging
 import logging.handlers
 from logging import Formatter
 import os
+import tempfile
 import time
 import StringIO
 import traceback
+import zlib
 
 import flask
 from flask import current_app
@@ -17,8 +22,11 @@ from flask import Flask
 from flask_restful import Resource, Api
 
 import lnt
+import lnt.server.db.jobs
+import lnt.server.db.submissions
 import lnt.server.db.v4db
 import lnt.server.instance
+import lnt.server.ui.cache
 import lnt.server.ui.filters
 import lnt.server.ui.globals
 import lnt.server.ui.views
@@ -27,9 +35,15 @@ import lnt.server.ui.regression_views
 import lnt.server.ui.profile_views
 from lnt.server.ui.api import load_api_resources
 import lnt.server.db.rules_manager
+from lnt.util import async_ops
 
 from sqlalchemy.exc import DatabaseError
 
+# The longest (and shortest) time, in seconds, between two checks for the
+# background jobs which became ready to run (see App.drain_queued_jobs).
+JOB_POLL_INTERVAL = 300
+MIN_JOB_POLL_INTERVAL = 10
+
 class RootSlashPatchMiddleware(object):
     def __init__(self, app):
         self.app = app
@@ -40,6 +54,113 @@ class RootSlashPatchMiddleware(object):
                 environ, start_response)
         return self.app(environ, start_response)
 
+class BodyTooLarge(Exception):
+    pass
+
+class DecompressBodyMiddleware(object):
+    """Decompress the bodies of the submissions sent with a gzip or deflate
+    Content-Encoding (by lnt submit), so the application sees them as if they
+    were sent uncompressed.
+
+    The body is decompressed a chunk at a time, into a temporary file once it
+    gets large, so it is never whole in memory. Bodies which decompress to more
+    than max_size bytes are rejected. Bodies without a Content-Length are read
+    to their end when the server marks them as terminated (as servers do for
+    chunked requests), and rejected otherwise, as they would be lost."""
+
+    ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+    # The pages which take submissions.
+    PAGES = ('submitRun', 'submitBatch')
+    CHUNK_SIZE = 64 * 1024
+    # How much of a decompressed body to keep in memory.
+    MEMORY_SIZE = 1024 * 1024
+    # The default size limit of decompressed bodies.
+    MAX_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, app, max_size=None):
+        self.app = app
+        self.max_size = max_size or self.MAX_SIZE
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        page = environ.get('PATH_INFO', '').rstrip('/').rsplit('/', 1)[-1]
+        if encoding not in self.ENCODINGS or page not in self.PAGES:
+            return self.app(environ, start_response)
+
+        length = environ.get('CONTENT_LENGTH')
+        if not length and not environ.get('wsgi.input_terminated'):
+            response = flask.Response(
+                "compressed bodies require a Content-Length", status=411,
+                mimetype='text/plain')
+            return response(environ, start_response)
+
+        try:
+            length = int(length) if length else None
+            body = self._decompress(environ['wsgi.input'], length, encoding)
+        except BodyTooLarge:
+            response = flask.Response(
+                "the decompressed body is larger than %d bytes" %
+                self.max_size, status=413, mimetype='text/plain')
+            return response(environ, start_response)
+        except (ValueError, zlib.error) as e:
+            response = flask.Response("unable to decompress the body: %s" % e,
+                                      status=400, mimetype='text/plain')
+            return response(environ, start_response)
+
+        environ = dict(environ)
+        del environ['HTTP_CONTENT_ENCODING']
+        environ['CONTENT_LENGTH'] = str(body.tell())
+        body.seek(0)
+        environ['wsgi.input'] = body
+        return self.app(environ, start_response)
+
+    def _read(self, stream, length):
+        """Read the body a chunk at a time, up to length bytes, or up to its
+        end if length is None."""
+        while length is None or length > 0:
+            size = self.CHUNK_SIZE
+            if length is not None:
+                size = min(length, size)
+            data = stream.read(size)
+            if not data:
+                if length is None:
+                    return
+                raise ValueError("truncated body")
+            if length is not None:
+                length -= len(data)
+            yield data
+
+    @staticmethod
+    def _decompressor(data, encoding):
+        """Make the decompressor of the body which starts with data."""
+        # Accept both gzip and zlib streams, whatever the encoding says.
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            # Some clients send raw deflate streams, without the zlib header.
+            try:
+                decompressor.copy().decompress(data[:2])
+            except zlib.error:
+                return zlib.decompressobj(-zlib.MAX_WBITS)
+        return decompressor
+
+    def _decompress(self, stream, length, encoding):
+        body = tempfile.SpooledTemporaryFile(self.MEMORY_SIZE)
+        decompressor = None
+        for data in self._read(stream, length):
+            if decompressor is None:
+                decompressor = self._decompressor(data, encoding)
+            # Decompress a chunk at a time, however much data expands.
+            while data:
+                body.write(decompressor.decompress(data, self.CHUNK_SIZE))
+                data = decompressor.unconsumed_tail
+                if body.tell() > self.max_size:
+                    raise BodyTooLarge()
+        if decompressor is not None:
+            body.write(decompressor.flush())
+        if body.tell() > self.max_size:
+            raise BodyTooLarge()
+        return body
+
 class Request(flask.Request):
     def __init__(self, *args, **kwargs):
         super(Request, self).__init__(*args, **kwargs)
@@ -138,11 +259,14 @@ class App(LNTExceptionLoggerFlask):
         instance = lnt.server.instance.Instance.frompath(config_path)
         app =  App.create_with_instance(instance)
         app.start_file_logging()
+        app.before_first_request(app.resume_queued_jobs)
         return app
     
     def __init__(self, name):
         super(App, self).__init__(name)
         self.start_time = time.time()
+        # The last time the finished jobs were removed (see drain_queued_jobs).
+        self.last_prune_time = 0
         # Override the request class.
         self.request_class = Request
 
@@ -152,6 +276,8 @@ class App(LNTExceptionLoggerFlask):
         # Inject a fix for missing slashes on the root URL (see Flask issue
         # #169).
         self.wsgi_app = RootSlashPatchMiddleware(self.wsgi_app)
+        self.decompress_body = DecompressBodyMiddleware(self.wsgi_app)
+        self.wsgi_app = self.decompress_body
         self.logger.setLevel(logging.DEBUG)
 
         
@@ -165,9 +291,67 @@ class App(LNTExceptionLoggerFlask):
 
         # Set the application secret key.
         self.secret_key = self.old_config.secretKey
+
+        # Limit the size of the submissions once decompressed.
+        max_size = getattr(self.old_config, 'max_submission_size', None)
+        if max_size:
+            self.decompress_body.max_size = max_size * 1024 * 1024
+
+        # Cache the pages about runs, unless disabled.
+        self.response_cache = lnt.server.ui.cache.get_cache(self.old_config,
+                                                            'responses')
         
         lnt.server.db.rules_manager.register_hooks()
 
+    def resume_queued_jobs(self):
+        """Run the background jobs left queued when the server last stopped,
+        and then the ones which become ready later (see drain_queued_jobs)."""
+        for db_name in self.old_config.get_database_names():
+            async_ops.async_run_queued_jobs(db_name, self.old_config)
+        self.schedule_queued_jobs(MIN_JOB_POLL_INTERVAL)
+
+    def schedule_queued_jobs(self, delay):
+        """Drain the job queues again in delay seconds."""
+        timer = threading.Timer(delay, self.drain_queued_jobs)
+        timer.daemon = True
+        timer.start()
+
+    def drain_queued_jobs(self):
+        """Have the workers run the jobs of each database which are ready to
+        run, and check again when the next one is.
+
+        Submissions have the jobs they queue run right away, but the retries of
+        failed jobs, and the jobs whose lease expired, become ready later on
+        their own. The queues are checked every JOB_POLL_INTERVAL at most, as
+        other processes may queue jobs as well. The jobs and submissions which
+        finished long ago are removed along the way (see
+        lnt.server.db.jobs.prune).
+        """
+        delay = JOB_POLL_INTERVAL
+        now = datetime.datetime.utcnow()
+        prune = time.time() - self.last_prune_time >= \
+            lnt.server.db.jobs.PRUNE_INTERVAL
+        if prune:
+            self.last_prune_time = time.time()
+        for db_name in self.old_config.get_database_names():
+            try:
+                with contextlib.closing(
+                        self.old_config.get_database(db_name)) as db:
+                    if prune:
+                        lnt.server.db.jobs.prune(db)
+                        lnt.server.db.submissions.prune(db)
+                    next_time = lnt.server.db.jobs.get_next_time(db)
+                if next_time is None:
+                    continue
+                if next_time <= now:
+                    async_ops.async_run_queued_jobs(db_name, self.old_config)
+                else:
+                    delay = min(delay, (next_time - now).total_seconds())
+            except Exception:
+                error("Failed to drain the job queue of %s: %s" % (
+                    db_name, traceback.format_exc()))
+        self.schedule_queued_jobs(max(delay, MIN_JOB_POLL_INTERVAL))
+
     def start_file_logging(self):
         """Start server production logging.  At this point flask already logs
         to stderr, so just log to a file as well.
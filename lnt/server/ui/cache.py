@@ -0,0 +1,300 @@
+"""
+Cache of the responses of the pages about runs.
+
+The data of a run never changes once imported, but the pages about it also show
+the runs around it on its machine, and its field changes, which do change as
+runs are imported and deleted. Every such change bumps the data generation of
+the machine (see TestSuiteDB.bump_data_generation), so a response is identified
+by its URL and the generations of the machines it shows data of:
+
+ * The identity of the response is sent as its ETag, along with the time of
+   the latest change of the data as its Last-Modified time, so clients which
+   already have it are answered with a 304, without rendering it.
+
+ * The rendered responses are kept in a directory shared by all the server
+   processes, which is bounded in size by removing the least recently used
+   ones, once a process estimates it grew over its size. The most recently
+   used ones are also kept in the memory of each process. A response which is
+   out of date is never looked up again, and is eventually removed.
+
+ * The responses are also identified by the version of LNT and of the cache
+   (see CACHE_VERSION), and kept in a directory of their own for each, so the
+   responses rendered before an upgrade are neither served nor reported as
+   unchanged to clients.
+
+The comparisons the run reports are rendered from are cached in the same way
+(see lnt.server.reporting.runs.get_run_report).
+"""
+
+import cPickle
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import flask
+import werkzeug.http
+from flask import current_app, g
+from flask import request
+
+import lnt
+from lnt.testing.util.commands import warning
+
+# The size (in megabytes) of each cache, if the configuration does not set it.
+DEFAULT_SIZE = 64
+
+# The size of the values each process keeps in memory, as a fraction of the
+# size of the ones kept on disk.
+MEMORY_FRACTION = 8
+
+# The number of values a process stores between the scans of the whole cache
+# directory, besides the scans made once its estimate of the size of the
+# directory exceeds the size of the cache. Other processes also store values.
+SCAN_INTERVAL = 100
+
+# The version of the cached values, and of the pages rendered from them,
+# besides the version of LNT. Bump it when either changes in a way older values
+# should not be used for.
+CACHE_VERSION = 1
+
+# What the cached values and responses are identified by besides their data.
+VERSION = '%s-%d' % (lnt.__version__, CACHE_VERSION)
+
+
+class FileCache(object):
+    """A size-bounded, least recently used store of values, by key, on disk
+    and in memory. The values are pickled."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.max_memory_size = max_size // MEMORY_FRACTION
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # The estimated size of the values on disk (None until scanned), and
+        # the number of values stored since the last scan.
+        self._disk_size = None
+        self._puts = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """Return the value stored for key, or None if there is none (or it
+        cannot be unpickled, in which case it is removed)."""
+        with self._lock:
+            data = self._memory.pop(key, None)
+            if data is not None:
+                self._memory[key] = data
+        if data is None:
+            path = self._file(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # Mark the value as recently used.
+                os.utime(path, None)
+            except (IOError, OSError):
+                return None
+            self._remember(key, data)
+        try:
+            return cPickle.loads(data)
+        except Exception as e:
+            # Values of classes which changed since they were stored fail with
+            # about any error.
+            warning("Unable to load cached %s: %s" % (key, e))
+            self._forget(key)
+            return None
+
+    def _forget(self, key):
+        with self._lock:
+            data = self._memory.pop(key, None)
+            if data is not None:
+                self._memory_size -= len(data)
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def put(self, key, value):
+        """Store the value for key, removing the least recently used ones if
+        the cache grows over its size."""
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            # Write to a temporary file first, so other processes never read
+            # half written values.
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._file(key))
+            if self._should_scan(len(data)):
+                self._evict()
+        except (IOError, OSError) as e:
+            warning("Unable to cache %s: %s" % (key, e))
+
+    def _remember(self, key, data):
+        size = len(data)
+        if size > self.max_memory_size:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_size -= len(old)
+            self._memory[key] = data
+            self._memory_size += size
+            while self._memory_size > self.max_memory_size:
+                _, old = self._memory.popitem(last=False)
+                self._memory_size -= len(old)
+
+    def _should_scan(self, size):
+        with self._lock:
+            self._puts += 1
+            if self._disk_size is not None:
+                self._disk_size += size
+            return self._disk_size is None or \
+                self._disk_size > self.max_size or \
+                self._puts >= SCAN_INTERVAL
+
+    def _evict(self):
+        """Remove the least recently used values from disk, until the others
+        fit."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            try:
+                st = os.stat(self._file(name))
+            except OSError:
+                # Removed by another process.
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+            total += st.st_size
+        if total > self.max_size:
+            entries.sort()
+            for _, name, size in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(self._file(name))
+                except OSError:
+                    pass
+                total -= size
+        with self._lock:
+            self._disk_size = total
+            self._puts = 0
+
+    def clear(self):
+        """Remove all the stored values."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            self._disk_size = None
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            try:
+                os.remove(self._file(name))
+            except OSError:
+                pass
+
+
+# The caches of each process, by path, so the values they keep in memory
+# outlive the requests.
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(config, name):
+    """
+    get_cache(config, name) -> FileCache or None
+
+    Get the cache of the given name in the temporary directory of the
+    configuration, or None if caching is disabled (or there is no
+    configuration). The values of each version are kept in a directory of
+    their own, and the ones of other versions are removed.
+    """
+    if config is None:
+        return None
+    size = getattr(config, 'response_cache_size', None)
+    if size is None:
+        size = DEFAULT_SIZE
+    if not size:
+        return None
+    path = os.path.join(config.tempDir, name, VERSION)
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            _remove_other_versions(path)
+            _caches[path] = cache = FileCache(path, int(size * 1024 * 1024))
+    return cache
+
+
+def _remove_other_versions(path):
+    parent = os.path.dirname(path)
+    try:
+        names = os.listdir(parent)
+    except OSError:
+        return
+    for name in names:
+        other = os.path.join(parent, name)
+        if other == path:
+            continue
+        if os.path.isdir(other):
+            shutil.rmtree(other, ignore_errors=True)
+        else:
+            try:
+                os.remove(other)
+            except OSError:
+                pass
+
+
+def cached_response(ts, machine_ids, render):
+    """
+    cached_response(ts, machine_ids, render) -> Response
+
+    Respond to the current request with the response made by render(), which
+    shows data of the given machines (None standing for the whole test suite)
+    and depends on nothing else but the request URL.
+
+    The response is looked up in the cache of the application before
+    rendering it, and answered with a 304 if the client has it already.
+    """
+    # Only the pages which are read are cached, and the messages flashed to
+    # the user are shown once.
+    if request.method not in ('GET', 'HEAD') or '_flashes' in flask.session:
+        return render()
+
+    generations, modified = ts.get_data_generation(machine_ids)
+    identity = repr((VERSION, request.host_url, g.db_name, ts.name,
+                     request.path, sorted(request.args.items(multi=True)),
+                     generations))
+    etag = hashlib.sha1(identity).hexdigest()
+
+    def conditional(response):
+        response.set_etag(etag)
+        if modified is not None:
+            response.last_modified = modified
+        # Clients must ask whether the response changed before using it.
+        response.cache_control.no_cache = True
+        return response
+
+    if not werkzeug.http.is_resource_modified(request.environ, etag=etag,
+                                              last_modified=modified):
+        return conditional(current_app.response_class(status=304))
+
+    cache = getattr(current_app, 'response_cache', None)
+    item = cache.get(etag) if cache is not None else None
+    if item is not None:
+        mimetype, data = item
+        response = current_app.response_class(data, mimetype=mimetype)
+    else:
+        response = current_app.make_response(render())
+        if response.status_code != 200:
+            return response
+        if cache is not None:
+            cache.put(etag, (response.mimetype, response.get_data()))
+    return conditional(response)
@@ -388,7 +388,7 @@ def v4_make_regression(machine_id, test_id, field_index, run_id):
             .filter(ts.FieldChange.end_order == end_order) \
             .filter(ts.FieldChange.test_id == test_id) \
             .filter(ts.FieldChange.machine == run.machine) \
-            .filter(ts.FieldChange.field == field) \
+            .filter(ts.FieldChange.field_id == field.id) \
             .one()
     except sqlalchemy.orm.exc.NoResultFound:
             f = None
@@ -406,6 +406,9 @@ def v4_make_regression(machine_id, test_id, field_index, run_id):
         f.old_value = result.previous
         f.new_value = result.current
         f.run = run
+    ts.session.flush()
+    ts.update_test_stability(run.machine_id, [test_id])
+    ts.bump_data_generation([run.machine_id])
     ts.commit()
     
     # Make new regressions.
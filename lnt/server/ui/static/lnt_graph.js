@@ -9,6 +9,9 @@ var normalize = false;
 var prefix = "";
 
 var MAX_TO_DRAW = 10;
+// The number of revisions of each line to download, the server downsamples
+// longer histories.
+var MAX_POINTS = 1000;
 
 var STATE_NAMES = {0: 'Detected',
                    1: 'Staged',
@@ -355,7 +358,8 @@ function update_graph() {
 // To be called by main page. It will fetch data and make graph ready.
 function add_data_to_graph(URL, index) {
     "use strict";
-    $.getJSON(get_api_url("graph", db_name, test_suite_name, URL), function (data) {
+    $.getJSON(get_api_url("graph", db_name, test_suite_name, URL),
+              {max_points: MAX_POINTS}, function (data) {
         new_graph_data_callback(data, index);
     });
     $.getJSON(get_api_url("regression", db_name, test_suite_name, URL), function (data) {
@@ -3,11 +3,11 @@ import datetime
 import logging
 import os
 import re
+import shutil
 import tempfile
 import time
 import copy
 import json
-import urllib2
 import sys
 
 import flask
@@ -30,18 +30,21 @@ import lnt.util.stats
 from lnt.server.ui.globals import db_url_for, v4_url_for
 import lnt.server.reporting.analysis
 import lnt.server.reporting.runs
+import lnt.server.ui.cache
 from lnt.server.ui.decorators import frontend, db_route, v4_route
 from lnt.testing.util.commands import warning, error, note
 import lnt.server.ui.util
 import lnt.server.reporting.dailyreport
 import lnt.server.reporting.summaryreport
+import lnt.server.db.gerrit
+import lnt.server.db.graph
 import lnt.server.db.rules_manager
 import lnt.server.db.search
-from collections import namedtuple
+import lnt.server.db.submissions
+from collections import namedtuple, OrderedDict
 from lnt.util import async_ops
 
 integral_rex = re.compile(r"[\d]+")
-cv_sha_regex = re.compile('h=(?P<sha>[0-9A-z]+)')
 
 ###
 # Root-Only Routes
@@ -81,15 +84,82 @@ def index():
 ###
 # Database Actions
 
-@db_route('/submitRun', only_v3=False, methods=('GET', 'POST'))
-def submit_run():
-    if request.method == 'POST':
-        input_file = request.files.get('file')
-        input_data = request.form.get('input_data')
-        commit = int(request.form.get('commit', 0))
+# The content types of submissions posted as forms. Other submissions are the
+# data itself, with the options in the query string.
+FORM_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
 
+
+def _submission_input():
+    """Return the uploaded file (as a stream), the posted data and the options
+    of the submission being posted."""
+    if request.mimetype in FORM_TYPES:
+        input_file = request.files.get('file')
         if input_file and not input_file.content_length:
             input_file = None
+        return (input_file.stream if input_file else None,
+                request.form.get('input_data'), request.form)
+    if not request.content_length:
+        return None, None, request.args
+    return request.stream, None, request.args
+
+
+def _stash_submission(input_file, input_data, suffix):
+    """Stash a copy of the raw submission, either the uploaded file or the
+    posted data, and return its path. Files are copied a chunk at a time, so
+    large ones are never whole in memory."""
+    # To keep the temporary directory organized, we keep files in
+    # subdirectories organized by (database, year-month).
+    utcnow = datetime.datetime.utcnow()
+    tmpdir = os.path.join(current_app.old_config.tempDir, g.db_name,
+                          "%04d-%02d" % (utcnow.year, utcnow.month))
+    try:
+        os.makedirs(tmpdir)
+    except OSError, e:
+        pass
+
+    # Save the file under a name prefixed with the date, to make it easier
+    # to use these files in cases we might need them for debugging or data
+    # recovery.
+    prefix = utcnow.strftime("data-%Y-%m-%d_%H-%M-%S")
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix,
+                                dir=str(tmpdir))
+    with os.fdopen(fd, 'wb') as f:
+        if input_file:
+            shutil.copyfileobj(input_file, f)
+        else:
+            f.write(input_data)
+    return path
+
+
+def _fixup_result_urls(result):
+    # It is nice to have a full URL to the runs, so fixup the request URL
+    # here were we know more about the flask instance.
+    for item in [result] + result.get('results', []):
+        if item.get('result_url'):
+            item['result_url'] = request.url_root + item['result_url']
+    return result
+
+
+def _queued_response(submission):
+    """Answer a submission imported in the background with where to poll for
+    its result."""
+    status_url = db_url_for('submission_status', id=submission.id,
+                            _external=True)
+    response = flask.jsonify(submission_id=submission.id,
+                             state=submission.state,
+                             status_url=status_url)
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+
+@db_route('/submitRun', only_v3=False, methods=('GET', 'POST'))
+def submit_run():
+    if request.method == 'POST':
+        input_file, input_data, options = _submission_input()
+        commit = int(options.get('commit', 0))
+        # Whether to answer right away, and import the data in the background.
+        async_import = int(options.get('async', 0))
 
         if not input_file and not input_data:
             return render_template(
@@ -99,35 +169,20 @@ def submit_run():
                 "submit_run.html",
                 error="cannot provide input file *and* data")
 
-        if input_file:
-            data_value = input_file.read()
-        else:
-            data_value = input_data
-
-        # Stash a copy of the raw submission.
-        #
-        # To keep the temporary directory organized, we keep files in
-        # subdirectories organized by (database, year-month).
-        utcnow = datetime.datetime.utcnow()
-        tmpdir = os.path.join(current_app.old_config.tempDir, g.db_name,
-                              "%04d-%02d" % (utcnow.year, utcnow.month))
-        try:
-            os.makedirs(tmpdir)
-        except OSError, e:
-            pass
-
-        # Save the file under a name prefixed with the date, to make it easier
-        # to use these files in cases we might need them for debugging or data
-        # recovery.
-        prefix = utcnow.strftime("data-%Y-%m-%d_%H-%M-%S")
-        fd, path = tempfile.mkstemp(prefix=prefix, suffix='.plist',
-                                    dir=str(tmpdir))
-        os.write(fd, data_value)
-        os.close(fd)
+        path = _stash_submission(input_file, input_data, '.plist')
 
         # Get a DB connection.
         db = request.get_db()
 
+        if async_import:
+            # Queue the import of the data, and tell the submitter where to
+            # poll for its result.
+            submission = lnt.server.db.submissions.stage(db, g.db_name, path,
+                                                         commit)
+            db.commit()
+            async_ops.async_run_queued_jobs(g.db_name, current_app.old_config)
+            return _queued_response(submission)
+
         # Import the data.
         #
         # FIXME: Gracefully handle formats failures and DOS attempts. We
@@ -135,16 +190,61 @@ def submit_run():
         result = lnt.util.ImportData.import_and_report(
             current_app.old_config, g.db_name, db, path, '<auto>', commit)
 
-        # It is nice to have a full URL to the run, so fixup the request URL
-        # here were we know more about the flask instance.
-        if result.get('result_url'):
-            result['result_url'] = request.url_root + result['result_url']
-
-        return flask.jsonify(**result)
+        return flask.jsonify(**_fixup_result_urls(result))
 
     return render_template("submit_run.html")
 
 
+@db_route('/submitBatch', only_v3=False, methods=('POST',))
+def submit_batch():
+    """Import a batch of reports, either newline delimited JSON or a tar of
+    report files, and answer with the result of each report (see
+    lnt.util.ImportData.import_batch)."""
+    input_file, input_data, options = _submission_input()
+    commit = int(options.get('commit', 0))
+    batch_size = int(options.get('batch_size',
+                                 lnt.util.ImportData.BATCH_SIZE))
+    async_import = int(options.get('async', 0))
+
+    if bool(input_file) == bool(input_data):
+        response = flask.jsonify(
+            success=False, error="must provide either input file or data")
+        response.status_code = 400
+        return response
+
+    path = _stash_submission(input_file, input_data, '.batch')
+
+    db = request.get_db()
+    if async_import:
+        submission = lnt.server.db.submissions.stage(db, g.db_name, path,
+                                                     commit, batch=True)
+        db.commit()
+        async_ops.async_run_queued_jobs(g.db_name, current_app.old_config)
+        return _queued_response(submission)
+
+    result = lnt.util.ImportData.import_batch(
+        current_app.old_config, g.db_name, db, path, commit, batch_size)
+    return flask.jsonify(**_fixup_result_urls(result))
+
+
+@db_route('/submission/<int:id>', only_v3=False)
+def submission_status(id):
+    """The state of a submission imported in the background, or the result of
+    its import once it is done (like the one of a synchronous submission)."""
+    db = request.get_db()
+    submission = db.query(lnt.server.db.submissions.Submission).get(id)
+    if submission is None:
+        abort(404)
+
+    if submission.state != lnt.server.db.submissions.DONE:
+        response = flask.jsonify(submission_id=submission.id,
+                                 state=submission.state)
+        response.status_code = 202
+        return response
+
+    return flask.jsonify(**_fixup_result_urls(submission.result))
+
+
 ###
 # V4 Schema Viewer
 
@@ -200,28 +300,26 @@ def v4_machines():
 @v4_route("/machine/<int:id>")
 def v4_machine(id):
     # Compute the list of associated runs, grouped by order.
-    from lnt.server.ui import util
 
     # Gather all the runs on this machine.
     ts = request.get_testsuite()
 
-    master_runs = util.multidict(
-        (run_order, r)
-        for r, run_order in ts.query(ts.Run, ts.Order).
-            join(ts.Order).
-            filter(ts.Run.machine_id == id).
-            order_by(ts.Run.start_time.desc()))
+    master_runs = OrderedDict()
+    for r, run_order in ts.query(ts.Run, ts.Order). \
+            join(ts.Order). \
+            filter(ts.Run.machine_id == id). \
+            order_by(ts.Order.rank, ts.Order.id, ts.Run.start_time.desc()):
+        master_runs.setdefault(run_order, []).append(r)
     master_runs = master_runs.items()
-    master_runs.sort()
-
-    cv_runs = util.multidict(
-        (run_order, r)
-        for r, run_order in ts.query(ts.CVRun, ts.CVOrder). \
-            join(ts.CVOrder).
-            filter(ts.CVRun.machine_id == id).
-            order_by(ts.CVRun.start_time.desc()))
+
+    cv_runs = OrderedDict()
+    for r, run_order in ts.query(ts.CVRun, ts.CVOrder). \
+            join(ts.CVOrder). \
+            filter(ts.CVRun.machine_id == id). \
+            order_by(ts.CVOrder.rank, ts.CVOrder.id,
+                     ts.CVRun.start_time.desc()):
+        cv_runs.setdefault(run_order, []).append(r)
     cv_runs = cv_runs.items()
-    cv_runs.sort()
 
     if request.args.get('json'):
         json_obj = dict()
@@ -342,7 +440,11 @@ class V4RequestInfo(object):
             num_comparison_runs=self.num_comparison_runs,
             aggregation_fn=self.aggregation_fn, confidence_lv=confidence_lv,
             styles=styles, classes=classes)
-        _, self.text_report, self.html_report, self.sri = reports
+        _, self.text_report, self.html_report, self.report = reports
+
+    @property
+    def sri(self):
+        return self.report.get_run_info(self.ts)
 
 
 class V4CVRequestInfo(object):
@@ -438,30 +540,65 @@ class V4CVRequestInfo(object):
             num_comparison_runs=self.num_comparison_runs,
             aggregation_fn=self.aggregation_fn, confidence_lv=confidence_lv,
             styles=styles, classes=classes, cv=True)
-        _, self.text_report, self.html_report, self.sri = reports
+        _, self.text_report, self.html_report, self.report = reports
+
+    @property
+    def sri(self):
+        return self.report.get_run_info(self.ts)
+
+
+def cached_run_response(id, render, cv=False):
+    """
+    Respond with render(), cached until the runs or field changes change on
+    the machine of the run, or on the ones of the runs it is compared to.
+    """
+    ts = request.get_testsuite()
+    run_class = ts.CVRun if cv else ts.Run
+    machine_ids = [machine_id for machine_id, in
+                   ts.query(run_class.machine_id).filter(run_class.id == id)]
+    other_ids = []
+    for name in ('compare_to', 'baseline'):
+        try:
+            other_ids.append(int(request.args.get(name)))
+        except (TypeError, ValueError):
+            pass
+    if other_ids:
+        machine_ids.extend(machine_id for machine_id, in
+                           ts.query(ts.Run.machine_id).
+                           filter(ts.Run.id.in_(other_ids)))
+    # The data table lists all the tests of the test suite.
+    if request.args.get('show_data_table'):
+        machine_ids.append(None)
+    return lnt.server.ui.cache.cached_response(ts, machine_ids, render)
 
 
 @v4_route("/<int:id>/report")
 def v4_report(id):
-    info = V4RequestInfo(id, only_html_body=False)
+    def render():
+        info = V4RequestInfo(id, only_html_body=False)
 
-    return make_response(info.html_report)
+        return make_response(info.html_report)
+    return cached_run_response(id, render)
 
 
 @v4_route("/cv/<int:id>/report")
 def v4_cv_report(id):
-    info = V4CVRequestInfo(id, only_html_body=False)
+    def render():
+        info = V4CVRequestInfo(id, only_html_body=False)
 
-    return make_response(info.html_report)
+        return make_response(info.html_report)
+    return cached_run_response(id, render, cv=True)
 
 
 @v4_route("/<int:id>/text_report")
 def v4_text_report(id):
-    info = V4RequestInfo(id, only_html_body=False)
+    def render():
+        info = V4RequestInfo(id, only_html_body=False)
 
-    response = make_response(info.text_report)
-    response.mimetype = "text/plain"
-    return response
+        response = make_response(info.text_report)
+        response.mimetype = "text/plain"
+        return response
+    return cached_run_response(id, render)
 
 
 # Compatilibity route for old run pages.
@@ -496,6 +633,10 @@ Unable to find a v0.4 run for this ID. Please use the native v0.4 URL interface
 
 @v4_route("/<int:id>")
 def v4_run(id):
+    return cached_run_response(id, lambda: render_v4_run(id))
+
+
+def render_v4_run(id):
     info = V4RequestInfo(id)
 
     ts = info.ts
@@ -580,6 +721,10 @@ def v4_run(id):
 
 @v4_route("/cv/<int:id>")
 def v4_cv_run(id):
+    return cached_run_response(id, lambda: render_v4_cv_run(id), cv=True)
+
+
+def render_v4_cv_run(id):
     info = V4CVRequestInfo(id)
 
     ts = info.ts
@@ -671,73 +816,22 @@ def v4_git_search():
 
 @v4_route("/git/<sha>", methods=('GET', 'POST'))
 def v4_git_sha(sha):
-    def get_gerrit_for_sha(_sha):
-        url = ('http://review.couchbase.org/changes/?q={}&o=ALL_REVISIONS&o='
-               'ALL_COMMITS&o=WEB_LINKS'.format(_sha))
-
-        try:
-            response = urllib2.urlopen(url).read()
-        except:
-            abort(404)
-
-        start_index = response.index('{')
-        end_index = response.rindex(']')
-        response = response[start_index:end_index]
-
-        try:
-            json_response = json.loads(response)
-        except:
-            abort(400)
-
-        return json_response
-
     ts = request.get_testsuite()
 
-    gerrit_response = get_gerrit_for_sha(sha)
+    # The change is read from the cache, and only looked up on the code review
+    # server if it is not known yet. Recording it fills in the Gerrit records
+    # of the orders of all its patch sets.
+    db = request.get_db()
+    try:
+        gerrit_response = lnt.server.db.gerrit.get_change(db, sha)
+    except Exception:
+        db.rollback()
+        abort(404)
+    if gerrit_response is None:
+        abort(404)
     change_id = gerrit_response["change_id"]
     merged = gerrit_response["status"]
 
-    patch_shas = []
-    for revision in gerrit_response['revisions']:
-        match = cv_sha_regex.search(gerrit_response['revisions'][revision]
-                                    ['commit']['web_links'][0]['url'])
-        if match:
-            patch_shas.append(match.group('sha'))
-
-    for p_sha in patch_shas:
-        master_shas = ts.query(ts.Order).filter(
-            ts.Order.git_sha == p_sha).all()
-        cv_shas = ts.query(ts.CVOrder).filter(
-            ts.CVOrder.git_sha == p_sha).all()
-        if master_shas and cv_shas:
-            abort(400)
-        else:
-            if master_shas:
-                for order in master_shas:
-                    if not ts.query(ts.Gerrit).filter(
-                            ts.Gerrit.order == order).all():
-                        gerrit = ts.Gerrit(order)
-                        gerrit.set_field_by_name("gerrit_change_id",
-                                                 change_id)
-                        ts.add(gerrit)
-                        ts.commit()
-                        note("Retro-adding new Gerrit: {}".format(gerrit.id))
-            else:
-                for order in cv_shas:
-                    if not ts.query(ts.CVGerrit).filter(
-                            ts.CVGerrit.order == order).all():
-                        gerrit = ts.CVGerrit(order)
-                        gerrit.set_field_by_name("gerrit_change_id",
-                                                 change_id)
-                        gerrit.set_field_by_name("gerrit_change_id_parent",
-                                                 get_gerrit_for_sha(
-                                                     order.parent_commit)[
-                                                     "change_id"])
-                        ts.add(gerrit)
-                        ts.commit()
-                        note(("Retro-adding new CV Gerrit: {}".format(
-                            gerrit.id)))
-
     # Get the list of Gerrit changes we have for the change ID of the SHA
     master_gerrits = ts.query(ts.Gerrit).filter(
         ts.Gerrit.gerrit_change_id == change_id).all()
@@ -747,30 +841,31 @@ def v4_git_sha(sha):
     master_orders = []
     cv_orders = []
 
-    for master_run in master_gerrits:
-        master_orders.extend(ts.query(ts.Order).filter(
-            ts.Order.id == master_run.order.id).all())
-    for cv_run in cv_gerrits:
-        cv_orders.extend(ts.query(ts.CVOrder).filter(
-            ts.CVOrder.id == cv_run.order.id).all())
-
-    master_orders.sort()
-    cv_orders.sort()
+    if master_gerrits:
+        master_orders = ts.query(ts.Order).filter(
+            ts.Order.id.in_([g.order_id for g in master_gerrits])). \
+            order_by(ts.Order.rank, ts.Order.id).all()
+    if cv_gerrits:
+        cv_orders = ts.query(ts.CVOrder).filter(
+            ts.CVOrder.id.in_([g.order_id for g in cv_gerrits])). \
+            order_by(ts.CVOrder.rank, ts.CVOrder.id).all()
 
     return render_template("v4_git_sha.html", ts=ts, sha=sha,
                            gerrit=gerrit_response,
                            master_orders=master_orders, cv_orders=cv_orders,
-                           merged=merged)
+                           merged=merged,
+                           gerrit_url=lnt.server.db.gerrit.get_url(
+                               current_app.old_config))
 
 
 @v4_route("/test_status")
 def v4_test_status():
     ts = request.get_testsuite()
 
-    test_status, latest_order, latest_run, tests = ts.get_stability_status(10)
+    test_status, latest_order, latest_run = ts.get_stability_status(10)
 
     return render_template("v4_test_status.html", ts=ts, status=test_status,
-                           order=latest_order, run=latest_run, tests=tests,
+                           order=latest_order, run=latest_run,
                            metric_fields=list(ts.Sample.get_metric_fields()),
                            num_stable=sum(1 for c in test_status if test_status[c]["stable"]),
                            num_unstable=sum(1 for c in test_status if not test_status[c]["stable"]),
@@ -809,11 +904,8 @@ def v4_all_orders():
     # Get the testsuite.
     ts = request.get_testsuite()
 
-    # Get the orders.
-    orders = ts.query(ts.Order).all()
-
-    # Order the runs totally.
-    orders.sort()
+    # Get the orders, ordered totally.
+    orders = ts.query(ts.Order).order_by(ts.Order.rank, ts.Order.id).all()
 
     return render_template("v4_all_orders.html", ts=ts, orders=orders)
 
@@ -894,7 +986,6 @@ LegendItem = namedtuple('LegendItem', 'machine test_name field_name color url')
 @v4_route("/graph")
 def v4_graph():
     from lnt.server.ui import util
-    from lnt.testing import PASS
     from lnt.util import stats
     from lnt.external.stats import stats as ext_stats
 
@@ -925,6 +1016,23 @@ def v4_graph():
         request.args.get('hide_highlight'))
     show_highlight = not options['hide_highlight']
 
+    # Long histories are downsampled to at most max_points revisions per plot
+    # (0 shows them all), and can be restricted to a range of revisions, which
+    # the page asks for when zooming in.
+    try:
+        options['max_points'] = max_points = int(
+            request.args.get('max_points', 0))
+        min_revision = request.args.get('min_revision')
+        if min_revision is not None:
+            min_revision = int(min_revision)
+        max_revision = request.args.get('max_revision')
+        if max_revision is not None:
+            max_revision = int(max_revision)
+    except ValueError:
+        return abort(400)
+    options['min_revision'] = min_revision
+    options['max_revision'] = max_revision
+
     def convert_revision(dotted):
         """Turn a version number like 489.2.10 into something
         that is ordered and sortable.
@@ -934,7 +1042,7 @@ def v4_graph():
         return tuple([int(d) for d in dotted])
 
     # Load the graph parameters.
-    graph_parameters = []
+    plot_parameters = []
     for name, value in request.args.items():
         # Plots to graph are passed as::
         #
@@ -954,18 +1062,7 @@ def v4_graph():
         if not (0 <= field_index < len(ts.sample_fields)):
             return abort(404)
 
-        try:
-            machine = \
-                ts.query(ts.Machine).filter(ts.Machine.id == machine_id).one()
-            test = ts.query(ts.Test).filter(ts.Test.id == test_id).one()
-            field = ts.sample_fields[field_index]
-        except NoResultFound:
-            return abort(404)
-
-        graph_parameters.append((machine, test, field, field_index))
-
-    # Order the plots by machine name, test name and then field.
-    graph_parameters.sort(key=lambda (m, t, f, _): (m.name, t.name, f.name, _))
+        plot_parameters.append((machine_id, test_id, field_index))
 
     # Extract requested mean trend.
     mean_parameter = None
@@ -986,20 +1083,35 @@ def v4_graph():
         if not (0 <= field_index < len(ts.sample_fields)):
             return abort(404)
 
-        try:
-            machine = \
-                ts.query(ts.Machine).filter(ts.Machine.id == machine_id).one()
-        except NoResultFound:
+        mean_parameter = (machine_id, field_index)
+
+    # Load the machines and tests of all the plots at once.
+    machine_ids = [machine_id for machine_id, _, _ in plot_parameters]
+    if mean_parameter:
+        machine_ids.append(mean_parameter[0])
+    machines, tests = lnt.server.db.graph.get_machines_and_tests(
+        ts, machine_ids, [test_id for _, test_id, _ in plot_parameters])
+    graph_parameters = []
+    for machine_id, test_id, field_index in plot_parameters:
+        if machine_id not in machines or test_id not in tests:
+            return abort(404)
+        graph_parameters.append((machines[machine_id], tests[test_id],
+                                 ts.sample_fields[field_index], field_index))
+    if mean_parameter:
+        machine_id, field_index = mean_parameter
+        if machine_id not in machines:
             return abort(404)
-        field = ts.sample_fields[field_index]
-        mean_parameter = (machine, field)
+        mean_parameter = (machines[machine_id], ts.sample_fields[field_index])
+
+    # Order the plots by machine name, test name and then field.
+    graph_parameters.sort(key=lambda (m, t, f, _): (m.name, t.name, f.name, _))
 
     # Sanity check the arguments.
     if not graph_parameters and not mean_parameter:
         return render_template("error.html", message="Nothing to graph.")
 
     # Extract requested baselines, and their titles.
-    baseline_parameters = []
+    baseline_ids = []
     for name, value in request.args.items():
         # Baselines to graph are passed as:
         #
@@ -1015,40 +1127,45 @@ def v4_graph():
         except:
             return abort(400)
 
-        try:
-            run = ts.query(ts.Run).join(ts.Machine).filter(
-                ts.Run.id == run_id).one()
-        except:
+        baseline_ids.append((run_id, baseline_title))
+
+    baseline_runs = lnt.server.db.graph.get_runs(
+        ts, [run_id for run_id, _ in baseline_ids])
+    baseline_parameters = []
+    for run_id, baseline_title in baseline_ids:
+        if run_id not in baseline_runs:
             err_msg = "The run {} was not found in the database.".format(
                 run_id)
             return render_template("error.html",
                                    message=err_msg)
 
-        baseline_parameters.append((run, baseline_title))
+        baseline_parameters.append((baseline_runs[run_id], baseline_title))
 
     # Create region of interest for run data region if we are performing a
     # comparison.
     revision_range = None
 
+    # The orders are compared by rank, their integer revision.
     cv = request.args.get('cv')
+    parent_order = None
     if cv and cv.isdigit():
         cv = int(cv)
         cv_run = ts.query(ts.CVRun).filter(ts.CVRun.id == cv).first()
         if cv_run:
             parent_order = ts.get_parent_order(cv_run)
-            if parent_order:
-                max_revision = parent_order.llvm_project_revision
-            else:
-                max_revision = ts.query(
-                    sqlalchemy.func.max(
-                        ts.Order.llvm_project_revision)).scalar()
-        else:
-            max_revision = ts.query(
-                sqlalchemy.func.max(ts.Order.llvm_project_revision)).scalar()
+    if parent_order:
+        max_rank = parent_order.rank
     else:
-        max_revision = ts.query(sqlalchemy.func.max(
-            ts.Order.llvm_project_revision)).scalar()
-
+        max_rank = ts.query(sqlalchemy.func.max(ts.Order.rank)).scalar()
+    show_cv_point = (cv and isinstance(cv, int) and cv_run and
+                     max_rank is not None and
+                     (min_revision is None or min_revision <= max_rank + 1) and
+                     (max_revision is None or max_revision >= max_rank + 1))
+    if max_revision is not None and max_rank is not None:
+        max_rank = min(max_rank, max_revision)
+
+    # The revisions which are never downsampled away.
+    keep_revisions = set()
     highlight_run_id = request.args.get('highlight_run')
     if show_highlight and highlight_run_id and highlight_run_id.isdigit():
         if cv and isinstance(cv, int) and cv_run and int(
@@ -1056,11 +1173,12 @@ def v4_graph():
             highlight_run = cv_run
             if highlight_run is None:
                 abort(404)
+            keep_revisions.add(str(max_rank + 1))
             prev_runs = list(
                 ts.get_previous_runs_on_machine(highlight_run, N=1, cv=True))
             if prev_runs:
                 start_rev = prev_runs[0].order.llvm_project_revision
-                end_rev = int(max_revision) + 1
+                end_rev = max_rank + 1
                 revision_range = {
                     "start": convert_revision(start_rev),
                     "end": end_rev}
@@ -1069,6 +1187,7 @@ def v4_graph():
                 id=int(highlight_run_id)).first()
             if highlight_run is None:
                 abort(404)
+            keep_revisions.add(highlight_run.order.llvm_project_revision)
 
             # Find the neighboring runs, by order.
             prev_runs = list(
@@ -1088,6 +1207,32 @@ def v4_graph():
     baseline_plots = []
     num_plots = len(graph_parameters)
 
+    # Load the samples of all the plots, and of the baselines, with a query
+    # per field.
+    plots = [(machine.id, test.id, field)
+             for machine, test, field, _ in graph_parameters]
+    # Without the individual samples, the plots are drawn from the summaries
+    # of the samples at each order.
+    use_rollups = hide_all_points and not show_stddev and not show_failures
+    if use_rollups:
+        plot_rollups = lnt.server.db.graph.get_plot_rollups(
+            ts, plots, max_rank=max_rank, min_rank=min_revision)
+    else:
+        plot_samples = lnt.server.db.graph.get_plot_samples(
+            ts, plots, max_rank=max_rank, show_failures=show_failures,
+            min_rank=min_revision)
+    if show_cv_point:
+        cv_plot_samples = lnt.server.db.graph.get_cv_plot_samples(
+            ts, cv_run, plots)
+    # The regressions of the plots are never downsampled away.
+    if max_points:
+        change_revisions = lnt.server.db.graph.get_plot_change_revisions(
+            ts, plots)
+    baseline_means = lnt.server.db.graph.get_baseline_means(
+        ts, [baseline for baseline, _ in baseline_parameters],
+        [test.id for _, test, _, _ in graph_parameters],
+        [field for _, _, field, _ in graph_parameters])
+
     for i, (machine, test, field, field_index) in enumerate(graph_parameters):
         # Determine the base plot color.
         col = list(util.makeDarkColor(float(i) / num_plots))
@@ -1095,66 +1240,35 @@ def v4_graph():
         legend.append(
             LegendItem(machine, test.name, field.name, tuple(col), url))
 
-        # Load all the field values for this test on the same machine.
-        #
-        # FIXME: Don't join to Order here, aggregate this across all the tests
-        # we want to load. Actually, we should just make this a single query.
-        #
-        # FIXME: Don't hard code field name.
-        q = ts.query(field.column, ts.Order.llvm_project_revision,
-                     ts.Run.start_time, ts.Run.id). \
-            join(ts.Run).join(ts.Order). \
-            filter(ts.Run.machine_id == machine.id). \
-            filter(ts.Sample.test == test). \
-            filter(ts.Order.llvm_project_revision <= max_revision). \
-            filter(field.column != None)
-
-        # Unless all samples requested, filter out failing tests.
-        if not show_failures:
-            if field.status_field:
-                q = q.filter((field.status_field.column == PASS) |
-                             (field.status_field.column == None))
-
-        # Aggregate by revision.
-        data = util.multidict(
-            (rev, (val, date, run_id)) for val, rev, date, run_id in q).items()
+        # The field values for this test on the same machine, aggregated by
+        # revision.
+        plot = (machine.id, test.id, field)
+        if use_rollups:
+            rollups = plot_rollups[plot]
+            data = [(rev, [rollup[:3]]) for rev, rollup in rollups.items()]
+        else:
+            rollups = {}
+            data = plot_samples[plot].items()
 
         # If CV result, add it to the data points
-        if cv and isinstance(cv, int) and cv_run:
-            cv_field = ts.cv_sample_fields[field_index]
-            q_cv = ts.query(cv_field.column, ts.CVRun.start_time, ts.CVRun.id). \
-                join(ts.CVRun).join(ts.CVOrder). \
-                filter(ts.CVRun.machine_id == machine.id). \
-                filter(ts.CVSample.test == test). \
-                filter(ts.CVRun.id == cv_run.id). \
-                filter(cv_field.column != None)
+        if show_cv_point:
+            data.append((str(max_rank + 1), cv_plot_samples[plot]))
 
-            data.append((str(int(max_revision) + 1), [(val, date, run_id)
-                                                      for val, date, run_id in
-                                                      q_cv]))
-
-        data.sort(key=lambda sample: convert_revision(sample[0]))
-
-        graph_datum.append((test.name, data, col, field, url))
+        plot_keep_revisions = keep_revisions
+        if max_points:
+            plot_keep_revisions = keep_revisions | change_revisions[plot]
+        graph_datum.append((test.name, data, col, field, url,
+                            plot_keep_revisions, rollups))
 
         # Get baselines for this line
         num_baselines = len(baseline_parameters)
         for baseline_id, (baseline, baseline_title) in enumerate(
                 baseline_parameters):
-            q_baseline = ts.query(field.column, ts.Order.llvm_project_revision,
-                                  ts.Run.start_time, ts.Machine.name). \
-                join(ts.Run).join(ts.Order).join(ts.Machine). \
-                filter(ts.Run.id == baseline.id). \
-                filter(ts.Sample.test == test). \
-                filter(field.column != None)
-            # In the event of many samples, use the mean of the samples as the baseline.
-            samples = []
-            for sample in q_baseline:
-                samples.append(sample[0])
-            # Skip this baseline if there is no data.
-            if not samples:
+            # In the event of many samples, use the mean of the samples as the
+            # baseline. Skip this baseline if there is no data.
+            mean = baseline_means.get((baseline.id, test.id, field))
+            if mean is None:
                 continue
-            mean = sum(samples) / len(samples)
             # Darken the baseline color distinguish from non-baselines.
             # Make a color closer to the sample than its neighbour.
             color_offset = float(baseline_id) / num_baselines / 2
@@ -1164,10 +1278,9 @@ def v4_graph():
             baseline_plots.append({'color': str_dark_col,
                                    'lineWidth': 2,
                                    'yaxis': {'from': mean, 'to': mean},
-                                   'name': q_baseline[
-                                       0].llvm_project_revision})
+                                   'name': baseline.order.llvm_project_revision})
             baseline_name = "Baseline {} on {}".format(baseline_title,
-                                                       q_baseline[0].name)
+                                                       baseline.machine.name)
             legend.append(
                 LegendItem(BaselineLegendItem(baseline_name, baseline.id),
                            test.name, field.name, dark_col, None))
@@ -1180,41 +1293,35 @@ def v4_graph():
         col = (0, 0, 0)
         legend.append(LegendItem(machine, test_name, field.name, col, None))
 
-        q = ts.query(sqlalchemy.sql.func.min(field.column),
-                     ts.Order.llvm_project_revision,
-                     sqlalchemy.sql.func.min(ts.Run.start_time)). \
-            join(ts.Run).join(ts.Order).join(ts.Test). \
-            filter(ts.Run.machine_id == machine.id). \
-            filter(field.column != None). \
-            group_by(ts.Order.llvm_project_revision, ts.Test)
-
-        # Calculate geomean of each revision.
-        data = util.multidict(
-            ((rev, date), val) for val, rev, date in q).items()
-        data = [
-            (rev, [(lnt.server.reporting.analysis.calc_geomean(vals), date)])
-            for ((rev, date), vals) in data]
+        # Calculate geomean of each revision, keeping the revisions in order.
+        data = lnt.server.db.graph.get_geomean_trend(
+            ts, machine.id, field, max_rank=max_revision,
+            min_rank=min_revision)
 
-        # Sort data points according to revision number.
-        data.sort(key=lambda sample: convert_revision(sample[0]))
+        graph_datum.append((test_name, data, col, field, None,
+                            keep_revisions, {}))
 
-        graph_datum.append((test_name, data, col, field, None))
-
-    for name, data, col, field, url in graph_datum:
+    for (name, data, col, field, url, plot_keep_revisions,
+         rollups) in graph_datum:
         # Compute the graph points.
         errorbar_data = []
         points_data = []
         pts = []
+        keep_indices = []
         moving_median_data = []
         moving_average_data = []
 
         if normalize_by_median:
-            normalize_by = 1.0 / stats.median([min([d[0] for d in values])
-                                               for _, values in data])
+            normalize_by = 1.0 / stats.median([
+                rollups[label][4] if label in rollups
+                else min([d[0] for d in values])
+                for label, values in data])
         else:
             normalize_by = 1.0
 
         for pos, (point_label, datapoints) in enumerate(data):
+            # Order the samples by value, to find the median one.
+            datapoints = sorted(datapoints, key=lambda d: d[0])
             # Get the samples.
             data = [data_date[0] for data_date in datapoints]
             # And the date on which they were taken.
@@ -1231,17 +1338,15 @@ def v4_graph():
             values = [v * normalize_by for v in data]
 
             # Ensure the median value is being used
-            values = sorted(values)
             agg_index = len(values) // 2
-            agg_value = values[agg_index]
+            agg_value = stats.median(values)
 
             # Generate metadata.
             metadata = {"label": point_label}
             metadata["date"] = str(dates[agg_index])
             if runs:
                 metadata["runID"] = str(runs[agg_index])
-            if (cv and isinstance(cv, int) and cv_run and
-                    int(max_revision) < int(point_label)):
+            if show_cv_point and max_rank < int(point_label):
                 metadata["cv"] = True
             if len(graph_datum) > 1:
                 # If there are more than one plot in the graph, also label the
@@ -1249,6 +1354,8 @@ def v4_graph():
                 metadata["test_name"] = name
 
             pts.append((x, agg_value, metadata))
+            if point_label in plot_keep_revisions:
+                keep_indices.append(pos)
 
             # Add the individual points, if requested.
             # For each point add a text label for the mouse over.
@@ -1266,8 +1373,12 @@ def v4_graph():
 
             # Add the MAD error bar, if requested.
             if show_mad:
-                med = stats.median(values)
-                mad = stats.median_absolute_deviation(values, med)
+                med = agg_value
+                rollup = rollups.get(point_label)
+                if rollup is not None:
+                    mad = rollup[6] * normalize_by
+                else:
+                    mad = stats.median_absolute_deviation(values, med)
                 errorbar_data.append((x, med, mad))
 
         # Compute the moving average and or moving median of our data if requested.
@@ -1275,15 +1386,15 @@ def v4_graph():
             fun = None
 
             def compute_moving_average(x, window, average_list, median_list):
-                average_list.append((x, lnt.util.stats.mean(window)))
+                average_list.append((x, window.mean()))
 
             def compute_moving_median(x, window, average_list, median_list):
-                median_list.append((x, lnt.util.stats.median(window)))
+                median_list.append((x, window.median()))
 
             def compute_moving_average_and_median(x, window, average_list,
                                                   median_list):
-                average_list.append((x, lnt.util.stats.mean(window)))
-                median_list.append((x, lnt.util.stats.median(window)))
+                average_list.append((x, window.mean()))
+                median_list.append((x, window.median()))
 
             if moving_average and moving_median:
                 fun = compute_moving_average_and_median
@@ -1292,15 +1403,30 @@ def v4_graph():
             else:
                 fun = compute_moving_median
 
-            len_pts = len(pts)
-            for i in range(len_pts):
-                start_index = max(0, i - moving_window_size)
-                end_index = min(len_pts, i + moving_window_size)
-
-                window_pts = [x[1] for x in pts[start_index:end_index]]
-                fun(pts[i][0], window_pts, moving_average_data,
+            # The window slides over the points, rather than being sorted
+            # again at each of them.
+            windows = lnt.util.stats.sliding_windows(
+                [p[1] for p in pts], moving_window_size, moving_window_size)
+            for i, window in enumerate(windows):
+                fun(pts[i][0], window, moving_average_data,
                     moving_median_data)
 
+        # The linear regression is fit to all the points.
+        all_pts = pts
+
+        # Downsample the plot, keeping only the points of the revisions which
+        # shape the line the most, and the ones to keep.
+        kept = lnt.server.db.graph.lttb(pts, max_points, keep_indices)
+        if len(kept) < len(pts):
+            pts = [pts[i] for i in kept]
+            kept_xs = set(x for x, _, _ in pts)
+            points_data = [p for p in points_data if p[0] in kept_xs]
+            errorbar_data = [p for p in errorbar_data if p[0] in kept_xs]
+            moving_average_data = [p for p in moving_average_data
+                                   if p[0] in kept_xs]
+            moving_median_data = [p for p in moving_median_data
+                                  if p[0] in kept_xs]
+
         # On the overview, we always show the line plot.
         overview_plots.append({
             "data": pts,
@@ -1316,8 +1442,8 @@ def v4_graph():
             graph_plots.append(plot)
         # Add regression line, if requested.
         if show_linear_regression:
-            xs = [t for t, v, _ in pts]
-            ys = [v for t, v, _ in pts]
+            xs = [t for t, v, _ in all_pts]
+            ys = [v for t, v, _ in all_pts]
 
             # We compute the regression line in terms of a normalized X scale.
             x_min, x_max = min(xs), max(xs)
@@ -1443,7 +1569,7 @@ def v4_global_status():
 
     # Get arguments.
     revision = int(request.args.get('revision',
-                                    ts.Machine.DEFAULT_BASELINE_REVISION))
+                                    ts.v4db.baseline_revision))
     field = fields.get(request.args.get('field', None), metric_fields[0])
 
     # Get the list of all runs we might be interested in.
@@ -1707,7 +1833,7 @@ def health():
     explode = False
     msg = "Ok"
     queue_length = async_ops.check_workers(False)
-    if queue_length > 10:
+    if queue_length >= async_ops.QUEUE_LIMIT:
         explode = True
         msg = "Queue too long."
 
@@ -1717,6 +1843,7 @@ def health():
     if mem > 1024 ** 3:
         explode = True
         msg = "Over memory " + str(mem) + ">" + str(1024 ** 3)
+    msg = "{} ({} job(s) in the queue)".format(msg, queue_length)
     if explode:
         return msg, 500
     return msg, 200
@@ -128,6 +128,8 @@ class CouchbaseTest(builtintest.BuiltinTest):
                             nargs='*')
         parser.add_argument('--commit', default=True, type=int,
                             help='commit result to db')
+        parser.add_argument('--compress', default=True, type=int,
+                            help='compress the report submitted')
         parser.add_argument('-i', '--iterations', default=1, type=int,
                             help='number of iterations to run')
         parsed_args = parser.parse_args(args)
@@ -242,15 +244,20 @@ class CouchbaseTest(builtintest.BuiltinTest):
         result = None
         if parsed_args.submit_url:
             from lnt.util import ServerUtil
+            # Submit to all the servers (and retry) over the same
+            # connections.
+            connections = ServerUtil.Connections()
             for server in parsed_args.submit_url:
                 self.log("submitting result to %r" % (server,))
                 try:
                     result = ServerUtil.submitFile(
                         server, parsed_args.report_path, parsed_args.commit,
-                        parsed_args.verbose)
+                        parsed_args.verbose, compress=parsed_args.compress,
+                        connections=connections)
                 except (urllib2.HTTPError, urllib2.URLError) as e:
                     warning("submitting to {} failed with {}".format(server,
                                                                      e))
+            connections.close()
         else:
             # Simulate a submission to retrieve the results report.
             # Construct a temporary database and import the result.
@@ -1,25 +1,32 @@
-import os, re, time
+import os, re, time, traceback
 import collections
 import lnt.testing
 import lnt.formats
 import lnt.server.reporting.analysis
+import lnt.server.reporting.runs
 from lnt.testing.util.commands import note
 from lnt.util import NTEmailReport
 from lnt.util import async_ops
+from lnt.server.db import jobs
 
 def import_and_report(config, db_name, db, file, format, commit=False,
                       show_sample_count=False, disable_email=False,
-                      disable_report=False):
+                      disable_report=False, run_jobs=True):
     """
     import_and_report(config, db_name, db, file, format,
                       [commit], [show_sample_count],
-                      [disable_email]) -> ... object ...
+                      [disable_email], [disable_report],
+                      [run_jobs]) -> ... object ...
 
     Import a test data file into an LNT server and generate a test report. On
     success, run is the newly imported run. Note that success is uneffected by
     the value of commit, this merely changes whether the run (on success) is
     committed to the database.
 
+    The background jobs queued for a committed run are handed to the worker
+    pool, unless run_jobs is False (e.g. when importing in a worker, which runs
+    the queued jobs itself).
+
     The result object is a dictionary containing information on the imported run
     and its comparison to the previous run.
     """
@@ -38,11 +45,12 @@ def import_and_report(config, db_name, db, file, format, commit=False,
 
     startTime = time.time()
     try:
-        data = lnt.formats.read_any(file, format)
+        # The tests of the report are read as they are imported, so the report
+        # is never whole in memory.
+        data = lnt.formats.read_report(file, format)
     except KeyboardInterrupt:
         raise
     except:
-        import traceback
         result['error'] = "load failure: %s" % traceback.format_exc()
         return result
 
@@ -77,9 +85,12 @@ def import_and_report(config, db_name, db, file, format, commit=False,
         success, run = db.importDataFromDict(data, commit, config=db_config, cv=cv)
     except KeyboardInterrupt:
         raise
+    except lnt.formats.ReadError:
+        db.rollback()
+        result['error'] = "load failure: %s" % traceback.format_exc()
+        return result
     except:
         raise
-        import traceback
         result['error'] = "import failure: %s" % traceback.format_exc()
         return result
 
@@ -101,11 +112,13 @@ def import_and_report(config, db_name, db, file, format, commit=False,
     ts_name = data['Run']['Info'].get('tag')
 
 
+    run_report = None
     if not disable_report:
         #  This has the side effect of building the run report for
         #  this result.
-        NTEmailReport.emailReport(result, db, run, report_url,
-                                  email_config, toAddress, success, commit, cv=cv)
+        run_report = NTEmailReport.emailReport(result, db, run, report_url,
+                                               email_config, toAddress,
+                                               success, commit, cv=cv)
 
     result['added_machines'] = db.getNumMachines() - numMachines
     result['added_runs'] = db.getNumRuns() - numRuns
@@ -118,14 +131,30 @@ def import_and_report(config, db_name, db, file, format, commit=False,
 
 
     if commit:
+        #  If we are not in a dummy instance, also run backgound jobs.
+        queue_jobs = db_config and not cv and result['added_runs'] > 0
+        if queue_jobs:
+            #  Queue the jobs in the same transaction as the run, so they are
+            #  not lost if we are stopped before they ran.
+            jobs.enqueue(db, 'post_submit', ts_name, run.id,
+                         {'run_id': run.id})
+        #  Bump the data generation last, as it locks the generation of the
+        #  test suite until the commit.
+        generation = None
+        if success:
+            generation = run.testsuite.bump_data_generation([run.machine_id])
         db.commit()
-        if db_config:
-            #  If we are not in a dummy instance, also run backgound jobs.
+        #  The run report can be shared with the pages of the run, now that
+        #  the data it was computed from is committed.
+        if run_report is not None and generation is not None:
+            lnt.server.reporting.runs.store_run_report(run.testsuite,
+                                                       run_report, generation)
+        #  The runs also queue the lookups of the Gerrit changes of their
+        #  commits, whether they are about master or about commit validation.
+        if db_config and result['added_runs'] > 0 and run_jobs:
             #  We have to have a commit before we run, so subprocesses can
             #  see the submitted data.
-            ts = db.testsuite.get(ts_name)
-            if not cv and result['added_runs'] > 0:
-                async_ops.async_fieldchange_calc(db_name, ts, run)
+            async_ops.async_run_queued_jobs(db_name, config)
 
     else:
         db.rollback()
@@ -153,7 +182,7 @@ def import_and_report(config, db_name, db, file, format, commit=False,
             shadow_result = import_and_report(config, shadow_name,
                                               shadow_db, file, format, commit,
                                               show_sample_count, disable_email,
-                                              disable_report)
+                                              disable_report, run_jobs)
 
             # Append the shadow result to the result.
             result['shadow_result'] = shadow_result
@@ -161,6 +190,146 @@ def import_and_report(config, db_name, db, file, format, commit=False,
     result['success'] = True
     return result
 
+# The number of reports of a batch imported in each transaction.
+BATCH_SIZE = 50
+
+def import_batch(config, db_name, db, file, commit=False,
+                 batch_size=BATCH_SIZE, run_jobs=True):
+    """
+    import_batch(config, db_name, db, file, [commit], [batch_size],
+                 [run_jobs]) -> ... object ...
+
+    Import a batch of reports (see lnt.formats.read_batch) into an LNT server,
+    in one session. The machines, orders and tests are looked up once for the
+    whole batch, and the runs are committed batch_size reports at a time, along
+    with one job per machine which runs the post submission tasks of its runs.
+    No reports are generated or emailed for the runs.
+
+    The result object is a dictionary containing the result of each report, in
+    order, as 'results'. A report which fails to import does not stop the
+    others from being imported.
+    """
+    startTime = time.time()
+    if config:
+        db_config = config.databases[db_name]
+    else:
+        db_config = None
+
+    result = {}
+    result['success'] = False
+    result['error'] = None
+    result['import_file'] = file
+    result['committed'] = commit
+    results = result['results'] = []
+
+    # The reports imported since the last commit, with their results, the
+    # runs of each machine they added, by test suite and machine, and the
+    # machines they added runs (or CV runs) to, by test suite.
+    pending = []
+    pending_runs = collections.OrderedDict()
+    pending_machines = collections.defaultdict(set)
+
+    def import_report(data, report):
+        cv = 'parent_commit' in data['Run']['Info']
+        success, run = db.importDataFromDict(data, commit, config=db_config,
+                                             cv=cv)
+        # Get the ids of the new records.
+        db.session.flush()
+        ts_name = data['Run']['Info'].get('tag')
+        if success:
+            run.imported_from = "%s:%s" % (file, report['name'])
+            pending_machines[ts_name].add(run.machine_id)
+        elif run.id != report.get('run_id'):
+            # Record the original run this is a duplicate of (unless it is the
+            # run we imported it as, before a rollback).
+            report['original_run'] = run.id
+        if not cv and 'original_run' not in report:
+            pending_runs.setdefault((ts_name, run.machine_id), []).append(
+                run.id)
+        report['run_id'] = run.id
+        if cv:
+            report['result_url'] = "db_{}/v4/{}/cv/{}".format(
+                db_name, ts_name, run.id)
+        else:
+            report['result_url'] = "db_{}/v4/{}/{}".format(
+                db_name, ts_name, run.id)
+        report['success'] = True
+
+    def import_failed(report):
+        report['success'] = False
+        report['error'] = "import failure: %s" % traceback.format_exc()
+        db.rollback()
+        db.reset_import_caches()
+        pending_runs.clear()
+        pending_machines.clear()
+
+    def replay(items):
+        #  The reports imported since the last commit were rolled back along
+        #  with a failed one, so import them again.
+        del pending[:]
+        for data, report in items:
+            try:
+                import_report(data, report)
+            except Exception:
+                import_failed(report)
+                return replay([item for item in items if item[1]['success']])
+            pending.append((data, report))
+
+    def finish_transaction():
+        if commit:
+            #  Queue the post submission tasks of the runs of each machine as
+            #  one job, in the same transaction as the runs.
+            if db_config:
+                for (ts_name, machine_id), run_ids in pending_runs.items():
+                    jobs.enqueue(db, 'post_submit_runs', ts_name,
+                                 "%d/%d" % (machine_id, run_ids[0]),
+                                 {'run_ids': run_ids})
+                result['queued_jobs'] += len(pending_runs)
+            #  Bump the data generations last, as they lock the generation of
+            #  the test suite until the commit.
+            for ts_name, machine_ids in pending_machines.items():
+                db.testsuite[ts_name].bump_data_generation(machine_ids)
+            db.commit()
+        else:
+            db.rollback()
+            db.reset_import_caches()
+        del pending[:]
+        pending_runs.clear()
+        pending_machines.clear()
+
+    result['queued_jobs'] = 0
+    numRuns = db.getNumRuns()
+    with db.import_caching():
+        for name, data, error in lnt.formats.read_batch(file):
+            report = {'name': name, 'success': False, 'error': error}
+            results.append(report)
+            if error is not None:
+                report['error'] = "load failure: %s" % error
+                continue
+
+            lnt.testing.upgrade_report(data)
+            try:
+                import_report(data, report)
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                import_failed(report)
+                replay(pending[:])
+                continue
+
+            pending.append((data, report))
+            if len(pending) >= batch_size:
+                finish_transaction()
+        finish_transaction()
+
+    result['added_runs'] = db.getNumRuns() - numRuns
+    result['import_time'] = time.time() - startTime
+    if commit and db_config and result['added_runs'] and run_jobs:
+        async_ops.async_run_queued_jobs(db_name, config)
+    note("Imported {} report(s) of {}".format(len(results), file))
+    result['success'] = all(report['success'] for report in results)
+    return result
+
 def print_report_result(result, out, err, verbose = True):
     """
     print_report_result(result, out, [err], [verbose]) -> None
@@ -294,3 +463,27 @@ def print_report_result(result, out, err, verbose = True):
     for kind, count in result_kinds.items():
         print >>out, kind, ":", count
     print >>out
+
+def print_batch_result(result, out, err):
+    """
+    print_batch_result(result, out, err) -> None
+
+    Print a human readable form of a batch import result object to the given
+    output stream, one line per report.
+    """
+    print >>out, "Importing %r" % os.path.basename(result['import_file'])
+    for report in result['results']:
+        if not report['success']:
+            out.flush()
+            print >>err, "%s: Import Failed:" % report['name']
+            print >>err, "--\n%s--\n" % report['error']
+            err.flush()
+        elif 'original_run' in report:
+            print >>out, "%s: duplicate of run %d" % (report['name'],
+                                                      report['original_run'])
+        else:
+            print >>out, "%s: imported as run %d" % (report['name'],
+                                                     report['run_id'])
+    print >>out, "Added Runs : %d" % result['added_runs']
+    print >>out, "Queued Jobs : %d" % result['queued_jobs']
+    print >>out, "Import Time : %.2fs" % result['import_time']
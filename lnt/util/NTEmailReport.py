@@ -12,14 +12,14 @@ def emailReport(result, db, run, baseurl, email_config, to, was_added=True,
     import email.mime.multipart
     import email.mime.text
 
-    subject, report, html_report = getReport(result, db, run, baseurl,
-                                             was_added, will_commit, cv=cv)
+    subject, report, html_report, run_report = getReport(
+        result, db, run, baseurl, was_added, will_commit, cv=cv)
 
     # Ignore if no to address was given, we do things this way because of the
     # awkward way we collect result information as part of generating the email
     # report.
     if email_config is None or to is None:
-        return
+        return run_report
 
     # Generate a plain text message if we have no html report.
     if not html_report:
@@ -42,13 +42,16 @@ def emailReport(result, db, run, baseurl, email_config, to, was_added=True,
     s = smtplib.SMTP(email_config.host)
     s.sendmail(email_config.from_address, [to], msg.as_string())
     s.quit()
+    return run_report
 
 def getReport(result, db, run, baseurl, was_added, will_commit,
               only_html_body = False, compare_to = None, cv=False):
     assert isinstance(db, lnt.server.db.v4db.V4DB)
     report = StringIO.StringIO()
 
-    reports = lnt.server.reporting.runs.generate_run_report(
+    # The run may not be committed yet, so its report is not cached here (see
+    # lnt.server.reporting.runs.store_run_report).
+    return lnt.server.reporting.runs.generate_run_report(
         run, baseurl=baseurl, only_html_body=only_html_body,
-        result=result, compare_to=compare_to, num_comparison_runs=1, cv=cv)
-    return reports[:3]
+        result=result, compare_to=compare_to, num_comparison_runs=1, cv=cv,
+        cache=False)
@@ -2,12 +2,20 @@
 Utility for submitting files to a web server over HTTP.
 """
 
+import contextlib
+import httplib
 import plistlib
+import socket
+import StringIO
 import sys
+import tempfile
+import time
 import urllib
 import urllib2
-import contextlib
+import urlparse
+import zlib
 
+import lnt.formats
 import lnt.server.instance
 from lnt.util import json
 from lnt.util import ImportData
@@ -17,13 +25,165 @@ from lnt.util import ImportData
 # system to report to LNT, for example. It might be nice to factor the
 # simplified submit code into a separate utility.
 
-def submitFileToServer(url, file, commit):
-    with open(file, 'rb') as f:
-        values = { 'input_data' : f.read(),
-                   'commit' : ('0', '1')[not not commit] }
-    data = urllib.urlencode(values)
-    response = urllib2.urlopen(urllib2.Request(url, data))
-    result_data = response.read()
+# How often (in seconds) to poll the state of a submission imported in the
+# background, and how long to wait for the import at most.
+POLL_INTERVAL = 2
+POLL_TIMEOUT = 30 * 60
+
+# How many times to retry a request when the server cannot be reached (or is
+# unavailable), and how long to wait (in seconds) before the second and later
+# retries, times the number of the retry.
+RETRIES = 3
+RETRY_DELAY = 2
+RETRY_STATUSES = (502, 503, 504)
+
+# The requests which may be sent again whatever happened to them. Others (the
+# submissions) are only sent again when they cannot have reached the server.
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+# How long to wait (in seconds) for the server to answer.
+CONNECTION_TIMEOUT = 10 * 60
+
+class Connections(object):
+    """
+    The HTTP connections to the servers submitted to, which are kept open
+    across submissions (e.g. to several databases of a server), retries and
+    polls of their state.
+    """
+
+    def __init__(self, retries=RETRIES, retry_delay=RETRY_DELAY):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._connections = {}
+
+    def _connect(self, scheme, netloc):
+        connection_class = httplib.HTTPConnection
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+
+        # Go through the proxy of the environment, if any, as urllib2 does.
+        host = netloc.rsplit(':', 1)[0]
+        proxy = urllib.getproxies().get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return connection_class(netloc, timeout=CONNECTION_TIMEOUT), False
+        proxy_netloc = urlparse.urlsplit(proxy).netloc or proxy
+        if scheme == 'https':
+            connection = connection_class(proxy_netloc,
+                                          timeout=CONNECTION_TIMEOUT)
+            connection.set_tunnel(netloc)
+            return connection, False
+        return connection_class(proxy_netloc,
+                                timeout=CONNECTION_TIMEOUT), True
+
+    def request(self, method, url, body=None, headers={}):
+        """
+        request(method, url, [body], [headers]) -> (status, headers, data)
+
+        Send a request, and return the response, retrying when the server
+        cannot be reached. Errors reaching the server are raised as
+        urllib2.URLError.
+
+        Requests which are not idempotent (see IDEMPOTENT_METHODS) are only
+        sent again when they cannot have been processed: when the connection
+        to the server failed, or when the server closed a connection kept open
+        before answering them. They are not sent again when the server (or a
+        proxy) answered with an error, or did not answer in time, as they may
+        have been processed anyway.
+        """
+        idempotent = method in IDEMPOTENT_METHODS
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        for attempt in range(self.retries + 1):
+            # A connection kept open may have been closed by the server since
+            # it was last used, so the first retry is immediate.
+            if attempt > 1:
+                time.sleep(self.retry_delay * (attempt - 1))
+            if key not in self._connections:
+                self._connections[key] = self._connect(*key)
+            connection, proxied = self._connections[key]
+            path = url if proxied else urlparse.urlunsplit(
+                ('', '', parts.path or '/', parts.query, ''))
+            reused = connection.sock is not None
+            try:
+                if not reused:
+                    connection.connect()
+            except (httplib.HTTPException, socket.error) as e:
+                # Nothing was sent.
+                self._close(key)
+                if attempt == self.retries:
+                    raise urllib2.URLError(e)
+                continue
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                self._close(key)
+                retry = idempotent or (reused and
+                                       not isinstance(e, socket.timeout))
+                if not retry or attempt == self.retries:
+                    raise urllib2.URLError(e)
+                continue
+            try:
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                self._close(key)
+                if not idempotent or attempt == self.retries:
+                    raise urllib2.URLError(e)
+                continue
+            if response.will_close:
+                self._close(key)
+            if (idempotent and response.status in RETRY_STATUSES and
+                    attempt < self.retries):
+                continue
+            return response.status, response.msg, data
+
+    def _close(self, key):
+        connection, _ = self._connections.pop(key)
+        connection.close()
+
+    def close(self):
+        for key in self._connections.keys():
+            self._close(key)
+
+# The connections of the submissions which are not given their own.
+_connections = Connections()
+
+def _compress(data):
+    """Compress data as a gzip stream."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _post(url, params, data, content_type, compress, connections):
+    """Post data as the body of a request to url, with the params as its query
+    string, and return the response. HTTP errors are raised as
+    urllib2.HTTPError."""
+    if params:
+        url += ('&' if '?' in url else '?') + urllib.urlencode(params)
+    headers = {'Content-Type': content_type}
+    if compress:
+        data = _compress(data)
+        headers['Content-Encoding'] = 'gzip'
+    status, response_headers, result_data = connections.request(
+        'POST', url, data, headers)
+    if status >= 400:
+        raise urllib2.HTTPError(url, status, httplib.responses.get(status, ''),
+                                response_headers,
+                                StringIO.StringIO(result_data))
+    return status, result_data
+
+def _isJSONObject(data):
+    try:
+        return isinstance(json.loads(data), dict)
+    except ValueError:
+        return False
+
+def _result(status, result_data, poll_interval, timeout, connections):
+    """Return the result of a submission, from the response to it."""
+    if status == 202:
+        result_data = _waitForSubmission(json.loads(result_data),
+                                         poll_interval, timeout, connections)
+        if result_data is None:
+            return
 
     # The result is expected to be a JSON object.
     try:
@@ -39,6 +199,81 @@ def submitFileToServer(url, file, commit):
         print result_data
         return
 
+def submitDataToServer(url, values, async_import=True,
+                       poll_interval=POLL_INTERVAL, timeout=POLL_TIMEOUT,
+                       connections=None):
+    """
+    submitDataToServer(url, values, [async_import], [poll_interval],
+                       [timeout], [connections]) -> result or None
+
+    Post the form values to the server, and return the result of the import.
+    If async_import is set, the server is asked to import it in the
+    background, and the state of the submission is polled until the import
+    finished.
+    """
+    connections = connections or _connections
+    values = dict(values)
+    if async_import:
+        values['async'] = '1'
+    status, result_data = _post(url, None, urllib.urlencode(values),
+                                'application/x-www-form-urlencoded', False,
+                                connections)
+    return _result(status, result_data, poll_interval, timeout, connections)
+
+def submitFileToServer(url, file, commit, async_import=True,
+                       poll_interval=POLL_INTERVAL, timeout=POLL_TIMEOUT,
+                       compress=True, connections=None):
+    """
+    submitFileToServer(url, file, commit, [async_import], [poll_interval],
+                       [timeout], [compress], [connections]) -> result or None
+
+    Submit a file to the server, and return the result of its import. If
+    async_import is set, the server is asked to import it in the background
+    (servers which cannot do so import it right away), and the state of the
+    submission is polled until the import finished.
+
+    The file is posted as the body of the request, compressed unless compress
+    is False. Servers which only take submissions as forms are sent the form
+    instead.
+    """
+    connections = connections or _connections
+    with open(file, 'rb') as f:
+        data = f.read()
+    params = { 'commit' : ('0', '1')[not not commit] }
+    if async_import:
+        params['async'] = '1'
+    content_type = 'application/octet-stream'
+    if data.lstrip().startswith('{'):
+        content_type = 'application/json'
+
+    try:
+        status, result_data = _post(url, params, data, content_type,
+                                    compress, connections)
+    except urllib2.HTTPError as e:
+        if e.code not in (400, 415):
+            raise
+        status, result_data = None, None
+    if status is None or (status == 200 and not _isJSONObject(result_data)):
+        # The server answered with the submission form.
+        params['input_data'] = data
+        return submitDataToServer(url, params, async_import, poll_interval,
+                                  timeout, connections)
+    return _result(status, result_data, poll_interval, timeout, connections)
+
+def _waitForSubmission(status, poll_interval, timeout, connections):
+    """Poll the state of a submission queued for import, until its result is
+    ready (and return it), or we waited for timeout seconds."""
+    status_url = status['status_url']
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(poll_interval)
+        code, _, result_data = connections.request('GET', status_url)
+        if code != 202:
+            return result_data
+    print "Timed out waiting for the import of submission %s, see %s" % (
+        status['submission_id'], status_url)
+    return
+
 def submitFileToInstance(path, file, commit):
     # Otherwise, assume it is a local url and submit to the default database
     # in the instance.
@@ -52,19 +287,68 @@ def submitFileToInstance(path, file, commit):
             config, db_name, db, file, format='<auto>', commit=commit)
 
 
-def submitFile(url, file, commit, verbose):
-    # If this is a real url, submit it using urllib.
+def submitFile(url, file, commit, verbose, async_import=True, compress=True,
+               connections=None):
+    # If this is a real url, submit it over HTTP.
     if '://' in url:
-        result = submitFileToServer(url, file, commit)
+        result = submitFileToServer(url, file, commit, async_import,
+                                    compress=compress,
+                                    connections=connections)
         if result is None:
             return
     else:
         result = submitFileToInstance(url, file, commit)
     return result
 
-def submitFiles(url, files, commit, verbose):
+def submitFiles(url, files, commit, verbose, async_import=True,
+                compress=True, connections=None):
     results = []
     for file in files:
-        result = submitFile(url, file, commit, verbose)
+        result = submitFile(url, file, commit, verbose, async_import,
+                            compress, connections)
         results.append(result)
     return results
+
+def _batchData(files):
+    """Return the reports of the files as a batch of newline delimited
+    JSON."""
+    return ''.join(json.dumps(lnt.formats.read_any(file, '<auto>')) + '\n'
+                   for file in files)
+
+def submitBatch(url, files, commit, verbose, async_import=True,
+                batch_size=ImportData.BATCH_SIZE, compress=True,
+                connections=None):
+    """
+    submitBatch(url, files, commit, verbose, [async_import],
+                [batch_size], [compress], [connections]) -> result or None
+
+    Submit the reports of the files as one batch (see
+    lnt.util.ImportData.import_batch), to the submitBatch page of the server
+    whose submitRun page is at url, or to a local instance.
+    """
+    data = _batchData(files)
+    if '://' in url:
+        connections = connections or _connections
+        if url.rstrip('/').endswith('/submitRun'):
+            url = url.rstrip('/')[:-len('submitRun')] + 'submitBatch'
+        params = { 'commit' : ('0', '1')[not not commit],
+                   'batch_size' : str(batch_size) }
+        if async_import:
+            params['async'] = '1'
+        status, result_data = _post(url, params, data, 'application/x-ndjson',
+                                    compress, connections)
+        return _result(status, result_data, POLL_INTERVAL, POLL_TIMEOUT,
+                       connections)
+
+    instance = lnt.server.instance.Instance.frompath(url)
+    config = instance.config
+    db_name = 'default'
+    with tempfile.NamedTemporaryFile(suffix='.batch') as f:
+        f.write(data)
+        f.flush()
+        with contextlib.closing(config.get_database(db_name)) as db:
+            if db is None:
+                raise ValueError("no default database in instance: %r" %
+                                 (url,))
+            return ImportData.import_batch(config, db_name, db, f.name,
+                                           commit, batch_size)
@@ -1,39 +1,78 @@
 """Asynchrounus operations for LNT.
 
 For big tasks it is nice to be able to run in the backgorund.  This module
-contains wrappers to run particular LNT tasks in subprocesess. 
+contains wrappers to run particular LNT tasks in a pool of long-lived worker
+processes.
 
 Because multiprocessing cannot directly use the LNT test-suite objects in
 subprocesses (because they are not serializable because they don't have a fix
-package in the system, but are generated on program load) we recreate the test
-suite that we need inside each subprocess before we execute the work job.
+package in the system, but are generated on program load) we pass the names of
+the database and test suite, and look the test suite up inside the worker
+before we execute the work job.
+
+The number of jobs which may be queued or running at once is bounded. Once the
+queue is full, no more jobs are handed to the pool, and the requests queuing
+them do not wait: the work stays in the durable job queue of the database (see
+below), and is run by the workers already draining it, or by the next drain.
+The slot of a job whose worker died while running it (which the pool never
+reports) is reclaimed.
+
+The work done after a submission is recorded in the durable job queue of the
+database (see lnt.server.db.jobs) along with the submission, and the worker
+pool is just asked to run the queued jobs. Jobs which are lost with the pool
+(because the server stopped) are picked up again after a restart.
 """
 import atexit
+import itertools
 import os
 import time
 import logging
 from flask import current_app, g
 import sys
-import lnt.server.db.fieldchange as fieldchange
+import lnt.server.db.jobs
 import lnt.server.db.v4db
 import traceback
 import signal
 import contextlib
 import multiprocessing
-from multiprocessing import Pool, TimeoutError, Manager, Process
-from threading import Lock
+from multiprocessing import Pool, TimeoutError, Manager
+from threading import BoundedSemaphore, Lock
 from lnt.testing.util.commands import note, warning, timed, error
-NUM_WORKERS = 8  # The number of subprocesses to spawn per LNT process.
+NUM_WORKERS = 8  # The default number of worker processes per LNT process.
+MAX_QUEUED = 64  # The default number of jobs which may be queued or running.
 WORKERS = None  # The worker pool.
+QUEUE_LIMIT = MAX_QUEUED  # The queue bound of the worker pool.
+QUEUE_SLOTS = None  # One slot per job which may be queued or running.
+
+# The jobs handed to the worker pool which have not finished yet, mapping the
+# job id to the job name and the time it was queued.
+PENDING = {}
+# The process id of the worker running each of the pending jobs which started,
+# by job id (shared with the workers).
+STARTED = None
+PENDING_LOCK = Lock()
+JOB_IDS = itertools.count()
 
-JOBS = []
+# Statistics on the jobs finished by this process.
+JOB_STATS = {'finished': 0, 'failed': 0, 'lost': 0, 'wait_time': 0.0,
+             'run_time': 0.0}
 
+# The configuration used to open databases in the worker processes, and where
+# they record the jobs they start.
+WORKER_CONFIG = None
+WORKER_STARTED = None
 
-def launch_workers():
+
+def launch_workers(config):
     """Make sure we have a worker pool ready to queue."""
-    global WORKERS
-    if not WORKERS:
-        note("Starting workers")
+    global WORKERS, QUEUE_LIMIT, QUEUE_SLOTS, STARTED
+    with PENDING_LOCK:
+        if WORKERS:
+            return
+
+        num_workers = getattr(config, 'async_workers', None) or NUM_WORKERS
+        QUEUE_LIMIT = getattr(config, 'async_queue_limit', None) or MAX_QUEUED
+        note("Starting {} workers".format(num_workers))
         manager = Manager()
         try:
             current_app.config['mem_logger'].buffer = \
@@ -44,6 +83,22 @@ def launch_workers():
             #  sufficent for console mode.
             pass
 
+        QUEUE_SLOTS = BoundedSemaphore(QUEUE_LIMIT)
+        STARTED = manager.dict()
+        WORKERS = Pool(num_workers, initializer=init_worker,
+                       initargs=(config, STARTED))
+
+
+def init_worker(config, started=None):
+    """Prepare a freshly started worker process."""
+    global WORKER_CONFIG, WORKER_STARTED
+    WORKER_CONFIG = config
+    WORKER_STARTED = started
+
+    # The database connections were inherited from the parent process, so get
+    # rid of them and let this process open its own.
+    lnt.server.db.v4db.V4DB.dispose_engines()
+
 
 def sigHandler(signo, frame):
     sys.exit(0)
@@ -51,29 +106,63 @@ def sigHandler(signo, frame):
 
 def cleanup():
     note("Running process cleanup.")
-    for p in JOBS:
-        note("Waiting for %s %s" % (p.name, p.pid))
-        if p.is_alive:
-            p.join()
+    if WORKERS:
+        note("Waiting for {} job(s)".format(len(PENDING)))
+        WORKERS.close()
+        # The pool never finishes the jobs lost with their workers, so wait for
+        # the pending jobs rather than for the pool.
+        while check_workers(False):
+            time.sleep(0.1)
+        WORKERS.terminate()
 
 
 atexit.register(cleanup)
 signal.signal(signal.SIGTERM, sigHandler)
 
 
-def async_fieldchange_calc(db_name, ts, run):
-    """Run regenerate field changes in the background."""
-    func_args = {'run_id': run.id}
-    #  Make sure this run is in the database!
-    async_run_job(fieldchange.post_submit_tasks,
-                  db_name, ts,
-                  func_args)
+def async_run_queued_jobs(db_name, config):
+    """Have a worker run the jobs queued in the database. If the queue of the
+    workers is full, the jobs are left to the workers already running queued
+    jobs (or to the next drain of the queue)."""
+    queue_on_workers(run_queued_jobs_wrapper, "queued jobs of " + db_name,
+                     [db_name], config)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def reclaim_lost_jobs():
+    """Forget the jobs whose worker died while running them (the pool never
+    finishes them), and release their slots. Returns the number of them."""
+    if STARTED is None:
+        return 0
+    try:
+        started = dict(STARTED)
+    except Exception:
+        return 0
+
+    lost = []
+    with PENDING_LOCK:
+        for job_id, pid in started.items():
+            if job_id in PENDING and not _is_alive(pid):
+                lost.append(PENDING.pop(job_id)[0])
+                JOB_STATS['lost'] += 1
+                QUEUE_SLOTS.release()
+                STARTED.pop(job_id, None)
+    for name in lost:
+        error("The worker running {} died, releasing its slot.".format(name))
+    return len(lost)
 
 
 def check_workers(is_logged):
-    global JOBS
-    JOBS = [x for x in JOBS if x.is_alive()]
-    still_running = len(JOBS)
+    """Return the number of jobs which are queued or running."""
+    reclaim_lost_jobs()
+    still_running = len(PENDING)
     msg = "{} Job(s) in the queue.".format(still_running)
     if is_logged:
         if still_running > 5:
@@ -84,75 +173,111 @@ def check_workers(is_logged):
             logging.getLogger("lnt.server.ui.app").info(msg)
         else:
             logging.getLogger("lnt.server.ui.app").info("Job queue empty.")
-    return len(JOBS)
+    return still_running
 
 
 def async_run_job(job, db_name, ts, func_args):
-    """Send a job to the async wrapper in the subprocess."""
-    # If the run is not in the database, we can't do anything more.
-    note("Queuing background job to process fieldchanges " + str(os.getpid()))
-    launch_workers()
-    check_workers(True)
-
+    """Send a job to the async wrapper in the worker pool."""
     args = {'tsname': ts.name,
             'db': db_name}
-    job = Process(target=async_wrapper,
-                  args=[job, args, func_args])
+    queue_on_workers(async_wrapper, job.__name__, [job, args, func_args],
+                     ts.v4db.config)
+
+
+def queue_on_workers(func, name, args, config):
+    """Queue func(*args) on the worker pool, unless the queue is full. Returns
+    whether the job was queued."""
+    note("Queuing background job {} ".format(name) + str(os.getpid()))
+    launch_workers(config)
+    check_workers(True)
 
-    job.start()
-    JOBS.append(job)
+    if not QUEUE_SLOTS.acquire(False):
+        warning("Job queue is full ({} jobs), not queuing {}.".format(
+            QUEUE_LIMIT, name))
+        return False
 
+    job_id = next(JOB_IDS)
+    queued_time = time.time()
+    with PENDING_LOCK:
+        PENDING[job_id] = (name, queued_time)
 
-# Flag to track if we have disposed of the parents database connections in
-# this subprocess.
-clean_db = False
+    WORKERS.apply_async(func, args + [job_id, queued_time],
+                        callback=async_job_finished)
+    return True
 
 
-def async_wrapper(job, ts_args, func_args):
-    """Setup test-suite in this subprocess and run something.
-    
+def run_in_worker(name, job_id, queued_time, func, *args):
+    """Run func(*args) in this worker.
+
     Because of multipocessing, capture excptions and log messages,
-    and return them.
+    and return them (along with the job timing) to the parent process.
     """
-    global clean_db
+    start_time = time.time()
+    result = {'id': job_id,
+              'name': name,
+              'wait_time': start_time - (queued_time or start_time),
+              'run_time': None,
+              'error': None}
+    if WORKER_STARTED is not None and job_id is not None:
+        # Let the parent process know which worker runs the job, in case it
+        # dies.
+        try:
+            WORKER_STARTED[job_id] = os.getpid()
+        except Exception:
+            pass
     try:
-        start_time = time.time()
-        
-        if not clean_db:
-            lnt.server.db.v4db.V4DB.close_all_engines()
-            clean_db = True
-        
-        note("Running async wrapper: {} ".format(job.__name__)+ str(os.getpid()))
-
-        _v4db = current_app.old_config.get_database(ts_args['db'])
-        # with contextlib.closing(_v4db) as db:
-        ts = _v4db.testsuite[ts_args['tsname']]
-        nothing = job(ts, **func_args)
+        note("Running async wrapper: {} ".format(name) + str(os.getpid()))
+        nothing = func(*args)
         assert nothing is None
-        end_time = time.time()
-        delta = end_time-start_time
-        msg = "Finished: {name} in {time:.2f}s ".format(name=job.__name__,
-                                                time=delta)
-        if delta < 100:
-            note(msg)
-        else:
-            warning(msg)
     except Exception:
-        # Put all exception text into an exception and raise that for our
-        # parent process.
-        error("Subprocess failed with:" + "".join(traceback.format_exception(*sys.exc_info())))
-        sys.exit(1)
-    sys.exit(0)
+        # Put all exception text into the result for our parent process.
+        result['error'] = "".join(traceback.format_exception(*sys.exc_info()))
+        error("Subprocess failed with:" + result['error'])
+    result['run_time'] = time.time() - start_time
+    return result
+
+
+def async_wrapper(job, ts_args, func_args, job_id=None, queued_time=None):
+    """Setup test-suite in this worker and run something."""
+    def run():
+        _v4db = WORKER_CONFIG.get_database(ts_args['db'])
+        with contextlib.closing(_v4db) as db:
+            ts = db.testsuite[ts_args['tsname']]
+            return job(ts, **func_args)
+    return run_in_worker(job.__name__, job_id, queued_time, run)
+
 
+def run_queued_jobs_wrapper(db_name, job_id=None, queued_time=None):
+    """Run the jobs queued in a database, in this worker."""
+    def run():
+        with contextlib.closing(WORKER_CONFIG.get_database(db_name)) as db:
+            count = lnt.server.db.jobs.run_queued_jobs(db)
+            note("Ran {} queued job(s) of {}".format(count, db_name))
+    return run_in_worker("queued jobs of " + db_name, job_id, queued_time,
+                         run)
+
+
+def async_job_finished(result):
+    """Account for a job finished by the worker pool."""
+    with PENDING_LOCK:
+        if PENDING.pop(result['id'], None) is not None:
+            QUEUE_SLOTS.release()
+        JOB_STATS['finished'] += 1
+        if result['error']:
+            JOB_STATS['failed'] += 1
+        JOB_STATS['wait_time'] += result['wait_time']
+        JOB_STATS['run_time'] += result['run_time']
+    try:
+        STARTED.pop(result['id'], None)
+    except Exception:
+        pass
 
-def make_callback():
-    app = current_app
-    def async_job_finished(arg):
-        if isinstance(arg, Exception):
-            logging.getLogger("lnt.server.ui.app").error(str(arg))
-            raise arg
-        if isinstance(arg, list):
-            for log_entry in arg:
-                logging.getLogger("lnt.server.ui.app").handle(log_entry)
-        check_workers()
-    return async_job_finished
+    logger = logging.getLogger("lnt.server.ui.app")
+    msg = "Finished: {name} in {run_time:.2f}s (queued {wait_time:.2f}s)"\
+        .format(**result)
+    if result['error']:
+        logger.error(msg + " with an error")
+    elif result['run_time'] < 100:
+        logger.info(msg)
+    else:
+        logger.warning(msg)
@@ -1,6 +1,7 @@
 from __future__ import division
+import bisect
+import collections
 import math
-from lnt.external.stats.stats import mannwhitneyu as mannwhitneyu_large
 
 
 def safe_min(l):
@@ -41,6 +42,114 @@ def median_absolute_deviation(l, med = None):
     return median([abs(x - med) for x in l])
 
 
+class SlidingWindow(object):
+    """
+    A window of values, which slides over a sequence: values are appended at
+    its end and removed from its start.
+
+    The values are kept in order of insertion and sorted, with their running
+    sum, so the mean is found in constant time, the median by index, and the
+    median absolute deviation by walking outwards from the median, instead of
+    sorting the window again for every position.
+    """
+
+    # The running sum is computed again after this many removals, so that
+    # rounding errors don't add up over long sequences.
+    RESUM_INTERVAL = 1024
+
+    def __init__(self, values=()):
+        self._values = collections.deque()
+        self._sorted = []
+        self._sum = 0
+        self._removals = 0
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self._values)
+
+    def append(self, value):
+        """Add a value at the end of the window."""
+        self._values.append(value)
+        bisect.insort(self._sorted, value)
+        self._sum += value
+
+    def popleft(self):
+        """Remove the value at the start of the window, and return it."""
+        value = self._values.popleft()
+        del self._sorted[bisect.bisect_left(self._sorted, value)]
+        self._removals += 1
+        if self._removals % self.RESUM_INTERVAL == 0:
+            self._sum = sum(self._values)
+        else:
+            self._sum -= value
+        return value
+
+    def mean(self):
+        if not self._values:
+            return None
+        return self._sum/len(self._values)
+
+    def median(self):
+        l = self._sorted
+        if not l:
+            return None
+        N = len(l)
+        return (l[(N-1)//2] + l[N//2])*.5
+
+    def median_absolute_deviation(self, med = None):
+        """The median of the deviations of the values from med (their median
+        by default), found by merging the deviations below and above it, which
+        are already in order."""
+        l = self._sorted
+        if not l:
+            return None
+        if med is None:
+            med = self.median()
+        N = len(l)
+        # The deviations of the values below med grow leftwards from lo, the
+        # ones of the values from med upwards grow rightwards from hi.
+        hi = bisect.bisect_left(l, med)
+        lo = hi - 1
+        k1 = (N-1)//2
+        k2 = N//2
+        low = None
+        for k in range(k2 + 1):
+            if hi >= N or (lo >= 0 and med - l[lo] <= l[hi] - med):
+                deviation = med - l[lo]
+                lo -= 1
+            else:
+                deviation = l[hi] - med
+                hi += 1
+            if k == k1:
+                low = deviation
+        return (low + deviation)*.5
+
+
+def sliding_windows(values, before, after):
+    """
+    Slide a window over values, yielding for each position i a SlidingWindow
+    of values[max(0, i - before):i + after].
+
+    The same window object is yielded at every position, and moved on when
+    the next one is asked for.
+    """
+    values = list(values)
+    N = len(values)
+    window = SlidingWindow()
+    start = end = 0
+    for i in range(N):
+        new_start = min(N, max(0, i - before))
+        new_end = max(new_start, min(N, i + after))
+        while end < new_end:
+            window.append(values[end])
+            end += 1
+        while start < new_start:
+            window.popleft()
+            start += 1
+        yield window
+
+
 def standard_deviation(l):
     m = mean(l)
     means_sqrd = sum([(v - m)**2 for v in l]) / len(l)
@@ -48,129 +157,139 @@ def standard_deviation(l):
     return rms
 
 
+# Samples up to this size are tested with the exact distribution of U (unless
+# they have ties), larger ones with its normal approximation.
+MANNWHITNEYU_EXACT_LIMIT = 20
+
+# The exact cumulative distributions of U under the null hypothesis, by sample
+# sizes, built as needed.
+_mannwhitneyu_cdfs = {}
+
+
+def _mannwhitneyu_exact_cdf(n, m):
+    """Return the cumulative distribution of U for samples of sizes n and m
+    without ties: the probability of each U value or less."""
+    key = (min(n, m), max(n, m))
+    cdf = _mannwhitneyu_cdfs.get(key)
+    if cdf is not None:
+        return cdf
+    n, m = key
+
+    # Count the arrangements of the samples giving each U value, with the
+    # recurrence on whether the largest value comes from the first sample
+    # (which then adds m to U) or from the second one.
+    counts = [[1]] * (m + 1)
+    for i in range(1, n + 1):
+        row = [[1]]
+        for j in range(1, m + 1):
+            above = counts[j]
+            left = row[j - 1]
+            freq = [0] * (i * j + 1)
+            for u, c in enumerate(left):
+                freq[u] += c
+            for u, c in enumerate(above):
+                freq[u + j] += c
+            row.append(freq)
+        counts = row
+
+    freq = counts[m]
+    total = sum(freq)
+    cdf = []
+    cumulative = 0
+    for c in freq:
+        cumulative += c
+        cdf.append(cumulative / total)
+    _mannwhitneyu_cdfs[key] = cdf
+    return cdf
+
+
+def _mannwhitneyu_sorted(a, b):
+    """Return (U, ties) for the sample a and the sorted sample b.
+
+    U counts the pairs with the value of a larger than the value of b, ties
+    counting half. ties is the sum of t^3 - t over the groups of t equal
+    values, for the tie correction."""
+    u = 0.
+    for x in a:
+        lower = bisect.bisect_left(b, x)
+        upper = bisect.bisect_right(b, x, lower)
+        u += lower + .5 * (upper - lower)
+
+    values = list(a)
+    values.extend(b)
+    ties = 0
+    if len(set(values)) != len(values):
+        counts = {}
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+        for t in counts.itervalues():
+            ties += t * t * t - t
+    return u, ties
+
+
+def _mannwhitneyu_pvalue(u, ties, n, m):
+    """Return the two-sided p-value of U for samples of sizes n and m."""
+    if n == 0 or m == 0:
+        return 1.
+    nm = n * m
+    if not ties and n <= MANNWHITNEYU_EXACT_LIMIT and \
+            m <= MANNWHITNEYU_EXACT_LIMIT:
+        cdf = _mannwhitneyu_exact_cdf(n, m)
+        return min(1., 2 * cdf[int(min(u, nm - u))])
+
+    # The normal approximation, with tie and continuity corrections.
+    N = n + m
+    var = nm / 12. * ((N + 1) - ties / (N * (N - 1)))
+    if var <= 0:
+        # All the values are the same.
+        return 1.
+    z = max(abs(u - nm / 2.) - .5, 0.) / math.sqrt(var)
+    return math.erfc(z / math.sqrt(2))
+
+
+def mannwhitneyu_u(a, b):
+    """Return the Mann-Whitney U statistic of sample a against sample b."""
+    return _mannwhitneyu_sorted(a, sorted(b))[0]
+
+
+def mannwhitneyu_pvalue(a, b):
+    """Return the two-sided p-value of the Mann-Whitney U test of samples a
+    and b."""
+    u, ties = _mannwhitneyu_sorted(a, sorted(b))
+    return _mannwhitneyu_pvalue(u, ties, len(a), len(b))
+
+
 def mannwhitneyu(a, b, sigLevel = .05):
     """
     Determine if sample a and b are the same at given significance level.
     """
-    if len(a) <= 20 and len(b) <= 20:
-        return mannwhitneyu_small(a, b, sigLevel)
-    else:
-        try:
-            # MWU in SciPy is one-sided, multiply by 2 to get two-sided.
-            p = mannwhitneyu_large(a, b) * 2
-            return p >= sigLevel
-        except ValueError:
-            return True
+    return mannwhitneyu_pvalue(a, b) >= sigLevel
 
 
-def mannwhitneyu_small(a, b, sigLevel):
-    """
-    Determine if sample a and b are the same.
-    Sample size must be less than 20.
+def mannwhitneyu_many(pairs, sigLevel = .05):
     """
-    assert len(a) <= 20, "Sample size must be less than 20."
-    assert len(b) <= 20, "Sample size must be less than 20."
-
-    if not sigLevel in SIGN_TABLES:
-        raise ValueError("Do not have according significance table.")
+    Determine if the samples of each (a, b) pair are the same at given
+    significance level.
 
-    # Calculate U value for sample groups using method described on Wikipedia.
-    flip = len(a) > len(b)
-    x = a if not flip else b
-    y = b if not flip else a
-
-    Ux = 0.
-    for xe in x:
-        for ye in y:
-            if xe < ye:
-                Ux += 1
-            elif xe == ye:
-                Ux += .5
-    Uy = len(a) * len(b) - Ux
-    Ua = Ux if not flip else Uy
-    Ub = Uy if not flip else Ux
-
-    U = abs(Ua - Ub)
-
-    same = U <= SIGN_TABLES[sigLevel][len(a) - 1][len(b) - 1]
-    return same
+    Each second sample is only sorted once, however many pairs it is part of:
+    the comparisons of many current runs against the same window of previous
+    runs share its sorting.
+    """
+    # The samples are kept along with their sorted values, so that their ids
+    # aren't reused.
+    sorted_samples = {}
+    results = []
+    for a, b in pairs:
+        key = id(b)
+        if key not in sorted_samples:
+            sorted_samples[key] = (b, sorted(b))
+        u, ties = _mannwhitneyu_sorted(a, sorted_samples[key][1])
+        results.append(_mannwhitneyu_pvalue(u, ties, len(a), len(b)) >=
+                       sigLevel)
+    return results
 
 
 def variance(l, m=None):
     if m is None:
         m = mean(l)
     return (sum((a - m) ** 2 for a in l)) / (len(l) - 1)
-
-# Table for .10 significance level.
-TABLE_0_10 = [
-        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 3, 3, 3, 3, 4, 4, 4],
-        [0, 0, 0, 0, 1, 2, 2, 3, 4, 4, 5, 5, 6, 7, 7, 8, 9, 9, 10, 11],
-        [0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 14, 15, 16, 17, 18],
-        [0, 0, 1, 2, 4, 5, 6, 8, 9, 11, 12, 13, 15, 16, 18, 19, 20, 22, 23, 25],
-        [0, 0, 2, 3, 5, 7, 8, 10, 12, 14, 16, 17, 19, 21, 23, 25, 26, 28, 30, 32],
-        [0, 0, 2, 4, 6, 8, 11, 13, 15, 17, 19, 21, 24, 26, 28, 30, 33, 35, 37, 39],
-        [0, 1, 3, 5, 8, 10, 13, 15, 18, 20, 23, 26, 28, 31, 33, 36, 39, 41, 44, 47],
-        [0, 1, 4, 6, 9, 12, 15, 18, 21, 24, 27, 30, 33, 36, 39, 42, 45, 48, 51, 54],
-        [0, 1, 4, 7, 11, 14, 17, 20, 24, 27, 31, 34, 37, 41, 44, 48, 51, 55, 58, 62],
-        [0, 1, 5, 8, 12, 16, 19, 23, 27, 31, 34, 38, 42, 46, 50, 54, 57, 61, 65, 69],
-        [0, 2, 5, 9, 13, 17, 21, 26, 30, 34, 38, 42, 47, 51, 55, 60, 64, 68, 72, 77],
-        [0, 2, 6, 10, 15, 19, 24, 28, 33, 37, 42, 47, 51, 56, 61, 65, 70, 75, 80, 89],
-        [0, 3, 7, 11, 16, 21, 26, 31, 36, 41, 46, 51, 56, 61, 66, 71, 77, 82, 87, 92],
-        [0, 3, 7, 12, 18, 23, 28, 33, 39, 44, 50, 55, 61, 66, 72, 77, 83, 88, 94, 100],
-        [0, 3, 8, 14, 19, 25, 30, 36, 42, 48, 54, 60, 65, 71, 77, 83, 89, 95, 101, 107],
-        [0, 3, 9, 15, 20, 26, 33, 39, 45, 51, 57, 64, 70, 77, 83, 89, 96, 102, 109, 115],
-        [0, 4, 9, 16, 22, 28, 35, 41, 48, 55, 61, 68, 75, 82, 88, 95, 102, 109, 116, 123],
-        [0, 4, 10, 17, 23, 30, 37, 44, 51, 58, 65, 72, 80, 87, 94, 101, 109, 116, 123, 130],
-        [0, 4, 11, 18, 25, 32, 39, 47, 54, 62, 69, 77, 89, 92, 100, 107, 115, 123, 130, 138]
-        ]
-
-# Table for .05 significance level.
-TABLE_0_05 = [
-        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 2, 2, 2, 2],
-        [0, 0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8],
-        [0, 0, 0, 0, 1, 2, 3, 4, 4, 5, 6, 7, 8, 9, 10, 11, 11, 12, 13, 13],
-        [0, 0, 0, 1, 2, 3, 5, 6, 7, 8, 9, 11, 12, 13, 14, 15, 17, 18, 19, 20],
-        [0, 0, 1, 2, 3, 5, 6, 8, 10, 11, 13, 14, 16, 17, 19, 21, 22, 24, 25, 27],
-        [0, 0, 1, 3, 5, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26, 28, 30, 32, 34],
-        [0, 0, 2, 4, 6, 8, 10, 13, 15, 17, 19, 22, 24, 26, 29, 31, 34, 36, 38, 41],
-        [0, 0, 2, 4, 7, 10, 12, 15, 17, 20, 23, 26, 28, 31, 34, 37, 39, 42, 45, 48],
-        [0, 0, 3, 5, 8, 11, 14, 17, 20, 23, 26, 29, 33, 36, 39, 42, 45, 48, 52, 55],
-        [0, 0, 3, 6, 9, 13, 16, 19, 23, 26, 30, 33, 37, 40, 44, 47, 51, 55, 58, 62],
-        [0, 1, 4, 7, 11, 14, 18, 22, 26, 29, 33, 37, 41, 45, 49, 53, 57, 61, 65, 69],
-        [0, 1, 4, 8, 12, 16, 20, 24, 28, 33, 37, 41, 45, 50, 54, 59, 63, 67, 72, 76],
-        [0, 1, 5, 9, 13, 17, 22, 26, 31, 36, 40, 45, 50, 55, 59, 64, 67, 74, 78, 83],
-        [0, 1, 5, 10, 14, 19, 24, 29, 34, 39, 44, 49, 54, 59, 64, 70, 75, 80, 85, 90],
-        [0, 1, 6, 11, 15, 21, 26, 31, 37, 42, 47, 53, 59, 64, 70, 75, 81, 86, 92, 98],
-        [0, 2, 6, 11, 17, 22, 28, 34, 39, 45, 51, 57, 63, 67, 75, 81, 87, 93, 99, 105],
-        [0, 2, 7, 12, 18, 24, 30, 36, 42, 48, 55, 61, 67, 74, 80, 86, 93, 99, 106, 112],
-        [0, 2, 7, 13, 19, 25, 32, 38, 45, 52, 58, 65, 72, 78, 85, 92, 99, 106, 113, 119],
-        [0, 2, 8, 13, 20, 27, 34, 41, 48, 55, 62, 69, 76, 83, 90, 98, 105, 112, 119, 127]
-        ]
-
-# Table for .01 significance level.
-TABLE_0_01 = [
-        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 2, 2, 2, 2, 3, 3],
-        [0, 0, 0, 0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 5, 5, 6, 6, 7, 8],
-        [0, 0, 0, 0, 0, 1, 1, 2, 3, 4, 5, 6, 7, 7, 8, 9, 10, 11, 12, 13],
-        [0, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 9, 10, 11, 12, 13, 15, 16, 17, 18],
-        [0, 0, 0, 0, 1, 3, 4, 6, 7, 9, 10, 12, 13, 15, 16, 18, 19, 21, 22, 24],
-        [0, 0, 0, 1, 2, 4, 6, 7, 9, 11, 13, 15, 17, 18, 20, 22, 24, 26, 28, 30],
-        [0, 0, 0, 1, 3, 5, 7, 9, 11, 13, 16, 18, 20, 22, 24, 27, 29, 31, 33, 36],
-        [0, 0, 0, 2, 4, 6, 9, 11, 13, 16, 18, 21, 24, 26, 29, 31, 34, 37, 39, 42],
-        [0, 0, 0, 2, 5, 7, 10, 13, 16, 18, 21, 24, 27, 30, 33, 36, 39, 42, 45, 46],
-        [0, 0, 1, 3, 6, 9, 12, 15, 18, 21, 24, 27, 31, 34, 37, 41, 44, 47, 51, 54],
-        [0, 0, 1, 3, 7, 10, 13, 17, 20, 24, 27, 31, 34, 38, 42, 45, 49, 53, 56, 60],
-        [0, 0, 1, 4, 7, 11, 15, 18, 22, 26, 30, 34, 38, 42, 46, 50, 54, 58, 63, 67],
-        [0, 0, 2, 5, 8, 12, 16, 20, 24, 29, 33, 37, 42, 46, 51, 55, 60, 64, 69, 73],
-        [0, 0, 2, 5, 9, 13, 18, 22, 27, 31, 36, 41, 45, 50, 55, 60, 65, 70, 74, 79],
-        [0, 0, 2, 6, 10, 15, 19, 24, 29, 34, 39, 44, 49, 54, 60, 65, 70, 75, 81, 86],
-        [0, 0, 2, 6, 11, 16, 21, 26, 31, 37, 42, 47, 53, 58, 64, 70, 75, 81, 87, 92],
-        [0, 0, 3, 7, 12, 17, 22, 28, 33, 39, 45, 51, 56, 63, 69, 74, 81, 87, 93, 99],
-        [0, 0, 3, 8, 13, 18, 24, 30, 36, 42, 46, 54, 60, 67, 73, 79, 86, 92, 99, 105]
-        ]
-
-SIGN_TABLES = {.10: TABLE_0_10, .05: TABLE_0_05, .01: TABLE_0_01}
@@ -1,5 +1,7 @@
 import os
-from lit import lit
 
 def test_all():
+    # Imported here, so the tests can import their shared fixtures (see
+    # testutils) without lit.
+    from lit import lit
     return lit.load_test_suite([os.path.dirname(__file__)])
@@ -0,0 +1,97 @@
+# Check the lookup of runs adjacent to a run on the same machine.
+# RUN: python %s
+"""Test get_adjacent_runs_on_machine"""
+import datetime
+import logging
+import shutil
+import sys
+import tempfile
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.v4db
+
+TAG = 'kv-engine'
+
+
+def make_run_data(revision, sha=None, parent=None, index=0):
+    start = (datetime.datetime(2016, 1, 1) +
+             datetime.timedelta(minutes=index)).strftime(
+                 "%Y-%m-%d %H:%M:%S")
+    info = {'tag': TAG, 'run_order': str(revision),
+            'git_sha': sha or 'sha%d' % revision}
+    if parent:
+        info['parent_commit'] = parent
+    return {'Start Time': start, 'End Time': start, 'Info': info}
+
+
+class AdjacentRunsTests(unittest.TestCase):
+    """Test the adjacent run lookup."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = lnt.server.db.v4db.V4DB(
+            'sqlite:///%s/lnt.db' % self.tmpdir, None)
+        self.ts = self.db.testsuite[TAG]
+        self.machine, _ = self.ts._getOrCreateMachine(
+            {'Name': 'machine', 'Info': {}})
+        self.other, _ = self.ts._getOrCreateMachine(
+            {'Name': 'other', 'Info': {}})
+
+        # Report out of order, with two runs at order 30 and some runs on
+        # another machine.
+        self.runs = {}
+        for i, revision in enumerate((10, 30, 20, 50, 40, 30)):
+            run, _ = self.ts._getOrCreateRun(make_run_data(revision, index=i),
+                                             self.machine)
+            self.runs.setdefault(revision, []).append(run)
+        for revision in (25, 35):
+            self.ts._getOrCreateRun(make_run_data(revision), self.other)
+        self.ts.commit()
+
+    def tearDown(self):
+        self.db.close()
+        lnt.server.db.v4db.V4DB.close_all_engines()
+        shutil.rmtree(self.tmpdir)
+
+    def _revisions(self, runs):
+        return [int(r.order.llvm_project_revision) for r in runs]
+
+    def test_previous_runs(self):
+        """Are the previous runs returned closest first?"""
+        ts = self.ts
+        run = self.runs[40][0]
+        self.assertEqual(self._revisions(
+            ts.get_previous_runs_on_machine(run, 2)), [30, 30, 20])
+        self.assertEqual(self._revisions(
+            ts.get_previous_runs_on_machine(run, 10)), [30, 30, 20, 10])
+        self.assertEqual(ts.get_previous_runs_on_machine(self.runs[10][0], 3),
+                         [])
+
+    def test_next_runs(self):
+        """Are the following orders returned?"""
+        ts = self.ts
+        run = self.runs[20][0]
+        self.assertEqual(self._revisions(
+            ts.get_next_runs_on_machine(run, 3)), [30, 30, 40])
+        self.assertEqual(ts.get_next_runs_on_machine(self.runs[50][0], 3), [])
+
+    def test_cv_runs(self):
+        """Are CV runs compared against the runs up to their parent?"""
+        ts = self.ts
+        cv_run, _ = ts._getOrCreateRun(make_run_data(60, 'cv', 'sha30'),
+                                       self.machine, cv=True)
+        self.assertEqual(self._revisions(
+            ts.get_previous_runs_on_machine(cv_run, 2, cv=True)),
+            [30, 30, 20])
+        self.assertEqual(ts.get_next_runs_on_machine(cv_run, 2, cv=True), [])
+
+        # Without a known parent, the latest orders are used.
+        cv_run, _ = ts._getOrCreateRun(make_run_data(61, 'cv2', 'unknown'),
+                                       self.machine, cv=True)
+        self.assertEqual(self._revisions(
+            ts.get_previous_runs_on_machine(cv_run, 2, cv=True)), [50, 40])
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
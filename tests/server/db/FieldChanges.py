@@ -0,0 +1,166 @@
+# Check the regeneration of the field changes of a run.
+# RUN: python %s
+"""Test regenerate_fieldchanges_for_run"""
+import logging
+import sys
+import unittest
+
+import sqlalchemy.event
+
+logging.basicConfig(level=logging.DEBUG)
+
+from lnt.server.db.fieldchange import regenerate_fieldchanges_for_run
+from lnt.server.db.fieldchange import RegressionIndex
+from lnt.server.db.regression import RegressionState
+from lnt.server.db.rules.rule_update_fixed_regressions import \
+    regression_evolution
+from tests.testutils import DBTestCase, make_report, make_test
+
+
+def make_tests(changed, num_tests=20):
+    """Make the tests of a report where the ones in changed take twice as
+    long."""
+    tests = []
+    for i in range(num_tests):
+        value = 2.0 if i in changed else 1.0
+        tests.append(make_test('test%d.exec' % i,
+                               [value + 0.001 * j for j in range(3)]))
+    return tests
+
+
+class FieldChangeTests(DBTestCase):
+    """Test the field change regeneration."""
+
+    def setUp(self):
+        super(FieldChangeTests, self).setUp()
+        self.statements = []
+        sqlalchemy.event.listen(self.db.engine, 'before_cursor_execute',
+                                self._record_statement)
+        sqlalchemy.event.listen(self.db.engine, 'commit', self._record_commit)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(self.db.engine, 'before_cursor_execute',
+                                self._record_statement)
+        sqlalchemy.event.remove(self.db.engine, 'commit', self._record_commit)
+        super(FieldChangeTests, self).tearDown()
+
+    def _record_statement(self, conn, cursor, statement, parameters, context,
+                          executemany):
+        self.statements.append(statement)
+
+    def _record_commit(self, conn):
+        self.statements.append('COMMIT')
+
+    def _import(self, revision, changed, machine='machine'):
+        return self.import_report(
+            make_report(revision, make_tests(changed), machine)).id
+
+    def _changes(self):
+        ts = self.ts
+        return sorted(f.test.name.split('/')[-1]
+                      for f in ts.query(ts.FieldChange))
+
+    def test_regenerate(self):
+        """Are changes created, updated and removed in one pass?"""
+        ts = self.ts
+        self._import(1, ())
+        run_id = self._import(2, (3, 5, 7))
+
+        del self.statements[:]
+        regenerate_fieldchanges_for_run(ts, run_id)
+        statements = list(self.statements)
+        self.assertEqual(self._changes(), ['test3', 'test5', 'test7'])
+        # The changes share the machine and field, so they make up a single
+        # regression.
+        self.assertEqual(ts.query(ts.RegressionIndicator).count(), 3)
+        self.assertEqual(ts.query(ts.Regression).one().title,
+                         "Regression of 3 benchmarks: test3, test5, test7")
+
+        # The existing changes are looked up with a single query (rather than
+        # one per test and field), and everything is committed once.
+        lookups = [s for s in statements
+                   if 'WHERE "KV_FieldChangeV2"."StartOrderID" = ?' in s]
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(statements.count('COMMIT'), 1)
+
+        # Regenerating again keeps the same changes.
+        regenerate_fieldchanges_for_run(ts, run_id)
+        self.assertEqual(self._changes(), ['test3', 'test5', 'test7'])
+        change = ts.query(ts.FieldChange).first()
+        self.assertEqual(change.run_id, run_id)
+        self.assertTrue(change.new_value > change.old_value)
+
+        # Once the samples no longer change, the changes and their orphaned
+        # regression are removed.
+        ts.query(ts.Sample).filter(ts.Sample.run_id == run_id).update(
+            {ts.Sample.execution_time: 1.0}, synchronize_session=False)
+        ts.commit()
+        regenerate_fieldchanges_for_run(ts, run_id)
+        self.assertEqual(self._changes(), [])
+        self.assertEqual(ts.query(ts.RegressionIndicator).count(), 0)
+        self.assertEqual(ts.query(ts.Regression).count(), 0)
+
+    def test_regression_index(self):
+        """Are related regressions found by order range?"""
+        ts = self.ts
+        orders = {}
+        for revision in range(1, 6):
+            orders[revision], _ = ts._getOrCreateOrder(
+                {'run_order': str(revision), 'git_sha': 'sha%d' % revision})
+        machine = ts.Machine('machine')
+        other_machine = ts.Machine('other')
+        test, other_test = ts.Test('test'), ts.Test('other')
+        field, other_field = ts.sample_fields[:2]
+
+        def change(start, end, machine=machine, test=test, field=field):
+            return ts.FieldChange(orders[start], orders[end], machine, test,
+                                  field)
+
+        first = ts.Regression("first", "", RegressionState.DETECTED)
+        second = ts.Regression("second", "", RegressionState.DETECTED)
+        for item in (machine, other_machine, test, other_test, first, second,
+                     ts.RegressionIndicator(first, change(1, 3))):
+            ts.add(item)
+        ts.commit()
+
+        index = RegressionIndex(ts, [first, second])
+        self.assertEqual(index.find(change(2, 4, test=other_test)),
+                         (first, ['Revision', 'Machine', 'Field']))
+        self.assertEqual(index.find(change(1, 3, field=other_field)),
+                         (first, ['Revision', 'Machine', 'Test']))
+        self.assertEqual(index.find(change(2, 2)),
+                         (first, ['Revision', 'Machine', 'Test', 'Field']))
+        # Adjacent ranges don't overlap.
+        self.assertEqual(index.find(change(3, 5)), (None, None))
+        # Only the field matches.
+        self.assertEqual(index.find(change(2, 4, other_machine, other_test)),
+                         (None, None))
+
+        # Earlier regressions win.
+        index.add(second, change(2, 5))
+        self.assertEqual(index.find(change(2, 3))[0], first)
+        self.assertEqual(index.find(change(4, 5))[0], second)
+
+    def test_regression_evolution(self):
+        """Are only the regressions of the submitted machine checked?"""
+        ts = self.ts
+        self._import(1, ())
+        regenerate_fieldchanges_for_run(ts, self._import(2, (3, 5)))
+        self._import(1, (), machine='other')
+        regenerate_fieldchanges_for_run(
+            ts, self._import(2, (9,), machine='other'))
+        fixed, other = ts.query(ts.Regression).order_by(ts.Regression.id)
+        self.assertEqual(other.state, RegressionState.DETECTED)
+
+        # A run which is not fixed yet.
+        regression_evolution(ts, self._import(3, (3,)))
+        self.assertEqual(fixed.state, RegressionState.DETECTED)
+
+        # Fix the regression of the first machine only.
+        regression_evolution(ts, self._import(4, ()))
+        self.assertEqual(fixed.state, RegressionState.IGNORED)
+        self.assertTrue(fixed.title.endswith("[Detected Fixed]"))
+        self.assertEqual(other.state, RegressionState.DETECTED)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
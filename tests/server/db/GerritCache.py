@@ -0,0 +1,214 @@
+# Check that the Gerrit changes of the commits of the runs are looked up in the
+# background, from the code review server of the configuration, and cached.
+# RUN: python %s
+"""Test lnt.server.db.gerrit"""
+import BaseHTTPServer
+import json
+import logging
+import os
+import sys
+import threading
+import unittest
+import urlparse
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.gerrit as gerrit
+import lnt.server.db.jobs as jobs
+import lnt.util.ImportData
+from tests.testutils import DBTestCase, TAG, make_config, make_report
+from tests.testutils import make_test
+
+
+def _change(number, shas):
+    """The answer of Gerrit about a change with patch sets of the shas."""
+    return {'change_id': 'I%d' % number, '_number': number,
+            'project': 'kv_engine', 'branch': 'master',
+            'subject': 'Change %d' % number, 'status': 'MERGED',
+            'revisions': dict(
+                (sha, {'commit': {'web_links': [
+                    {'url': 'http://git/?p=kv_engine.git;a=commit;h=' + sha}
+                ]}}) for sha in shas)}
+
+CHANGES = [_change(1, ['sha1', 'sha1b']), _change(2, ['sha2'])]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer the lookups of changes like Gerrit, recording them."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        sha = urlparse.parse_qs(url.query)['q'][0]
+        self.server.lookups.append(sha)
+        if self.server.unavailable:
+            self.send_response(503)
+            self.end_headers()
+            return
+        changes = [change for change in CHANGES
+                   if sha in change['revisions']]
+        body = ")]}'\n" + json.dumps(changes)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GerritCacheTests(DBTestCase):
+    """Test the lookups of the changes of the commits of imported runs."""
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.lookups = []
+        self.server.unavailable = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        super(GerritCacheTests, self).setUp()
+
+    def tearDown(self):
+        super(GerritCacheTests, self).tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_config(self):
+        return make_config(
+            self.tmpdir, self.db_path,
+            gerrit_url='http://127.0.0.1:%d/' % self.server.server_address[1])
+
+    def _import(self, revision, sha, parent=None):
+        info = {'git_sha': sha}
+        if parent:
+            info['parent_commit'] = parent
+        path = os.path.join(self.tmpdir, 'report.json')
+        with open(path, 'w') as f:
+            json.dump(make_report(
+                revision, [make_test('test.exec', [float(revision)])],
+                **info), f)
+        result = lnt.util.ImportData.import_and_report(
+            self.config, 'default', self.db, path, '<auto>', True,
+            run_jobs=False)
+        self.assertTrue(result['success'], result.get('error'))
+        return result
+
+    def _lookups(self):
+        return [(job.key, job.state) for job in self.db.query(jobs.Job).filter(
+            jobs.Job.kind == 'resolve_gerrit_change').order_by(jobs.Job.id)]
+
+    def test_resolve(self):
+        """Are the changes looked up after the import, and filled in?"""
+        self._import(1, 'sha1')
+        ts = self.db.testsuite[TAG]
+        record = ts.query(ts.Gerrit).one()
+        # The import did not wait for the code review server.
+        self.assertEqual(self.server.lookups, [])
+        self.assertEqual(record.gerrit_change_id, None)
+        self.assertEqual(self._lookups(), [('sha1', jobs.QUEUED)])
+
+        jobs.run_queued_jobs(self.db)
+        self.assertEqual(self.server.lookups, ['sha1'])
+        self.assertEqual(self._lookups(), [('sha1', jobs.DONE)])
+        self.db.session.expire_all()
+        self.assertEqual(ts.query(ts.Gerrit).one().gerrit_change_id, 'I1')
+
+        # The other patch sets of the change were recorded along with it, so
+        # their runs get the change id without looking it up again.
+        self._import(2, 'sha1b')
+        self.assertEqual(self._lookups(), [('sha1', jobs.DONE)])
+        records = ts.query(ts.Gerrit).all()
+        self.assertEqual([r.gerrit_change_id for r in records], ['I1', 'I1'])
+        self.assertEqual(gerrit.get_change(self.db, 'sha1b')['_number'], 1)
+        self.assertEqual(self.server.lookups, ['sha1'])
+
+        # Duplicate submissions look nothing up.
+        result = self._import(1, 'sha1')
+        self.assertEqual(result['added_runs'], 0)
+        self.assertEqual(len(self._lookups()), 1)
+
+    def test_commit_validation(self):
+        """Are the changes of the commits and parents of CV runs filled in,
+        and are unknown commits recorded as such?"""
+        self._import(1, 'sha3', parent='sha2')
+        jobs.run_queued_jobs(self.db)
+        self.assertEqual(sorted(self.server.lookups), ['sha2', 'sha3'])
+        ts = self.db.testsuite[TAG]
+        self.db.session.expire_all()
+        record = ts.query(ts.CVGerrit).one()
+        self.assertEqual((record.gerrit_change_id,
+                          record.gerrit_change_id_parent), (None, 'I2'))
+        change = self.db.query(gerrit.GerritChange).filter(
+            gerrit.GerritChange.sha == 'sha3').one()
+        self.assertEqual(change.state, gerrit.NOT_FOUND)
+        # The pages about commits look unknown commits up again.
+        self.assertEqual(gerrit.get_change(self.db, 'sha3'), None)
+        self.assertEqual(len(self.server.lookups), 3)
+
+    def test_unavailable(self):
+        """Do imports succeed while the code review server is down, and are
+        the lookups retried?"""
+        self.server.unavailable = True
+        self._import(1, 'sha1')
+        self.assertEqual(self.server.lookups, [])
+        jobs.run_queued_jobs(self.db)
+        self.assertEqual(self.server.lookups, ['sha1'])
+        job = self.db.query(jobs.Job).filter(
+            jobs.Job.kind == 'resolve_gerrit_change').one()
+        self.assertEqual((job.state, job.attempts), (jobs.QUEUED, 1))
+        self.assertIn('503', job.last_error)
+        change = self.db.query(gerrit.GerritChange).one()
+        self.assertEqual(change.state, gerrit.PENDING)
+
+        # Once the server is back, the retry resolves the change.
+        self.server.unavailable = False
+        jobs.requeue(self.db, [job.id], reset_attempts=False)
+        jobs.run_queued_jobs(self.db)
+        self.db.session.expire_all()
+        ts = self.db.testsuite[TAG]
+        self.assertEqual(ts.query(ts.Gerrit).one().gerrit_change_id, 'I1')
+
+    def test_concurrent_add(self):
+        """Does an import go on with the commit another import added since it
+        looked for it?"""
+        gerrit.get_change_id(self.db, 'sha1')
+        self.db.commit()
+        find_change = gerrit._find_change
+        missed = []
+        def miss_once(db, sha):
+            if not missed:
+                missed.append(sha)
+                return None
+            return find_change(db, sha)
+        gerrit._find_change = miss_once
+        try:
+            self._import(1, 'sha1')
+        finally:
+            gerrit._find_change = find_change
+        self.assertEqual(missed, ['sha1'])
+        self.assertEqual(self.db.query(gerrit.GerritChange).count(), 1)
+        ts = self.db.testsuite[TAG]
+        self.assertEqual(ts.query(ts.Run).count(), 1)
+
+    def test_failed_lookup(self):
+        """Is the lookup of a commit queued again once it failed for good?"""
+        self.server.unavailable = True
+        self._import(1, 'sha1')
+        job = self.db.query(jobs.Job).filter(
+            jobs.Job.kind == 'resolve_gerrit_change').one()
+        job.state = jobs.FAILED
+        self.db.commit()
+
+        self.server.unavailable = False
+        self._import(2, 'sha1')
+        self.assertEqual(self._lookups(), [('sha1', jobs.FAILED),
+                                           ('sha1', jobs.QUEUED)])
+        jobs.run_queued_jobs(self.db)
+        self.db.session.expire_all()
+        ts = self.db.testsuite[TAG]
+        self.assertEqual([r.gerrit_change_id for r in ts.query(ts.Gerrit)],
+                         ['I1', 'I1'])
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
@@ -0,0 +1,183 @@
+# Check that the graph data of many plots, loaded at once, matches the data
+# loaded plot by plot, and that long histories are downsampled.
+# RUN: python %s
+"""Test lnt.server.db.graph"""
+import logging
+import sys
+import unittest
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.graph
+from lnt.testing import FAIL, PASS
+from tests.testutils import DBTestCase, make_report, make_test
+
+
+def reference_samples(ts, machine_id, test_id, field, max_rank=None,
+                      show_failures=False, min_rank=None):
+    """The samples of a single plot."""
+    q = ts.query(field.column, ts.Order.llvm_project_revision,
+                 ts.Run.start_time, ts.Run.id). \
+        join(ts.Run).join(ts.Order). \
+        filter(ts.Run.machine_id == machine_id). \
+        filter(ts.Sample.test_id == test_id). \
+        filter(field.column != None). \
+        order_by(ts.Order.rank, ts.Order.id)
+    if max_rank is not None:
+        q = q.filter(ts.Order.rank <= max_rank)
+    if min_rank is not None:
+        q = q.filter(ts.Order.rank >= min_rank)
+    if not show_failures and field.status_field:
+        q = q.filter((field.status_field.column == PASS) |
+                     (field.status_field.column == None))
+    data = OrderedDict()
+    for val, rev, date, run_id in q:
+        data.setdefault(rev, []).append((val, date, run_id))
+    return data
+
+
+class GraphTests(DBTestCase):
+    """Test the batched loading of graph data."""
+
+    def _import(self, machine_name, revision, tests):
+        # Every run starts at a different time.
+        return self.import_report(make_report(revision, tests, machine_name,
+                                              start=len(self.runs)))
+
+    def test_plot_samples(self):
+        """Do the samples of many plots match the ones of each plot?"""
+        ts = self.ts
+        for machine_name in ('machine0', 'machine1'):
+            # Revision 11 sorts before revision 100, as an integer.
+            for revision in (2, 1, 11, 100, 11):
+                tests = []
+                for i in range(4):
+                    name = 'test%d' % i
+                    if (i + revision) % 3:
+                        tests.append(make_test(name + '.exec',
+                                               [float(revision + i),
+                                                revision * 2.0]))
+                    if i == 2 and revision == 11:
+                        tests.append(make_test(name + '.exec.status',
+                                               [FAIL, FAIL]))
+                self._import(machine_name, revision, tests)
+
+        machine_ids = [m.id for m in ts.query(ts.Machine)]
+        test_ids = [t.id for t in ts.query(ts.Test)]
+        fields = list(ts.Sample.get_metric_fields())
+        # Leave a combination out, and ask for an unknown test.
+        plots = [(m, t, f) for m in machine_ids for t in test_ids
+                 for f in fields][1:] + [(machine_ids[0], 1000, fields[0])]
+        for min_rank, max_rank in ((None, None), (None, 11), (2, 11)):
+            for show_failures in (False, True):
+                samples = lnt.server.db.graph.get_plot_samples(
+                    ts, plots, max_rank=max_rank,
+                    show_failures=show_failures, min_rank=min_rank)
+                self.assertEqual(set(samples), set(plots))
+                for plot in plots:
+                    expected = reference_samples(ts, *plot,
+                                                 max_rank=max_rank,
+                                                 show_failures=show_failures,
+                                                 min_rank=min_rank)
+                    self.assertEqual(samples[plot].items(), expected.items())
+
+        # The baselines are the means of the samples of the runs.
+        means = lnt.server.db.graph.get_baseline_means(
+            ts, self.runs[2:4], test_ids, fields)
+        for run in self.runs[2:4]:
+            for test_id in test_ids:
+                for field in fields:
+                    values = [v for v, in ts.query(field.column).
+                              filter(ts.Sample.run_id == run.id).
+                              filter(ts.Sample.test_id == test_id).
+                              filter(field.column != None)]
+                    if values:
+                        self.assertEqual(means[run.id, test_id, field],
+                                         sum(values) / len(values))
+                    else:
+                        self.assertFalse((run.id, test_id, field) in means)
+
+    def test_machines_and_tests(self):
+        """Are the machines and tests loaded at once, leaving out unknown
+        ids?"""
+        ts = self.ts
+        run = self._import('machine', 1, [make_test('test.exec', [1.0])])
+        test = ts.query(ts.Test).one()
+        machine_id = run.machine.id
+
+        machines, tests = lnt.server.db.graph.get_machines_and_tests(
+            ts, [machine_id, machine_id + 1], [test.id, test.id + 1])
+        self.assertEqual(machines.keys(), [machine_id])
+        self.assertEqual(tests.keys(), [test.id])
+        machines, tests = lnt.server.db.graph.get_machines_and_tests(
+            ts, [machine_id], [])
+        self.assertEqual((machines.keys(), tests), ([machine_id], {}))
+        self.assertEqual(lnt.server.db.graph.get_runs(ts, [run.id, 1000]),
+                         {run.id: run})
+
+    def test_change_revisions(self):
+        """Are the revisions of the field changes of each plot found?"""
+        ts = self.ts
+        tests = [make_test('test%d.exec' % i, [1.0]) for i in range(2)]
+        runs = [self._import('machine', revision, tests)
+                for revision in (1, 2, 3)]
+        test0, test1 = ts.query(ts.Test).order_by(ts.Test.name)
+        field = ts.Sample.get_metric_fields().next()
+        change = ts.FieldChange(runs[0].order, runs[2].order,
+                                runs[0].machine, test0, field)
+        ts.add(change)
+        ts.commit()
+
+        plots = [(runs[0].machine.id, test0.id, field),
+                 (runs[0].machine.id, test1.id, field)]
+        revisions = lnt.server.db.graph.get_plot_change_revisions(ts, plots)
+        self.assertEqual(revisions, {plots[0]: set(['1', '3']),
+                                     plots[1]: set()})
+
+
+class DownsampleTests(unittest.TestCase):
+    """Test the downsampling of long histories."""
+
+    def test_short(self):
+        """Are short or not downsampled lines left alone?"""
+        points = [(x, x * x) for x in range(10)]
+        self.assertEqual(lnt.server.db.graph.lttb(points, 10), range(10))
+        self.assertEqual(lnt.server.db.graph.lttb(points, 0), range(10))
+        self.assertEqual(lnt.server.db.graph.lttb([], 3), [])
+
+    def test_lttb(self):
+        """Does the downsampling keep the shape of the line?"""
+        # A flat line with two spikes.
+        points = [(x, 0.0) for x in range(1000)]
+        points[300] = (300, 10.0)
+        points[700] = (700, -5.0)
+        kept = lnt.server.db.graph.lttb(points, 50)
+        self.assertEqual(len(kept), 50)
+        self.assertEqual(kept, sorted(set(kept)))
+        for i in (0, 300, 700, 999):
+            self.assertTrue(i in kept)
+
+    def test_keep(self):
+        """Are the points to keep always kept, within the budget?"""
+        points = [(x, float(x % 7)) for x in range(1000)]
+        keep = [5, 10, 500, 501, 998]
+        kept = lnt.server.db.graph.lttb(points, 100, keep)
+        self.assertEqual(len(kept), 100)
+        for i in keep + [0, 999]:
+            self.assertTrue(i in kept)
+
+    def test_plot_samples(self):
+        """Are the samples of plots downsampled by revision?"""
+        data = OrderedDict(
+            (str(rev), [(10.0 if rev == 50 else 1.0, None, rev),
+                        (1.0, None, rev)])
+            for rev in range(1, 101))
+        downsampled = lnt.server.db.graph.downsample_plot_samples(
+            data, 10, set(['20']))
+        self.assertEqual(len(downsampled), 10)
+        for rev in ('1', '20', '50', '100'):
+            self.assertEqual(downsampled[rev], data[rev])
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
@@ -0,0 +1,146 @@
+# Check the import of batches of reports.
+# RUN: python %s
+"""Test lnt.util.ImportData.import_batch"""
+import json
+import logging
+import os
+import StringIO
+import sys
+import tarfile
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.jobs as jobs
+import lnt.util.ImportData
+from tests.testutils import DBTestCase, TAG, make_config, make_report
+from tests.testutils import make_test
+
+
+class ImportBatchTests(DBTestCase):
+    """Test the import of many reports in one session."""
+
+    def setUp(self):
+        super(ImportBatchTests, self).setUp()
+        self.config = make_config(self.tmpdir, self.db_path)
+
+    def _report(self, machine, revision, tests=('test',)):
+        return make_report(revision, [make_test(name + '.exec',
+                                                [float(revision)])
+                                      for name in tests], machine)
+
+    def _batch(self, lines):
+        path = os.path.join(self.tmpdir, 'batch.json')
+        with open(path, 'w') as f:
+            for line in lines:
+                if not isinstance(line, str):
+                    line = json.dumps(line)
+                f.write(line + '\n')
+        return path
+
+    def _import(self, path, batch_size=lnt.util.ImportData.BATCH_SIZE):
+        return lnt.util.ImportData.import_batch(
+            self.config, 'default', self.db, path, True, batch_size,
+            run_jobs=False)
+
+    def test_batch(self):
+        """Are the reports of a batch imported, with the result of each, and
+        the post submission tasks queued once per machine and commit?"""
+        reports = [self._report('machine%d' % (i % 2), i, ('a', 'b'))
+                   for i in range(1, 6)]
+        ts = self.db.testsuite[TAG]
+        (generation,), _ = ts.get_data_generation([None])
+        result = self._import(self._batch(reports), batch_size=3)
+        self.assertTrue(result['success'])
+        self.assertEqual(result['added_runs'], 5)
+        results = result['results']
+        self.assertEqual([r['name'] for r in results],
+                         ['line %d' % i for i in range(1, 6)])
+        self.assertTrue(all(r['success'] for r in results))
+
+        # The machines, orders and tests were created once.
+        self.assertEqual(ts.query(ts.Machine).count(), 2)
+        self.assertEqual(ts.query(ts.Order).count(), 5)
+        self.assertEqual(ts.query(ts.Test).count(), 2)
+        run = ts.query(ts.Run).get(results[0]['run_id'])
+        self.assertEqual(run.imported_from, result['import_file'] + ':line 1')
+        self.assertEqual(results[0]['result_url'],
+                         'db_default/v4/%s/%d' % (TAG, run.id))
+        # The data generation was bumped once per commit.
+        machine_ids = [m.id for m in ts.query(ts.Machine)]
+        self.assertEqual(ts.get_data_generation([None] + machine_ids)[0],
+                         (generation + 2,) * 3)
+
+        # Two machines in each of the two commits.
+        queued = self.db.query(jobs.Job).order_by(jobs.Job.id).all()
+        self.assertEqual(result['queued_jobs'], 4)
+        self.assertEqual([job.kind for job in queued],
+                         ['post_submit_runs'] * 4)
+        self.assertEqual([len(job.arguments['run_ids']) for job in queued],
+                         [2, 1, 1, 1])
+        self.assertEqual(jobs.run_queued_jobs(self.db), 4)
+
+        # Importing it again only finds duplicates.
+        result = self._import(self._batch(reports))
+        self.assertEqual(result['added_runs'], 0)
+        self.assertEqual(result['queued_jobs'], 0)
+        self.assertEqual([r['original_run'] for r in result['results']],
+                         [r['run_id'] for r in results])
+
+    def test_failures(self):
+        """Are the other reports of a batch imported when some fail?"""
+        bad = self._report('machine0', 2)
+        del bad['Run']['Start Time']
+        lines = [self._report('machine0', 1), '{ not json', bad,
+                 self._report('machine0', 3)]
+        result = self._import(self._batch(lines))
+        self.assertFalse(result['success'])
+        self.assertEqual([r['success'] for r in result['results']],
+                         [True, False, False, True])
+        self.assertIn('load failure', result['results'][1]['error'])
+        self.assertIn('import failure', result['results'][2]['error'])
+        # The report imported before the failure was imported again.
+        self.assertEqual(result['added_runs'], 2)
+        ts = self.db.testsuite[TAG]
+        self.assertEqual(sorted(run.id for run in ts.query(ts.Run)),
+                         sorted(result['results'][i]['run_id']
+                                for i in (0, 3)))
+        job = self.db.query(jobs.Job).one()
+        self.assertEqual(len(job.arguments['run_ids']), 2)
+
+    def test_dry_run(self):
+        """Does a batch which is not committed leave nothing behind?"""
+        reports = [self._report('machine%d' % (i % 2), i) for i in range(1, 5)]
+        result = lnt.util.ImportData.import_batch(
+            self.config, 'default', self.db, self._batch(reports), False,
+            batch_size=3, run_jobs=False)
+        self.assertTrue(result['success'])
+        self.assertEqual(result['added_runs'], 0)
+        self.assertEqual(result['queued_jobs'], 0)
+        ts = self.db.testsuite[TAG]
+        self.assertEqual(ts.query(ts.Run).count(), 0)
+        self.assertEqual(ts.query(ts.Order).count(), 0)
+
+        # The batch is imported once committed.
+        result = self._import(self._batch(reports))
+        self.assertEqual(result['added_runs'], 4)
+        self.assertEqual([r['original_run'] for r in result['results']
+                          if 'original_run' in r], [])
+
+    def test_tar(self):
+        """Are the reports of a tar archive imported?"""
+        path = os.path.join(self.tmpdir, 'batch.tar.gz')
+        with tarfile.open(path, 'w:gz') as archive:
+            for i in range(1, 3):
+                data = json.dumps(self._report('machine0', i))
+                info = tarfile.TarInfo('report%d.json' % i)
+                info.size = len(data)
+                archive.addfile(info, StringIO.StringIO(data))
+        result = self._import(path)
+        self.assertTrue(result['success'])
+        self.assertEqual([r['name'] for r in result['results']],
+                         ['report1.json', 'report2.json'])
+        self.assertEqual(result['added_runs'], 2)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
@@ -0,0 +1,75 @@
+# Check that the bulk sample import path stores the same data as the ORM path.
+# RUN: python %s
+"""Test the bulk sample import"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.v4db
+from tests.testutils import TAG, import_report, make_config, make_report
+from tests.testutils import make_test
+
+INPUTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Inputs')
+
+
+def make_tests():
+    # Borrow the encoded profile from the profile import test.
+    with open(os.path.join(INPUTS, 'profile-report.json')) as f:
+        profile_data = [t['Data'] for t in json.load(f)['Tests']
+                        if t['Name'].endswith('.profile')][0]
+
+    tests = []
+    for i in range(10):
+        name = 'test%d' % i
+        tests.append(make_test(name + '.exec', [float(i), i + 0.5]))
+        if i % 2:
+            tests.append(make_test(name + '.exec.status', [1]))
+        if i % 3 == 0:
+            tests.append(make_test(name + '.profile', profile_data))
+    return tests
+
+
+class BulkImportTests(unittest.TestCase):
+    """Test the bulk sample import path."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        lnt.server.db.v4db.V4DB.close_all_engines()
+        shutil.rmtree(self.tmpdir)
+
+    def _import(self, bulk):
+        path = 'sqlite:///%s/%s.db' % (self.tmpdir, 'bulk' if bulk else 'orm')
+        config = make_config(self.tmpdir, path, bulk_import=bulk)
+        db = config.get_database('default')
+        ts = db.testsuite[TAG]
+        run = import_report(ts, make_report(10, make_tests()),
+                            config.databases['default'])
+
+        samples = []
+        for sample in ts.query(ts.Sample).filter(ts.Sample.run_id == run.id):
+            counters = None
+            if sample.profile is not None:
+                self.assertTrue(os.path.exists(sample.profile.filename))
+                counters = sample.profile.counters
+            samples.append((sample.test.name, sample.execution_time,
+                            sample.execution_status, counters))
+        db.close()
+        return sorted(samples)
+
+    def test_bulk_matches_orm(self):
+        """Does the bulk import write the same samples as the ORM?"""
+        orm_samples = self._import(False)
+        bulk_samples = self._import(True)
+        self.assertEqual(len(bulk_samples), 20)
+        self.assertEqual(orm_samples, bulk_samples)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
@@ -0,0 +1,49 @@
+# Check that reports whose tests fail to read while they are imported are
+# load failures.
+# RUN: python %s
+"""Test lnt.util.ImportData.import_and_report with streamed reports"""
+import json
+import logging
+import os
+import sys
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.util.ImportData
+from tests.testutils import DBTestCase, make_report, make_test
+
+
+class ImportStreamedTests(DBTestCase):
+    """Test the import of reports which are read as they are imported."""
+
+    def _import(self, data):
+        path = os.path.join(self.tmpdir, 'report.json')
+        with open(path, 'w') as f:
+            f.write(data)
+        return lnt.util.ImportData.import_and_report(
+            None, 'default', self.db, path, '<auto>', True,
+            disable_report=True, run_jobs=False)
+
+    def test_truncated(self):
+        """Is a report whose tests are cut short a load failure, which adds
+        no run?"""
+        data = json.dumps(make_report(1, [make_test('test%d.exec' % i,
+                                                     [float(i)])
+                                           for i in range(10)]),
+                          sort_keys=True)
+        # Machine and Run come before Tests, so the tests are streamed.
+        self.assertTrue(data.index('"Tests"') > data.index('"Run"'))
+
+        result = self._import(data[:-60])
+        self.assertFalse(result['success'])
+        self.assertIn('load failure', result['error'])
+        ts = self.ts
+        self.assertEqual(ts.query(ts.Run).count(), 0)
+
+        result = self._import(data)
+        self.assertTrue(result['success'], result['error'])
+        self.assertEqual(ts.query(ts.Run).count(), 1)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
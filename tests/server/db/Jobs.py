@@ -0,0 +1,195 @@
+# Check the durable background job queue.
+# RUN: python %s
+"""Test lnt.server.db.jobs"""
+import datetime
+import logging
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.jobs as jobs
+import lnt.server.db.v4db
+
+TAG = 'kv-engine'
+
+# The arguments of the test jobs which ran.
+RAN = []
+
+
+def record_job(ts, value, fail=False, sleep=0):
+    time.sleep(sleep)
+    RAN.append(value)
+    if fail:
+        raise ValueError("failing as asked")
+
+jobs.JOB_KINDS['test'] = '__main__.record_job'
+
+
+class JobsTests(unittest.TestCase):
+    """Test the job queue."""
+
+    def setUp(self):
+        del RAN[:]
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = 'sqlite:///%s/lnt.db' % self.tmpdir
+        self.db = lnt.server.db.v4db.V4DB(self.path, None)
+        # Another process sharing the database.
+        self.other_db = lnt.server.db.v4db.V4DB(self.path, None)
+
+    def tearDown(self):
+        self.db.close()
+        self.other_db.close()
+        lnt.server.db.v4db.V4DB.close_all_engines()
+        shutil.rmtree(self.tmpdir)
+
+    def _enqueue(self, key, max_attempts=jobs.MAX_ATTEMPTS, **arguments):
+        arguments.setdefault('value', key)
+        job = jobs.enqueue(self.db, 'test', TAG, key, arguments, max_attempts)
+        self.db.commit()
+        return job.id
+
+    def _get(self, job_id):
+        self.db.session.expire_all()
+        return self.db.query(jobs.Job).get(job_id)
+
+    def test_enqueue_once(self):
+        """Is a job queued only once while it is pending?"""
+        job_id = self._enqueue(1)
+        self.assertEqual(self._enqueue(1), job_id)
+        self.assertNotEqual(self._enqueue(2), job_id)
+
+        self.assertEqual(jobs.run_queued_jobs(self.db), 2)
+        self.assertEqual(sorted(RAN), [1, 2])
+        self.assertEqual(self._get(job_id).state, jobs.DONE)
+
+        # Once done, the same job can be queued again.
+        self.assertNotEqual(self._enqueue(1), job_id)
+
+    def test_claim_once(self):
+        """Can a job only be claimed by one worker?"""
+        job_id = self._enqueue(1)
+        job = jobs.claim(self.db, 'worker-a')
+        self.assertEqual(job.id, job_id)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(jobs.claim(self.other_db, 'worker-b'), None)
+
+    def test_lease_expiry(self):
+        """Is a job whose worker died claimed again?"""
+        job_id = self._enqueue(1)
+        stale = jobs.claim(self.db, 'worker-a', lease_time=-1)
+
+        job = jobs.claim(self.other_db, 'worker-b')
+        self.assertEqual(job.id, job_id)
+        self.assertEqual(job.owner, 'worker-b')
+        self.assertEqual(job.attempts, 2)
+
+        # The first worker can no longer complete it.
+        jobs.complete(self.db, stale, 0.0)
+        self.assertEqual(self._get(job_id).state, jobs.RUNNING)
+        jobs.complete(self.other_db, job, 0.0)
+        self.assertEqual(self._get(job_id).state, jobs.DONE)
+
+    def test_lease_renewal(self):
+        """Is the lease of a job renewed while it runs?"""
+        job_id = self._enqueue(1, sleep=2.0)
+        job = jobs.claim(self.db, 'worker-a', lease_time=1)
+
+        # Another worker tries to claim the job once it ran past its first
+        # lease.
+        claimed = []
+        def claim():
+            time.sleep(1.5)
+            db = lnt.server.db.v4db.V4DB(self.path, None)
+            claimed.append(jobs.claim(db, 'worker-b'))
+            db.close()
+        thread = threading.Thread(target=claim)
+        thread.start()
+        jobs.run_job(self.db, job, lease_time=1)
+        thread.join()
+        self.assertEqual(claimed, [None])
+        self.assertEqual(RAN, [1])
+        job = self._get(job_id)
+        self.assertEqual((job.state, job.owner, job.attempts),
+                         (jobs.DONE, 'worker-a', 1))
+
+    def test_next_time(self):
+        """Is the time the next job is ready to run known?"""
+        self.assertEqual(jobs.get_next_time(self.db), None)
+        job_id = self._enqueue(1, fail=True)
+        jobs.run_queued_jobs(self.db)
+        # The retry is the next job.
+        retry_time = self._get(job_id).available_time
+        self.assertTrue(retry_time > datetime.datetime.utcnow())
+        self.assertEqual(jobs.get_next_time(self.db), retry_time)
+
+        self._enqueue(2)
+        job = jobs.claim(self.db, 'worker-a', lease_time=5)
+        self.assertEqual(jobs.get_next_time(self.db), job.lease_expires)
+
+    def test_retry(self):
+        """Are failed jobs retried with a backoff, until out of attempts?"""
+        job_id = self._enqueue(1, max_attempts=2, fail=True)
+
+        self.assertEqual(jobs.run_queued_jobs(self.db), 1)
+        job = self._get(job_id)
+        self.assertEqual(job.state, jobs.QUEUED)
+        self.assertTrue(job.available_time > datetime.datetime.utcnow())
+        self.assertTrue("failing as asked" in job.last_error)
+
+        # Not ready yet.
+        self.assertEqual(jobs.run_queued_jobs(self.db), 0)
+
+        job.available_time = datetime.datetime.utcnow()
+        self.db.commit()
+        self.assertEqual(jobs.run_queued_jobs(self.db), 1)
+        job = self._get(job_id)
+        self.assertEqual(job.state, jobs.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(RAN, [1, 1])
+        self.assertTrue(job.is_stuck)
+
+    def test_requeue(self):
+        """Are stuck jobs requeued?"""
+        failed_id = self._enqueue(1, max_attempts=1, fail=True)
+        jobs.run_queued_jobs(self.db)
+        alive_id = self._enqueue(2)
+        jobs.claim(self.db, 'worker-a')
+        running_id = self._enqueue(3)
+        jobs.claim(self.db, 'worker-b', lease_time=-1)
+
+        requeued = jobs.requeue(self.db, stuck=True)
+        self.assertEqual([job.id for job in requeued], [failed_id, running_id])
+        self.assertEqual(self._get(failed_id).state, jobs.QUEUED)
+        self.assertEqual(self._get(failed_id).attempts, 0)
+        self.assertEqual(self._get(alive_id).state, jobs.RUNNING)
+        self.assertEqual(jobs.get_state_counts(self.db),
+                         {jobs.QUEUED: 2, jobs.RUNNING: 1, jobs.DONE: 0,
+                          jobs.FAILED: 0})
+
+    def test_prune(self):
+        """Are the jobs which finished long ago removed, and only them?"""
+        done_id = self._enqueue(1)
+        failed_id = self._enqueue(2, max_attempts=1, fail=True)
+        jobs.run_queued_jobs(self.db)
+        queued_id = self._enqueue(3)
+        self.assertEqual(jobs.prune(self.db), 0)
+
+        # Age the finished jobs past the retention.
+        for job_id in (done_id, failed_id):
+            job = self._get(job_id)
+            job.finished_time -= datetime.timedelta(
+                days=jobs.RETENTION_DAYS + 1)
+            self.db.commit()
+        recent_id = self._enqueue(4)
+        jobs.run_queued_jobs(self.db)
+        self.assertEqual(jobs.prune(self.db), 2)
+        self.assertEqual([job.id for job in self.db.query(jobs.Job).
+                          order_by(jobs.Job.id)], [queued_id, recent_id])
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
@@ -0,0 +1,123 @@
+# Check that order ranks and the order linked list are maintained on insert,
+# backfilled by the migrations, and used to sort orders.
+# RUN: python %s
+"""Test the order total ordering"""
+import datetime
+import logging
+import shutil
+import sys
+import tempfile
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.migrate
+import lnt.server.db.v4db
+from lnt.server.db.regression import get_all_orders_for_machine
+
+TAG = 'kv-engine'
+
+
+class OrderRankTests(unittest.TestCase):
+    """Test the maintenance of the order total ordering."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = 'sqlite:///%s/lnt.db' % self.tmpdir
+        self.db = lnt.server.db.v4db.V4DB(self.path, None)
+        self.ts = self.db.testsuite[TAG]
+
+    def tearDown(self):
+        self.db.close()
+        lnt.server.db.v4db.V4DB.close_all_engines()
+        shutil.rmtree(self.tmpdir)
+
+    def _add_order(self, revision, sha=None):
+        order, inserted = self.ts._getOrCreateOrder(
+            {'run_order': str(revision), 'git_sha': sha or 'sha%d' % revision})
+        self.assertTrue(inserted)
+        self.ts.commit()
+        return order
+
+    def _walk(self):
+        """Return the revisions in linked list order."""
+        ts = self.ts
+        order = ts.query(ts.Order).filter(
+            ts.Order.previous_order_id == None).one()
+        revisions = []
+        while order is not None:
+            revisions.append(order.llvm_project_revision)
+            order = order.next_order
+        return revisions
+
+    def test_insert_order(self):
+        """Are out of order inserts linked into the total ordering?"""
+        for revision in (10, 30, 20, 5, 40, 25):
+            self._add_order(revision)
+        self.assertEqual(self._walk(), ['5', '10', '20', '25', '30', '40'])
+
+        ts = self.ts
+        order = ts.query(ts.Order).filter(
+            ts.Order.llvm_project_revision == '25').one()
+        self.assertEqual(order.rank, 25)
+        self.assertEqual(ts._get_predecessor_order(order).rank, 20)
+        self.assertEqual(ts._get_successor_order(order).rank, 30)
+
+    def test_equal_rank(self):
+        """Are orders with the same revision kept in insertion order?"""
+        self._add_order(10)
+        self._add_order(20)
+        self._add_order(10, 'other')
+        ts = self.ts
+        shas = []
+        order = ts.query(ts.Order).filter(
+            ts.Order.previous_order_id == None).one()
+        while order is not None:
+            shas.append(order.git_sha)
+            order = order.next_order
+        self.assertEqual(shas, ['sha10', 'other', 'sha20'])
+
+    def test_backfill(self):
+        """Does the migration backfill missing ranks?"""
+        ts = self.ts
+        machine = ts.Machine('machine')
+        now = datetime.datetime.now()
+        for revision in (3, 1, 2):
+            # Orders without runs are dropped by the migrations.
+            ts.add(ts.Run(machine, self._add_order(revision), now, now))
+        ts.query(ts.Order).update({ts.Order.rank: None})
+        ts.commit()
+
+        lnt.server.db.migrate.update(self.db.engine)
+
+        ranks = sorted((o.llvm_project_revision, o.rank)
+                       for o in ts.query(ts.Order))
+        self.assertEqual(ranks, [('1', 1), ('2', 2), ('3', 3)])
+
+    def test_numeric_order(self):
+        """Are the orders sorted and filtered by integer revision?"""
+        ts = self.ts
+        machine = ts.Machine('machine')
+        now = datetime.datetime.now()
+        for revision in (9, 100, 10):
+            ts.add(ts.Run(machine, self._add_order(revision), now, now))
+        ts.commit()
+
+        orders = get_all_orders_for_machine(ts, machine.id)
+        self.assertEqual([o.llvm_project_revision for o in orders],
+                         ['9', '10', '100'])
+        self.assertEqual(ts._get_max_run_order(), 101)
+
+        # CV orders are ranked too, and backfilled by the migration.
+        cv_order, _ = ts._getOrCreateOrder(
+            {'run_order': '11', 'git_sha': 'cv', 'parent_commit': 'sha10'},
+            cv=True)
+        self.assertEqual(cv_order.rank, 11)
+        self.assertEqual(ts._get_max_run_order(cv=True), 12)
+        ts.query(ts.CVOrder).update({ts.CVOrder.rank: None})
+        ts.commit()
+        lnt.server.db.migrate.update(self.db.engine)
+        self.assertEqual(ts.query(ts.CVOrder.rank).scalar(), 11)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
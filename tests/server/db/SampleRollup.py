@@ -0,0 +1,189 @@
+# Check that the summaries of the samples at each order, and the geometric
+# means of the tests computed from them, are maintained as runs are imported
+# and removed, and agree with the samples.
+# RUN: python %s
+"""Test the SampleRollup and OrderGeomean records of TestSuiteDB"""
+import logging
+import sys
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.graph
+import lnt.server.db.migrate
+import lnt.server.reporting.analysis
+import lnt.util.stats
+from lnt.testing import FAIL
+from tests.testutils import DBTestCase, make_report, make_test
+
+
+def reference_rollups(ts):
+    """The summaries of the samples, computed from all of them."""
+    samples = {}
+    for field in ts.Sample.get_metric_fields():
+        q = ts.query(ts.Run.machine_id, ts.Sample.test_id, ts.Run.order_id,
+                     field.column). \
+            select_from(ts.Sample).join(ts.Run). \
+            filter(field.column != None)
+        if field.status_field:
+            q = q.filter((field.status_field.column == None) |
+                         (field.status_field.column != FAIL))
+        for machine_id, test_id, order_id, value in q:
+            samples.setdefault((machine_id, test_id, field.id, order_id),
+                               []).append(value)
+    rollups = []
+    for key, values in samples.items():
+        median = lnt.util.stats.median(values)
+        rollups.append(key + (len(values), min(values), median,
+                              lnt.util.stats.mean(values),
+                              lnt.util.stats.median_absolute_deviation(
+                                  values, median)))
+    return sorted(rollups)
+
+
+def reference_geomeans(ts):
+    """The geometric means of the tests, computed from all the samples."""
+    mins = {}
+    for machine_id, test_id, field_id, order_id, _, min_value, _, _, _ in \
+            reference_rollups(ts):
+        mins.setdefault((machine_id, field_id, order_id), []).append(
+            min_value)
+    return sorted(key + (len(values),
+                         lnt.server.reporting.analysis.calc_geomean(values))
+                  for key, values in mins.items())
+
+
+class SampleRollupTests(DBTestCase):
+    """Test the maintenance of the summaries of the samples."""
+
+    def _import(self, revision, tests, machine_name='machine'):
+        # Every run starts at a different time.
+        return self.import_report(make_report(revision, tests, machine_name,
+                                              start=len(self.runs)))
+
+    def _records(self):
+        ts = self.ts
+        return sorted((r.machine_id, r.test_id, r.field_id, r.order_id,
+                       r.num_samples, r.min, r.median, r.mean, r.mad)
+                      for r in ts.query(ts.SampleRollup))
+
+    def _geomeans(self):
+        ts = self.ts
+        return sorted((r.machine_id, r.field_id, r.order_id, r.num_tests,
+                       r.geomean)
+                      for r in ts.query(ts.OrderGeomean))
+
+    def _check_records(self):
+        """Do the records agree with the samples, and with the ones computed
+        from scratch?"""
+        records = self._records()
+        self.assertEqual(records, reference_rollups(self.ts))
+        geomeans = self._geomeans()
+        self.assertEqual(geomeans, reference_geomeans(self.ts))
+        self.assertEqual(self.ts.check_order_geomeans(), [])
+        self.ts.rebuild_sample_rollups()
+        self.ts.rebuild_order_geomeans()
+        self.ts.commit()
+        self.assertEqual(self._records(), records)
+        self.assertEqual(self._geomeans(), geomeans)
+        return records
+
+    def _tests(self, revision):
+        tests = [make_test('test0.exec', [float(revision), revision + 2.0]),
+                 make_test('test1.exec', [1.0, 3.0, 2.0 * revision])]
+        if revision == 3:
+            tests.append(make_test('test1.exec.status', [FAIL, FAIL, FAIL]))
+        return tests
+
+    def test_rollups(self):
+        """Are the records maintained on import and removal of runs?"""
+        ts = self.ts
+        for revision in (1, 2, 3, 2, 4):
+            self._import(revision, self._tests(revision))
+        self._import(2, self._tests(5), 'machine2')
+        records = self._check_records()
+        # The failing samples are left out.
+        self.assertEqual(len(records), 2 * 4 + 2 - 1)
+
+        # Removing a run updates the records of its order.
+        run = self.runs[1]
+        ts.query(ts.Sample).filter(ts.Sample.run_id == run.id).delete()
+        ts.query(ts.Run).filter(ts.Run.id == run.id).delete()
+        ts.update_sample_rollups(run.machine_id, [run.order_id])
+        ts.commit()
+        self._check_records()
+
+    def test_graph(self):
+        """Are the plots drawn from the records like from the samples?"""
+        ts = self.ts
+        for revision in (1, 2, 3, 2, 4):
+            self._import(revision, self._tests(revision))
+        test_ids = [test.id
+                    for test in ts.query(ts.Test).order_by(ts.Test.name)]
+        field = ts.Sample.get_metric_fields().next()
+        plots = [(self.runs[0].machine_id, test_id, field)
+                 for test_id in test_ids]
+
+        samples = lnt.server.db.graph.get_plot_samples(ts, plots)
+        rollups = lnt.server.db.graph.get_plot_rollups(ts, plots, max_rank=3)
+        for plot in plots:
+            self.assertEqual(rollups[plot].keys(), ['1', '2', '3'][
+                :3 if plot[1] == test_ids[0] else 2])
+            for rev, rollup in rollups[plot].items():
+                values = sorted(samples[plot][rev])
+                self.assertEqual(rollup[0],
+                                 lnt.util.stats.median(
+                                     [v for v, _, _ in values]))
+                # The run of the median sample.
+                self.assertEqual(rollup[2], values[len(values) // 2][2])
+
+        # The geometric mean of the minimum of the tests at each order, at
+        # the time of the earliest run.
+        trend = lnt.server.db.graph.get_geomean_trend(
+            ts, self.runs[0].machine_id, field, min_rank=2)
+        self.assertEqual([rev for rev, _ in trend], ['2', '3', '4'])
+        self.assertAlmostEqual(trend[2][1][0][0], 2.0, places=3)
+        self.assertEqual(trend[0][1][0][1], self.runs[1].start_time)
+
+    def test_check_geomeans(self):
+        """Are inconsistent geometric means found?"""
+        ts = self.ts
+        for revision in (1, 2):
+            self._import(revision, self._tests(revision))
+        record = ts.query(ts.OrderGeomean).first()
+        geomean = record.geomean
+        record.geomean += 1
+        ts.commit()
+        mismatches = ts.check_order_geomeans()
+        self.assertEqual([(stored.id, expected.geomean)
+                          for stored, expected in mismatches],
+                         [(record.id, geomean)])
+
+        ts.delete(record)
+        ts.commit()
+        mismatches = ts.check_order_geomeans()
+        self.assertEqual([(stored, expected.order_id)
+                          for stored, expected in mismatches],
+                         [(None, record.order_id)])
+
+    def test_backfill(self):
+        """Does the migration fill the records in from the samples?"""
+        ts = self.ts
+        for revision in (1, 2, 3, 2):
+            self._import(revision, self._tests(revision))
+        records = self._records()
+        self.assertNotEqual(records, [])
+
+        geomeans = self._geomeans()
+        self.assertNotEqual(geomeans, [])
+
+        for table in ('SampleRollup', 'OrderGeomean'):
+            ts.session.execute('DROP TABLE "%s_%s"' %
+                               (ts.test_suite.db_key_name, table))
+        ts.commit()
+        lnt.server.db.migrate.update(self.db.engine)
+        self.assertEqual(self._records(), records)
+        self.assertEqual(self._geomeans(), geomeans)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
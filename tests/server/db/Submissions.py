@@ -0,0 +1,90 @@
+# Check the submissions imported in the background.
+# RUN: python %s
+"""Test lnt.server.db.submissions"""
+import datetime
+import json
+import logging
+import os
+import sys
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.jobs as jobs
+import lnt.server.db.submissions as submissions
+from tests.testutils import DBTestCase, TAG, make_report, make_test
+
+
+class SubmissionsTests(DBTestCase):
+    """Test the staging and import of submissions."""
+
+    def _stage(self, name, data, commit=True):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        submission = submissions.stage(self.db, 'default', path, commit)
+        self.db.commit()
+        return submission.id
+
+    def _get(self, submission_id):
+        self.db.session.expire_all()
+        return self.db.query(submissions.Submission).get(submission_id)
+
+    def _report(self, revision):
+        return json.dumps(make_report(
+            revision, [make_test('test.exec', [float(revision)])]))
+
+    def test_import(self):
+        """Is a staged submission imported by the job queue, and its result
+        recorded?"""
+        submission_id = self._stage('a.json', self._report(1))
+        submission = self._get(submission_id)
+        self.assertEqual(submission.state, submissions.QUEUED)
+        self.assertEqual(submission.result, None)
+        job = self.db.query(jobs.Job).one()
+        self.assertEqual((job.kind, job.test_suite, job.key),
+                         ('import_submission', None, str(submission_id)))
+
+        # The import runs the jobs it queued as well.
+        self.assertEqual(jobs.run_queued_jobs(self.db), 1)
+        submission = self._get(submission_id)
+        self.assertEqual(submission.state, submissions.DONE)
+        result = submission.result
+        self.assertTrue(result["success"])
+        self.assertTrue(result['committed'])
+        ts = self.db.testsuite[TAG]
+        self.assertEqual(ts.query(ts.Run.id).all(), [(result['run_id'],)])
+        self.assertEqual(result['result_url'],
+                         'db_default/v4/%s/%d' % (TAG, result['run_id']))
+
+    def test_failure(self):
+        """Is the error of a submission which fails to import recorded?"""
+        submission_id = self._stage('bad.json', '{ not json')
+        jobs.run_queued_jobs(self.db)
+        submission = self._get(submission_id)
+        self.assertEqual(submission.state, submissions.DONE)
+        self.assertFalse(submission.result['success'])
+        self.assertIn('load failure', submission.result['error'])
+        # The job itself is done, as retrying it would fail again.
+        self.assertEqual(self.db.query(jobs.Job).one().state, jobs.DONE)
+
+    def test_prune(self):
+        """Are the submissions done long ago removed, and only them?"""
+        old_id = self._stage('old.json', self._report(1))
+        jobs.run_queued_jobs(self.db)
+        submission = self._get(old_id)
+        submission.finished_time -= datetime.timedelta(
+            days=jobs.RETENTION_DAYS + 1)
+        self.db.commit()
+        recent_id = self._stage('recent.json', self._report(2))
+        jobs.run_queued_jobs(self.db)
+        queued_id = self._stage('queued.json', self._report(3))
+
+        self.assertEqual(submissions.prune(self.db), 1)
+        self.assertEqual(self._get(old_id), None)
+        self.assertEqual([s.id for s in self.db.query(submissions.Submission).
+                          order_by(submissions.Submission.id)],
+                         [recent_id, queued_id])
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
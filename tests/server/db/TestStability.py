@@ -0,0 +1,139 @@
+# Check that the stability records of the tests are maintained as runs are
+# imported and field changes come and go, and agree with the test history.
+# RUN: python %s
+"""Test the TestStability records of TestSuiteDB"""
+import logging
+import sys
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.migrate
+from lnt.server.db.fieldchange import delete_fieldchanges
+from lnt.server.db.fieldchange import regenerate_fieldchanges_for_run
+from tests.testutils import DBTestCase, make_report, make_test
+
+
+def reference_stable(ts, run, test_id, stability_threshold):
+    """Whether the test is stable at the order of the run, from the whole
+    history of the test on the machine."""
+    orders = ts.query(ts.Order).join(ts.Run).join(ts.Sample).\
+        filter(ts.Sample.test_id == test_id).\
+        filter(ts.Run.machine_id == run.machine_id).\
+        distinct().order_by(ts.Order.rank).all()
+    try:
+        run_index = orders.index(run.order)
+    except ValueError:
+        return True
+    window = orders[max(0, run_index - stability_threshold):run_index + 1]
+    if len(window) < stability_threshold:
+        return False
+    order_ids = [order.id for order in window]
+    return not any(change.start_order_id in order_ids or
+                   change.end_order_id in order_ids
+                   for change in ts.query(ts.FieldChange).
+                   filter(ts.FieldChange.test_id == test_id).
+                   filter(ts.FieldChange.machine_id == run.machine_id))
+
+
+class TestStabilityTests(DBTestCase):
+    """Test the maintenance of the stability of the tests."""
+
+    def _import(self, revision, times):
+        tests = [make_test('test%d.exec' % i, [time, time, time])
+                 for i, time in enumerate(times)]
+        return self.import_report(make_report(revision, tests))
+
+    def _records(self):
+        ts = self.ts
+        return sorted((r.machine_id, r.test_id, r.field_id, r.first_run_id,
+                       r.last_run_id, r.last_rank, r.num_orders,
+                       r.change_rank, r.orders_since_change)
+                      for r in ts.query(ts.TestStability))
+
+    def _check_records(self):
+        """Do the records agree with the ones computed from scratch?"""
+        records = self._records()
+        self.ts.rebuild_test_stability()
+        self.ts.commit()
+        self.assertEqual(self._records(), records)
+        return records
+
+    def _check_stable(self, runs, stability_threshold):
+        """Does the stability of the tests at every run agree with the
+        history?"""
+        ts = self.ts
+        test_ids = [test.id for test in ts.query(ts.Test)]
+        for run in runs:
+            stable_tests = ts.get_stable_tests(run, test_ids,
+                                               stability_threshold)
+            for test_id in test_ids:
+                self.assertEqual(
+                    stable_tests[test_id],
+                    reference_stable(ts, run, test_id, stability_threshold),
+                    (run.order.rank, test_id))
+
+    def test_stability(self):
+        """Are the records maintained on import and on field changes?"""
+        ts = self.ts
+        runs = []
+        for revision in range(1, 13):
+            # The second test gets slower at revision 7, the third is added
+            # at revision 4.
+            times = [1.0, 1.0 if revision < 7 else 2.0]
+            if revision >= 4:
+                times.append(3.0)
+            runs.append(self._import(revision, times))
+            regenerate_fieldchanges_for_run(ts, runs[-1].id)
+        changes = ts.query(ts.FieldChange).all()
+        self.assertEqual([(c.test.name, c.end_order.rank) for c in changes],
+                         [('suite/test1', 7)])
+
+        records = self._check_records()
+        self.assertEqual(len(records),
+                         3 * len(list(ts.Sample.get_metric_fields())))
+        for threshold in (3, 5, 10):
+            self._check_stable(runs, threshold)
+
+        status, order, run = ts.get_stability_status(4)
+        self.assertEqual(order.rank, 12)
+        self.assertEqual(run.id, runs[-1].id)
+        self.assertEqual(sorted((s["name"], s["stable"], s["number_of_runs"])
+                                for s in status.values()),
+                         [('suite/test0', True, 11),
+                          ('suite/test1', True, 11),
+                          ('suite/test2', True, 8)])
+        status, _, _ = ts.get_stability_status(10)
+        self.assertEqual(sorted((s["name"], s["stable"])
+                                for s in status.values()),
+                         [('suite/test0', True), ('suite/test1', False),
+                          ('suite/test2', False)])
+
+        # Importing an earlier revision refreshes the records.
+        runs.append(self._import(0, [1.0, 1.0]))
+        self._check_records()
+        self._check_stable(runs, 5)
+
+        # Removing the field change makes the test stable again.
+        delete_fieldchanges(ts, changes)
+        ts.commit()
+        self._check_records()
+        self._check_stable(runs, 10)
+        self.assertTrue(ts.is_test_stable(runs[-2], changes[0].test_id, 10))
+
+    def test_backfill(self):
+        """Does the migration fill the records in from the history?"""
+        ts = self.ts
+        for revision in range(1, 5):
+            self._import(revision, [1.0, float(revision)])
+        records = self._records()
+        self.assertNotEqual(records, [])
+
+        ts.session.execute('DROP TABLE "%s_TestStability"' %
+                           ts.test_suite.db_key_name)
+        ts.commit()
+        lnt.server.db.migrate.update(self.db.engine)
+        self.assertEqual(self._records(), records)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
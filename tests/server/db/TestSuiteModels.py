@@ -0,0 +1,79 @@
+# Check that the model classes of a test suite are generated once per process.
+# RUN: python %s
+"""Test the model class cache of TestSuiteDB"""
+import logging
+import shutil
+import sys
+import tempfile
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.db.v4db
+from lnt.server.db.testsuitedb import TestSuiteDB
+
+TAG = 'kv-engine'
+
+
+class TestSuiteModelsTests(unittest.TestCase):
+    """Test the sharing of the model classes between databases."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = 'sqlite:///%s/lnt.db' % self.tmpdir
+        self.db = lnt.server.db.v4db.V4DB(self.path, None)
+        # Another request using the same database.
+        self.other_db = lnt.server.db.v4db.V4DB(self.path, None)
+
+    def tearDown(self):
+        self.db.close()
+        self.other_db.close()
+        lnt.server.db.v4db.V4DB.close_all_engines()
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_models(self):
+        """Do the databases share the model classes, but not the sessions?"""
+        ts = self.db.testsuite[TAG]
+        other_ts = self.other_db.testsuite[TAG]
+        self.assertTrue(ts is not other_ts)
+        self.assertTrue(ts.Sample is other_ts.Sample)
+        self.assertTrue(ts.sample_fields is other_ts.sample_fields)
+        self.assertTrue(ts.session is not other_ts.session)
+
+        machine = ts.Machine('machine')
+        machine.hardware = machine.os = ''
+        machine.parameters = {}
+        order, _ = ts._getOrCreateOrder({'run_order': '1', 'git_sha': 'sha1'})
+        test = ts.Test('test')
+        field = ts.Sample.get_metric_fields().next()
+        for item in (machine, test, ts.FieldChange(order, order, machine, test,
+                                                   field)):
+            ts.add(item)
+        ts.commit()
+        self.db.close()
+
+        # The instances find the test suite of their own session, and the
+        # fields are shared.
+        other_machine = other_ts.query(other_ts.Machine).one()
+        self.assertTrue(other_machine.testsuite is other_ts)
+        change = other_ts.query(other_ts.FieldChange).one()
+        self.assertTrue(change.field is field)
+        self.assertEqual(change.field.index, field.index)
+        self.assertEqual(change.field.name, 'execution_time')
+
+    def test_invalidate(self):
+        """Are the model classes generated again once invalidated?"""
+        ts = self.db.testsuite[TAG]
+        TestSuiteDB.invalidate_models(self.path, 'other')
+        self.assertTrue(self.other_db.testsuite[TAG].Sample is ts.Sample)
+
+        TestSuiteDB.invalidate_models(self.path)
+        self.other_db.close()
+        self.other_db = lnt.server.db.v4db.V4DB(self.path, None)
+        other_ts = self.other_db.testsuite[TAG]
+        self.assertTrue(other_ts.Sample is not ts.Sample)
+        self.assertEqual([f.name for f in other_ts.sample_fields],
+                         [f.name for f in ts.sample_fields])
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
@@ -0,0 +1,91 @@
+# Check that comparing all the tests of a run at once matches comparing them
+# one by one.
+# RUN: python %s
+"""Test RunInfo.get_comparison_results"""
+import logging
+import sys
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+from lnt.server.reporting.analysis import RunInfo
+from lnt.testing import FAIL
+from tests.testutils import DBTestCase, make_report, make_test
+
+# The execution times of the tests in the previous and current runs.
+TIMES = [
+    ([1.0, 1.001, 1.002], [1.0, 1.001, 1.002]),
+    ([1.0, 1.001, 1.002], [2.0, 2.001, 2.002]),
+    ([2.0, 2.1, 1.9], [1.0, 1.1, 0.9]),
+    ([1.0], [1.5]),
+    ([1.0, 1.2, 1.4], [1.0, 1.2, 1.4]),
+    ([5.0, 5.0, 5.0], []),
+    ([], [5.0, 5.0]),
+]
+
+# The tests which fail in the previous and current runs.
+FAILURES = ({3, 4}, {4, 5})
+
+
+def make_tests(run_index):
+    tests = []
+    for i, times in enumerate(TIMES):
+        name = 'test%d' % i
+        if times[run_index]:
+            tests.append(make_test(name + '.exec', times[run_index]))
+        if i in FAILURES[run_index]:
+            tests.append(make_test(name + '.exec.status', [FAIL]))
+    return tests
+
+
+class RunInfoTests(DBTestCase):
+    """Test the batched comparison of runs."""
+
+    def _import(self, revision, tests):
+        return self.import_report(make_report(revision, tests))
+
+    def test_comparison_results(self):
+        """Do the batched comparisons match the individual ones?"""
+        ts = self.ts
+        previous = self._import(1, make_tests(0))
+        current = self._import(2, make_tests(1))
+        runinfo = RunInfo(ts, [previous.id, current.id])
+        hash_field = ts.Sample.get_hash_of_binary_field()
+        stable_tests = {min(runinfo.test_ids): False}
+
+        for field in ts.Sample.get_metric_fields():
+            results = runinfo.get_run_comparison_results(
+                current, previous, field, hash_field,
+                stable_tests=stable_tests)
+            self.assertEqual(set(results), runinfo.test_ids)
+            for test_id in runinfo.test_ids:
+                expected = runinfo.get_run_comparison_result(
+                    current, previous, test_id, field, hash_field,
+                    stable_test=stable_tests.get(test_id, True))
+                result = results[test_id]
+                for name in ('current', 'previous', 'delta', 'pct_delta',
+                             'stddev', 'prev_stddev', 'failed',
+                             'prev_failed', 'stable_test'):
+                    self.assertEqual(getattr(result, name),
+                                     getattr(expected, name), name)
+                self.assertEqual(result.get_test_status(),
+                                 expected.get_test_status())
+                self.assertEqual(result.get_value_status(),
+                                 expected.get_value_status())
+                self.assertEqual(result.is_result_performance_change(),
+                                 expected.is_result_performance_change())
+                self.assertEqual(result._result, None)
+
+                # The full result is only built when needed.
+                self.assertEqual(result.samples, expected.samples)
+                self.assertEqual(result.MAD, expected.MAD)
+                self.assertEqual(result.__json__(), expected.__json__())
+
+        # Without comparison runs, every test is new.
+        results = runinfo.get_run_comparison_results(
+            current, None, list(ts.Sample.get_metric_fields())[0], hash_field)
+        self.assertTrue(all(r.previous is None for r in results.values()))
+        self.assertEqual(results.get_changed_test_ids(), [])
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
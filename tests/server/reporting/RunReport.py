@@ -0,0 +1,101 @@
+# Check that the comparisons the run reports are rendered from are cached until
+# the data of the machine of the run changes, and that a report computed on
+# submission is shared with the pages of the run.
+# RUN: python %s
+"""Test lnt.server.reporting.runs.get_run_report"""
+import logging
+import re
+import sys
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import lnt.server.reporting.runs
+from tests.testutils import DBTestCase, make_config, make_report, make_test
+
+
+class RunReportTests(DBTestCase):
+    """Test the cache of run reports."""
+
+    def make_config(self):
+        # The run reports are cached in the temporary directory.
+        return make_config(self.tmpdir)
+
+    def _import(self, revision, commit=True):
+        tests = [make_test('test%d.exec' % i,
+                           [float(revision * i), revision * i + 1.0])
+                 for i in range(4)]
+        # Every run starts at a different time.
+        return self.import_report(
+            make_report(revision, tests, start=len(self.runs)), commit)
+
+    def _render(self, run, **kwargs):
+        subject, text, html, report = \
+            lnt.server.reporting.runs.generate_run_report(
+                run, 'http://localhost', **kwargs)
+        # Leave out the time it took to render the reports.
+        text, html = [re.sub(r'Report Time.*', '', r) for r in (text, html)]
+        return (subject, text, html), report
+
+    def test_cached(self):
+        """Is the report computed once per generation of the data of the
+        machine, and rendered the same from the cache?"""
+        for revision in (1, 2, 3):
+            run = self._import(revision)
+        rendered, report = self._render(run, num_comparison_runs=1)
+        self.assertNotEqual(report._run_info, None)
+        cached, cached_report = self._render(run, num_comparison_runs=1)
+        # The samples are not loaded again.
+        self.assertEqual(cached_report._run_info, None)
+        self.assertEqual(cached, rendered)
+
+        # The full comparisons are computed from the samples, when needed.
+        for key, cr in report.run_to_run_info.items():
+            cached_cr = cached_report.run_to_run_info[key]
+            self.assertEqual((cached_cr.samples, cached_cr.MAD),
+                             (cr.samples, cr.MAD))
+        self.assertNotEqual(cached_report._run_info, None)
+
+        # Importing a run on the machine changes the stability of its tests.
+        self._import(4)
+        _, report = self._render(run, num_comparison_runs=1)
+        self.assertNotEqual(report._run_info, None)
+        self.assertNotEqual(report.cache_key, cached_report.cache_key)
+
+    def test_submission(self):
+        """Is the report computed on submission stored once committed, and
+        shared with the page of the run?"""
+        for revision in (1, 2):
+            self._import(revision)
+        run = self._import(3, commit=False)
+        rendered, report = self._render(run, num_comparison_runs=1,
+                                        cache=False)
+        generation = self.ts.bump_data_generation([run.machine_id])
+        self.ts.commit()
+        lnt.server.reporting.runs.store_run_report(self.ts, report,
+                                                   generation)
+
+        # The page of the run compares it to the previous run.
+        cached, cached_report = self._render(run, compare_to=self.runs[1])
+        self.assertEqual(cached_report._run_info, None)
+        self.assertEqual(cached_report.cache_key, report.cache_key)
+        self.assertEqual(cached, rendered)
+
+    def test_concurrent_submission(self):
+        """Is the report computed on submission left out of the cache when
+        the test suite changed before the run was committed?"""
+        for revision in (1, 2):
+            self._import(revision)
+        run = self._import(3, commit=False)
+        _, report = self._render(run, num_comparison_runs=1, cache=False)
+        self.ts.bump_data_generation([])
+        generation = self.ts.bump_data_generation([run.machine_id])
+        self.ts.commit()
+        lnt.server.reporting.runs.store_run_report(self.ts, report,
+                                                   generation)
+
+        _, cached_report = self._render(run, num_comparison_runs=1)
+        self.assertNotEqual(cached_report._run_info, None)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
@@ -0,0 +1,252 @@
+# Check that compressed submissions are decompressed by the server, and that
+# lnt submit compresses them, over connections kept open across submissions.
+# RUN: python %s
+"""Test lnt.server.ui.app.DecompressBodyMiddleware and lnt.util.ServerUtil"""
+import BaseHTTPServer
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib2
+import urlparse
+import zlib
+
+logging.basicConfig(level=logging.DEBUG)
+
+import flask
+import werkzeug.test
+
+import lnt.server.ui.app
+from lnt.util import ServerUtil
+
+
+class MiddlewareTests(unittest.TestCase):
+    """Test the decompression of the bodies of requests."""
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+
+        @app.route('/db_default/submitRun', methods=('POST',))
+        def echo():
+            return json.dumps({'form': flask.request.form.to_dict(),
+                               'data': flask.request.data})
+
+        @app.route('/other', methods=('POST',))
+        def other():
+            return flask.request.data
+
+        app.wsgi_app = self.middleware = \
+            lnt.server.ui.app.DecompressBodyMiddleware(app.wsgi_app)
+        self.client = app.test_client()
+
+    def _post(self, data, url='/db_default/submitRun', **kwargs):
+        response = self.client.post(url, data=data, **kwargs)
+        return response.status_code, json.loads(response.data)
+
+    def test_encodings(self):
+        """Are gzip and deflate bodies decompressed?"""
+        body = json.dumps({'Tests': ['x' * 100] * 1000})
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress(body) + compressor.flush()
+        self.assertTrue(len(gzipped) < len(body) / 10)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = compressor.compress(body) + compressor.flush()
+        for encoding, data in (('gzip', gzipped),
+                               ('deflate', zlib.compress(body)),
+                               ('deflate', raw)):
+            self.assertEqual(
+                self._post(data, content_type='application/json',
+                           headers={'Content-Encoding': encoding}),
+                (200, {'form': {}, 'data': body}))
+
+        # Forms are decompressed before they are parsed.
+        form = zlib.compress('input_data=abc&commit=1')
+        self.assertEqual(
+            self._post(form, content_type='application/x-www-form-urlencoded',
+                       headers={'Content-Encoding': 'deflate'}),
+            (200, {'form': {'input_data': 'abc', 'commit': '1'},
+                   'data': ''}))
+
+        # Bodies which are not compressed are left alone.
+        self.assertEqual(self._post(body, content_type='application/json'),
+                         (200, {'form': {}, 'data': body}))
+
+    def test_chunked(self):
+        """Are bodies without a length read to their end, when the server
+        marks them as terminated, and rejected otherwise?"""
+        body = 'x' * 100000
+        builder = werkzeug.test.EnvironBuilder(
+            path='/db_default/submitRun', method='POST',
+            data=zlib.compress(body), content_type='text/plain',
+            headers={'Content-Encoding': 'deflate'})
+
+        def post(terminated):
+            environ = builder.get_environ()
+            del environ['CONTENT_LENGTH']
+            environ['wsgi.input_terminated'] = terminated
+            app_iter, status, _ = werkzeug.test.run_wsgi_app(
+                self.middleware, environ, buffered=True)
+            return int(status.split()[0]), ''.join(app_iter)
+
+        status, data = post(True)
+        self.assertEqual((status, json.loads(data)['data']), (200, body))
+        self.assertEqual(post(False)[0], 411)
+
+    def test_corrupt(self):
+        """Are bodies which do not decompress rejected?"""
+        response = self.client.post('/db_default/submitRun',
+                                    data='not compressed',
+                                    headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_limits(self):
+        """Are only submissions decompressed, up to the size limit?"""
+        body = 'x' * 100000
+        data = zlib.compress(body)
+        # Other pages are left the body as it was sent.
+        response = self.client.post('/other', data=data,
+                                    content_type='text/plain',
+                                    headers={'Content-Encoding': 'deflate'})
+        self.assertEqual(response.data, data)
+
+        self.middleware.max_size = len(body)
+        self.assertEqual(
+            self._post(data, content_type='text/plain',
+                       headers={'Content-Encoding': 'deflate'}),
+            (200, {'form': {}, 'data': body}))
+        self.middleware.max_size = len(body) - 1
+        response = self.client.post('/db_default/submitRun', data=data,
+                                    content_type='text/plain',
+                                    headers={'Content-Encoding': 'deflate'})
+        self.assertEqual(response.status_code, 413)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer submissions like a server, recording them and the connections
+    they were sent over."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        url = urlparse.urlsplit(self.path)
+        server.requests.append((self.client_address, url.path, encoding,
+                                self.headers['Content-Type'],
+                                dict(urlparse.parse_qsl(url.query)), data))
+        if server.unavailable:
+            server.unavailable -= 1
+            return self._respond(503, 'unavailable', 'text/plain')
+        if server.forms_only and encoding:
+            # Servers which take forms only answer with the form.
+            return self._respond(200, '<html></html>', 'text/html')
+        self._respond(200, json.dumps({'success': True, 'run_id': 1}))
+        if server.close_idle:
+            # Close the connection kept open, as servers do once it is idle
+            # for a while, without telling the client.
+            self.close_connection = 1
+
+
+class ServerUtilTests(unittest.TestCase):
+    """Test the submissions to a server."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.report = os.path.join(self.tmpdir, 'report.json')
+        with open(self.report, 'w') as f:
+            json.dump({'Machine': {}, 'Run': {},
+                       'Tests': [{'Name': 'test', 'Data': [1.0] * 100}]}, f)
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.unavailable = 0
+        self.server.forms_only = False
+        self.server.close_idle = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/db_%%s/submitRun' % (
+            self.server.server_address[1])
+        self.connections = ServerUtil.Connections(retry_delay=0)
+
+    def tearDown(self):
+        self.connections.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _submit(self, db_name):
+        return ServerUtil.submitFile(self.url % db_name, self.report, True,
+                                     False, async_import=False,
+                                     connections=self.connections)
+
+    def test_compressed(self):
+        """Are the reports posted compressed, over one connection?"""
+        with open(self.report) as f:
+            report = f.read()
+        self.assertEqual(self._submit('default'), {'success': True,
+                                                   'run_id': 1})
+        self.assertEqual(self._submit('other'), {'success': True,
+                                                 'run_id': 1})
+        requests = self.server.requests
+        self.assertEqual(
+            [request[1:] for request in requests],
+            [('/db_default/submitRun', 'gzip', 'application/json',
+              {'commit': '1'}, report),
+             ('/db_other/submitRun', 'gzip', 'application/json',
+              {'commit': '1'}, report)])
+        # The submissions were sent over the same connection.
+        self.assertEqual(len(set(request[0] for request in requests)), 1)
+
+    def test_retries(self):
+        """Are submissions sent again only when they cannot have reached the
+        server?"""
+        # The server closed the connection kept open before the second
+        # submission, which is sent again over a new connection.
+        self.server.close_idle = True
+        self._submit('default')
+        self._submit('default')
+        requests = self.server.requests
+        self.assertEqual(len(requests), 2)
+        self.assertNotEqual(requests[0][0], requests[1][0])
+
+        # Submissions the server answered are not sent again, as they may
+        # have been processed.
+        self.server.unavailable = 1
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            self._submit('default')
+        self.assertEqual(cm.exception.code, 503)
+        self.assertEqual(len(requests), 3)
+
+    def test_forms_only(self):
+        """Are servers which only take forms sent the form instead?"""
+        self.server.forms_only = True
+        self.assertEqual(self._submit('default'), {'success': True,
+                                                   'run_id': 1})
+        request = self.server.requests[-1]
+        self.assertEqual(request[2:4], (None,
+                                        'application/x-www-form-urlencoded'))
+        form = dict(urlparse.parse_qsl(request[5]))
+        self.assertEqual(form['commit'], '1')
+        self.assertEqual(json.loads(form['input_data'])['Tests'][0]['Name'],
+                         'test')
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
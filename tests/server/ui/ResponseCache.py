@@ -0,0 +1,232 @@
+# Check that the responses about runs are cached until the data of their
+# machines changes, and that clients which have them are answered with a 304.
+# RUN: python %s
+"""Test lnt.server.ui.cache"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+logging.basicConfig(level=logging.DEBUG)
+
+import flask
+
+import lnt.server.db.fieldchange
+import lnt.server.db.migrate
+import lnt.server.ui.cache
+from tests.testutils import DBTestCase, make_config, make_report, make_test
+
+
+class Stale(object):
+    """A value which fails to unpickle, as if its class changed since."""
+
+    def __reduce__(self):
+        return (Stale, ('argument',))
+
+
+class ResponseCacheTests(unittest.TestCase):
+    """Test the store of cached values."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'responses')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared(self):
+        """Are the values stored by a process found by the others?"""
+        cache = lnt.server.ui.cache.FileCache(self.path, 1000)
+        self.assertEqual(cache.get('a'), None)
+        cache.put('a', ('text/plain', 'x' * 10))
+        self.assertEqual(cache.get('a'), ('text/plain', 'x' * 10))
+        other = lnt.server.ui.cache.FileCache(self.path, 1000)
+        self.assertEqual(other.get('a'), ('text/plain', 'x' * 10))
+        other.clear()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_lru(self):
+        """Are the least recently used values removed first?"""
+        cache = lnt.server.ui.cache.FileCache(self.path, 2000)
+        for i in range(3):
+            cache.put(str(i), ('text/plain', 'x' * 500))
+            # Keep the modification times apart.
+            os.utime(os.path.join(self.path, str(i)), (i, i))
+        other = lnt.server.ui.cache.FileCache(self.path, 2000)
+        self.assertNotEqual(other.get('0'), None)
+        cache.put('3', ('text/plain', 'x' * 500))
+        self.assertEqual(sorted(os.listdir(self.path)), ['0', '2', '3'])
+        # The values larger than the memory of a process are still kept
+        # on disk.
+        cache.put('4', ('text/plain', 'x' * 300))
+        self.assertEqual(cache._memory.keys(), [])
+        self.assertEqual(other.get('4'), ('text/plain', 'x' * 300))
+
+    def test_scans(self):
+        """Is the cache directory only scanned once it may have grown over
+        its size, or after many values were stored?"""
+        scans = []
+        def counting(cache):
+            evict = cache._evict
+            def counted():
+                scans.append(len(os.listdir(self.path)))
+                evict()
+            cache._evict = counted
+            return cache
+        cache = counting(lnt.server.ui.cache.FileCache(self.path, 2000))
+        for i in range(3):
+            cache.put(str(i), ('text/plain', 'x' * 500))
+        # The first value starts the estimate of the size of the directory.
+        self.assertEqual(scans, [1])
+        cache.put('3', ('text/plain', 'x' * 500))
+        self.assertEqual(scans, [1, 4])
+        self.assertEqual(len(os.listdir(self.path)), 3)
+
+        cache = counting(lnt.server.ui.cache.FileCache(self.path, 10 ** 6))
+        del scans[:]
+        for i in range(lnt.server.ui.cache.SCAN_INTERVAL + 1):
+            cache.put(str(i), i)
+        self.assertEqual(len(scans), 2)
+
+    def test_stale(self):
+        """Are the values which cannot be unpickled any more removed?"""
+        cache = lnt.server.ui.cache.FileCache(self.path, 1000)
+        cache.put('a', Stale())
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertEqual(cache._memory.keys(), [])
+
+    def test_versions(self):
+        """Are the values of each version kept apart, and the ones of other
+        versions removed?"""
+        config = make_config(self.tmpdir)
+        old = os.path.join(self.path, '0.1-1')
+        lnt.server.ui.cache.FileCache(old, 1000).put('a', 'old')
+        with open(os.path.join(self.path, 'b'), 'w') as f:
+            f.write('unversioned')
+        cache = lnt.server.ui.cache.get_cache(config, 'responses')
+        self.assertEqual(cache.path, os.path.join(
+            self.path, lnt.server.ui.cache.VERSION))
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertEqual(cache.get('a'), None)
+
+
+class CachedResponseTests(DBTestCase):
+    """Test the responses cached by the data generation of machines."""
+
+    def setUp(self):
+        super(CachedResponseTests, self).setUp()
+        self.app = flask.Flask(__name__)
+        self.app.secret_key = 'secret'
+        self.app.response_cache = lnt.server.ui.cache.FileCache(
+            os.path.join(self.tmpdir, 'responses'), 100000)
+        self.renders = []
+
+    def _import(self, machine_name, revision):
+        # Every run starts at a different time.
+        return self.import_report(make_report(
+            revision, [make_test('test.exec', [float(revision)])],
+            machine_name, start=len(self.runs)))
+
+    def _get(self, machine_ids, url='/run', headers=None):
+        def render():
+            self.renders.append(url)
+            return 'rendered %d' % len(self.renders)
+        with self.app.test_request_context(url, headers=headers):
+            flask.g.db_name = 'default'
+            return lnt.server.ui.cache.cached_response(self.ts, machine_ids,
+                                                       render)
+
+    def test_generations(self):
+        """Do the generations change with the data of their machines?"""
+        ts = self.ts
+        run = self._import('machine0', 1)
+        other = self._import('machine1', 1)
+        machine_id = run.machine_id
+        generations, modified = ts.get_data_generation([machine_id])
+        self.assertNotEqual(modified, None)
+        suite, _ = ts.get_data_generation([None])
+        both, _ = ts.get_data_generation([machine_id, other.machine_id])
+        self.assertEqual(len(both), 2)
+
+        # Importing a run on another machine only changes the generation of
+        # the test suite.
+        self._import('machine1', 2)
+        self.assertEqual(ts.get_data_generation([machine_id])[0],
+                         generations)
+        self.assertNotEqual(ts.get_data_generation([None])[0], suite)
+
+        self._import('machine0', 2)
+        generations2, _ = ts.get_data_generation([machine_id])
+        self.assertNotEqual(generations2, generations)
+
+        # So does removing field changes.
+        change = ts.FieldChange(run.order, self.runs[-1].order, run.machine,
+                                ts.query(ts.Test).one(),
+                                ts.Sample.get_metric_fields().next())
+        ts.add(change)
+        ts.commit()
+        lnt.server.db.fieldchange.delete_fieldchange(ts, change)
+        self.assertNotEqual(ts.get_data_generation([machine_id])[0],
+                            generations2)
+        # Unknown machines have no generation.
+        self.assertEqual(ts.get_data_generation([1000]), ((0,), None))
+
+    def test_cached_response(self):
+        """Are the responses rendered once per generation of their data, and
+        answered with a 304 when the client has them?"""
+        run = self._import('machine0', 1)
+        machine_ids = [run.machine_id]
+        response = self._get(machine_ids)
+        self.assertEqual(response.data, 'rendered 1')
+        etag = response.headers['ETag']
+        self.assertNotEqual(response.headers.get('Last-Modified'), None)
+        self.assertEqual(self._get(machine_ids).data, 'rendered 1')
+        self.assertEqual(self._get(machine_ids, '/run?a=1').data,
+                         'rendered 2')
+
+        response = self._get(machine_ids, headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.data), (304, ''))
+        self.assertEqual(len(self.renders), 2)
+
+        # The responses are rendered again once the data changes.
+        self._import('machine0', 2)
+        response = self._get(machine_ids, headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.data),
+                         (200, 'rendered 3'))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_version(self):
+        """Are the responses rendered again after an upgrade?"""
+        run = self._import('machine0', 1)
+        machine_ids = [run.machine_id]
+        etag = self._get(machine_ids).headers['ETag']
+        version = lnt.server.ui.cache.VERSION
+        lnt.server.ui.cache.VERSION = version + '.next'
+        try:
+            response = self._get(machine_ids,
+                                 headers={'If-None-Match': etag})
+        finally:
+            lnt.server.ui.cache.VERSION = version
+        self.assertEqual((response.status_code, response.data),
+                         (200, 'rendered 2'))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_migration(self):
+        """Does the migration start the generations of the machines?"""
+        ts = self.ts
+        run = self._import('machine0', 1)
+        ts.session.execute('DROP TABLE "%s_DataGeneration"' %
+                           ts.test_suite.db_key_name)
+        ts.commit()
+        lnt.server.db.migrate.update(self.db.engine)
+        self.assertEqual(ts.get_data_generation([run.machine_id, None])[0],
+                         (1, 1))
+        self._import('machine0', 2)
+        self.assertEqual(ts.get_data_generation([run.machine_id, None])[0],
+                         (2, 2))
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
@@ -0,0 +1,94 @@
+"""
+Fixtures shared by the tests of the server: synthetic kv-engine reports, and
+test cases with a temporary database to import them into.
+"""
+import datetime
+import shutil
+import tempfile
+import unittest
+
+import lnt.server.config
+import lnt.server.db.v4db
+
+TAG = 'kv-engine'
+
+MACHINE_INFO = {'hardware': 'x86', 'os': 'linux'}
+
+
+def make_test(name, data):
+    """Make the entry of a test of the report (e.g. 'test1.exec'), with the
+    given samples."""
+    return {'Name': '%s.suite/%s' % (TAG, name), 'Info': {}, 'Data': data}
+
+
+def make_report(revision, tests, machine='machine', start=None, **info):
+    """Make a report of a run of the machine at the revision, with the given
+    tests (see make_test).
+
+    The run starts and ends start (by default, revision) minutes into 2016, and
+    has the commit 'sha<revision>', along with the given run info."""
+    if start is None:
+        start = revision
+    start_time = (datetime.datetime(2016, 1, 1) +
+                  datetime.timedelta(minutes=start)).\
+        strftime("%Y-%m-%d %H:%M:%S")
+    run_info = {'tag': TAG, 'run_order': str(revision),
+                'git_sha': 'sha%d' % revision}
+    run_info.update(info)
+    return {'Machine': {'Name': machine, 'Info': dict(MACHINE_INFO)},
+            'Run': {'Start Time': start_time, 'End Time': start_time,
+                    'Info': run_info},
+            'Tests': tests}
+
+
+def make_config(tmpdir, db_path=None, bulk_import=False, **options):
+    """Make the configuration of an instance in tmpdir, with the database at
+    db_path as its default database, if given."""
+    databases = {}
+    if db_path is not None:
+        email_config = lnt.server.config.EmailConfig(False, '', '', [])
+        databases['default'] = lnt.server.config.DBInfo(
+            db_path, '0.4', None, email_config, 0, bulk_import=bulk_import)
+    return lnt.server.config.Config('LNT', 'http://localhost:8000', tmpdir,
+                                    tmpdir, tmpdir, None, databases, **options)
+
+
+def import_report(ts, report, db_info=None, commit=True):
+    """Import the report straight into the test suite, the way
+    lnt.util.ImportData does, and return its run. The data generation of the
+    machine is bumped and the run committed, unless commit is false."""
+    machine, _ = ts._getOrCreateMachine(report['Machine'])
+    run, _ = ts._getOrCreateRun(report['Run'], machine)
+    ts._importSampleValues(report['Tests'], run, TAG, True, db_info)
+    if commit:
+        ts.bump_data_generation([run.machine_id])
+        ts.commit()
+    return run
+
+
+class DBTestCase(unittest.TestCase):
+    """A test case with a temporary directory, and a database in it, opened
+    with the configuration make_config returns (none by default).
+
+    The runs imported with import_report are kept in order, as runs."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = 'sqlite:///%s/lnt.db' % self.tmpdir
+        self.config = self.make_config()
+        self.db = lnt.server.db.v4db.V4DB(self.db_path, self.config)
+        self.ts = self.db.testsuite[TAG]
+        self.runs = []
+
+    def tearDown(self):
+        self.db.close()
+        lnt.server.db.v4db.V4DB.close_all_engines()
+        shutil.rmtree(self.tmpdir)
+
+    def make_config(self):
+        return None
+
+    def import_report(self, report, commit=True):
+        run = import_report(self.ts, report, commit=commit)
+        self.runs.append(run)
+        return run
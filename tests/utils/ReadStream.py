@@ -0,0 +1,83 @@
+# Check the reports streamed by lnt.formats.read_stream.
+# RUN: python %s
+"""Test lnt.formats.read_stream"""
+import json
+import StringIO
+import sys
+import unittest
+
+import lnt.formats
+from lnt.formats import JSONFormat
+
+
+class Unseekable(object):
+    """A file which can only be read forwards, like a socket."""
+
+    def __init__(self, data):
+        self.file = StringIO.StringIO(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+
+class StreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tests = [{'Name': 'kv-engine.suite/test%d.exec' % i, 'Info': {},
+                       'Data': [1.5 * i, 123456789 + i]} for i in range(50)]
+        self.report = {'Machine': {'Name': 'machine', 'Info': {}},
+                       'Run': {'Info': {'tag': 'kv-engine',
+                                        'run_order': '1'}},
+                       'Tests': self.tests}
+
+    def _stream(self, data, chunk_size=7):
+        return list(JSONFormat._stream_format(StringIO.StringIO(data),
+                                              chunk_size))
+
+    def _expected(self):
+        return [('Machine', self.report['Machine']),
+                ('Run', self.report['Run'])] + \
+            [('Test', test) for test in self.tests]
+
+    def test_stream(self):
+        """Are the parts of the report read in order, whatever the size of
+        the chunks they are read in?"""
+        data = json.dumps(self.report, sort_keys=True, indent=2)
+        for chunk_size in (1, 7, 4096):
+            self.assertEqual(self._stream(data, chunk_size), self._expected())
+        self.assertEqual(list(lnt.formats.read_stream(
+                    StringIO.StringIO(data), '<auto>')), self._expected())
+
+    def test_tests_first(self):
+        """Are the tests read after the machine and run, when the report has
+        them first?"""
+        data = '{"Tests": %s, "Run": %s, "Machine": %s}' % (
+            json.dumps(self.tests), json.dumps(self.report['Run']),
+            json.dumps(self.report['Machine']))
+        self.assertEqual(self._stream(data), self._expected())
+        self.assertEqual(
+            list(JSONFormat._stream_format(Unseekable(data), 7)),
+            self._expected())
+
+    def test_read_report(self):
+        """Is a report read with its tests left to iterate?"""
+        data = StringIO.StringIO(json.dumps(self.report))
+        report = lnt.formats.read_report(data, 'json')
+        self.assertEqual(report['Run'], self.report['Run'])
+        self.assertEqual(list(report['Tests']), self.tests)
+
+    def test_errors(self):
+        """Are malformed reports reported once the stream gets to them?"""
+        data = json.dumps(self.report, sort_keys=True)
+        data = data[:-100] + '}'
+        report = lnt.formats.read_report(StringIO.StringIO(data), 'json')
+        self.assertEqual(report['Machine'], self.report['Machine'])
+        self.assertRaises(lnt.formats.ReadError, list, report['Tests'])
+
+        data = json.dumps({'Machine': self.report['Machine'],
+                           'Tests': []})
+        self.assertRaises(lnt.formats.ReadError, lnt.formats.read_report,
+                          StringIO.StringIO(data), 'json')
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
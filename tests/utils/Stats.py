@@ -0,0 +1,121 @@
+# Check the Mann-Whitney U test of lnt.util.stats.
+# RUN: python %s
+"""Test lnt.util.stats.mannwhitneyu"""
+import random
+import sys
+import unittest
+
+from lnt.util import stats
+
+
+def nested_u(a, b):
+    """U computed from every pair of values."""
+    u = 0.
+    for x in a:
+        for y in b:
+            if x > y:
+                u += 1
+            elif x == y:
+                u += .5
+    return u
+
+
+class MannWhitneyUTests(unittest.TestCase):
+    """Test the rank based Mann-Whitney U test."""
+
+    def test_u(self):
+        """Is U the same as counting the pairs?"""
+        rng = random.Random(42)
+        for _ in range(500):
+            a = [rng.randint(0, 5) for _ in range(rng.randint(0, 10))]
+            b = [rng.randint(0, 5) for _ in range(rng.randint(0, 10))]
+            self.assertEqual(stats.mannwhitneyu_u(a, b), nested_u(a, b))
+
+    def test_exact(self):
+        """Does the exact distribution give the critical values of U?"""
+        # The two-sided critical values at .05, from the published tables.
+        for n, m, critical in ((5, 5, 2), (8, 8, 13), (10, 10, 23),
+                               (6, 12, 14), (20, 20, 127)):
+            cdf = stats._mannwhitneyu_exact_cdf(n, m)
+            self.assertTrue(2 * cdf[critical] <= .05)
+            self.assertTrue(2 * cdf[critical + 1] > .05)
+
+        a = [1.0, 1.1, 1.2, 1.3, 1.4]
+        self.assertEqual(stats.mannwhitneyu_pvalue(a, [2.0, 2.1, 2.2]),
+                         2. / 56)
+        self.assertFalse(stats.mannwhitneyu(a, [x + 1 for x in a]))
+        self.assertTrue(stats.mannwhitneyu(a, [x + .05 for x in a]))
+
+    def test_normal_approximation(self):
+        """Are large and tied samples tested with the normal approximation?"""
+        a = range(30)
+        self.assertAlmostEqual(stats.mannwhitneyu_pvalue(a, a), 1.)
+        self.assertAlmostEqual(
+            stats.mannwhitneyu_pvalue(a, range(15, 45)), 6.248e-7, 9)
+        # Ties in small samples.
+        self.assertTrue(stats.mannwhitneyu([1, 1, 2], [1, 2, 2]))
+        self.assertFalse(stats.mannwhitneyu([1] * 10, [2] * 10))
+        # All the values are the same, or a sample is empty.
+        self.assertTrue(stats.mannwhitneyu([1] * 30, [1] * 30))
+        self.assertTrue(stats.mannwhitneyu([], [1, 2]))
+
+    def test_many(self):
+        """Does the batched test agree with the single one?"""
+        rng = random.Random(42)
+        window = [rng.gauss(1., .1) for _ in range(15)]
+        pairs = []
+        for _ in range(50):
+            n = rng.choice((3, 10, 25))
+            sample = [rng.gauss(rng.choice((1., 1.5)), .1) for _ in range(n)]
+            pairs.append((sample, window))
+        self.assertEqual(stats.mannwhitneyu_many(pairs, .01),
+                         [stats.mannwhitneyu(a, b, .01) for a, b in pairs])
+
+
+class SlidingWindowTests(unittest.TestCase):
+    """Test the windows sliding over sequences of values."""
+
+    def test_window(self):
+        """Do the statistics of a window match the ones of its values?"""
+        rng = random.Random(42)
+        window = stats.SlidingWindow()
+        self.assertEqual((window.mean(), window.median(),
+                          window.median_absolute_deviation()),
+                         (None, None, None))
+        values = []
+        for _ in range(2000):
+            if values and rng.random() < .45:
+                self.assertEqual(window.popleft(), values.pop(0))
+            else:
+                # Many ties.
+                value = rng.randint(0, 20) / 4.
+                window.append(value)
+                values.append(value)
+            self.assertEqual(len(window), len(values))
+            if not values:
+                continue
+            self.assertAlmostEqual(window.mean(), stats.mean(values))
+            self.assertEqual(window.median(), stats.median(values))
+            self.assertEqual(window.median_absolute_deviation(),
+                             stats.median_absolute_deviation(values))
+            self.assertEqual(window.median_absolute_deviation(1.),
+                             stats.median_absolute_deviation(values, 1.))
+
+    def test_sliding_windows(self):
+        """Are the windows the slices of the values around each position?"""
+        rng = random.Random(42)
+        values = [rng.gauss(1., .1) for _ in range(50)]
+        for before, after in ((0, 1), (10, 10), (3, 0), (100, 2), (0, 0),
+                              (-2, 5), (4, -2)):
+            windows = stats.sliding_windows(values, before, after)
+            for i, window in enumerate(windows):
+                expected = values[max(0, i - before):max(0, i + after)]
+                self.assertEqual(len(window), len(expected))
+                self.assertEqual(window.median(), stats.median(expected))
+                if expected:
+                    self.assertAlmostEqual(window.mean(),
+                                           stats.mean(expected))
+            self.assertEqual(i, len(values) - 1)
+
+if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0], ])
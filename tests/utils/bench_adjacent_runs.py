@@ -0,0 +1,93 @@
+"""
+Micro-benchmark TestSuiteDB.get_adjacent_runs_on_machine.
+
+Builds databases where one machine has reported a growing number of runs and
+prints the average latency of looking up the previous and next runs of the
+latest run and of a run in the middle of the history. The latency should stay
+flat as the history grows.
+
+Usage: bench_adjacent_runs.py [--sizes N,N,...] [--repeat N]
+"""
+## Just to make sure this keeps working, run a tiny version of the benchmark.
+# RUN: python %{src_root}/tests/utils/bench_adjacent_runs.py \
+# RUN:     --sizes 10,100 --repeat 2
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import lnt.server.db.v4db
+
+TAG = 'kv-engine'
+
+
+def create_history(ts, num_runs):
+    """Populate the database with num_runs runs of one machine."""
+    machine = ts.Machine('bench')
+    machine.hardware = machine.os = ''
+    machine.parameters = {}
+    ts.add(machine)
+    ts.commit()
+
+    conn = ts.session.connection()
+    conn.execute(ts.Order.__table__.insert(),
+                 [{'llvm_project_revision': str(i), 'git_sha': 'sha%d' % i,
+                   'Rank': i}
+                  for i in xrange(num_runs)])
+    orders = ts.query(ts.Order.id, ts.Order.rank).all()
+    now = datetime.datetime.now()
+    conn.execute(ts.Run.__table__.insert(),
+                 [{'MachineID': machine.id, 'OrderID': order_id,
+                   'StartTime': now, 'EndTime': now}
+                  for order_id, _ in orders])
+    conn.execute(ts.MachineOrder.__table__.insert(),
+                 [{'MachineID': machine.id, 'OrderID': order_id,
+                   'Rank': rank}
+                  for order_id, rank in orders])
+    ts.commit()
+
+
+def time_lookups(ts, run, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        prev_runs = ts.get_previous_runs_on_machine(run, 3)
+        next_runs = ts.get_next_runs_on_machine(run, 3)
+    return (time.time() - start) / repeat, len(prev_runs), len(next_runs)
+
+
+def main():
+    parser = OptionParser(__doc__.strip())
+    parser.add_option("", "--sizes", dest="sizes",
+                      default="100,1000,10000,20000",
+                      help="comma separated history sizes [%default]")
+    parser.add_option("", "--repeat", dest="repeat", type=int, default=50,
+                      help="number of lookups to average over [%default]")
+    opts, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for size in map(int, opts.sizes.split(',')):
+            path = 'sqlite:///%s' % os.path.join(tmpdir, 'bench-%d.db' % size)
+            db = lnt.server.db.v4db.V4DB(path, None)
+            try:
+                ts = db.testsuite[TAG]
+                create_history(ts, size)
+                runs = ts.query(ts.Run).join(ts.Order).\
+                    order_by(ts.Order.rank).all()
+                for label, run in (('latest', runs[-1]),
+                                   ('middle', runs[len(runs) // 2])):
+                    elapsed, num_prev, num_next = time_lookups(ts, run,
+                                                               opts.repeat)
+                    print "%6d runs, %s run: %.2fms (%d previous, %d next)" % (
+                        size, label, elapsed * 1000, num_prev, num_next)
+                    sys.stdout.flush()
+            finally:
+                db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
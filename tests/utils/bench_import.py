@@ -0,0 +1,115 @@
+"""
+Benchmark the sample import paths of TestSuiteDB.
+
+Imports a synthetic kv-engine report into an empty database and into one which
+already holds a long history of runs, once through the ORM and once through the
+bulk insertion path, and prints the time spent importing the samples.
+
+Usage: bench_import.py [--tests N] [--runs N] [--history-tests N]
+"""
+## Just to make sure this keeps working, run a tiny version of the benchmark.
+# RUN: python %{src_root}/tests/utils/bench_import.py \
+# RUN:     --tests 50 --runs 20 --history-tests 5
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import lnt.server.config
+import lnt.server.db.v4db
+from tests.testutils import TAG, make_report, make_test
+
+
+def make_bench_report(num_tests, revision):
+    tests = []
+    for i in xrange(num_tests):
+        tests.append(make_test('test%d.exec' % i,
+                               [random.random() for _ in range(3)]))
+        tests.append(make_test('test%d.exec.status' % i, [0]))
+    return make_report(revision, tests, 'bench')
+
+
+def create_history(ts, num_runs, num_tests):
+    """Populate the database with num_runs runs, using core inserts."""
+    machine, _ = ts._getOrCreateMachine(make_bench_report(0, 0)['Machine'])
+    ts.commit()
+
+    conn = ts.session.connection()
+    conn.execute(ts.Test.__table__.insert(),
+                 [{'Name': 'suite/test%d' % i} for i in xrange(num_tests)])
+    conn.execute(ts.Order.__table__.insert(),
+                 [{'llvm_project_revision': str(i), 'git_sha': 'sha%d' % i}
+                  for i in xrange(num_runs)])
+    order_ids = [id for id, in ts.query(ts.Order.id).order_by(ts.Order.id)]
+    test_ids = [id for id, in ts.query(ts.Test.id)]
+    now = datetime.datetime.now()
+    conn.execute(ts.Run.__table__.insert(),
+                 [{'MachineID': machine.id, 'OrderID': order_id,
+                   'StartTime': now, 'EndTime': now}
+                  for order_id in order_ids])
+    run_ids = [id for id, in ts.query(ts.Run.id)]
+    for run_id in run_ids:
+        conn.execute(ts.Sample.__table__.insert(),
+                     [{'RunID': run_id, 'TestID': test_id,
+                       'execution_time': random.random(),
+                       'execution_status': 0}
+                      for test_id in test_ids])
+    ts.commit()
+
+
+def time_import(path, report, bulk):
+    db_info = lnt.server.config.DBInfo(path, '0.4', None, None, 0,
+                                       bulk_import=bulk)
+    db = lnt.server.db.v4db.V4DB(path, None)
+    try:
+        ts = db.testsuite[TAG]
+        machine, _ = ts._getOrCreateMachine(report['Machine'])
+        run, _ = ts._getOrCreateRun(report['Run'], machine)
+        start = time.time()
+        ts._importSampleValues(report['Tests'], run, TAG, True, db_info)
+        ts.commit()
+        elapsed = time.time() - start
+        num_samples = ts.query(ts.Sample).filter(ts.Sample.run_id ==
+                                                 run.id).count()
+    finally:
+        db.close()
+    return elapsed, num_samples
+
+
+def main():
+    parser = OptionParser(__doc__.strip())
+    parser.add_option("", "--tests", dest="tests", type=int, default=5000,
+                      help="number of tests in the imported report")
+    parser.add_option("", "--runs", dest="runs", type=int, default=20000,
+                      help="number of runs already in the populated database")
+    parser.add_option("", "--history-tests", dest="history_tests", type=int,
+                      default=50, help="number of tests in each existing run")
+    opts, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for num_runs in (0, opts.runs):
+            for bulk in (False, True):
+                path = 'sqlite:///%s' % os.path.join(
+                    tmpdir, 'bench-%d-%d.db' % (num_runs, bulk))
+                db = lnt.server.db.v4db.V4DB(path, None)
+                if num_runs:
+                    create_history(db.testsuite[TAG], num_runs,
+                                   opts.history_tests)
+                db.close()
+
+                report = make_bench_report(opts.tests, num_runs + 1)
+                elapsed, num_samples = time_import(path, report, bulk)
+                assert num_samples == opts.tests * 3
+                print "%-4s import of %d tests into %d runs: %.3fs" % (
+                    'bulk' if bulk else 'orm', opts.tests, num_runs, elapsed)
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Micro-benchmark lnt.util.stats.mannwhitneyu.
+
+Compares random samples of growing sizes against a window of previous samples,
+with the rank based test one pair at a time and batched, and with the previous
+implementation: U computed from every pair of values for samples of up to 20
+values, and the external stats module for larger ones. Prints the average time
+of a test.
+
+Usage: bench_mannwhitneyu.py [--sizes N,N,...] [--pairs N]
+"""
+## Just to make sure this keeps working, run a tiny version of the benchmark.
+# RUN: python %{src_root}/tests/utils/bench_mannwhitneyu.py \
+# RUN:     --sizes 5,30 --pairs 10
+import random
+import time
+from optparse import OptionParser
+
+from lnt.external.stats.stats import mannwhitneyu as mannwhitneyu_large
+from lnt.util import stats
+
+
+def previous_mannwhitneyu(a, b):
+    """The cost of the previous implementation, which computed U with a
+    nested loop for small samples."""
+    if len(a) <= 20 and len(b) <= 20:
+        u = 0.
+        for x in a:
+            for y in b:
+                if x < y:
+                    u += 1
+                elif x == y:
+                    u += .5
+        return u
+    try:
+        return mannwhitneyu_large(a, b)
+    except ValueError:
+        return None
+
+
+def time_pairs(fn, pairs):
+    # Leave out building the exact distribution of U for these sizes.
+    fn(pairs[:1])
+    start = time.time()
+    fn(pairs)
+    return (time.time() - start) / len(pairs)
+
+
+def main():
+    parser = OptionParser(__doc__.strip())
+    parser.add_option("", "--sizes", dest="sizes", default="5,10,20,50,200",
+                      help="comma separated sample sizes [%default]")
+    parser.add_option("", "--pairs", dest="pairs", type=int, default=2000,
+                      help="number of pairs of samples to test [%default]")
+    opts, args = parser.parse_args()
+
+    rng = random.Random(42)
+    print "%8s %14s %14s %14s" % ("size", "previous (us)", "rank (us)",
+                                  "batched (us)")
+    for size in [int(s) for s in opts.sizes.split(',')]:
+        window = [rng.gauss(1., .1) for _ in range(size)]
+        pairs = [([rng.gauss(rng.choice((1., 1.2)), .1)
+                   for _ in range(size)], window)
+                 for _ in range(opts.pairs)]
+        previous = time_pairs(
+            lambda pairs: [previous_mannwhitneyu(a, b) for a, b in pairs],
+            pairs)
+        rank = time_pairs(
+            lambda pairs: [stats.mannwhitneyu(a, b) for a, b in pairs],
+            pairs)
+        batched = time_pairs(stats.mannwhitneyu_many, pairs)
+        print "%8d %14.1f %14.1f %14.1f" % (size, previous * 1e6, rank * 1e6,
+                                            batched * 1e6)
+
+if __name__ == '__main__':
+    main()
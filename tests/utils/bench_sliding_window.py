@@ -0,0 +1,58 @@
+"""
+Micro-benchmark lnt.util.stats.sliding_windows.
+
+Computes the moving average and median of random histories of growing
+lengths, as the graphs do, with windows sliding over the values and with the
+previous implementation: a slice of the values around each point, whose mean
+and median are computed from scratch. Prints the time of a history.
+
+Usage: bench_sliding_window.py [--lengths N,N,...] [--window N]
+"""
+## Just to make sure this keeps working, run a tiny version of the benchmark.
+# RUN: python %{src_root}/tests/utils/bench_sliding_window.py \
+# RUN:     --lengths 10,100 --window 5
+import random
+import time
+from optparse import OptionParser
+
+from lnt.util import stats
+
+
+def previous_moving(values, size):
+    moving = []
+    for i in range(len(values)):
+        window = values[max(0, i - size):min(len(values), i + size)]
+        moving.append((stats.mean(window), stats.median(window)))
+    return moving
+
+
+def sliding_moving(values, size):
+    return [(window.mean(), window.median())
+            for window in stats.sliding_windows(values, size, size)]
+
+
+def time_history(fn, values, size):
+    start = time.time()
+    fn(values, size)
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser(__doc__.strip())
+    parser.add_option("", "--lengths", dest="lengths",
+                      default="100,1000,10000",
+                      help="comma separated history lengths [%default]")
+    parser.add_option("", "--window", dest="window", type=int, default=100,
+                      help="points on each side of the window [%default]")
+    opts, args = parser.parse_args()
+
+    rng = random.Random(42)
+    print "%8s %14s %14s" % ("length", "previous (ms)", "sliding (ms)")
+    for length in [int(s) for s in opts.lengths.split(',')]:
+        values = [rng.gauss(1., .1) for _ in range(length)]
+        previous = time_history(previous_moving, values, opts.window)
+        sliding = time_history(sliding_moving, values, opts.window)
+        print "%8d %14.1f %14.1f" % (length, previous * 1e3, sliding * 1e3)
+
+if __name__ == '__main__':
+    main()
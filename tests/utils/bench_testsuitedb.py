@@ -0,0 +1,57 @@
+"""
+Micro-benchmark opening a test suite database, as every request does.
+
+Opens the database and gets its test suite repeatedly, first generating the
+model classes of the test suite each time (as at startup, or as every request
+did before they were cached), then with the cached classes, and prints the
+average latency of both.
+
+Usage: bench_testsuitedb.py [--repeat N]
+"""
+## Just to make sure this keeps working, run a tiny version of the benchmark.
+# RUN: python %{src_root}/tests/utils/bench_testsuitedb.py --repeat 2
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+import lnt.server.db.v4db
+from lnt.server.db.testsuitedb import TestSuiteDB
+
+TAG = 'kv-engine'
+
+
+def time_requests(path, repeat, cached):
+    start = time.time()
+    for i in xrange(repeat):
+        if not cached:
+            TestSuiteDB.invalidate_models(path)
+        db = lnt.server.db.v4db.V4DB(path, None)
+        ts = db.testsuite[TAG]
+        ts.query(ts.Machine).count()
+        db.close()
+    return (time.time() - start) / repeat
+
+
+def main():
+    parser = OptionParser(__doc__.strip())
+    parser.add_option("", "--repeat", dest="repeat", type=int, default=50,
+                      help="number of requests to time [%default]")
+    opts, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = 'sqlite:///%s/lnt.db' % tmpdir
+        # Create and upgrade the database.
+        lnt.server.db.v4db.V4DB(path, None).close()
+
+        generated = time_requests(path, opts.repeat, False)
+        cached = time_requests(path, opts.repeat, True)
+        print "generating models: %8.2fms per request" % (generated * 1e3)
+        print "cached models:     %8.2fms per request" % (cached * 1e3)
+    finally:
+        lnt.server.db.v4db.V4DB.close_all_engines()
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()